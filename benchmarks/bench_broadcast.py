@@ -0,0 +1,74 @@
+"""广播的CPU开销随接收者数量的变化：每个接收者各自序列化 vs 预编码的Frame共享
+
+不经过网络，只测量服务端把一条广场视频放入所有接收者发送队列的耗时。
+用法: python benchmarks/bench_broadcast.py [--size-kb 1024]
+"""
+import argparse
+import contextlib
+import io
+import json
+import time
+
+import common  # noqa: F401  把server目录加入sys.path
+from outbound import OutboundPolicy, OutboundQueue
+from server import ChatServer
+
+
+def make_server(n_recipients):
+    server = ChatServer()
+    server.outbound_policy = OutboundPolicy(max_bytes=1 << 40, disconnect_bytes=1 << 40)
+    for i in range(n_recipients + 1):
+        sock = object()
+        server.sessions.add(sock, f'user{i}', ('127.0.0.1', 9000 + i))
+        server.outbound[sock] = OutboundQueue(server.outbound_policy)
+    return server
+
+
+def legacy_broadcast(server, sender, message):
+    """旧实现：每个接收者各自json.dumps一次、encode两次"""
+    for session in server.sessions.snapshot:
+        sock = session.sock
+        if sock != sender:
+            message_json = json.dumps(message, ensure_ascii=False)
+            message_length = len(message_json.encode())
+            server.outbound[sock].put((message_length.to_bytes(4, 'big') + message_json.encode(),))
+
+
+def measure(n_recipients, payload, legacy):
+    server = make_server(n_recipients)
+    sender = server.sessions.snapshot[0].sock
+    message = {
+        'type': 'square_video',
+        'video_data': payload,
+        'video_ext': '.mp4',
+        'file_name': 'bench.mp4',
+        'timestamp': '2024-12-12 12:12:12',
+    }
+    start = time.process_time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if legacy:
+            sender_info = server.sessions.get(sender)
+            legacy_broadcast(server, sender, dict(
+                message, username=sender_info.username,
+                ip=sender_info.address[0], port=sender_info.address[1]))
+        else:
+            server.process_message(sender, message)
+    return time.process_time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-kb', type=int, default=1024)
+    args = parser.parse_args()
+    payload = 'A' * (args.size_kb * 1024)
+
+    print(f"payload {args.size_kb} KB")
+    print(f"{'recipients':>10} {'legacy ms':>10} {'frame ms':>10} {'speedup':>8}")
+    for n in (10, 50, 100, 200):
+        legacy = measure(n, payload, legacy=True)
+        frame = measure(n, payload, legacy=False)
+        print(f"{n:>10} {legacy * 1000:>10.1f} {frame * 1000:>10.1f} {legacy / frame:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+"""比较各种序列化实现对现有消息形状的编解码吞吐量
+
+消息形状: text(广场文本)、presence(200人的在线用户列表)、media(256KB图片)。
+v2帧中经过序列化的只有元数据，媒体数据原样发送，因此media测量的是去掉数据后的元数据；
+media_v1是v1帧的形状(媒体数据base64编码后整体放入JSON)，只对json的实现测量。
+对每种已安装的实现(标准库json、orjson、msgpack)分别测量dumps和loads。
+用法: python benchmarks/bench_codecs.py [--seconds 0.5] [--users 200] [--media-kb 256]
+"""
+import argparse
+import base64
+import time
+
+import common  # noqa: F401  把server目录加入sys.path
+from serializers import JSON, MSGPACK, ORJSON, STDLIB_JSON
+
+
+def shapes(n_users, media_kb):
+    return {
+        'text': {
+            'type': 'square_message',
+            'username': 'name123',
+            'ip': '192.168.31.227',
+            'port': 8001,
+            'content': '我在说话，' * 10,
+            'timestamp': '2024-12-12 12:12:12',
+        },
+        'presence': {
+            'type': 'old_friend_list',
+            'users': [{'username': f'user{i}', 'address': ['192.168.1.%d' % (i % 250), 8000 + i]}
+                      for i in range(n_users)],
+            'protocol': 2,
+            'features': ['media_ref'],
+            'timestamp': '2024-12-12 12:12:12',
+        },
+        'media': media_message(None),
+        'media_v1': media_message(base64.b64encode(bytes(media_kb * 1024)).decode('ascii')),
+    }
+
+
+def media_message(image_data):
+    message = {
+        'type': 'square_image',
+        'username': 'name123',
+        'ip': '192.168.31.227',
+        'port': 8001,
+        'image_ext': '.png',
+        'file_name': 'example.png',
+        'timestamp': '2024-12-12 12:12:12',
+    }
+    if image_data is not None:
+        message['image_data'] = image_data
+    return message
+
+
+def measure(fn, seconds):
+    """重复调用fn直到超过seconds，返回每秒次数"""
+    fn()
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        for _ in range(10):
+            fn()
+        count += 10
+        now = time.perf_counter()
+        if now >= deadline:
+            return count / (now - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=0.5)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--media-kb', type=int, default=256)
+    args = parser.parse_args()
+
+    backends = [('json', STDLIB_JSON)]
+    if ORJSON is not None:
+        backends.append(('orjson', ORJSON))
+    if MSGPACK is not None:
+        backends.append(('msgpack', MSGPACK))
+    print(f"可用实现: {', '.join(name for name, _ in backends)}  (协商为json时使用{JSON.backend})")
+    print(f"{'shape':<10} {'backend':<8} {'bytes':>9} {'dumps/s':>11} {'loads/s':>11} {'dumps MB/s':>11} {'loads MB/s':>11}")
+    for shape, message in shapes(args.users, args.media_kb).items():
+        for name, codec in backends:
+            if shape == 'media_v1' and codec.name != 'json':
+                continue
+            data = codec.dumps(message)
+            dumps_rate = measure(lambda: codec.dumps(message), args.seconds)
+            loads_rate = measure(lambda: codec.loads(data), args.seconds)
+            size = len(data)
+            print(f"{shape:<10} {name:<8} {size:>9} {dumps_rate:>11.0f} {loads_rate:>11.0f} "
+                  f"{dumps_rate * size / 1e6:>11.1f} {loads_rate * size / 1e6:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""对比线程引擎与asyncio引擎：每秒建立的连接数、每个空闲连接占用的内存，
+以及有用户连续发送大文件(媒体仓库和消息历史写盘)时其他连接的ping往返时间
+
+用法: python benchmarks/bench_engines.py [--clients 500] [--media-mb 16] [--uploads 8]
+"""
+import argparse
+import base64
+import os
+import selectors
+import socket
+import statistics
+import tempfile
+import threading
+import time
+
+from common import free_port, login, recv_frame, rss_kb, send_frame, start_server, stop_server
+
+
+def drain(sockets, stop_event):
+    """持续读取并丢弃老用户收到的上线广播，避免服务端因缓冲区写满而阻塞"""
+    sel = selectors.DefaultSelector()
+    for s in sockets:
+        sel.register(s, selectors.EVENT_READ)
+    while not stop_event.is_set():
+        for key, _ in sel.select(timeout=0.1):
+            try:
+                if not key.fileobj.recv(65536):
+                    sel.unregister(key.fileobj)
+            except OSError:
+                sel.unregister(key.fileobj)
+    sel.close()
+
+
+def run(engine, n_clients):
+    port = free_port()
+    proc = start_server(port, '--engine', engine, '--no-rate-limit')
+    time.sleep(0.5)
+    base_rss = rss_kb(proc.pid)
+
+    sockets = []
+    start = time.perf_counter()
+    for i in range(n_clients):
+        s = socket.create_connection(('127.0.0.1', port))
+        login(s, f'bench{i}', 20000 + i)
+        recv_frame(s)  # old_friend_list，表示登录已被处理
+        s.setblocking(False)
+        sockets.append(s)
+    elapsed = time.perf_counter() - start
+
+    # 所有连接保持空闲，等待服务端处理完积压的广播后测量内存
+    stop_event = threading.Event()
+    drainer = threading.Thread(target=drain, args=(sockets, stop_event), daemon=True)
+    drainer.start()
+    time.sleep(1.0)
+    idle_rss = rss_kb(proc.pid)
+
+    stop_event.set()
+    drainer.join()
+    for s in sockets:
+        s.close()
+    stop_server(proc)
+
+    return {
+        'engine': engine,
+        'conn_per_sec': n_clients / elapsed,
+        'kb_per_conn': (idle_rss - base_rss) / n_clients,
+    }
+
+
+def run_media(engine, media_mb, uploads):
+    """A连续给B发送uploads个media_mb大小的私聊文件，同时另一个连接每5ms发一次ping，统计往返时间"""
+    port = free_port()
+    data_dir = tempfile.mkdtemp()
+    proc = start_server(port, '--engine', engine, '--no-rate-limit',
+                        '--media-dir', os.path.join(data_dir, 'media'), '--history-dir', os.path.join(data_dir, 'history'))
+    sender = socket.create_connection(('127.0.0.1', port))
+    receiver = socket.create_connection(('127.0.0.1', port))
+    for i, s in enumerate((sender, receiver)):
+        login(s, f'media{i}', 21000 + i)
+        recv_frame(s)
+    receiver.setblocking(False)
+    stop_event = threading.Event()
+    drainer = threading.Thread(target=drain, args=([receiver], stop_event), daemon=True)
+    drainer.start()
+
+    blob = bytearray(os.urandom(media_mb * 1024 * 1024))
+    def upload():
+        for i in range(uploads):
+            blob[:4] = i.to_bytes(4, 'big')  # 每个文件内容不同，媒体仓库每次都要写盘
+            send_frame(sender, {'type': 'private_file', 'target_ip': '127.0.0.1', 'target_port': 21001,
+                                'file_data': base64.b64encode(blob).decode(), 'file_ext': '.bin',
+                                'file_name': f'{i}.bin', 'timestamp': 't'})
+    uploader = threading.Thread(target=upload)
+
+    probe = socket.create_connection(('127.0.0.1', port))
+    probe.settimeout(30)
+    rtts = []
+    started = time.perf_counter()
+    uploader.start()
+    while uploader.is_alive():
+        sent = time.perf_counter()
+        send_frame(probe, {'type': 'ping', 'timestamp': sent})
+        while recv_frame(probe).get('type') != 'pong':
+            pass
+        rtts.append((time.perf_counter() - sent) * 1000)
+        time.sleep(0.005)
+    uploader.join()
+    elapsed = time.perf_counter() - started
+
+    stop_event.set()
+    drainer.join()
+    for s in (sender, receiver, probe):
+        s.close()
+    stop_server(proc)
+
+    rtts.sort()
+    return {
+        'engine': engine,
+        'mb_per_sec': media_mb * uploads / elapsed,
+        'rtt_p50': statistics.median(rtts),
+        'rtt_p99': rtts[int(len(rtts) * 0.99)],
+        'rtt_max': rtts[-1],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--media-mb', type=int, default=16, help="大文件测试中每个文件的大小，0表示不测")
+    parser.add_argument('--uploads', type=int, default=8, help="大文件测试中连续发送的文件数")
+    args = parser.parse_args()
+
+    print(f"{'engine':<8} {'conn/s':>10} {'KB/idle conn':>14}")
+    for engine in ('thread', 'async'):
+        r = run(engine, args.clients)
+        print(f"{r['engine']:<8} {r['conn_per_sec']:>10.1f} {r['kb_per_conn']:>14.1f}")
+
+    if args.media_mb:
+        print(f"\n发送 {args.uploads} 个 {args.media_mb}MB 的私聊文件期间，其他连接的ping往返时间(ms)")
+        print(f"{'engine':<8} {'MB/s':>8} {'p50':>8} {'p99':>8} {'max':>8}")
+        for engine in ('thread', 'async'):
+            r = run_media(engine, args.media_mb, args.uploads)
+            print(f"{r['engine']:<8} {r['mb_per_sec']:>8.1f} {r['rtt_p50']:>8.2f} {r['rtt_p99']:>8.2f} {r['rtt_max']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
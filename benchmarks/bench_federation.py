@@ -0,0 +1,125 @@
+"""服务器联网：一条广场图片在节点之间经过的帧数和送达所有节点的耗时
+
+在一个进程中启动N个ChatServer，按line(链状)、star(星形)或mesh(全连接)用FederationLink连接，
+每个节点一个v2接收者，节点0上的发送者连续发送广场图片。统计所有接收者收齐的耗时，
+以及节点之间每条消息实际发送的帧数(理想情况下每条连接一次，全连接时为N-1而不是N*(N-1))。
+用法: python benchmarks/bench_federation.py [--nodes 4] [--messages 200] [--size-kb 64]
+"""
+import argparse
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from common import free_port, login, recv_exact
+
+import federation
+from chatlog import setup_logging
+from federation import FederationLink
+from media_store import MediaStore
+from protocol import TYPE_NAMES, encode_v2
+from server import ChatServer
+
+
+class CountingPeer(federation.Peer):
+    """统计发往相邻节点的帧数和字节数"""
+    frames = 0
+    bytes = 0
+
+    def send(self, parts):
+        CountingPeer.frames += 1
+        CountingPeer.bytes += sum(map(len, parts))
+        super().send(parts)
+
+
+def topology(name, n):
+    """每个节点主动连接的节点编号"""
+    if name == 'line':
+        return {i: [i - 1] if i else [] for i in range(n)}
+    if name == 'star':
+        return {i: [0] if i else [] for i in range(n)}
+    return {i: list(range(i)) for i in range(n)}
+
+
+def recv_type(sock):
+    length = int.from_bytes(recv_exact(sock, 4), 'big')
+    payload = recv_exact(sock, length)
+    return payload[1] if payload[:1] != b'{' else None
+
+
+def measure(name, n_nodes, n_messages, size_kb):
+    servers, ports = [], []
+    federation_ports = [free_port() for _ in range(n_nodes)]
+    for i, peers in topology(name, n_nodes).items():
+        server = ChatServer()
+        server.rate_limits = None
+        server.history = None
+        server.offline = None
+        server.media_store = MediaStore(tempfile.mkdtemp(prefix='bench-media-'))
+        server.links.append(FederationLink(server, f'node{i}', ('127.0.0.1', federation_ports[i]),
+                                           [('127.0.0.1', federation_ports[j]) for j in peers]))
+        port = free_port()
+        threading.Thread(target=server.start, args=('127.0.0.1', port), daemon=True).start()
+        servers.append(server)
+        ports.append(port)
+    try:
+        time.sleep(1.0)  # 等待节点之间连接
+        receivers = []
+        for i, port in enumerate(ports):
+            sock = socket.create_connection(('127.0.0.1', port))
+            login(sock, f'recv{i}', 20000 + i, protocol=2)
+            sock.settimeout(30)
+            receivers.append(sock)
+        sender = socket.create_connection(('127.0.0.1', ports[0]))
+        login(sender, 'sender', 30000, protocol=2)
+        time.sleep(0.5)  # 等待上线消息到达所有节点
+        image = encode_v2({'type': 'square_image', 'image_data': os.urandom(size_kb * 1024), 'image_ext': '.png',
+                           'file_name': 'bench.png', 'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")})
+        code = next(c for c, t in TYPE_NAMES.items() if t == 'square_image')
+        CountingPeer.frames = CountingPeer.bytes = 0
+        done = []
+
+        def receive(sock):
+            received = 0
+            while received < n_messages:
+                if recv_type(sock) == code:
+                    received += 1
+            done.append(time.perf_counter())
+
+        threads = [threading.Thread(target=receive, args=(s,)) for s in receivers]
+        for t in threads:
+            t.start()
+        started = time.perf_counter()
+        frame = len(image).to_bytes(4, 'big') + image
+        for _ in range(n_messages):
+            sender.sendall(frame)
+        for t in threads:
+            t.join()
+        for sock in receivers + [sender]:
+            sock.close()
+        return max(done) - started, CountingPeer.frames / n_messages, CountingPeer.bytes / n_messages
+    finally:
+        for server in servers:
+            server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=200, help="发送的广场图片数")
+    parser.add_argument('--size-kb', type=int, default=64, help="每张图片的大小(KB)")
+    args = parser.parse_args()
+    setup_logging('ERROR')
+    federation.Peer = CountingPeer
+
+    print(f"{args.nodes} 个节点，{args.messages} 张 {args.size_kb}KB 广场图片，每个节点一个接收者")
+    print(f"{'topology':>8} {'links':>6} {'seconds':>8} {'msg/s':>8} {'frames/msg':>11} {'KB/msg':>8}")
+    for name in ('line', 'star', 'mesh'):
+        links = sum(map(len, topology(name, args.nodes).values()))
+        elapsed, frames, size = measure(name, args.nodes, args.messages, args.size_kb)
+        print(f"{name:>8} {links:>6} {elapsed:>8.2f} {args.messages / elapsed:>8.0f} {frames:>11.1f} {size / 1024:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
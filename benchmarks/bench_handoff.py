@@ -0,0 +1,105 @@
+"""不中断连接的重启：交接期间消息的最大延迟和交接耗时
+
+用--handoff-socket启动服务端，登录N个空闲客户端和一对收发者，发送者每隔几毫秒给接收者发一条带发送时间的私聊，
+期间向服务端发送SIGUSR2。统计接收者看到的最大延迟(即交接造成的停顿)、交接前后的中位延迟，以及是否丢消息。
+旧进程在新进程启动(导入模块)并连接上来之后才冻结，所以停顿远小于旧进程退出的用时。
+用法: python benchmarks/bench_handoff.py [--engine thread] [--clients 500] [--interval-ms 5]
+"""
+import argparse
+import os
+import signal
+import socket
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+from common import free_port, login, recv_frame, send_frame, start_server
+
+
+def measure(engine, n_clients, interval):
+    port = free_port()
+    path = os.path.join(tempfile.mkdtemp(prefix='bench-handoff-'), 'handoff.sock')
+    proc = start_server(port, '--engine', engine, '--handoff-socket', path, '--no-rate-limit', '--no-history',
+                        '--no-offline')
+    try:
+        while not os.path.exists(path):
+            time.sleep(0.05)
+        idle = []
+        for i in range(n_clients):
+            sock = socket.create_connection(('127.0.0.1', port))
+            login(sock, f'idle{i}', 20000 + i)
+            idle.append(sock)
+        receiver = socket.create_connection(('127.0.0.1', port))
+        login(receiver, 'receiver', 30001)
+        sender = socket.create_connection(('127.0.0.1', port))
+        login(sender, 'sender', 30000)
+        receiver.settimeout(60)
+        while recv_frame(receiver).get('username') != 'sender':
+            pass    # 等待前面的登录都处理完，接收者收到发送者上线
+
+        latencies = []      # [(发送时间, 延迟)]
+        sent = [0]
+        stop = threading.Event()
+
+        def receive():
+            receiver.settimeout(0.2)
+            idle_since = time.perf_counter()
+            while not stop.is_set() or len(latencies) < sent[0]:
+                try:
+                    message = recv_frame(receiver)
+                except socket.timeout:
+                    if stop.is_set() and time.perf_counter() - idle_since > 10:
+                        break   # 丢失的消息不再等待
+                    continue
+                idle_since = time.perf_counter()
+                if message.get('type') == 'private_message' and message.get('content', '').startswith('t='):
+                    sent_at = float(message['content'][2:])
+                    latencies.append((sent_at, time.perf_counter() - sent_at))
+
+        thread = threading.Thread(target=receive, daemon=True)
+        thread.start()
+        started = time.perf_counter()
+        upgraded_at = exited_at = None
+        while time.perf_counter() - started < 4.0:
+            if upgraded_at is None and time.perf_counter() - started > 1.0:
+                upgraded_at = time.perf_counter()
+                proc.send_signal(signal.SIGUSR2)
+            send_frame(sender, {'type': 'private_message', 'target_ip': '127.0.0.1', 'target_port': '30001',
+                                'content': f't={time.perf_counter()}', 'timestamp': 't'})
+            sent[0] += 1
+            time.sleep(interval)
+            if upgraded_at is not None and exited_at is None and proc.poll() is not None:
+                exited_at = time.perf_counter()
+        proc.wait(30)
+        exited_at = exited_at or time.perf_counter()
+        handoff = exited_at - upgraded_at
+        stop.set()
+        thread.join(10)
+        before = [lat for at, lat in latencies if at < upgraded_at]
+        after = [lat for at, lat in latencies if at > exited_at]
+        return (sent[0], len(latencies), max(lat for _, lat in latencies), statistics.median(before),
+                statistics.median(after) if after else float('nan'), handoff)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+        subprocess.run(['pkill', '-f', f'handoff-socket {path}'])  # SIGUSR2启动的新进程
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread')
+    parser.add_argument('--clients', type=int, default=500, help="交接时的空闲连接数")
+    parser.add_argument('--interval-ms', type=float, default=5, help="发送者两条消息的间隔(毫秒)")
+    args = parser.parse_args()
+
+    sent, received, worst, before, after, handoff = measure(args.engine, args.clients, args.interval_ms / 1000)
+    print(f"{args.engine} 引擎，{args.clients} 个空闲连接，每 {args.interval_ms:g}ms 一条消息")
+    print(f"发送 {sent} 条，收到 {received} 条")
+    print(f"中位延迟: 交接前 {before * 1000:.2f}ms，交接后 {after * 1000:.2f}ms")
+    print(f"最大延迟(交接停顿): {worst * 1000:.1f}ms，旧进程退出用时 {handoff * 1000:.0f}ms(含新进程启动)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""消息历史的追加吞吐量、重新打开的耗时和按时间范围读取的延迟
+
+在临时目录中写入N条消息(大部分是广场消息，其余分布在若干私聊会话中，时间间隔0.1秒)，
+写入过程中每隔N/10条输出一次吞吐量，用来确认写入速度不随已存的消息数下降；
+然后重新打开目录，测量第一次读取前的准备时间，再随机选取时间窗口读取，最后从最新一页向前翻完随机选取的私聊。
+用法: python benchmarks/bench_history.py [--messages 1000000] [--queries 200]
+"""
+import argparse
+import random
+import shutil
+import tempfile
+import time
+
+import common  # noqa: F401  把server目录加入sys.path
+from history import SQUARE, MessageHistory, private_conversation
+
+START_TIME = 1_700_000_000.0
+INTERVAL = 0.1
+
+
+def make_message(i, conversation):
+    if conversation == SQUARE:
+        return {
+            'type': 'square_message',
+            'username': f'user{i % 200}',
+            'ip': '192.168.1.%d' % (i % 200),
+            'port': 8000 + i % 200,
+            'content': '我在说话，' * (1 + i % 10),
+            'timestamp': '2024-12-12 12:12:12',
+        }
+    return {
+        'type': 'private_image',
+        'username': f'user{i % 200}',
+        'ip': '192.168.1.%d' % (i % 200),
+        'port': 8000 + i % 200,
+        'image_ext': '.png',
+        'file_name': 'example.png',
+        'media_hash': '0' * 64,
+        'media_size': 256 * 1024,
+        'timestamp': '2024-12-12 12:12:12',
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--private', type=int, default=50, help="私聊会话数")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--window', type=float, default=60.0, help="每次读取的时间窗口(秒)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='lanchat-history-')
+    try:
+        conversations = [private_conversation(('192.168.1.1', 8000), ('192.168.1.2', 9000 + k))
+                         for k in range(args.private)]
+        history = MessageHistory(directory)
+        step = max(1, args.messages // 10)
+        print(f"{'stored':>10} {'msgs/s':>10}")
+        started = last = time.perf_counter()
+        for i in range(args.messages):
+            conversation = SQUARE if i % 5 else conversations[i // 5 % args.private]
+            history.append(conversation, make_message(i, conversation), when=START_TIME + i * INTERVAL)
+            if (i + 1) % step == 0:
+                now = time.perf_counter()
+                print(f"{i + 1:>10} {step / (now - last):>10.0f}")
+                last = now
+        elapsed = time.perf_counter() - started
+        stats = history.stats()
+        history.close()
+        print(f"追加 {args.messages} 条: {elapsed:.2f}s ({args.messages / elapsed:.0f} 条/s) "
+              f"{stats['bytes_stored'] / 1e6:.1f} MB {stats['segments']} 个分段")
+
+        started = time.perf_counter()
+        history = MessageHistory(directory)
+        history.query(SQUARE, limit=1)
+        print(f"重新打开并读取第一条: {(time.perf_counter() - started) * 1000:.1f} ms")
+
+        end_time = START_TIME + args.messages * INTERVAL
+        for name, pick in (('square', lambda: SQUARE), ('private', lambda: random.choice(conversations))):
+            latencies = []
+            returned = 0
+            for _ in range(args.queries):
+                since = random.uniform(START_TIME, max(START_TIME, end_time - args.window))
+                started = time.perf_counter()
+                returned += len(history.query(pick(), since, since + args.window))
+                latencies.append(time.perf_counter() - started)
+            print(f"{name:<8} {args.window:.0f}s窗口 平均 {returned / args.queries:.0f} 条 "
+                  f"p50 {percentile(latencies, 0.5) * 1000:.2f} ms p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+
+        # 私聊向前翻页：沿同一会话的指针读取，不扫描其他会话的消息
+        latencies = []
+        for _ in range(args.queries):
+            conversation = random.choice(conversations)
+            started = time.perf_counter()
+            page = history.before(conversation, None, 50)
+            while page:
+                page = history.before(conversation, page[0][0], 50)
+            latencies.append(time.perf_counter() - started)
+        print(f"private  翻到最早一页(每页50条) p50 {percentile(latencies, 0.5) * 1000:.2f} ms "
+              f"p99 {percentile(latencies, 0.99) * 1000:.2f} ms")
+        history.close()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""重新连接潮的在线用户通知开销：逐个发送new_friend_login vs 合并后的roster_delta
+
+不经过网络，N个客户端依次登录同一个服务器，统计所有发送队列收到的帧数、字节数和服务端耗时。
+roster模式下每登录batch个用户触发一次合并发送，相当于合并窗口内登录了batch个用户。
+用法: python benchmarks/bench_presence.py [--clients 500] [--batch 50]
+"""
+import argparse
+import time
+
+import common  # noqa: F401  把server目录加入sys.path
+from outbound import OutboundPolicy, OutboundQueue
+from server import ChatServer
+
+
+def measure(n_clients, batch, roster):
+    server = ChatServer()
+    server.history = server.recent = server.offline = None
+    server.outbound_policy = OutboundPolicy(max_bytes=1 << 40, disconnect_bytes=1 << 40)
+    features = ['roster'] if roster else []
+    started = time.process_time()
+    for i in range(n_clients):
+        sock = object()
+        server.outbound[sock] = OutboundQueue(server.outbound_policy)
+        server.handle_login(sock, {
+            'type': 'login', 'username': f'user{i}', 'local_ip': '10.0.0.1', 'local_port': 9000 + i,
+            'protocol': 2, 'features': features, 'timestamp': '2024-12-12 12:12:12'
+        })
+        if roster and (i + 1) % batch == 0:
+            server.flush_presence()
+    server.flush_presence()
+    elapsed = time.process_time() - started
+    queues = server.outbound.values()
+    return sum(len(q) for q in queues), sum(q.bytes_queued for q in queues), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=500)
+    parser.add_argument('--batch', type=int, default=50, help="每个合并窗口内登录的用户数")
+    args = parser.parse_args()
+
+    print(f"{args.clients} 个客户端重新连接，合并窗口内 {args.batch} 人")
+    print(f"{'mode':>8} {'frames':>10} {'MB':>8} {'cpu ms':>8}")
+    for name, roster in (('legacy', False), ('roster', True)):
+        frames, nbytes, elapsed = measure(args.clients, args.batch, roster)
+        print(f"{name:>8} {frames:>10} {nbytes / 1e6:>8.1f} {elapsed * 1000:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""服务端每转发1MB媒体数据消耗的CPU时间：v1(JSON + base64) vs v2(只解析帧头，消息体原样转发)
+
+一个发送者向广场连续发送文件，若干接收者只读取帧长度并丢弃内容。
+从/proc读取服务端进程的用户态和内核态CPU时间，除以转发给所有接收者的媒体字节数。
+用法: python benchmarks/bench_relay.py [--size-kb 512] [--frames 100] [--receivers 4]
+"""
+import argparse
+import socket
+import threading
+import time
+
+from common import cpu_seconds, free_port, login, recv_exact, start_server, stop_server
+from protocol import decode_payload, encode_v1, encode_v2
+
+MEDIA_FRAME_MIN = 1024  # 超过该长度的帧视为媒体帧
+
+
+def recv_message(sock):
+    """读取一帧，v1/v2都可以解析"""
+    length = int.from_bytes(recv_exact(sock, 4), 'big')
+    return decode_payload(recv_exact(sock, length))
+
+
+def receive(sock, expected, done):
+    """读取帧并计数媒体帧，收满expected个后置位done"""
+    count = 0
+    while count < expected:
+        length = int.from_bytes(recv_exact(sock, 4), 'big')
+        remaining = length
+        while remaining:
+            chunk = sock.recv(min(remaining, 1 << 20))
+            if not chunk:
+                raise ConnectionError("连接已断开")
+            remaining -= len(chunk)
+        if length > MEDIA_FRAME_MIN:
+            count += 1
+    done.set()
+
+
+def run(engine, version, size, n_frames, n_receivers):
+    port = free_port()
+    proc = start_server(port, '--engine', engine, '--no-rate-limit')
+    try:
+        extra = {'protocol': version} if version >= 2 else {}
+        receivers = []
+        for i in range(n_receivers):
+            s = socket.create_connection(('127.0.0.1', port))
+            login(s, f'recv{i}', 20000 + i, **extra)
+            recv_message(s)  # old_friend_list
+            receivers.append(s)
+        sender = socket.create_connection(('127.0.0.1', port))
+        login(sender, 'sender', 19999, **extra)
+        recv_message(sender)
+
+        # 其余用户收到的上线广播都是小帧，不计入媒体帧
+        events = [threading.Event() for _ in receivers]
+        threads = [threading.Thread(target=receive, args=(s, n_frames, e), daemon=True)
+                   for s, e in zip(receivers, events)]
+        for t in threads:
+            t.start()
+
+        message = {
+            'type': 'square_file',
+            'file_data': bytes(size),
+            'file_ext': '.bin',
+            'file_name': 'bench.bin',
+            'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        payload = encode_v2(message) if version >= 2 else encode_v1(message)
+        frame = len(payload).to_bytes(4, 'big') + payload
+
+        time.sleep(0.3)
+        cpu_start = cpu_seconds(proc.pid)
+        start = time.perf_counter()
+        for _ in range(n_frames):
+            sender.sendall(frame)
+        for e in events:
+            e.wait(timeout=120)
+        elapsed = time.perf_counter() - start
+        cpu = cpu_seconds(proc.pid) - cpu_start
+
+        for s in receivers + [sender]:
+            s.close()
+    finally:
+        stop_server(proc)
+
+    relayed_mb = size * n_frames * n_receivers / (1024 * 1024)
+    return cpu * 1000 / relayed_mb, relayed_mb / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-kb', type=int, default=512)
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--receivers', type=int, default=4)
+    args = parser.parse_args()
+
+    print(f"payload {args.size_kb} KB x {args.frames} frames -> {args.receivers} receivers")
+    print(f"{'engine':>8} {'protocol':>8} {'cpu ms/MB':>10} {'MB/s':>8}")
+    for engine in ('thread', 'async'):
+        for version in (1, 2):
+            cpu_per_mb, throughput = run(engine, version, args.size_kb * 1024,
+                                         args.frames, args.receivers)
+            print(f"{engine:>8} {'v' + str(version):>8} {cpu_per_mb:>10.2f} {throughput:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""聊天室的广播开销：所有消息都发到广场 vs 按聊天室只发给成员
+
+不经过网络，N个用户平均分到K个聊天室，每个聊天室发送相同条数的文本消息，
+统计所有发送队列收到的帧数、字节数和服务端的CPU耗时。
+用法: python benchmarks/bench_rooms.py [--users 1000] [--rooms 40] [--messages 20]
+"""
+import argparse
+import time
+
+import common  # noqa: F401  把server目录加入sys.path
+from outbound import OutboundPolicy, OutboundQueue
+from server import ChatServer
+
+
+def make_server(n_users, n_rooms):
+    server = ChatServer()
+    server.history = server.recent = server.offline = server.rate_limits = None
+    server.outbound_policy = OutboundPolicy(max_bytes=1 << 40, disconnect_bytes=1 << 40)
+    senders = {}
+    for i in range(n_users):
+        sock = object()
+        session = server.sessions.add(sock, f'user{i}', ('10.0.0.1', 9000 + i), 2, ('rooms',))
+        server.outbound[sock] = OutboundQueue(server.outbound_policy)
+        room = f'room{i % n_rooms}'
+        server.rooms.join(session, room)
+        senders.setdefault(room, sock)
+    return server, senders
+
+
+def measure(n_users, n_rooms, n_messages, rooms):
+    server, senders = make_server(n_users, n_rooms)
+    started = time.process_time()
+    for i in range(n_messages):
+        for room, sock in senders.items():
+            message = {'type': 'square_message', 'content': f'消息 {i}', 'timestamp': '2024-12-12 12:12:12'}
+            if rooms:
+                message['room'] = room
+            server.process_message(sock, message)
+    elapsed = time.process_time() - started
+    queues = server.outbound.values()
+    return sum(len(q) for q in queues), sum(q.bytes_queued for q in queues), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rooms', type=int, default=40)
+    parser.add_argument('--messages', type=int, default=20, help="每个聊天室发送的消息数")
+    args = parser.parse_args()
+
+    print(f"{args.users} 个用户，{args.rooms} 个聊天室，每个聊天室 {args.messages} 条消息")
+    print(f"{'mode':>8} {'frames':>10} {'MB':>8} {'cpu ms':>8}")
+    for name, rooms in (('square', False), ('rooms', True)):
+        frames, nbytes, elapsed = measure(args.users, args.rooms, args.messages, rooms)
+        print(f"{name:>8} {frames:>10} {nbytes / 1e6:>8.1f} {elapsed * 1000:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""私聊路由开销随在线人数的变化：线性扫描clients vs 地址/用户名索引
+
+用法: python benchmarks/bench_routing.py [--lookups 20000]
+"""
+import argparse
+import random
+import time
+
+import common  # noqa: F401  把server目录加入sys.path
+from server import ChatServer
+
+
+def make_server(n_sessions):
+    """返回登记了n_sessions个会话的服务器，以及旧实现使用的clients字典"""
+    server = ChatServer()
+    clients = {}
+    for i in range(n_sessions):
+        sock = object()
+        username = f'user{i}'
+        address = ('10.0.0.1', 10000 + i)
+        server.sessions.add(sock, username, address)
+        clients[sock] = {'username': username, 'address': address}
+    return server, clients
+
+
+def scan_by_address(clients, ip, port):
+    """旧实现：遍历所有在线用户"""
+    for c, info in clients.items():
+        if info['address'] == (ip, int(port)):
+            return c
+    return None
+
+
+def bench(fn, targets):
+    start = time.perf_counter()
+    for ip, port in targets:
+        fn(ip, port)
+    return (time.perf_counter() - start) / len(targets) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'sessions':>8} {'scan us':>10} {'index us':>10}")
+    for n in (10, 100, 1000, 5000, 10000):
+        server, clients = make_server(n)
+        targets = [('10.0.0.1', str(10000 + random.randrange(n))) for _ in range(args.lookups)]
+        scan = bench(lambda ip, port: scan_by_address(clients, ip, port), targets[:max(200, args.lookups // n)])
+        index = bench(server.sessions.find, targets)
+        print(f"{n:>8} {scan:>10.2f} {index:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
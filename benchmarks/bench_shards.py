@@ -0,0 +1,118 @@
+"""多进程模式的扩展性：1到N个工作进程下私聊图片的吞吐量
+
+每个工作进程数启动一次server/main.py --workers N。每对客户端(一个v1发送者、一个v2接收者)
+在独立的进程中运行，发送者连续发送base64编码的私聊图片，服务端需要解析JSON、解码base64并存入
+媒体仓库，正是单进程时占满一个核心的工作。连接由内核分配到各个工作进程，
+发送者和接收者不在同一个工作进程时消息经过本机总线转发。统计所有图片送达的总耗时。
+用法: python benchmarks/bench_shards.py [--max-workers 4] [--pairs 8] [--messages 200] [--size-kb 64]
+"""
+import argparse
+import base64
+import json
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from common import free_port, login, recv_exact, start_server, stop_server
+from protocol import TYPE_NAMES
+
+
+def run_pair(index, port, n_messages, payload, ready, start, results):
+    """一对客户端：登录后等待所有客户端就绪，发送者发送n_messages张图片，接收者全部收到后记下耗时"""
+    receiver = socket.create_connection(('127.0.0.1', port))
+    login(receiver, f'recv{index}', 20000 + index, protocol=2)
+    sender = socket.create_connection(('127.0.0.1', port))
+    login(sender, f'send{index}', 30000 + index)
+    for sock in (receiver, sender):
+        sock.settimeout(30)
+        while recv_frame_any(sock) != 'old_friend_list':
+            pass
+    ready.wait()
+    start.wait()
+    frame = image_frame(20000 + index, payload)
+
+    def send_all():
+        for _ in range(n_messages):
+            sender.sendall(frame)
+
+    threading.Thread(target=send_all, daemon=True).start()
+    received = 0
+    while received < n_messages:
+        if recv_frame_any(receiver) == 'private_image':
+            received += 1
+    results.put(time.perf_counter())
+    sender.close()
+    receiver.close()
+
+
+def recv_frame_any(sock):
+    """读取一帧(v1或v2)，只返回消息类型，v2帧不解析元数据以外的部分"""
+    length = int.from_bytes(recv_exact(sock, 4), 'big')
+    payload = recv_exact(sock, length)
+    if payload[:1] == b'{':
+        return json.loads(payload)['type']
+    return TYPE_NAMES.get(payload[1], payload[1])
+
+
+def image_frame(target_port, payload):
+    message = {
+        'type': 'private_image',
+        'image_data': base64.b64encode(payload).decode('ascii'),
+        'image_ext': '.png',
+        'file_name': 'bench.png',
+        'target_ip': '127.0.0.1',
+        'target_port': target_port,
+        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    encoded = json.dumps(message).encode()
+    return len(encoded).to_bytes(4, 'big') + encoded
+
+
+def measure(workers, n_pairs, n_messages, size_kb):
+    port = free_port()
+    proc = start_server(port, '--workers', str(workers), '--no-rate-limit', '--no-history', '--no-offline',
+                        '--log-level', 'WARNING', '--media-dir', tempfile.mkdtemp(prefix='bench-media-'))
+    try:
+        time.sleep(1.0)  # 等待所有工作进程开始监听
+        ctx = multiprocessing.get_context('spawn')
+        ready = ctx.Barrier(n_pairs + 1)
+        start = ctx.Barrier(n_pairs + 1)
+        results = ctx.Queue()
+        payload = os.urandom(size_kb * 1024)
+        pairs = [ctx.Process(target=run_pair, args=(i, port, n_messages, payload, ready, start, results))
+                 for i in range(n_pairs)]
+        for p in pairs:
+            p.start()
+        ready.wait()
+        time.sleep(0.5)  # 等待上线消息经过总线到达所有工作进程
+        started = time.perf_counter()
+        start.wait()
+        finished = max(results.get(timeout=300) for _ in pairs)
+        for p in pairs:
+            p.join()
+        return finished - started
+    finally:
+        stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--pairs', type=int, default=8, help="发送者和接收者的对数")
+    parser.add_argument('--messages', type=int, default=200, help="每个发送者发送的图片数")
+    parser.add_argument('--size-kb', type=int, default=64, help="每张图片的大小(KB)")
+    args = parser.parse_args()
+
+    total = args.pairs * args.messages
+    print(f"{args.pairs} 对客户端，每对 {args.messages} 张 {args.size_kb}KB 私聊图片，本机 {os.cpu_count()} 个CPU")
+    print(f"{'workers':>8} {'seconds':>8} {'msg/s':>8} {'MB/s':>8}")
+    for workers in range(1, args.max_workers + 1):
+        elapsed = measure(workers, args.pairs, args.messages, args.size_kb)
+        print(f"{workers:>8} {elapsed:>8.2f} {total / elapsed:>8.0f} {total * args.size_kb / 1024 / elapsed:>8.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""连接定时器堆的开销：安排、重新安排、取出到期定时器的速度，以及收到帧时记下时间的开销
+
+模拟N个连接：先为每个连接安排一次检查，再全部重新安排一次(旧条目作废但留在堆中)，
+然后一次取出所有到期的定时器；最后比较每收到一帧只写时间戳与每帧都重新安排定时器的耗时。
+用法: python benchmarks/bench_timers.py [--connections 100000]
+"""
+import argparse
+import time
+
+import common  # noqa: F401  把server目录加入sys.path
+from timers import Liveness, TimerHeap
+
+
+def rate(count, seconds):
+    return f"{count / seconds / 1e6:.2f} M/s ({seconds / count * 1e9:.0f} ns/次)"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--connections', type=int, default=100_000)
+    parser.add_argument('--frames', type=int, default=1_000_000, help="模拟收到的帧数")
+    args = parser.parse_args()
+
+    keys = [object() for _ in range(args.connections)]
+    timers = TimerHeap()
+    now = time.monotonic()
+
+    started = time.perf_counter()
+    for i, key in enumerate(keys):
+        timers.schedule(key, now + 30 + i * 1e-6)
+    print(f"安排 {args.connections} 个定时器: {rate(args.connections, time.perf_counter() - started)}")
+
+    started = time.perf_counter()
+    for i, key in enumerate(keys):
+        timers.schedule(key, now + 60 + i * 1e-6)
+    print(f"重新安排: {rate(args.connections, time.perf_counter() - started)} 堆中条目 {len(timers._heap)}")
+
+    started = time.perf_counter()
+    expired = timers.expired(now + 120)
+    elapsed = time.perf_counter() - started
+    assert len(expired) == args.connections
+    print(f"取出全部到期定时器: {elapsed * 1000:.1f} ms ({elapsed / args.connections * 1e9:.0f} ns/个)")
+
+    states = [Liveness(now) for _ in range(1000)]
+    started = time.perf_counter()
+    for i in range(args.frames):
+        states[i % 1000].last_recv = time.monotonic()
+    print(f"每帧记下时间: {rate(args.frames, time.perf_counter() - started)}")
+    started = time.perf_counter()
+    for i in range(args.frames):
+        timers.schedule(keys[i % 1000], time.monotonic() + 30)
+    print(f"每帧重新安排定时器(对比): {rate(args.frames, time.perf_counter() - started)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""基准测试共用的工具函数：启动服务端子进程、收发帧、读取进程内存"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(ROOT_DIR, 'server')
+
+if SERVER_DIR not in sys.path:
+    sys.path.insert(0, SERVER_DIR)
+
+
+def free_port():
+    """向系统申请一个空闲端口"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, *extra_args):
+    """在子进程中启动server/main.py，等待端口可连接后返回Popen对象"""
+    proc = subprocess.Popen(
+        [sys.executable, 'main.py', '--host', '127.0.0.1', '--port', str(port), *extra_args],
+        cwd=SERVER_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"服务端未能在端口 {port} 上启动")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def rss_kb(pid):
+    """读取进程常驻内存(KB)，仅支持Linux"""
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def cpu_seconds(pid):
+    """读取进程累计占用的CPU时间(用户态 + 内核态，秒)，仅支持Linux"""
+    with open(f'/proc/{pid}/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def send_frame(sock, message):
+    payload = json.dumps(message, ensure_ascii=False).encode()
+    sock.sendall(len(payload).to_bytes(4, 'big') + payload)
+
+
+def recv_exact(sock, n):
+    buf = bytearray()
+    while len(buf) < n:
+        chunk = sock.recv(n - len(buf))
+        if not chunk:
+            raise ConnectionError("连接已断开")
+        buf += chunk
+    return bytes(buf)
+
+
+def recv_frame(sock):
+    length = int.from_bytes(recv_exact(sock, 4), 'big')
+    return json.loads(recv_exact(sock, length).decode())
+
+
+def login(sock, username, port, **extra):
+    message = {
+        'type': 'login',
+        'username': username,
+        'local_ip': '127.0.0.1',
+        'local_port': port,
+        'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    message.update(extra)
+    send_frame(sock, message)
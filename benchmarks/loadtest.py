@@ -0,0 +1,381 @@
+"""无界面的压力测试：模拟N个用户登录后按设定的速率收发广场、私聊文本和媒体消息
+
+所有用户运行在同一个asyncio事件循环中，按info_example.txt中的协议收发。
+每条消息在内容(文本)或文件名(媒体)中带有发送序号和发送时刻，接收方据此计算端到端延迟。
+结束后输出延迟分位数(p50/p95/p99)、吞吐量、丢失和错误计数，并可写入JSON报告，
+用于比较不同版本之间的差异。
+
+用法: python benchmarks/loadtest.py [--users 50] [--seconds 10] [--engine thread|async]
+                                   [--square-rate 1] [--private-rate 1]
+                                   [--square-media-rate 0.1] [--private-media-rate 0.1] [--media-kb 64]
+                                   [--protocol 2] [--report loadtest.json]
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import time
+
+from common import ROOT_DIR, cpu_seconds, free_port, rss_kb, start_server, stop_server
+from protocol import decode_payload, encode_v1, encode_v2
+
+MARKER = 'lt'  # 压测消息的标记，接收方只统计带有该标记的消息
+
+# 消息种类: (消息类型, 是否私聊, 是否媒体)
+KINDS = {
+    'square_text': ('square_message', False, False),
+    'private_text': ('private_message', True, False),
+    'square_media': ('square_file', False, True),
+    'private_media': ('private_file', True, True),
+}
+KIND_BY_TYPE = {message_type: kind for kind, (message_type, _, _) in KINDS.items()}
+
+
+class Stats:
+    """所有模拟用户共享的统计，只在事件循环线程中修改"""
+
+    def __init__(self):
+        self.sent = {kind: 0 for kind in KINDS}
+        self.expected = {kind: 0 for kind in KINDS}     # 按发送时的在线人数计算的应收条数
+        self.delivered = {kind: 0 for kind in KINDS}
+        self.latencies = {kind: [] for kind in KINDS}   # 秒
+        self.login_latencies = []
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.errors = {'connect': 0, 'send': 0, 'decode': 0, 'disconnect': 0, 'rate_limited': 0}
+
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def pick(q):
+        return samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+
+    return {
+        'count': len(samples),
+        'p50_ms': round(pick(0.50), 3),
+        'p95_ms': round(pick(0.95), 3),
+        'p99_ms': round(pick(0.99), 3),
+        'max_ms': round(samples[-1] * 1000, 3),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 3),
+    }
+
+
+class SimUser:
+    """一个模拟用户：一个接收协程和一个发送协程"""
+
+    def __init__(self, index, args, stats, population):
+        self.index = index
+        self.args = args
+        self.stats = stats
+        self.population = population    # 所有模拟用户，私聊时从中选择目标
+        self.username = f'load{index}'
+        self.local_port = 30000 + index  # 登录时上报的地址，私聊按该地址寻址
+        self.reader = None
+        self.writer = None
+        self.receive_task = None
+        self.logged_in = asyncio.Event()
+        self.alive = False
+        self.seq = 0
+        self.encode = encode_v2 if args.protocol >= 2 else encode_v1
+
+    async def connect(self, host, port):
+        try:
+            self.reader, self.writer = await asyncio.open_connection(host, port)
+        except OSError:
+            self.stats.errors['connect'] += 1
+            return False
+        self.alive = True
+        started = time.perf_counter()
+        login = {
+            'type': 'login',
+            'username': self.username,
+            'local_ip': '127.0.0.1',
+            'local_port': self.local_port,
+            'timestamp': time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        if self.args.protocol >= 2:
+            login['protocol'] = self.args.protocol
+        await self.send(login)
+        self.receive_task = asyncio.ensure_future(self.receive_loop())
+        try:
+            await asyncio.wait_for(self.logged_in.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            self.stats.errors['connect'] += 1
+            return False
+        self.stats.login_latencies.append(time.perf_counter() - started)
+        return True
+
+    async def send(self, message):
+        payload = self.encode(message)
+        try:
+            self.writer.write(len(payload).to_bytes(4, 'big') + payload)
+            await self.writer.drain()
+        except (OSError, ConnectionError):
+            self.stats.errors['send'] += 1
+            self.alive = False
+            return False
+        self.stats.bytes_sent += len(payload) + 4
+        return True
+
+    async def receive_loop(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(4)
+                payload = await self.reader.readexactly(int.from_bytes(header, 'big'))
+                self.stats.bytes_received += len(payload) + 4
+                try:
+                    message = decode_payload(payload)
+                except (ValueError, KeyError):
+                    self.stats.errors['decode'] += 1
+                    continue
+                self.on_message(message)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            if self.alive:
+                self.stats.errors['disconnect'] += 1
+        finally:
+            self.alive = False
+
+    def on_message(self, message):
+        message_type = message.get('type')
+        if message_type == 'old_friend_list':
+            self.logged_in.set()
+            return
+        if message_type == 'error':
+            if message.get('code') == 'rate_limited':
+                self.stats.errors['rate_limited'] += 1  # 每个用户每类消息每秒最多一次
+            return
+        kind = KIND_BY_TYPE.get(message_type)
+        if kind is None:
+            return
+        marker = message.get('file_name' if KINDS[kind][2] else 'content') or ''
+        parts = marker.split('|', 3)
+        if len(parts) < 3 or parts[0] != MARKER:
+            return
+        self.stats.delivered[kind] += 1
+        self.stats.latencies[kind].append((time.perf_counter_ns() - int(parts[2])) / 1e9)
+
+    def build(self, kind):
+        """构造一条压测消息，序号和发送时刻写在内容或文件名中"""
+        message_type, private, media = KINDS[kind]
+        self.seq += 1
+        marker = f'{MARKER}|{self.seq}|{time.perf_counter_ns()}|'
+        message = {'type': message_type, 'timestamp': time.strftime("%Y-%m-%d %H:%M:%S")}
+        if media:
+            message.update({
+                'file_data': random.randbytes(self.args.media_kb * 1024),
+                'file_ext': '.bin',
+                'file_name': marker + 'load.bin',
+            })
+        else:
+            message['content'] = marker + 'x' * self.args.text_bytes
+        if private:
+            target = random.choice([u for u in self.population if u is not self and u.alive] or [self])
+            message['target_ip'] = '127.0.0.1'
+            message['target_port'] = str(target.local_port)
+        return message
+
+    async def send_loop(self, deadline, rates):
+        """按各类消息速率之和的泊松过程发送，每次按速率比例选择消息种类"""
+        kinds = [kind for kind in KINDS if rates[kind] > 0]
+        if not kinds:
+            return
+        weights = [rates[kind] for kind in kinds]
+        total_rate = sum(weights)
+        await asyncio.sleep(random.uniform(0, 1 / total_rate))  # 错开各用户的发送时刻
+        while self.alive and time.perf_counter() < deadline:
+            kind = random.choices(kinds, weights)[0]
+            recipients = 1 if KINDS[kind][1] else sum(1 for u in self.population if u.alive) - 1
+            if await self.send(self.build(kind)):
+                self.stats.sent[kind] += 1
+                self.stats.expected[kind] += recipients
+            await asyncio.sleep(random.expovariate(total_rate))
+
+    async def close(self):
+        self.alive = False
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (OSError, ConnectionError):
+                pass
+        if self.receive_task is not None:
+            self.receive_task.cancel()
+
+
+async def sample_server(pid, samples, stop):
+    """定期读取服务端进程的内存"""
+    while not stop.is_set():
+        samples.append(rss_kb(pid))
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.5)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_load(args, host, port, pid):
+    stats = Stats()
+    users = []
+    users.extend(SimUser(i, args, stats, users) for i in range(args.users))
+
+    # 分批登录，避免瞬间发起的连接超过监听队列
+    login_started = time.perf_counter()
+    for start in range(0, len(users), args.login_batch):
+        await asyncio.gather(*(u.connect(host, port) for u in users[start:start + args.login_batch]))
+    login_elapsed = time.perf_counter() - login_started
+    await asyncio.sleep(0.5)  # 等待上线广播收完
+
+    rss_samples = []
+    stop_sampling = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_server(pid, rss_samples, stop_sampling)) if pid else None
+    cpu_start = cpu_seconds(pid) if pid else None
+
+    rates = {
+        'square_text': args.square_rate,
+        'private_text': args.private_rate,
+        'square_media': args.square_media_rate,
+        'private_media': args.private_media_rate,
+    }
+    started = time.perf_counter()
+    deadline = started + args.seconds
+    await asyncio.gather(*(u.send_loop(deadline, rates) for u in users if u.alive))
+    send_elapsed = time.perf_counter() - started
+    await asyncio.sleep(args.drain)  # 等待在途的消息送达
+    elapsed = time.perf_counter() - started
+
+    cpu = cpu_seconds(pid) - cpu_start if pid else None
+    if sampler:
+        stop_sampling.set()
+        await sampler
+    for u in users:
+        await u.close()
+
+    per_kind = {}
+    for kind in KINDS:
+        expected = stats.expected[kind]
+        per_kind[kind] = {
+            'sent': stats.sent[kind],
+            'sent_per_sec': round(stats.sent[kind] / send_elapsed, 2),
+            'expected_deliveries': expected,
+            'delivered': stats.delivered[kind],
+            'lost': max(0, expected - stats.delivered[kind]),
+            'delivery_ratio': round(stats.delivered[kind] / expected, 6) if expected else None,
+            'latency': percentiles(stats.latencies[kind]),
+        }
+    all_latencies = [x for kind in KINDS for x in stats.latencies[kind]]
+    total_sent = sum(stats.sent.values())
+    total_expected = sum(stats.expected.values())
+    total_delivered = sum(stats.delivered.values())
+    return {
+        'logins': {
+            'users': args.users,
+            'logged_in': len(stats.login_latencies),
+            'per_sec': round(len(stats.login_latencies) / login_elapsed, 2),
+            'latency': percentiles(stats.login_latencies),
+        },
+        'messages': per_kind,
+        'totals': {
+            'sent': total_sent,
+            'delivered': total_delivered,
+            'lost': max(0, total_expected - total_delivered),
+            'delivery_ratio': round(total_delivered / total_expected, 6) if total_expected else None,
+            'sent_per_sec': round(total_sent / send_elapsed, 2),
+            'delivered_per_sec': round(total_delivered / elapsed, 2),
+            'mb_sent_per_sec': round(stats.bytes_sent / send_elapsed / 1e6, 3),
+            'mb_received_per_sec': round(stats.bytes_received / elapsed / 1e6, 3),
+            'latency': percentiles(all_latencies),
+        },
+        'errors': dict(stats.errors),
+        'server': {
+            'cpu_seconds': round(cpu, 3) if cpu is not None else None,
+            'rss_kb_peak': max(rss_samples) if rss_samples else None,
+        },
+        'elapsed_seconds': round(elapsed, 3),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(report):
+    print(f"{'kind':<14} {'sent':>8} {'delivered':>10} {'lost':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    rows = list(report['messages'].items()) + [('total', report['totals'])]
+    for kind, r in rows:
+        latency = r['latency']
+        if not r['sent']:
+            continue
+        print(f"{kind:<14} {r['sent']:>8} {r['delivered']:>10} {r['lost']:>6} "
+              f"{latency.get('p50_ms', 0):>9.2f} {latency.get('p95_ms', 0):>9.2f} {latency.get('p99_ms', 0):>9.2f}")
+    totals = report['totals']
+    print(f"登录 {report['logins']['logged_in']}/{report['logins']['users']}  "
+          f"发送 {totals['sent_per_sec']}/s  送达 {totals['delivered_per_sec']}/s  "
+          f"接收 {totals['mb_received_per_sec']} MB/s  错误 {report['errors']}")
+    if report['server']['cpu_seconds'] is not None:
+        print(f"服务端CPU {report['server']['cpu_seconds']}s  内存峰值 {report['server']['rss_kb_peak']} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="局域网聊天室服务端压力测试")
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seconds', type=float, default=10, help="发送阶段的时长")
+    parser.add_argument('--drain', type=float, default=2, help="发送结束后等待在途消息送达的时间")
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread')
+    parser.add_argument('--port', type=int, help="连接本机已经运行的服务端，不再启动子进程")
+    parser.add_argument('--protocol', type=int, choices=[1, 2], default=2)
+    parser.add_argument('--square-rate', type=float, default=1.0, help="每个用户每秒发送的广场文本")
+    parser.add_argument('--private-rate', type=float, default=1.0, help="每个用户每秒发送的私聊文本")
+    parser.add_argument('--square-media-rate', type=float, default=0.1, help="每个用户每秒发送的广场文件")
+    parser.add_argument('--private-media-rate', type=float, default=0.1, help="每个用户每秒发送的私聊文件")
+    parser.add_argument('--media-kb', type=int, default=64)
+    parser.add_argument('--text-bytes', type=int, default=64)
+    parser.add_argument('--login-batch', type=int, default=50)
+    parser.add_argument('--seed', type=int, help="随机数种子，便于重复同样的负载")
+    parser.add_argument('--report', help="把结果写入该JSON文件")
+    parser.add_argument('server_args', nargs='*', help="传给server/main.py的其他参数(放在--之后)")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    started_at = time.strftime("%Y-%m-%d %H:%M:%S")
+    proc = None
+    if args.port is None:
+        port = free_port()
+        proc = start_server(port, '--engine', args.engine, *args.server_args)
+    else:
+        port = args.port
+    try:
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(run_load(args, '127.0.0.1', port, proc.pid if proc else None))
+        finally:
+            loop.close()
+    finally:
+        if proc is not None:
+            stop_server(proc)
+
+    report = {
+        'tool': 'loadtest',
+        'started_at': started_at,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'config': {k: v for k, v in vars(args).items() if k != 'report'},
+        **result,
+    }
+    print_summary(report)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"报告已写入 {args.report}")
+
+
+if __name__ == '__main__':
+    main()
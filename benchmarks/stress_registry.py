@@ -0,0 +1,122 @@
+"""压力测试：大量线程反复登录/登出的同时，另一些线程持续广播
+
+检查广播过程中没有异常，结束后注册表的三个索引与snapshot保持一致。
+用法: python benchmarks/stress_registry.py [--seconds 5]
+"""
+import argparse
+import contextlib
+import io
+import sys
+import threading
+import time
+
+import common  # noqa: F401  把server目录加入sys.path
+from server import ChatServer
+
+
+class NullSocket:
+    """只实现服务端用到的方法，发送的数据直接丢弃"""
+
+    def sendall(self, data):
+        pass
+
+    def sendmsg(self, buffers):
+        return sum(len(b) for b in buffers)
+
+    def close(self):
+        pass
+
+
+def churn(server, worker_id, stop, errors, counts):
+    i = 0
+    while not stop.is_set():
+        sock = NullSocket()
+        server.open_connection(sock)
+        try:
+            server.handle_login(sock, {
+                'type': 'login',
+                'username': f'churn{worker_id}-{i}',
+                'local_ip': '10.0.0.2',
+                'local_port': worker_id * 100000 + i,
+            })
+            server.handle_logout(sock)
+        except Exception as e:
+            errors.append(repr(e))
+        server.close_connection(sock)
+        counts[worker_id] += 1
+        i += 1
+
+
+def broadcast(server, sender, stop, errors, counts, slot):
+    while not stop.is_set():
+        try:
+            server.handle_square_message(sender, {'type': 'square_message', 'content': 'x', 'timestamp': 't'})
+        except Exception as e:
+            errors.append(repr(e))
+        counts[slot] += 1
+
+
+def check_consistency(server):
+    registry = server.sessions
+    snapshot = registry.snapshot
+    assert len(snapshot) == len(registry._by_sock), "snapshot与socket索引数量不一致"
+    for session in snapshot:
+        assert registry.get(session.sock) is session
+        assert registry.find(*session.address) is session
+        assert registry.find_by_username(session.username) is session
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--churners', type=int, default=8)
+    parser.add_argument('--broadcasters', type=int, default=4)
+    parser.add_argument('--resident', type=int, default=200, help="常驻在线用户数")
+    args = parser.parse_args()
+
+    server = ChatServer()
+    stop = threading.Event()
+    errors = []
+    counts = [0] * (args.churners + args.broadcasters)
+
+    with contextlib.redirect_stdout(io.StringIO()) as sink:
+        resident = []
+        for i in range(args.resident):
+            sock = NullSocket()
+            server.open_connection(sock)
+            server.handle_login(sock, {'type': 'login', 'username': f'resident{i}',
+                                       'local_ip': '10.0.0.1', 'local_port': i})
+            resident.append(sock)
+            sink.seek(0)
+            sink.truncate()
+
+        threads = [threading.Thread(target=churn, args=(server, w, stop, errors, counts))
+                   for w in range(args.churners)]
+        threads += [threading.Thread(target=broadcast,
+                                     args=(server, resident[b], stop, errors, counts, args.churners + b))
+                    for b in range(args.broadcasters)]
+        for t in threads:
+            t.start()
+        deadline = time.time() + args.seconds
+        while time.time() < deadline:
+            time.sleep(0.2)
+            sink.seek(0)
+            sink.truncate()
+        stop.set()
+        for t in threads:
+            t.join()
+
+    check_consistency(server)
+    logins = sum(counts[:args.churners])
+    broadcasts = sum(counts[args.churners:])
+    print(f"登录/登出循环: {logins} ({logins / args.seconds:.0f}/s)")
+    print(f"广播: {broadcasts} ({broadcasts / args.seconds:.0f}/s)")
+    print(f"在线会话: {len(server.sessions)} (应为 {args.resident})")
+    if errors or len(server.sessions) != args.resident:
+        print(f"失败: {len(errors)} 个异常，例如 {errors[:3]}")
+        sys.exit(1)
+    print("通过")
+
+
+if __name__ == '__main__':
+    main()
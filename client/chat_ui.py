@@ -2,8 +2,8 @@ from PySide6.QtWidgets import (QWidget, QTextEdit, QLineEdit, QPushButton,
                              QVBoxLayout, QHBoxLayout, QListWidget, QSplitter,
                              QLabel, QFrame, QStackedWidget, QListWidgetItem,
                              QMessageBox, QFileDialog, QMenu, QSlider)
-from PySide6.QtCore import Qt, QSize, QPoint, QUrl
-from PySide6.QtGui import QAction, QCursor, QIcon
+from PySide6.QtCore import Qt, QSize, QPoint, QUrl, QBuffer, QIODevice
+from PySide6.QtGui import QAction, QCursor, QIcon, QImage
 from PySide6.QtMultimedia import QMediaPlayer
 from PySide6.QtMultimediaWidgets import QVideoWidget
 from PySide6.QtMultimedia import QAudioOutput
@@ -12,6 +12,58 @@ import base64
 import os
 import mimetypes
 import tempfile
+from client import RemoteMedia
+
+THUMBNAIL_SIZE = 200                # 缩略图最长边(像素)
+THUMBNAIL_MIN_BYTES = 256 * 1024    # 超过该大小的图片发送时附带缩略图
+
+
+def media_bytes(data):
+    """媒体数据统一转换为bytes：v2协议收到的是原始数据，v1协议收到的是base64字符串"""
+    return data if isinstance(data, (bytes, bytearray)) else base64.b64decode(data)
+
+
+def media_base64(data):
+    """媒体数据转换为base64字符串，用于在HTML中内嵌显示图片"""
+    return data if isinstance(data, str) else base64.b64encode(data).decode('ascii')
+
+
+def make_thumbnail(image_data):
+    """大图片生成base64编码的JPEG缩略图，接收方不下载原图也能预览"""
+    if len(image_data) < THUMBNAIL_MIN_BYTES:
+        return None
+    image = QImage.fromData(image_data)
+    if image.isNull():
+        return None
+    thumbnail = image.scaled(THUMBNAIL_SIZE, THUMBNAIL_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    thumbnail.save(buffer, "JPEG", 70)
+    return base64.b64encode(bytes(buffer.data())).decode('ascii')
+
+
+def image_source(image_data, image_ext):
+    """图片的src：已下载的直接内嵌，未下载的显示缩略图或图标"""
+    if isinstance(image_data, RemoteMedia):
+        if image_data.thumbnail:
+            return f"data:image/jpeg;base64,{image_data.thumbnail}"
+        return ":/icons/image.png"
+    return f"data:image/{image_ext[1:]};base64,{media_base64(image_data)}"
+
+
+def media_caption(display_name, data):
+    """聊天记录中显示的媒体名称，未下载的附带大小"""
+    if not isinstance(data, RemoteMedia):
+        return display_name
+    size = data.size
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'GB'
+    return f"{display_name}（{size:.1f}{unit}，右键下载）"
+
 
 class ChatPanel(QWidget):
     """聊天面板组件，用于群聊或私聊"""
@@ -227,7 +279,7 @@ class VideoPlayer(QWidget):
         
         # 创建临时文件并写入视频数据
         self.temp_file = tempfile.NamedTemporaryFile(suffix=self.video_ext, delete=False)
-        self.temp_file.write(base64.b64decode(self.video_data))
+        self.temp_file.write(media_bytes(self.video_data))
         self.temp_file.close()
         
         # 设置视频源
@@ -375,6 +427,7 @@ class MediaTextEdit(QTextEdit):
     def __init__(self):
         super().__init__()
         self.media_data = {}  # 存储媒体数据的字典
+        self.pending_downloads = {}  # 等待下载完成后执行的操作 {media_hash: [(media_name, 操作), ...]}
         self.setContextMenuPolicy(Qt.CustomContextMenu)
         self.customContextMenuRequested.connect(self.show_context_menu)
         self.video_players = []  # 存储视频播放器窗口
@@ -415,6 +468,31 @@ class MediaTextEdit(QTextEdit):
                 
                 menu.exec_(QCursor.pos())
 
+    def ensure_downloaded(self, media_name, action):
+        """媒体还没有下载时向服务器索取，返回False；下载完成后再执行action(media_name)"""
+        data = self.media_data[media_name]['data']
+        if not isinstance(data, RemoteMedia):
+            return True
+        self.pending_downloads.setdefault(data.media_hash, []).append((media_name, action))
+        client = getattr(self.window(), 'client', None)
+        if client:
+            client.download_media(data.media_hash)
+        return False
+
+    def media_downloaded(self, media_hash, data):
+        """按需下载完成，替换占位数据并执行等待中的操作"""
+        actions = self.pending_downloads.pop(media_hash, [])
+        if data is None:
+            if actions:
+                QMessageBox.warning(self, "错误", "下载失败：服务器上已没有该文件")
+            return
+        for media_info in self.media_data.values():
+            remote = media_info['data']
+            if isinstance(remote, RemoteMedia) and remote.media_hash == media_hash:
+                media_info['data'] = data
+        for media_name, action in actions:
+            action(media_name)
+
     def play_video(self, media_name):
         if media_name not in self.media_data:
             return
@@ -422,6 +500,8 @@ class MediaTextEdit(QTextEdit):
         media_info = self.media_data[media_name]
         if media_info['type'] != 'video':
             return
+        if not self.ensure_downloaded(media_name, self.play_video):
+            return
             
         # 创建视频播放器窗口
         player = VideoPlayer(media_info['data'], media_info['ext'])
@@ -433,6 +513,8 @@ class MediaTextEdit(QTextEdit):
         """保存媒体文件"""
         if media_name not in self.media_data:
             return
+        if not self.ensure_downloaded(media_name, self.save_media):
+            return
             
         media_info = self.media_data[media_name]
         media_data = media_info['data']
@@ -472,10 +554,9 @@ class MediaTextEdit(QTextEdit):
         
         if file_path:
             try:
-                # 解码Base64数据并保存为文件
-                media_bytes = base64.b64decode(media_data)
+                # 保存为文件
                 with open(file_path, 'wb') as f:
-                    f.write(media_bytes)
+                    f.write(media_bytes(media_data))
                 QMessageBox.information(self, "成功", f"{media_type}保存成功！")
             except Exception as e:
                 QMessageBox.warning(self, "错误", f"保存{media_type}失败：{str(e)}")
@@ -488,6 +569,8 @@ class MediaTextEdit(QTextEdit):
         media_info = self.media_data[media_name]
         if media_info['type'] != 'audio':
             return
+        if not self.ensure_downloaded(media_name, self.play_audio):
+            return
             
         # 创建音频播放器窗口
         player = AudioPlayer(media_info['data'], media_info['ext'])
@@ -619,7 +702,7 @@ class AudioPlayer(QWidget):
         # 将音频数据保存到���时文件
         import tempfile
         self.temp_file = tempfile.NamedTemporaryFile(suffix=self.audio_ext, delete=False)
-        self.temp_file.write(base64.b64decode(self.audio_data))
+        self.temp_file.write(media_bytes(self.audio_data))
         self.temp_file.close()
         
         # 设置音频源
@@ -715,15 +798,26 @@ class ChatWindow(QWidget):
             self.client.new_user_login.connect(self.handle_new_user_login)
             self.client.old_friend_list.connect(self.handle_old_friend_list)
             self.client.user_logout.connect(self.handle_user_logout)
+            self.client.roster_delta.connect(self.handle_roster_delta)  # 合并后的在线用户变化
+            self.client.room_joined.connect(self.handle_room_joined)  # 已加入聊天室
+            self.client.room_member.connect(self.handle_room_member)  # 聊天室成员变化
             self.client.new_message.connect(self.handle_new_message)
             self.client.new_private_message.connect(self.handle_private_message)
             self.client.new_image_message.connect(self.handle_image_message)
             self.client.new_video_message.connect(self.handle_video_message)  # 添加视频消息处理
             self.client.new_file_message.connect(self.handle_file_message)  # 添加文件消息处理
             self.client.new_audio_message.connect(self.handle_audio_message)  # 添加音频消息处理
+            self.client.media_downloaded.connect(self.handle_media_downloaded)  # 按需下载完成
+            self.client.delivery_status.connect(self.handle_delivery_status)  # 私聊对方不在线时的投递状态
+            self.client.server_error.connect(self.handle_server_error)  # 服务器拒绝了发出的消息
         
         # 连接用户列表点击事件
         self.user_list.itemClicked.connect(self.on_user_clicked)
+        # 连接聊天室列表和加入、离开按钮
+        self.room_list.itemClicked.connect(self.on_room_clicked)
+        self.join_room_btn.clicked.connect(self.join_room)
+        self.room_input.returnPressed.connect(self.join_room)
+        self.leave_room_btn.clicked.connect(self.leave_room)
         # 连接退出按钮事件
         self.logout_btn.clicked.connect(self.logout)
         
@@ -821,6 +915,58 @@ class ChatWindow(QWidget):
         
         left_layout.addWidget(self.user_list)
         
+        # 聊天室：输入名称加入，已加入的聊天室列在下面
+        room_row = QHBoxLayout()
+        self.room_input = QLineEdit()
+        self.room_input.setPlaceholderText("聊天室名称")
+        self.room_input.setStyleSheet("""
+            QLineEdit {
+                border: 1px solid #bdc3c7;
+                border-radius: 5px;
+                padding: 6px;
+                background-color: white;
+                font-size: 13px;
+            }
+        """)
+        self.join_room_btn = QPushButton("加入")
+        self.leave_room_btn = QPushButton("离开")
+        for button in (self.join_room_btn, self.leave_room_btn):
+            button.setStyleSheet("""
+                QPushButton {
+                    background-color: #3498db;
+                    color: white;
+                    padding: 6px 10px;
+                    border: none;
+                    border-radius: 5px;
+                    font-size: 13px;
+                }
+                QPushButton:hover {
+                    background-color: #2980b9;
+                }
+            """)
+        room_row.addWidget(self.room_input)
+        room_row.addWidget(self.join_room_btn)
+        room_row.addWidget(self.leave_room_btn)
+        left_layout.addLayout(room_row)
+        
+        self.room_list = QListWidget()
+        self.room_list.setMaximumHeight(120)
+        self.room_list.setStyleSheet("""
+            QListWidget {
+                border: 1px solid #bdc3c7;
+                border-radius: 5px;
+                padding: 5px;
+                background-color: white;
+                font-size: 14px;
+                outline: none;
+            }
+            QListWidget::item:selected {
+                background-color: #3498db;
+                color: white;
+            }
+        """)
+        left_layout.addWidget(self.room_list)
+        
         # 美化退出按钮
         self.logout_btn = QPushButton("退出登录")
         self.logout_btn.setStyleSheet("""
@@ -890,6 +1036,72 @@ class ChatWindow(QWidget):
         self.chat_stack.setCurrentWidget(self.chat_panels[address])
         self.current_chat = address
         
+    def on_room_clicked(self, item):
+        """切换到聊天室的面板"""
+        key = item.data(Qt.UserRole)
+        if key in self.chat_panels:
+            self.chat_stack.setCurrentWidget(self.chat_panels[key])
+            self.current_chat = key
+
+    def open_room_panel(self, room):
+        """聊天室的面板，不存在时创建并加入聊天室列表"""
+        key = f"room:{room}"
+        if key not in self.chat_panels:
+            room_chat = ChatPanel(f"聊天室 {room}")
+            room_chat.send_button.clicked.connect(self.send_message)
+            room_chat.image_button.clicked.connect(self.send_image)
+            room_chat.video_button.clicked.connect(self.send_video)
+            room_chat.file_button.clicked.connect(self.send_file)
+            room_chat.audio_button.clicked.connect(self.send_audio)
+            self.chat_stack.addWidget(room_chat)
+            self.chat_panels[key] = room_chat
+            item = QListWidgetItem(f"# {room}")
+            item.setData(Qt.UserRole, key)
+            self.room_list.addItem(item)
+        return self.chat_panels[key]
+
+    def square_panel(self, room):
+        """广场消息显示的面板：聊天室消息显示在该聊天室的面板中，已经离开的聊天室返回None"""
+        if not room:
+            return self.chat_panels["group"]
+        if f"room:{room}" in self.chat_panels or room in self.client.rooms:
+            return self.open_room_panel(room)
+        return None
+
+    def square_scope(self, message):
+        """当前是聊天室的面板时，给广场消息加上room字段，只发给该聊天室的成员"""
+        if self.current_chat.startswith("room:"):
+            message["room"] = self.current_chat[len("room:"):]
+        return message
+
+    def join_room(self):
+        """加入输入框中的聊天室并切换到它的面板"""
+        room = self.room_input.text().strip()
+        if not room:
+            return
+        if 'rooms' not in self.client.features:
+            QMessageBox.warning(self, "无法加入", "服务器不支持聊天室")
+            return
+        self.client.join_room(room)
+        panel = self.open_room_panel(room)
+        self.chat_stack.setCurrentWidget(panel)
+        self.current_chat = f"room:{room}"
+        self.room_input.clear()
+
+    def leave_room(self):
+        """离开当前面板对应的聊天室，切换回广场"""
+        if not self.current_chat.startswith("room:"):
+            return
+        key = self.current_chat
+        self.client.leave_room(key[len("room:"):])
+        panel = self.chat_panels.pop(key)
+        self.chat_stack.removeWidget(panel)
+        for row in range(self.room_list.count() - 1, -1, -1):
+            if self.room_list.item(row).data(Qt.UserRole) == key:
+                self.room_list.takeItem(row)
+        self.chat_stack.setCurrentWidget(self.chat_panels["group"])
+        self.current_chat = "group"
+
     def add_user(self, username, ip):
         """添加在线用户到列表"""
         # 在隔线添加用户
@@ -931,12 +1143,12 @@ class ChatWindow(QWidget):
         message = current_panel.message_input.toPlainText().strip()
         if message:
             time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            if self.current_chat == "group":  # 广场消息
-                self.client.send_message({
+            if self.current_chat == "group" or self.current_chat.startswith("room:"):  # 广场或聊天室消息
+                self.client.send_message(self.square_scope({
                     "type": "square_message",
                     "content": message,
                     "timestamp": time
-                })
+                }))
                 header = f"[{time}] 【我】"
                 current_panel.chat_display.append(f"<p style='color:#2c3e50;'>{header}</p>")
                 current_panel.chat_display.append(f"<p style='margin-left:20px;color:#34495e;'>{message}</p>")
@@ -1046,19 +1258,22 @@ class ChatWindow(QWidget):
             sys.exit(0)
         
     def handle_old_friend_list(self, users):
-        """处理已有用户列表"""
-        # 清空现有用户列表（保留广场和分隔线）
-        while self.user_list.count() > 2:
-            self.user_list.takeItem(2)
-
-        # 添加所有用户到列表
+        """处理已有用户列表，与当前列表比较后只增删变化的项（保留广场和分隔线）"""
+        wanted = {}
         for user in users:
             username = user.get('username')
             address = user.get('address')
             # if isinstance(address, (list, tuple)) and len(address) >= 2:
             ip, port = address
             if ip != self.client.local_ip or str(port) != str(self.client.local_port):  # 不显示自己
-                self.add_user(username, f"{ip}:{port}")
+                wanted[f"{username} ({ip}:{port})"] = (username, f"{ip}:{port}")
+
+        # 移除已经不在列表中的用户，已有的保留
+        for row in range(self.user_list.count() - 1, 1, -1):
+            if wanted.pop(self.user_list.item(row).text(), None) is None:
+                self.user_list.takeItem(row)
+        for username, address in wanted.values():
+            self.add_user(username, address)
         
         # 更新用户数量（加1是因为包含自己）
         self.user_list_label.setText(f"在线用户 ({len(users)})")
@@ -1083,6 +1298,68 @@ class ChatWindow(QWidget):
                 f"<p style='margin-left:20px;color:#95a5a6;'>{content}</p>"
             )
                     
+    def handle_roster_delta(self, joined, left):
+        """处理合并后的在线用户变化，广场中只显示一条汇总的系统消息"""
+        left_names = []
+        for user in left:
+            ip, port = user['address']
+            if ip != self.client.local_ip or str(port) != str(self.client.local_port):
+                self.remove_user(user['username'], f"{ip}:{port}")
+                left_names.append(f"{user['username']} ({ip}:{port})")
+        joined_names = []
+        for user in joined:
+            ip, port = user['address']
+            if ip != self.client.local_ip or str(port) != str(self.client.local_port):  # 不添加自己
+                # 同一地址换了用户名时替换原来的项
+                for item in self.user_list.findItems(f"({ip}:{port})", Qt.MatchEndsWith):
+                    self.user_list.takeItem(self.user_list.row(item))
+                self.add_user(user['username'], f"{ip}:{port}")
+                joined_names.append(f"{user['username']} ({ip}:{port})")
+        if not joined_names and not left_names:
+            return
+
+        # 更新用户数量
+        current_count = self.user_list.count() - 1  # 减1是因为不计算分隔线
+        self.user_list_label.setText(f"在线用户 ({current_count})")
+
+        def summary(names, action):
+            shown = '、'.join(names[:5])
+            return f"{shown} 等 {len(names)} 人{action}" if len(names) > 5 else f"{shown} {action}"
+
+        parts = []
+        if joined_names:
+            parts.append(summary(joined_names, "加入了聊天室"))
+        if left_names:
+            parts.append(summary(left_names, "离开了聊天室"))
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.chat_panels["group"].chat_display.append(
+            f"<p style='color:#7f8c8d;'>[{timestamp}] 【系统消息】</p>"
+        )
+        self.chat_panels["group"].chat_display.append(
+            f"<p style='margin-left:20px;color:#95a5a6;'>{'；'.join(parts)}</p>"
+        )
+
+    def handle_room_joined(self, room, members):
+        """已加入聊天室，在其面板中显示当前成员"""
+        panel = self.open_room_panel(room)
+        names = '、'.join(f"{m['username']}" for m in members[:20])
+        more = f" 等 {len(members)} 人" if len(members) > 20 else ""
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        panel.chat_display.append(f"<p style='color:#7f8c8d;'>[{timestamp}] 【系统消息】</p>")
+        panel.chat_display.append(
+            f"<p style='margin-left:20px;color:#95a5a6;'>已加入聊天室 {room}，当前成员: {names}{more}</p>"
+        )
+
+    def handle_room_member(self, room, action, username, ip, port):
+        """聊天室中有人加入或离开"""
+        panel = self.chat_panels.get(f"room:{room}")
+        if panel is None:
+            return
+        verb = "加入了" if action == 'join' else "离开了"
+        panel.chat_display.append(
+            f"<p style='margin-left:20px;color:#95a5a6;'>【系统消息】: {username} ({ip}:{port}) {verb}聊天室</p>"
+        )
+
     def handle_user_logout(self, username, ip, port):
         """处理用户登出"""
         self.remove_user(username, f"{ip}:{port}")
@@ -1096,13 +1373,16 @@ class ChatWindow(QWidget):
             f"【系统消息】: {username} ({ip}:{port}) 离开了聊天室"
         )
                     
-    def handle_new_message(self, username, ip, port, content, timestamp):
-        """处理群聊消息"""
+    def handle_new_message(self, username, ip, port, content, timestamp, room=""):
+        """处理群聊消息，聊天室消息显示在该聊天室的面板中"""
+        panel = self.square_panel(room)
+        if panel is None:
+            return
         header = f"[{timestamp}] {username} ({ip})"
-        self.chat_panels["group"].chat_display.append(
+        panel.chat_display.append(
             f"<p style='color:#2c3e50;'>{header}</p>"
         )
-        self.chat_panels["group"].chat_display.append(
+        panel.chat_display.append(
             f"<p style='margin-left:20px;color:#34495e;'>{content}</p>"
         )
                     
@@ -1138,8 +1418,9 @@ class ChatWindow(QWidget):
                 with open(file_path, 'rb') as f:
                     image_data = f.read()
                 
-                # 将图片数据转换为Base64编码
-                image_base64 = base64.b64encode(image_data).decode('utf-8')
+                # Base64编码只用于本地显示，发送原始数据，由Client按协议版本编码
+                image_base64 = media_base64(image_data)
+                thumbnail = make_thumbnail(image_data)
                 
                 # 获取文件名和扩展名
                 file_name = os.path.basename(file_path)
@@ -1148,14 +1429,15 @@ class ChatWindow(QWidget):
                 time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 image_name = f"img_{time.replace(':', '-')}"
                 
-                if self.current_chat == "group":  # 广场消息
-                    self.client.send_message({
+                if self.current_chat == "group" or self.current_chat.startswith("room:"):  # 广场或聊天室消息
+                    self.client.send_message(self.square_scope({
                         "type": "square_image",
-                        "image_data": image_base64,
+                        "image_data": image_data,
                         "image_ext": ext,
+                        "thumbnail": thumbnail,
                         "file_name": file_name,
                         "timestamp": time
-                    })
+                    }))
                     
                     # 在本地显示图片
                     header = f"[{time}] 【我】"
@@ -1167,7 +1449,7 @@ class ChatWindow(QWidget):
                     # 保存图片数据
                     current_panel.chat_display.media_data[image_name] = {
                         'type': 'image',
-                        'data': image_base64,
+                        'data': image_data,
                         'ext': ext,
                         'file_name': file_name
                     }
@@ -1178,8 +1460,9 @@ class ChatWindow(QWidget):
                         "type": "private_image",
                         "target_ip": target_ip,
                         "target_port": target_port,
-                        "image_data": image_base64,
+                        "image_data": image_data,
                         "image_ext": ext,
+                        "thumbnail": thumbnail,
                         "file_name": file_name,
                         "timestamp": time
                     })
@@ -1194,7 +1477,7 @@ class ChatWindow(QWidget):
                     # 保存图片数据
                     current_panel.chat_display.media_data[image_name] = {
                         'type': 'image',
-                        'data': image_base64,
+                        'data': image_data,
                         'ext': ext,
                         'file_name': file_name
                     }
@@ -1202,10 +1485,11 @@ class ChatWindow(QWidget):
             except Exception as e:
                 QMessageBox.warning(self, "发送失败", f"图片发送失败：{str(e)}")
 
-    def handle_image_message(self, username, ip, port, image_data, image_ext, timestamp, is_private=False, file_name=None):
+    def handle_image_message(self, username, ip, port, image_data, image_ext, timestamp, is_private=False, file_name=None, room=""):
         """处理接收到的图片消息"""
         image_name = f"img_{timestamp.replace(':', '-')}"
         display_name = file_name if file_name else f"image{image_ext}"
+        caption = media_caption(display_name, image_data)
         
         if is_private:
             address = f"{ip}:{port}"
@@ -1221,7 +1505,7 @@ class ChatWindow(QWidget):
                 f"<p style='color:#2c3e50;'>{header}</p>"
             )
             self.chat_panels[address].chat_display.append(
-                f"<p style='margin-left:20px;'><img src='data:image/{image_ext[1:]};base64,{image_data}' width='400' style='max-width:90%;' title='{image_name}'/><br/>[图片] {display_name}</p>"
+                f"<p style='margin-left:20px;'><img src='{image_source(image_data, image_ext)}' width='400' style='max-width:90%;' title='{image_name}'/><br/>[图片] {caption}</p>"
             )
             # 保存图片数据
             self.chat_panels[address].chat_display.media_data[image_name] = {
@@ -1231,15 +1515,18 @@ class ChatWindow(QWidget):
                 'file_name': display_name
             }
         else:
+            panel = self.square_panel(room)  # 聊天室消息显示在该聊天室的面板中
+            if panel is None:
+                return
             header = f"[{timestamp}] {username} ({ip})"
-            self.chat_panels["group"].chat_display.append(
+            panel.chat_display.append(
                 f"<p style='color:#2c3e50;'>{header}</p>"
             )
-            self.chat_panels["group"].chat_display.append(
-                f"<p style='margin-left:20px;'><img src='data:image/{image_ext[1:]};base64,{image_data}' width='400' style='max-width:90%;' title='{image_name}'/><br/>[图片] {display_name}</p>"
+            panel.chat_display.append(
+                f"<p style='margin-left:20px;'><img src='{image_source(image_data, image_ext)}' width='400' style='max-width:90%;' title='{image_name}'/><br/>[图片] {caption}</p>"
             )
             # 保存图片数据
-            self.chat_panels["group"].chat_display.media_data[image_name] = {
+            panel.chat_display.media_data[image_name] = {
                 'type': 'image',
                 'data': image_data,
                 'ext': image_ext,
@@ -1266,9 +1553,6 @@ class ChatWindow(QWidget):
                 with open(file_path, 'rb') as f:
                     video_data = f.read()
                 
-                # 将视频数据转换为Base64编码
-                video_base64 = base64.b64encode(video_data).decode('utf-8')
-                
                 # 获取文件名和扩展名
                 file_name = os.path.basename(file_path)
                 _, ext = os.path.splitext(file_path)
@@ -1276,14 +1560,14 @@ class ChatWindow(QWidget):
                 time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 media_name = f"video_{time.replace(':', '-')}"
                 
-                if self.current_chat == "group":  # 广场消息
-                    self.client.send_message({
+                if self.current_chat == "group" or self.current_chat.startswith("room:"):  # 广场或聊天室消息
+                    self.client.send_message(self.square_scope({
                         "type": "square_video",
-                        "video_data": video_base64,
+                        "video_data": video_data,
                         "video_ext": ext,
                         "file_name": file_name,
                         "timestamp": time
-                    })
+                    }))
                     
                     # 在本地显示视频占位图
                     header = f"[{time}] 【我】"
@@ -1295,7 +1579,7 @@ class ChatWindow(QWidget):
                     # 保存视频���据
                     current_panel.chat_display.media_data[media_name] = {
                         'type': 'video',
-                        'data': video_base64,
+                        'data': video_data,
                         'ext': ext,
                         'file_name': file_name
                     }
@@ -1306,7 +1590,7 @@ class ChatWindow(QWidget):
                         "type": "private_video",
                         "target_ip": target_ip,
                         "target_port": target_port,
-                        "video_data": video_base64,
+                        "video_data": video_data,
                         "video_ext": ext,
                         "file_name": file_name,
                         "timestamp": time
@@ -1322,7 +1606,7 @@ class ChatWindow(QWidget):
                     # 保存视频数据
                     current_panel.chat_display.media_data[media_name] = {
                         'type': 'video',
-                        'data': video_base64,
+                        'data': video_data,
                         'ext': ext,
                         'file_name': file_name
                     }
@@ -1330,10 +1614,11 @@ class ChatWindow(QWidget):
             except Exception as e:
                 QMessageBox.warning(self, "发送失败", f"视频发送失败：{str(e)}")
 
-    def handle_video_message(self, username, ip, port, video_data, video_ext, timestamp, is_private=False, file_name=None):
+    def handle_video_message(self, username, ip, port, video_data, video_ext, timestamp, is_private=False, file_name=None, room=""):
         """处理接收到的视频消息"""
         media_name = f"video_{timestamp.replace(':', '-')}"
         display_name = file_name if file_name else f"video{video_ext}"
+        caption = media_caption(display_name, video_data)
         
         if is_private:
             address = f"{ip}:{port}"
@@ -1350,7 +1635,7 @@ class ChatWindow(QWidget):
                 f"<p style='color:#2c3e50;'>{header}</p>"
             )
             self.chat_panels[address].chat_display.append(
-                f"<p style='margin-left:20px;'><img src=':/icons/video.png' width='100' title='{media_name}'/><br/>[视频] {display_name}</p>"
+                f"<p style='margin-left:20px;'><img src=':/icons/video.png' width='100' title='{media_name}'/><br/>[视频] {caption}</p>"
             )
             # 保存视频数据
             self.chat_panels[address].chat_display.media_data[media_name] = {
@@ -1360,15 +1645,18 @@ class ChatWindow(QWidget):
                 'file_name': display_name
             }
         else:
+            panel = self.square_panel(room)  # 聊天室消息显示在该聊天室的面板中
+            if panel is None:
+                return
             header = f"[{timestamp}] {username} ({ip})"
-            self.chat_panels["group"].chat_display.append(
+            panel.chat_display.append(
                 f"<p style='color:#2c3e50;'>{header}</p>"
             )
-            self.chat_panels["group"].chat_display.append(
-                f"<p style='margin-left:20px;'><img src=':/icons/video.png' width='100' title='{media_name}'/><br/>[视频] {display_name}</p>"
+            panel.chat_display.append(
+                f"<p style='margin-left:20px;'><img src=':/icons/video.png' width='100' title='{media_name}'/><br/>[视频] {caption}</p>"
             )
             # 保存视频数据
-            self.chat_panels["group"].chat_display.media_data[media_name] = {
+            panel.chat_display.media_data[media_name] = {
                 'type': 'video',
                 'data': video_data,
                 'ext': video_ext,
@@ -1395,9 +1683,6 @@ class ChatWindow(QWidget):
                 with open(file_path, 'rb') as f:
                     audio_data = f.read()
                 
-                # 将音频数据转换为Base64编码
-                audio_base64 = base64.b64encode(audio_data).decode('utf-8')
-                
                 # 获取文件名和扩展名
                 file_name = os.path.basename(file_path)
                 _, ext = os.path.splitext(file_path)
@@ -1405,14 +1690,14 @@ class ChatWindow(QWidget):
                 time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 media_name = f"audio_{time.replace(':', '-')}"
                 
-                if self.current_chat == "group":  # 广场消息
-                    self.client.send_message({
+                if self.current_chat == "group" or self.current_chat.startswith("room:"):  # 广场或聊天室消息
+                    self.client.send_message(self.square_scope({
                         "type": "square_audio",
-                        "audio_data": audio_base64,
+                        "audio_data": audio_data,
                         "audio_ext": ext,
                         "file_name": file_name,
                         "timestamp": time
-                    })
+                    }))
                     
                     # 在本地显示音频占位图
                     header = f"[{time}] 【我】"
@@ -1424,7 +1709,7 @@ class ChatWindow(QWidget):
                     # 保存音频数据
                     current_panel.chat_display.media_data[media_name] = {
                         'type': 'audio',
-                        'data': audio_base64,
+                        'data': audio_data,
                         'ext': ext,
                         'file_name': file_name
                     }
@@ -1435,7 +1720,7 @@ class ChatWindow(QWidget):
                         "type": "private_audio",
                         "target_ip": target_ip,
                         "target_port": target_port,
-                        "audio_data": audio_base64,
+                        "audio_data": audio_data,
                         "audio_ext": ext,
                         "file_name": file_name,
                         "timestamp": time
@@ -1451,7 +1736,7 @@ class ChatWindow(QWidget):
                     # 保存音频数据
                     current_panel.chat_display.media_data[media_name] = {
                         'type': 'audio',
-                        'data': audio_base64,
+                        'data': audio_data,
                         'ext': ext,
                         'file_name': file_name
                     }
@@ -1459,10 +1744,11 @@ class ChatWindow(QWidget):
             except Exception as e:
                 QMessageBox.warning(self, "发送失败", f"音频发送失败：{str(e)}")
 
-    def handle_audio_message(self, username, ip, port, audio_data, audio_ext, timestamp, is_private=False, file_name=None):
+    def handle_audio_message(self, username, ip, port, audio_data, audio_ext, timestamp, is_private=False, file_name=None, room=""):
         """处理接收到的音频消息"""
         media_name = f"audio_{timestamp.replace(':', '-')}"
         display_name = file_name if file_name else f"audio{audio_ext}"
+        caption = media_caption(display_name, audio_data)
         
         if is_private:
             address = f"{ip}:{port}"
@@ -1481,7 +1767,7 @@ class ChatWindow(QWidget):
                 f"<p style='color:#2c3e50;'>{header}</p>"
             )
             self.chat_panels[address].chat_display.append(
-                f"<p style='margin-left:20px;'><img src=':/icons/audio.png' width='100' title='{media_name}'/><br/>[音频] {display_name}</p>"
+                f"<p style='margin-left:20px;'><img src=':/icons/audio.png' width='100' title='{media_name}'/><br/>[音频] {caption}</p>"
             )
             # 保存音频数据
             self.chat_panels[address].chat_display.media_data[media_name] = {
@@ -1491,15 +1777,18 @@ class ChatWindow(QWidget):
                 'file_name': display_name
             }
         else:
+            panel = self.square_panel(room)  # 聊天室消息显示在该聊天室的面板中
+            if panel is None:
+                return
             header = f"[{timestamp}] {username} ({ip})"
-            self.chat_panels["group"].chat_display.append(
+            panel.chat_display.append(
                 f"<p style='color:#2c3e50;'>{header}</p>"
             )
-            self.chat_panels["group"].chat_display.append(
-                f"<p style='margin-left:20px;'><img src=':/icons/audio.png' width='100' title='{media_name}'/><br/>[音频] {display_name}</p>"
+            panel.chat_display.append(
+                f"<p style='margin-left:20px;'><img src=':/icons/audio.png' width='100' title='{media_name}'/><br/>[音频] {caption}</p>"
             )
             # 保存音频数据
-            self.chat_panels["group"].chat_display.media_data[media_name] = {
+            panel.chat_display.media_data[media_name] = {
                 'type': 'audio',
                 'data': audio_data,
                 'ext': audio_ext,
@@ -1520,9 +1809,6 @@ class ChatWindow(QWidget):
                 with open(file_path, 'rb') as f:
                     file_data = f.read()
                 
-                # 将文件数据转换���Base64编码
-                file_base64 = base64.b64encode(file_data).decode('utf-8')
-                
                 # 获取文件名和扩展名
                 file_name = os.path.basename(file_path)
                 _, ext = os.path.splitext(file_path)
@@ -1530,14 +1816,14 @@ class ChatWindow(QWidget):
                 time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
                 media_name = f"file_{time.replace(':', '-')}"
                 
-                if self.current_chat == "group":  # 广场消息
-                    self.client.send_message({
+                if self.current_chat == "group" or self.current_chat.startswith("room:"):  # 广场或聊天室消息
+                    self.client.send_message(self.square_scope({
                         "type": "square_file",
-                        "file_data": file_base64,
+                        "file_data": file_data,
                         "file_ext": ext,
                         "file_name": file_name,
                         "timestamp": time
-                    })
+                    }))
                     
                     # 在本地显示文件占位图
                     header = f"[{time}] 【我】"
@@ -1549,7 +1835,7 @@ class ChatWindow(QWidget):
                     # 保存文件数据
                     current_panel.chat_display.media_data[media_name] = {
                         'type': 'file',
-                        'data': file_base64,
+                        'data': file_data,
                         'ext': ext,
                         'file_name': file_name
                     }
@@ -1560,7 +1846,7 @@ class ChatWindow(QWidget):
                         "type": "private_file",
                         "target_ip": target_ip,
                         "target_port": target_port,
-                        "file_data": file_base64,
+                        "file_data": file_data,
                         "file_ext": ext,
                         "file_name": file_name,
                         "timestamp": time
@@ -1576,7 +1862,7 @@ class ChatWindow(QWidget):
                     # 保存文件数据
                     current_panel.chat_display.media_data[media_name] = {
                         'type': 'file',
-                        'data': file_base64,
+                        'data': file_data,
                         'ext': ext,
                         'file_name': file_name
                     }
@@ -1584,10 +1870,11 @@ class ChatWindow(QWidget):
             except Exception as e:
                 QMessageBox.warning(self, "发送失败", f"文件发送失败：{str(e)}")
 
-    def handle_file_message(self, username, ip, port, file_data, file_ext, timestamp, is_private=False, file_name=None):
+    def handle_file_message(self, username, ip, port, file_data, file_ext, timestamp, is_private=False, file_name=None, room=""):
         """处理接收到的文件消息"""
         media_name = f"file_{timestamp.replace(':', '-')}"
         display_name = file_name if file_name else f"file{file_ext}"
+        caption = media_caption(display_name, file_data)
         
         if is_private:
             address = f"{ip}:{port}"
@@ -1606,7 +1893,7 @@ class ChatWindow(QWidget):
                 f"<p style='color:#2c3e50;'>{header}</p>"
             )
             self.chat_panels[address].chat_display.append(
-                f"<p style='margin-left:20px;'><img src=':/icons/file.png' width='100' title='{media_name}'/><br/>[文件] {display_name}</p>"
+                f"<p style='margin-left:20px;'><img src=':/icons/file.png' width='100' title='{media_name}'/><br/>[文件] {caption}</p>"
             )
             # 保存文件数据
             self.chat_panels[address].chat_display.media_data[media_name] = {
@@ -1616,18 +1903,58 @@ class ChatWindow(QWidget):
                 'file_name': display_name
             }
         else:
+            panel = self.square_panel(room)  # 聊天室消息显示在该聊天室的面板中
+            if panel is None:
+                return
             header = f"[{timestamp}] {username} ({ip})"
-            self.chat_panels["group"].chat_display.append(
+            panel.chat_display.append(
                 f"<p style='color:#2c3e50;'>{header}</p>"
             )
-            self.chat_panels["group"].chat_display.append(
-                f"<p style='margin-left:20px;'><img src=':/icons/file.png' width='100' title='{media_name}'/><br/>[文件] {display_name}</p>"
+            panel.chat_display.append(
+                f"<p style='margin-left:20px;'><img src=':/icons/file.png' width='100' title='{media_name}'/><br/>[文件] {caption}</p>"
             )
             # 保存文件数据
-            self.chat_panels["group"].chat_display.media_data[media_name] = {
+            panel.chat_display.media_data[media_name] = {
                 'type': 'file',
                 'data': file_data,
                 'ext': file_ext,
                 'file_name': display_name
             }
-                    
+
+    def handle_delivery_status(self, status, ip, port, message_type):
+        """在私聊面板(没有时在广场)显示对方不在线时消息的投递状态"""
+        descriptions = {
+            'queued': f"对方 ({ip}:{port}) 不在线，消息已暂存，将在对方上线时送达",
+            'rejected': f"对方 ({ip}:{port}) 不在线，且离线消息已满，消息未能暂存",
+            'delivered': f"对方 ({ip}:{port}) 已上线，离线消息已送达",
+        }
+        content = descriptions.get(status)
+        if content is None:
+            return
+        panel = self.chat_panels.get(f"{ip}:{port}", self.chat_panels["group"])
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        panel.chat_display.append(
+            f"<p style='color:#7f8c8d;'>[{timestamp}] 【系统消息】</p>"
+        )
+        panel.chat_display.append(
+            f"<p style='margin-left:20px;color:#95a5a6;'>{content}</p>"
+        )
+
+    def handle_server_error(self, code, message_type, reason, retry_after):
+        """在当前聊天面板显示服务器拒绝消息的原因"""
+        content = reason or code
+        if retry_after:
+            content += f"（{retry_after:.1f} 秒后可以再发送）"
+        panel = self.chat_stack.currentWidget() or self.chat_panels["group"]
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        panel.chat_display.append(
+            f"<p style='color:#7f8c8d;'>[{timestamp}] 【系统消息】</p>"
+        )
+        panel.chat_display.append(
+            f"<p style='margin-left:20px;color:#e74c3c;'>{content}</p>"
+        )
+
+    def handle_media_downloaded(self, media_hash, data):
+        """按需下载完成，通知所有聊天面板"""
+        for panel in self.chat_panels.values():
+            panel.chat_display.media_downloaded(media_hash, data)
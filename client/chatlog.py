@@ -0,0 +1,169 @@
+"""日志：由后台线程写出，按事件类型开关和采样，消息内容截断或脱敏
+
+日志调用方只把记录放入队列，格式化之外的工作(写终端、写文件)都在后台线程完成。
+每条日志通过extra指定事件类型，例如 log.debug("...", extra=SEND)，
+运行时可以用configure_event()单独关闭某类事件或只输出其中的一部分。
+"""
+import atexit
+import itertools
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+
+LOGGER_NAME = 'lanchat'
+
+# 事件类型
+CONNECTION = {'event': 'connection'}    # 连接建立和断开
+SESSION = {'event': 'session'}          # 登录和登出
+ROSTER = {'event': 'roster'}            # 完整的在线用户列表，人数多时开销大
+SEND = {'event': 'send'}                # 每一帧的发送
+RECV = {'event': 'recv'}                # 每一帧的接收
+CHAT = {'event': 'chat'}                # 聊天和媒体消息
+TRANSFER = {'event': 'transfer'}        # 分块传输和媒体仓库
+ERROR = {'event': 'error'}              # 各种失败
+
+# 默认配置：每帧的收发和完整用户列表只在DEBUG级别输出
+DEFAULT_CONFIG = {
+    'level': 'INFO',
+    'truncate': 200,            # 文本字段超过该长度时截断
+    'redact_content': False,    # 为True时不输出聊天内容，只输出长度
+    'events': {},               # {事件类型: {'enabled': bool, 'sample': N}}，sample=N表示每N条输出1条
+}
+
+
+class EventFilter(logging.Filter):
+    """按事件类型开关和采样"""
+
+    def __init__(self):
+        super().__init__()
+        self.disabled = set()
+        self.sample = {}
+        self._counters = {}
+
+    def configure(self, event, enabled=None, sample=None):
+        if enabled is not None:
+            if enabled:
+                self.disabled.discard(event)
+            else:
+                self.disabled.add(event)
+        if sample is not None:
+            self.sample[event] = max(1, int(sample))
+            self._counters[event] = itertools.count()
+
+    def reset(self):
+        self.disabled.clear()
+        self.sample.clear()
+        self._counters.clear()
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None:
+            return True
+        if event in self.disabled:
+            return False
+        n = self.sample.get(event, 1)
+        if n > 1:
+            return next(self._counters[event]) % n == 0
+        return True
+
+
+_filter = EventFilter()
+_options = {'truncate': DEFAULT_CONFIG['truncate'], 'redact_content': DEFAULT_CONFIG['redact_content']}
+_listener = None
+
+
+class Redacted:
+    """消息字典的摘要，只有日志真正输出时才生成
+
+    媒体数据只显示字节数，长文本截断，长列表只显示条数。
+    """
+
+    __slots__ = ('message',)
+
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        limit = _options['truncate']
+        parts = []
+        for key, value in list(self.message.items()):
+            if isinstance(value, (bytes, bytearray, memoryview)):
+                text = f"<{len(value)}字节>"
+            elif key == 'content' and _options['redact_content'] and isinstance(value, str):
+                text = f"<{len(value)}字>"
+            elif isinstance(value, str) and len(value) > limit:
+                text = repr(value[:limit]) + f"...<共{len(value)}字>"
+            elif isinstance(value, (list, tuple)) and len(value) > 10:
+                text = f"<{len(value)}项>"
+            else:
+                text = repr(value)
+            parts.append(f"{key}={text}")
+        return '{' + ', '.join(parts) + '}'
+
+
+class Truncated:
+    """单个文本字段，输出时按配置截断或脱敏"""
+
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __str__(self):
+        text = self.text if isinstance(self.text, str) else str(self.text)
+        if _options['redact_content']:
+            return f"<{len(text)}字>"
+        limit = _options['truncate']
+        return text if len(text) <= limit else text[:limit] + f"...<共{len(text)}字>"
+
+
+def get_logger():
+    return logging.getLogger(LOGGER_NAME)
+
+
+def setup_logging(level=None, stream=None):
+    """安装后台写出的日志处理器，重复调用只调整级别"""
+    global _listener
+    logger = get_logger()
+    if _listener is None:
+        records = queue.SimpleQueue()
+        handler = logging.handlers.QueueHandler(records)
+        handler.addFilter(_filter)
+        output = logging.StreamHandler(stream or sys.stdout)
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s', '%H:%M:%S'))
+        _listener = logging.handlers.QueueListener(records, output)
+        _listener.start()
+        atexit.register(_listener.stop)
+        logger.addHandler(handler)
+        logger.propagate = False
+        logger.setLevel(DEFAULT_CONFIG['level'])
+    if level is not None:
+        logger.setLevel(level.upper() if isinstance(level, str) else level)
+    return logger
+
+
+def configure_event(event, enabled=None, sample=None):
+    """运行时开关某类事件或设置采样，event为事件名或上面的事件常量"""
+    if isinstance(event, dict):
+        event = event['event']
+    _filter.configure(event, enabled, sample)
+
+
+def apply_config(config):
+    """应用配置字典，格式同DEFAULT_CONFIG，没有给出的项恢复默认值"""
+    merged = dict(DEFAULT_CONFIG)
+    merged.update(config)
+    get_logger().setLevel(str(merged['level']).upper())
+    _options['truncate'] = int(merged['truncate'])
+    _options['redact_content'] = bool(merged['redact_content'])
+    _filter.reset()
+    for event, settings in (merged.get('events') or {}).items():
+        configure_event(event, settings.get('enabled'), settings.get('sample'))
+
+
+def load_config(path):
+    """从JSON文件读取并应用配置，可以在运行中重复调用"""
+    with open(path, 'r', encoding='utf-8') as f:
+        apply_config(json.load(f))
@@ -1,9 +1,50 @@
+import base64
 import datetime
+import functools
+import itertools
+import logging
+import os
 import socket
-import json
+import struct
+import tempfile
 import threading
+import time
 from PySide6.QtCore import QObject, Signal
 from datetime import datetime
+from chatlog import (CHAT, CONNECTION, ERROR, RECV, ROSTER, SEND, SESSION, TRANSFER, Redacted,
+                     Truncated, get_logger)
+from dispatch import Dispatcher
+from media_cache import MediaCache
+from serializers import CODECS
+from protocol import (MEDIA_FIELDS, MEDIA_MESSAGE_TYPES, MEDIA_REF_TYPES, PROTOCOL_VERSION,
+                      STREAM_CHUNK_SIZE, STREAM_THRESHOLD, SUPPORTED_FEATURES, decode_payload,
+                      encode_frame, is_media_hash, media_reference, recv_exact_into)
+from timers import Liveness, TimerHeap
+
+log = get_logger()
+
+MAX_FRAME_SIZE = 100 * 1024 * 1024   # 单帧最大字节数，超过则认为连接异常
+STREAM_SPOOL_SIZE = 8 * 1024 * 1024  # 分块接收时超过该大小的数据写入临时文件
+MEDIA_REF_MIN_SIZE = 64 * 1024       # 小于该大小的媒体直接发送，不先用哈希询问服务器
+# 收到媒体引用时自动下载的大小上限(字节)，超过的只显示名称和大小，播放或保存时再下载
+AUTO_DOWNLOAD_LIMITS = {
+    'image': 8 * 1024 * 1024,
+    'audio': 4 * 1024 * 1024,
+    'video': 1024 * 1024,
+    'file': 1024 * 1024,
+}
+
+
+class RemoteMedia:
+    """还没有下载的媒体，代替媒体数据随信号发给界面"""
+
+    __slots__ = ('media_hash', 'size', 'thumbnail')
+
+    def __init__(self, media_hash, size, thumbnail=None):
+        self.media_hash = media_hash
+        self.size = size
+        self.thumbnail = thumbnail      # 发送方附带的缩略图(base64编码的JPEG)，可能为None
+
 
 class Client(QObject):
     # 定义信号用于UI更新
@@ -12,12 +53,21 @@ class Client(QObject):
     new_user_login = Signal(str, str, int)  # 新用户登录信号(username, ip, port)
     old_friend_list = Signal(list)  # 已有用户列表信号，携带用户列表
     user_logout = Signal(str, str, int)  # 用户登出信号(username, ip, port)
-    new_message = Signal(str, str, str, str, str)  # 群聊消息信号(username, ip, port, content, timestamp)
+    roster_delta = Signal(list, list)  # 合并后的在线用户变化(joined, left)，元素为{'username', 'address'}
+    room_joined = Signal(str, list)  # 已加入聊天室(room, members)，members元素为{'username', 'address'}
+    room_member = Signal(str, str, str, str, int)  # 聊天室成员变化(room, action, username, ip, port)，action为join/leave
+    room_list = Signal(list)  # 所有聊天室及其人数 [{'room', 'members'}]
+    new_message = Signal(str, str, str, str, str, str)  # 群聊消息信号(username, ip, port, content, timestamp, room)，广场的room为空
     new_private_message = Signal(str, str, str, str, str)  # 私聊消息信号(username, ip, port, content, timestamp)
-    new_image_message = Signal(str, str, str, str, str, str, bool, str)  # 图片消息信号(username, ip, port, image_data, image_ext, timestamp, is_private, file_name)
-    new_video_message = Signal(str, str, str, str, str, str, bool, str)  # 视频消息信号(username, ip, port, video_data, video_ext, timestamp, is_private, file_name)
-    new_file_message = Signal(str, str, str, str, str, str, bool, str)  # 文件消息信号(username, ip, port, file_data, file_ext, timestamp, is_private, file_name)
-    new_audio_message = Signal(str, str, str, str, str, str, bool, str)  # 音频消息信号(username, ip, port, audio_data, audio_ext, timestamp, is_private, file_name)
+    # 媒体数据为bytes(v2协议，原始数据)或str(v1协议，base64编码)
+    new_image_message = Signal(str, str, str, object, str, str, bool, str, str)  # 图片消息信号(username, ip, port, image_data, image_ext, timestamp, is_private, file_name, room)
+    new_video_message = Signal(str, str, str, object, str, str, bool, str, str)  # 视频消息信号(username, ip, port, video_data, video_ext, timestamp, is_private, file_name, room)
+    new_file_message = Signal(str, str, str, object, str, str, bool, str, str)  # 文件消息信号(username, ip, port, file_data, file_ext, timestamp, is_private, file_name, room)
+    new_audio_message = Signal(str, str, str, object, str, str, bool, str, str)  # 音频消息信号(username, ip, port, audio_data, audio_ext, timestamp, is_private, file_name, room)
+    media_downloaded = Signal(str, object)  # 按需下载完成信号(media_hash, 数据)，失败时数据为None
+    history_page = Signal(str, object, list)  # 向前翻页的结果(会话名, 下一页的游标, 消息列表)，游标为None表示没有更早的消息
+    server_error = Signal(str, str, str, float)  # 服务器拒绝了发出的消息(code, message_type, reason, retry_after)
+    delivery_status = Signal(str, str, int, str)  # 私聊消息的投递状态(status, target_ip, target_port, message_type)，status为queued/rejected/delivered
     
     def __init__(self):
         super().__init__()
@@ -28,6 +78,34 @@ class Client(QObject):
         self.server_port = 0      # 服务器端口
         self.local_ip = ""        # 本地IP
         self.local_port = 0       # 本地端口
+        self.protocol = 1         # 发送使用的协议版本，登录后根据服务器回复升级
+        self.transfer_ids = itertools.count(1)  # 分块传输编号
+        self.incoming = {}        # 正在接收的分块传输 {transfer_id: (传输头, 临时文件)}
+        self.features = set()     # 服务器同意的可选功能
+        self.codec = 'json'       # v2帧元数据的编码，登录后使用服务器选定的编码
+        self.media_cache = MediaCache(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media_cache'))
+        self.pending_uploads = {}  # 已发送哈希、等待服务器答复的媒体 {media_hash: [完整消息, ...]}
+        self.waiting_media = {}    # 等待服务器发来数据的媒体引用 {media_hash: [引用消息, ...]}
+        self.auto_download = dict(AUTO_DOWNLOAD_LIMITS)  # 每种媒体自动下载的大小上限
+        self.max_frame_size = MAX_FRAME_SIZE  # 单帧最大字节数，分配接收缓冲区前检查
+        self.history_cursors = {}  # 每个会话向前翻页的游标 {会话名: 序号}，None表示没有更早的消息
+        self.replayed_seqs = set()  # 登录后已回放的消息序号，离线消息中重复的不再显示
+        # 本地的在线用户列表和版本号，重新登录时带上版本号，服务器只回复这之后的变化
+        self.roster = {}          # {(ip, port): 用户名}，按上线顺序
+        self.roster_version = None
+        self.roster_epoch = None
+        self.rooms = set()        # 已加入的聊天室，重新登录后自动重新加入
+        # 心跳和超时(秒)，设为None时不检查。服务器支持heartbeat时，空闲heartbeat_interval后发送ping，
+        # idle_timeout内没有收到任何帧则断开；一帧写入超过write_timeout也断开
+        self.heartbeat_interval = 30.0
+        self.idle_timeout = 90.0
+        self.write_timeout = 30.0
+        self.timers = TimerHeap()  # 'heartbeat'和'write'两个截止时间
+        # 界面线程、接收线程、心跳线程和上传线程都会发送，每帧在锁内整帧写出，不会与其他帧交错
+        self.send_lock = threading.Lock()
+        self.liveness = Liveness(time.monotonic())
+        self.dispatcher = Dispatcher()  # 消息类型到处理函数的表
+        self.register_handlers()
 
     def connect_to_server(self, server_ip, server_port, local_ip, local_port, username):
         """连接到服务器并初始化客户端"""
@@ -43,11 +121,11 @@ class Client(QObject):
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.bind((self.local_ip, self.local_port))
             self.socket.connect((self.server_ip, self.server_port))
+            self.liveness = Liveness(time.monotonic())
+            self.timers.schedule('heartbeat', self.liveness.last_recv + (self.heartbeat_interval or 1.0))
 
-            print(f"客户端启动成功。\n"
-                  f"服务器地址：{self.server_ip}:{self.server_port}\n"
-                  f"本地地址：{self.local_ip}:{self.local_port}\n"
-                  f"用户名: {self.username}")
+            log.info("客户端启动成功。服务器地址：%s:%s 本地地址：%s:%s 用户名: %s", self.server_ip,
+                     self.server_port, self.local_ip, self.local_port, self.username, extra=CONNECTION)
             
             # 发送用登录信息到服务器
             self.send_login()
@@ -57,140 +135,291 @@ class Client(QObject):
             self.receive_thread.daemon = True  # 设置为守护线程
             self.receive_thread.start()
             
+            # 启动心跳线程
+            self.watch_thread = threading.Thread(target=self.watch_connection, args=(self.socket,))
+            self.watch_thread.daemon = True
+            self.watch_thread.start()
+            
             # 发送连接成功信号，触发UI更新
             self.connected.emit()
             
         except Exception as e:
-            print(f"连接失败: {e}")
+            log.error("连接失败: %s", e, extra=ERROR)
             self.stop()
 
     def stop(self):
         """停止客户端连接"""
-        print("\n[客户端关闭]")
-        if hasattr(self, 'username') and self.username:
-            print(f"用户名: {self.username}")
-        if hasattr(self, 'local_ip') and self.local_ip:
-            print(f"本地地址: {self.local_ip}:{self.local_port}")
+        log.info("[客户端关闭] 用户名: %s 本地地址: %s:%s", self.username, self.local_ip, self.local_port,
+                 extra=CONNECTION)
         
         # 发送连接失败信号时附带错误信息
         self.connection_failed.emit("连接已断开")
         if self.socket:
             try:
                 self.socket.close()
-                print("Socket连接已关闭")
+                log.debug("Socket连接已关闭", extra=CONNECTION)
             except Exception as e:
-                print(f"[错误] 关闭Socket失败: {e}")
+                log.warning("[错误] 关闭Socket失败: %s", e, extra=ERROR)
             self.socket = None
 
     def send_message(self, message):
         """发送消息到服务器"""
+        field = MEDIA_FIELDS.get(message.get('type'))
+        if ('media_ref' in self.features and message.get('type') in MEDIA_REF_TYPES
+                and 'media_hash' not in message and message.get(field) is not None
+                and len(message[field]) >= MEDIA_REF_MIN_SIZE):
+            self.offer_media(message, field)
+            return
+        if (self.protocol >= 2 and field and message.get(field) is not None
+                and len(message[field]) > STREAM_THRESHOLD):
+            self.send_stream(message, field)
+            return
         if self.socket:
             try:
-                message_json = json.dumps(message)
-                message_length = len(message_json.encode())
-                
-                # 分两步发送，确保数据完整性
-                length_bytes = message_length.to_bytes(4, 'big')
-                self.socket.sendall(length_bytes)
-                self.socket.sendall(message_json.encode())
+                # 长度前缀和内容一次发送
+                self.write_frame(encode_frame(message, self.protocol, self.codec))
                 
-                print(f"\n[发送消息] 类型: {message.get('type')}")
-                if message.get('type') in ['square_image', 'private_image']:
-                    print("消息内容: [图片数据]")
-                else:
-                    print(f"消息内容: {message}")
+                log.debug("[发送消息] 类型: %s 内容: %s", message.get('type'), Redacted(message), extra=SEND)
             except Exception as e:
-                print(f"[错误] 发送消息失败: {e}")
+                log.warning("[错误] 发送消息失败: %s", e, extra=ERROR)
                 self.stop()
 
+    def offer_media(self, message, field):
+        """先只发送内容哈希，服务器已有该内容时就不必上传"""
+        data = message[field]
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        digest = self.media_cache.put(data)
+        full = dict(message)
+        full[field] = data
+        full['media_hash'] = digest
+        self.pending_uploads.setdefault(digest, []).append(full)
+        
+        reference = media_reference(full)
+        log.info("[发送媒体引用] 类型: %s 哈希: %.16s... 大小: %d字节", message.get('type'), digest, len(data),
+                 extra=TRANSFER)
+        if not self.send_raw(reference):
+            self.pending_uploads.pop(digest, None)
+
+    def send_stream(self, message, field):
+        """把大媒体拆成多个块发送，服务器收到一块转发一块"""
+        data = message[field]
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        view = memoryview(data)
+        transfer_id = next(self.transfer_ids)
+        
+        header = {k: v for k, v in message.items() if k not in ('type', field)}
+        header.update({
+            'type': 'stream_begin',
+            'transfer_id': transfer_id,
+            'media_type': message['type'],
+            'size': len(data),
+        })
+        log.info("[分块发送] 类型: %s 大小: %d字节", message['type'], len(data), extra=TRANSFER)
+        if not self.send_raw(header):
+            return
+        for offset in range(0, len(view), STREAM_CHUNK_SIZE):
+            chunk = {'type': 'stream_chunk', 'transfer_id': transfer_id,
+                     'data': view[offset:offset + STREAM_CHUNK_SIZE]}
+            if not self.send_raw(chunk):
+                return
+        self.send_raw({'type': 'stream_end', 'transfer_id': transfer_id})
+
+    def send_raw(self, message, blocking=True):
+        """按当前协议版本发送一帧，不打印日志，返回是否成功
+
+        blocking为False时其他线程正在写入则不等待，返回False。
+        """
+        if not self.socket:
+            return False
+        try:
+            return self.write_frame(encode_frame(message, self.protocol, self.codec), blocking)
+        except Exception as e:
+            log.warning("[错误] 发送消息失败: %s", e, extra=ERROR)
+            self.stop()
+            return False
+
+    def write_frame(self, data, blocking=True):
+        """在send_lock内把一帧写入socket，写入期间安排写入超时的检查
+
+        sendall可能分多次写出，加锁保证其他线程的帧不会插到这一帧中间。
+        blocking为False且其他线程正在写入时返回False。
+        """
+        if not self.send_lock.acquire(blocking):
+            return False
+        try:
+            started = time.monotonic()
+            self.liveness.write_started = started
+            if self.write_timeout is not None:
+                self.timers.schedule('write', started + self.write_timeout)
+            try:
+                self.socket.sendall(data)
+            finally:
+                self.liveness.write_started = None
+                self.timers.cancel('write')
+        finally:
+            self.send_lock.release()
+        return True
+
+    def watch_connection(self, sock):
+        """心跳线程：每秒(或更早的截止时间)醒来一次，处理到期的心跳检查和写入超时"""
+        while self.socket is sock:
+            deadline = self.timers.next_deadline()
+            time.sleep(1.0 if deadline is None else min(1.0, max(0.0, deadline - time.monotonic())))
+            now = time.monotonic()
+            for key in self.timers.expired(now):
+                if self.socket is not sock:
+                    return
+                if key == 'write':
+                    started = self.liveness.write_started
+                    if started is not None and now - started >= self.write_timeout:
+                        self.drop_connection(sock, f"发送超过 {self.write_timeout:g} 秒")
+                        return
+                elif key == 'heartbeat':
+                    self.check_heartbeat(sock, now)
+
+    def check_heartbeat(self, sock, now):
+        """空闲过久时断开，空闲超过心跳间隔时发送ping，然后安排下一次检查
+
+        服务器不支持heartbeat时不发送ping，也不因空闲断开，只定期检查协商结果。
+        """
+        last_recv = self.liveness.last_recv
+        idle = now - last_recv
+        if 'heartbeat' not in self.features:
+            self.timers.schedule('heartbeat', now + (self.heartbeat_interval or 1.0))
+            return
+        if self.idle_timeout is not None and idle >= self.idle_timeout:
+            self.drop_connection(sock, f"{idle:.0f} 秒没有收到服务器的消息")
+            return
+        deadlines = []
+        if self.heartbeat_interval is not None:
+            if idle >= self.heartbeat_interval:
+                # 心跳线程不等待发送锁，否则写入卡住时无法检查写入超时；正在写入时一秒后再试
+                ping = {'type': 'ping', 'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+                if not self.send_raw(ping, blocking=False):
+                    deadlines.append(now + 1.0)
+            else:
+                deadlines.append(last_recv + self.heartbeat_interval)
+        if self.idle_timeout is not None:
+            deadlines.append(last_recv + self.idle_timeout)
+        if deadlines:
+            self.timers.schedule('heartbeat', min(deadlines))
+
+    def drop_connection(self, sock, reason):
+        """认为连接已断开：关闭socket的读写，接收线程随之退出"""
+        log.warning("[连接超时] %s，断开连接", reason, extra=CONNECTION)
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
     def receive_messages(self):
         """接收服务器消息的循环"""
+        header = bytearray(4)
         while self.socket:
             try:
                 # 接收消息长度
-                length_bytes = self.socket.recv(4)
-                if not length_bytes:
-                    print("[连接断开] 服务器关闭了连接")
+                if not recv_exact_into(self.socket, memoryview(header)):
+                    log.info("[连接断开] 服务器关闭了连接", extra=CONNECTION)
                     break
                     
-                message_length = int.from_bytes(length_bytes, 'big')
-                
-                # 分块接收消息
-                chunks = []
-                bytes_received = 0
-                while bytes_received < message_length:
-                    chunk = self.socket.recv(min(8192, message_length - bytes_received))
-                    if not chunk:
-                        raise ConnectionError("接收消息时连接断开")
-                    chunks.append(chunk)
-                    bytes_received += len(chunk)
+                message_length = int.from_bytes(header, 'big')
+                if message_length > self.max_frame_size:
+                    raise ConnectionError(f"帧长度 {message_length} 超过上限 {self.max_frame_size}")
                 
-                # 组合所有分块
-                message_json = b''.join(chunks).decode()
+                # 按帧长度一次分配，recv_into直接写入，不再拼接分块
+                payload = bytearray(message_length)
+                if not recv_exact_into(self.socket, memoryview(payload)):
+                    raise ConnectionError("接收消息时连接断开")
+                self.liveness.last_recv = time.monotonic()
                 
                 try:
-                    message = json.loads(message_json)
+                    # v1(JSON)和v2(二进制)帧都可以解析
+                    message = decode_payload(payload)
                     # 处理接收到的消息
                     self.process_message(message)
-                except json.JSONDecodeError as e:
-                    print(f"[错误] JSON解析失败: {e}")
+                except (ValueError, struct.error) as e:
+                    log.warning("[错误] 消息解析失败: %s", e, extra=ERROR)
                     continue
                     
             except ConnectionError as e:
-                print(f"[错误] 连接错误: {e}")
+                log.warning("[错误] 连接错误: %s", e, extra=ERROR)
                 break
             except Exception as e:
-                print(f"[错误] 接收消息失败: {e}")
+                log.warning("[错误] 接收消息失败: %s", e, extra=ERROR)
                 break
         
         # 如果循环退出，说明连接已断开
         self.stop()
 
+    def register_handlers(self):
+        """登记中间件和每种消息类型的处理函数，新增消息类型时在这里登记"""
+        dispatcher = self.dispatcher
+        dispatcher.use('log', self.log_received)
+        dispatcher.use('media_ref', self.check_media_ref, types=MEDIA_REF_TYPES)
+
+        dispatcher.route('new_friend_login', self.handle_new_friend_login)
+        dispatcher.route('old_friend_list', self.handle_old_friend_list)
+        dispatcher.route('one_user_logout', self.handle_user_logout)
+        dispatcher.route('roster_delta', self.handle_roster_delta)
+        dispatcher.route('room_joined', self.handle_room_joined)
+        dispatcher.route('room_member', self.handle_room_member)
+        dispatcher.route('room_list', self.handle_room_list)
+        dispatcher.route('square_message', self.handle_square_message)
+        dispatcher.route('private_message', self.handle_private_message)
+        # 8种媒体消息共用一个处理函数，按媒体描述取字段和信号
+        for message_type, (kind, private) in MEDIA_MESSAGE_TYPES.items():
+            dispatcher.route(message_type, functools.partial(self.handle_media, kind=kind, private=private))
+        dispatcher.route('stream_begin', self.handle_stream_begin)
+        dispatcher.route('stream_chunk', self.handle_stream_chunk)
+        dispatcher.route('stream_end', self.handle_stream_end)
+        dispatcher.route('stream_abort', self.handle_stream_abort)
+        dispatcher.route('media_status', self.handle_media_status)
+        dispatcher.route('media_data', self.handle_media_data)
+        dispatcher.route('history', self.handle_history)
+        dispatcher.route('offline', self.handle_offline)
+        dispatcher.route('delivery_status', self.handle_delivery_status)
+        dispatcher.route('ping', self.handle_ping)
+        dispatcher.route('error', self.handle_error)
+        dispatcher.route('pong', self.handle_pong)
+
     def process_message(self, message):
         """处理接收到的消息"""
-        message_type = message.get('type')
-        
-        # 根据消息类型分发处理
-        if message_type == 'new_friend_login':
-            self.handle_new_friend_login(message)
-        elif message_type == 'old_friend_list':
-            self.handle_old_friend_list(message)
-        elif message_type == 'one_user_logout':
-            self.handle_user_logout(message)
-        elif message_type == 'square_message':
-            self.handle_square_message(message)
-        elif message_type == 'private_message':
-            self.handle_private_message(message)
-        elif message_type == 'square_image':
-            self.handle_square_image(message)
-        elif message_type == 'private_image':
-            self.handle_private_image(message)
-        elif message_type == 'square_video':
-            self.handle_square_video(message)
-        elif message_type == 'private_video':
-            self.handle_private_video(message)
-        elif message_type == 'square_file':
-            self.handle_square_file(message)
-        elif message_type == 'private_file':
-            self.handle_private_file(message)
-        elif message_type == 'square_audio':
-            self.handle_square_audio(message)
-        elif message_type == 'private_audio':
-            self.handle_private_audio(message)
+        if not self.dispatcher.dispatch(message):
+            log.debug("未知的消息类型: %s", message.get('type'), extra=RECV)
+
+    def log_received(self, message, route):
+        """中间件：DEBUG级别时输出收到的每一帧"""
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[收到消息] 类型: %s 内容: %s", route.message_type, Redacted(message), extra=RECV)
+        return True
+
+    def check_media_ref(self, message, route):
+        """中间件：带内容哈希的媒体消息先查本地缓存"""
+        if not is_media_hash(message.get('media_hash')):
+            return True
+        return self.resolve_media(message)
 
     def send_login(self):
         """发送登录信息到服务器"""
+        self.replayed_seqs.clear()
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         login_info = {
             "type": "login",
             "username": self.username,
             "local_ip": self.local_ip,
             "local_port": self.local_port,
+            "protocol": PROTOCOL_VERSION,  # 声明支持的最高协议版本
+            "features": list(SUPPORTED_FEATURES),  # 声明支持的可选功能
+            "codecs": list(CODECS),  # 声明支持的元数据编码，按优先顺序
             "timestamp": timestamp
         }
-        print(f"\n[发送登录请求] {timestamp}")
-        print(f"用户名: {self.username}")
-        print(f"本地地址: {self.local_ip}:{self.local_port}")
+        if self.roster_epoch is not None:  # 重新登录时只要求上次看到的版本之后的变化
+            login_info["roster_version"] = self.roster_version
+            login_info["roster_epoch"] = self.roster_epoch
+        log.info("[发送登录请求] %s 用户名: %s 本地地址: %s:%s", timestamp, self.username,
+                 self.local_ip, self.local_port, extra=SESSION)
         self.send_message(login_info)
 
     def send_logout_info(self):
@@ -203,11 +432,25 @@ class Client(QObject):
             "local_port": self.local_port,
             "timestamp": timestamp
         }
-        print(f"\n[发送登出请求] {timestamp}")
-        print(f"用户名: {self.username}")
-        print(f"本地地址: {self.local_ip}:{self.local_port}")
+        log.info("[发送登出请求] %s 用户名: %s 本地地址: %s:%s", timestamp, self.username,
+                 self.local_ip, self.local_port, extra=SESSION)
         self.send_message(logout_info)
 
+    def handle_error(self, message):
+        """服务器拒绝了发出的消息，例如超过发送限额"""
+        code = message.get('code') or ''
+        retry_after = float(message.get('retry_after') or 0)
+        log.warning("[服务器拒绝] %s %s %s，%.1f 秒后可重试", code, message.get('message_type'), message.get('reason'),
+                    retry_after, extra=ERROR)
+        self.server_error.emit(code, message.get('message_type') or '', message.get('reason') or '', retry_after)
+
+    def handle_ping(self, message):
+        """回复服务器的心跳"""
+        self.send_raw({'type': 'pong', 'timestamp': message.get('timestamp')})
+
+    def handle_pong(self, message):
+        """心跳回复，收到帧的时间已在接收循环中记下"""
+
     def handle_new_friend_login(self, message):
         """处理新朋友登录消息"""
         username = message.get('username')
@@ -215,30 +458,108 @@ class Client(QObject):
         local_port = int(message.get('local_port'))
         timestamp = message.get('timestamp')
         
-        print(f"\n[新用户上线] {timestamp}")
-        print(f"用户名: {username}")
-        print(f"地址: {local_ip}:{local_port}")
+        log.info("[新用户上线] %s 用户名: %s 地址: %s:%s", timestamp, username, local_ip, local_port,
+                 extra=SESSION)
+        self.roster.pop((local_ip, local_port), None)
+        self.roster[(local_ip, local_port)] = username
         
         # 发送信号通知UI更新
         self.new_user_login.emit(username, local_ip, local_port)
 
     def handle_old_friend_list(self, message):
-        """处理已有用户列表消息"""
-        users = message.get('users', [])
+        """处理已有用户列表消息，服务器可能只回复上次看到的版本之后的变化(delta)"""
         timestamp = message.get('timestamp')
         
-        print(f"\n[收到用户列表] {timestamp}")
-        print(f"在线用户数: {len(users)}人")
-        for user in users:
-            username = user.get('username')
-            address = user.get('address')
-            if isinstance(address, (list, tuple)) and len(address) >= 2:
-                ip, port = address
-                print(f"- {username} ({ip}:{port})")
+        # 服务器回复的协议版本，旧服务器不带该字段，继续使用v1
+        self.protocol = min(int(message.get('protocol', 1)), PROTOCOL_VERSION)
+        self.features = set(message.get('features') or ()) & set(SUPPORTED_FEATURES)
+        self.codec = message.get('codec') if message.get('codec') in CODECS else 'json'
+        
+        delta = message.get('delta')
+        if delta is not None:
+            self.apply_roster(delta.get('joined') or [], delta.get('left') or [])
+            log.info("[收到用户列表变化] %s 版本 %s -> %s", timestamp, self.roster_version,
+                     message.get('roster_version'), extra=SESSION)
+        else:
+            self.roster = {}
+            self.apply_roster(message.get('users', []), [])
+        self.roster_version = message.get('roster_version')
+        self.roster_epoch = message.get('roster_epoch')
+        users = [{'username': username, 'address': address} for address, username in self.roster.items()]
+        # 重新登录后重新加入之前的聊天室
+        if 'rooms' in self.features:
+            for room in sorted(self.rooms):
+                self.send_message({'type': 'room_join', 'room': room})
+        
+        log.info("[收到用户列表] %s 在线用户数: %d人", timestamp, len(users), extra=SESSION)
+        # 完整列表的输出与在线人数成正比，只在DEBUG级别输出
+        log.debug("在线用户: %s", users, extra=ROSTER)
         
         # 发送信号通知UI更新
         self.old_friend_list.emit(users)
 
+    def handle_roster_delta(self, message):
+        """处理合并后的在线用户变化，已经包含在登录回复中的旧版本跳过"""
+        version = message.get('version')
+        if message.get('epoch') != self.roster_epoch or (self.roster_version is not None
+                                                         and version <= self.roster_version):
+            return
+        joined = message.get('joined') or []
+        left = message.get('left') or []
+        left = self.apply_roster(joined, left)
+        self.roster_version = version
+        log.info("[在线用户变化] %s 上线 %d 人 下线 %d 人", message.get('timestamp'), len(joined), len(left),
+                 extra=SESSION)
+        self.roster_delta.emit(joined, left)
+
+    def apply_roster(self, joined, left):
+        """先移除left再加入joined(同一地址的替换为新的用户名)，返回补全了用户名的left"""
+        removed = []
+        for user in left:
+            address = (user['address'][0], int(user['address'][1]))
+            username = self.roster.pop(address, None)
+            if username is not None:
+                removed.append({'username': user.get('username') or username, 'address': address})
+        for user in joined:
+            address = (user['address'][0], int(user['address'][1]))
+            self.roster.pop(address, None)
+            self.roster[address] = user['username']
+        return removed
+
+    def join_room(self, room):
+        """加入聊天室，服务器回复room_joined后发出room_joined信号"""
+        self.rooms.add(room)
+        self.send_message({'type': 'room_join', 'room': room})
+
+    def leave_room(self, room):
+        """离开聊天室"""
+        self.rooms.discard(room)
+        self.send_message({'type': 'room_leave', 'room': room})
+
+    def request_room_list(self):
+        """请求所有聊天室及其人数，结果由room_list信号发出"""
+        self.send_message({'type': 'room_list'})
+
+    def handle_room_joined(self, message):
+        """已加入聊天室，带有当前的成员列表"""
+        room = message.get('room')
+        members = message.get('members') or []
+        if room not in self.rooms:  # 回复到达前已经离开
+            return
+        log.info("[加入聊天室] %s 成员: %d人", room, len(members), extra=SESSION)
+        self.room_joined.emit(room, members)
+
+    def handle_room_member(self, message):
+        """聊天室中有人加入或离开"""
+        room = message.get('room')
+        ip, port = message.get('address') or (None, 0)
+        log.info("[聊天室成员] %s %s %s (%s:%s)", room, message.get('action'), message.get('username'), ip, port,
+                 extra=SESSION)
+        self.room_member.emit(room, message.get('action') or '', message.get('username') or '', str(ip), int(port))
+
+    def handle_room_list(self, message):
+        self.room_list.emit(message.get('rooms') or [])
+
     def handle_user_logout(self, message):
         """处理用户登出消息"""
         username = message.get('username')
@@ -246,9 +567,9 @@ class Client(QObject):
         local_port = int(message.get('local_port'))
         timestamp = message.get('timestamp')
         
-        print(f"\n[用户离线] {timestamp}")
-        print(f"用户名: {username}")
-        print(f"地址: {local_ip}:{local_port}")
+        log.info("[用户离线] %s 用户名: %s 地址: %s:%s", timestamp, username, local_ip, local_port,
+                 extra=SESSION)
+        self.roster.pop((local_ip, local_port), None)
         
         # 发送信号通知UI更新
         self.user_logout.emit(username, local_ip, local_port)
@@ -261,13 +582,13 @@ class Client(QObject):
         content = message.get('content')
         timestamp = message.get('timestamp')
         
-        print(f"\n[收到广场消息]")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"内容: {content}")
-        print(f"时间: {timestamp}")
+        room = message.get('room') or ''
+        
+        log.info("[收到广场消息] %s 发送者: %s (%s:%s) %s内容: %s", timestamp, username, ip, port,
+                 f"聊天室: {room} " if room else '', Truncated(content), extra=CHAT)
         
         # 发送信号通知UI更新
-        self.new_message.emit(username, ip, port, content, timestamp)
+        self.new_message.emit(username, ip, port, content, timestamp, room)
     
     def handle_private_message(self, message):
         """处理私聊消息"""
@@ -277,150 +598,194 @@ class Client(QObject):
         content = message.get('content')
         timestamp = message.get('timestamp')
         
-        print(f"\n[收到私聊消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"内容: {content}")
+        log.info("[收到私聊消息] %s 发送者: %s (%s:%s) 内容: %s", timestamp, username, ip, port,
+                 Truncated(content), extra=CHAT)
         
         # 发送信号通知UI更新
         self.new_private_message.emit(username, ip, str(port), content, timestamp)
 
-    def handle_square_image(self, message):
-        """处理广场图片���息"""
-        username = message.get('username')
-        ip = message.get('ip')
-        port = message.get('port')
-        image_data = message.get('image_data')
-        image_ext = message.get('image_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
-        
-        print(f"\n[收到广场图片消息]")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"时间: {timestamp}")
-        print(f"文件名: {file_name}")
-        
-        # 发送信号通知UI更新
-        self.new_image_message.emit(username, ip, port, image_data, image_ext, timestamp, False, file_name)
-    
-    def handle_private_image(self, message):
-        """处理私聊图片消息"""
+    def handle_media(self, message, kind, private):
+        """处理图片、视频、文件、音频消息，kind是protocol.MEDIA_KINDS中的媒体描述"""
         username = message.get('username')
         ip = message.get('ip')
         port = message.get('port')
-        image_data = message.get('image_data')
-        image_ext = message.get('image_ext')
+        data = message.get(kind.data_field)
+        ext = message.get(kind.ext_field)
         file_name = message.get('file_name')  # 获取文件名
         timestamp = message.get('timestamp')
         
-        print(f"\n[收到私聊图片消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"文件名: {file_name}")
+        log.info("[收到%s%s消息] %s 发送者: %s (%s:%s) 文件名: %s", '私聊' if private else '广场', kind.label,
+                 timestamp, username, ip, port, file_name, extra=CHAT)
         
         # 发送信号通知UI更新
-        self.new_image_message.emit(username, ip, str(port), image_data, image_ext, timestamp, True, file_name)
+        signal = getattr(self, f'new_{kind.name}_message')
+        signal.emit(username, ip, str(port) if private else port, data, ext, timestamp, private, file_name,
+                    message.get('room') or '')
 
-    def handle_square_video(self, message):
-        """处理广场视频消息"""
-        username = message.get('username')
-        ip = message.get('ip')
-        port = message.get('port')
-        video_data = message.get('video_data')
-        video_ext = message.get('video_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
-        
-        print(f"\n[收到广场视频消息]")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"时间: {timestamp}")
-        print(f"文件名: {file_name}")
-        
-        # 发送信号通知UI更新
-        self.new_video_message.emit(username, ip, port, video_data, video_ext, timestamp, False, file_name)
-    
-    def handle_private_video(self, message):
-        """处理私聊视频消息"""
-        username = message.get('username')
-        ip = message.get('ip')
-        port = message.get('port')
-        video_data = message.get('video_data')
-        video_ext = message.get('video_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
-        
-        print(f"\n[收到私聊视频消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"文件名: {file_name}")
-        
-        # 发送信号通知UI更新
-        self.new_video_message.emit(username, ip, str(port), video_data, video_ext, timestamp, True, file_name)
+    def handle_stream_begin(self, message):
+        """开始接收分块传输，数据先写入临时文件"""
+        transfer_id = message.get('transfer_id')
+        log.info("[开始接收分块传输] 编号: %s 发送者: %s (%s:%s) 类型: %s 大小: %s字节", transfer_id,
+                 message.get('username'), message.get('ip'), message.get('port'),
+                 message.get('media_type'), message.get('size'), extra=TRANSFER)
+        spool = tempfile.SpooledTemporaryFile(max_size=STREAM_SPOOL_SIZE)
+        self.incoming[transfer_id] = (message, spool)
 
-    def handle_square_file(self, message):
-        """处理广场文件消息"""
-        username = message.get('username')
-        ip = message.get('ip')
-        port = message.get('port')
-        file_data = message.get('file_data')
-        file_ext = message.get('file_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
-        
-        print(f"\n[收到广场文件消息]")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"时间: {timestamp}")
-        print(f"文件名: {file_name}")
-        
-        # 发送信号通知UI更新
-        self.new_file_message.emit(username, ip, port, file_data, file_ext, timestamp, False, file_name)
-    
-    def handle_private_file(self, message):
-        """处理私聊文件消息"""
-        username = message.get('username')
-        ip = message.get('ip')
-        port = message.get('port')
-        file_data = message.get('file_data')
-        file_ext = message.get('file_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
-        
-        print(f"\n[收到私聊文件消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"文件名: {file_name}")
+    def handle_stream_chunk(self, message):
+        """写入一块数据"""
+        entry = self.incoming.get(message.get('transfer_id'))
+        if entry:
+            entry[1].write(message.get('data') or b'')
+
+    def handle_stream_end(self, message):
+        """分块传输完成，还原成普通的媒体消息后按原类型处理"""
+        entry = self.incoming.pop(message.get('transfer_id'), None)
+        if not entry:
+            return
+        header, spool = entry
+        spool.seek(0)
+        data = spool.read()
+        spool.close()
         
-        # 发送信号通知UI更新
-        self.new_file_message.emit(username, ip, str(port), file_data, file_ext, timestamp, True, file_name)
+        media_type = header.get('media_type')
+        media_message = {k: v for k, v in header.items()
+                         if k not in ('transfer_id', 'media_type', 'size')}
+        media_message['type'] = media_type
+        media_message[MEDIA_FIELDS[media_type]] = data
+        self.process_message(media_message)
 
-    def handle_square_audio(self, message):
-        """处理广场音频消息"""
-        username = message.get('username')
-        ip = message.get('ip')
-        port = message.get('port')
-        audio_data = message.get('audio_data')
-        audio_ext = message.get('audio_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
+    def handle_stream_abort(self, message):
+        """发送方断开或传输出错，丢弃已收到的数据"""
+        entry = self.incoming.pop(message.get('transfer_id'), None)
+        if entry:
+            entry[1].close()
+            log.info("[分块传输中止] 编号: %s", message.get('transfer_id'), extra=TRANSFER)
+
+    def handle_history(self, message):
+        """处理登录后的最近消息回放和向前翻页的结果"""
+        conversation = message.get('conversation')
+        messages = message.get('messages') or []
+        cursor = message.get('cursor')
+        self.history_cursors[conversation] = cursor
+        log.info("[历史消息] 会话: %s %d 条", conversation, len(messages), extra=CHAT)
+        if not message.get('replay'):
+            self.history_page.emit(conversation, cursor, messages)
+            return
+        # 回放的消息按收到新消息的方式显示
+        me = f"{self.local_ip}:{self.local_port}"
+        for item in messages:
+            if item.get('seq') is not None:
+                self.replayed_seqs.add(item['seq'])
+            if item.get('target_ip') is not None and f"{item.get('ip')}:{item.get('port')}" == me:
+                # 自己发出的私聊消息显示在对方的会话中
+                item = dict(item, ip=item['target_ip'], port=item['target_port'])
+            self.process_message(item)
+
+    def handle_offline(self, message):
+        """处理登录时收到的离线消息，已经在回放中显示过的跳过"""
+        messages = message.get('messages') or []
+        log.info("[离线消息] %d 条", len(messages), extra=CHAT)
+        for item in messages:
+            if item.get('seq') is not None and item['seq'] in self.replayed_seqs:
+                continue
+            self.process_message(item)
+        self.replayed_seqs.clear()
+
+    def handle_delivery_status(self, message):
+        """处理私聊消息的投递状态：对方不在线时已暂存或无法暂存，对方上线后已送达"""
+        status = message.get('status')
+        target_ip = message.get('target_ip')
+        target_port = message.get('target_port')
+        log.info("[投递状态] %s -> %s:%s %s %s条", message.get('message_type'), target_ip, target_port, status,
+                 message.get('count', 1), extra=CHAT)
+        self.delivery_status.emit(status or '', str(target_ip), int(target_port or 0), message.get('message_type') or '')
+
+    def request_history(self, conversation, limit=50):
+        """请求会话中更早的消息，结果由history_page信号发出；返回False表示没有更早的消息"""
+        if conversation in self.history_cursors and self.history_cursors[conversation] is None:
+            return False
+        self.send_message({
+            'type': 'history_request',
+            'conversation': conversation,
+            'before': self.history_cursors.get(conversation),
+            'limit': limit,
+        })
+        return True
+
+    def resolve_media(self, message):
+        """处理带有内容哈希的媒体消息，返回False表示数据还没有到，稍后再处理
+
+        带数据的消息存入本地缓存；只带哈希的引用先查缓存，没有则向服务器索取。
+        """
+        field = MEDIA_FIELDS[message['type']]
+        digest = message['media_hash']
+        data = message.get(field)
+        if data is not None:
+            self.media_cache.put(base64.b64decode(data) if isinstance(data, str) else data, digest)
+            return True
         
-        print(f"\n[收到广场音频消息]")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"时间: {timestamp}")
-        print(f"文件名: {file_name}")
+        data = self.media_cache.get(digest)
+        if data is not None:
+            message[field] = data
+            return True
         
-        # 发送信号通知UI更新
-        self.new_audio_message.emit(username, ip, port, audio_data, audio_ext, timestamp, False, file_name)
-    
-    def handle_private_audio(self, message):
-        """处理私聊音频消息"""
-        username = message.get('username')
-        ip = message.get('ip')
-        port = message.get('port')
-        audio_data = message.get('audio_data')
-        audio_ext = message.get('audio_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
+        # 超过自动下载上限的媒体先只把名称、大小交给界面
+        kind = message['type'].split('_', 1)[1]
+        size = message.get('media_size')
+        if isinstance(size, int) and size > self.auto_download.get(kind, 0):
+            message[field] = RemoteMedia(digest, size, message.get('thumbnail'))
+            return True
         
-        print(f"\n[收到私聊音频消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"文件名: {file_name}")
+        waiting = self.waiting_media.setdefault(digest, [])
+        waiting.append(message)
+        if len(waiting) == 1:
+            self.send_raw({'type': 'media_fetch', 'media_hash': digest})
+        return False
+
+    def handle_media_status(self, message):
+        """服务器对媒体引用的答复，没有该内容时上传完整数据"""
+        digest = message.get('media_hash')
+        pending = self.pending_uploads.get(digest)
+        if not pending:
+            return
+        full = pending.pop(0)
+        if not pending:
+            del self.pending_uploads[digest]
         
-        # 发送信号通知UI更新
-        self.new_audio_message.emit(username, ip, str(port), audio_data, audio_ext, timestamp, True, file_name)
+        if message.get('present'):
+            log.info("[媒体去重] 服务器已有 %.16s...，跳过上传", digest, extra=TRANSFER)
+        else:
+            log.info("[媒体上传] 服务器没有 %.16s...，上传完整数据", digest, extra=TRANSFER)
+            # 在上传线程中发送，接收线程不会被几MB的上传阻塞
+            upload_thread = threading.Thread(target=self.send_message, args=(full,))
+            upload_thread.daemon = True
+            upload_thread.start()
+
+    def download_media(self, digest):
+        """按需下载媒体，完成后发出media_downloaded信号"""
+        data = self.media_cache.get(digest)
+        if data is not None:
+            self.media_downloaded.emit(digest, data)
+            return
+        if digest not in self.waiting_media:
+            self.waiting_media[digest] = []
+            log.info("[下载媒体] %.16s...", digest, extra=TRANSFER)
+            self.send_raw({'type': 'media_fetch', 'media_hash': digest})
 
+    def handle_media_data(self, message):
+        """收到索取的媒体数据，补全等待中的消息后按原类型处理"""
+        digest = message.get('media_hash')
+        waiting = self.waiting_media.pop(digest, [])
+        data = message.get('data')
+        if data is None:
+            log.warning("[错误] 服务器上已没有 %s，丢弃 %d 条消息", digest, len(waiting), extra=ERROR)
+            self.media_downloaded.emit(digest, None)
+            return
+        if self.media_cache.put(data, digest) != digest:
+            log.warning("[错误] 收到的数据与哈希 %.16s... 不一致，已丢弃", digest, extra=ERROR)
+            self.media_downloaded.emit(digest, None)
+            return
+        self.media_downloaded.emit(digest, data)
+        for media_message in waiting:
+            media_message[MEDIA_FIELDS[media_message['type']]] = data
+            self.process_message(media_message)
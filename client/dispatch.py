@@ -0,0 +1,81 @@
+"""按消息类型分发
+
+每种消息类型登记一个Route(处理函数和选项)，中间件按登记顺序对所有类型或指定的类型生效。
+分发时依次执行中间件，任何一个返回False就不再继续；最后调用处理函数。
+设置了observe时分别记录每个中间件和处理函数的耗时，新增消息类型只需要登记，不需要修改分发循环。
+服务端和客户端使用同一份代码：dispatch的参数原样传给中间件和处理函数，最后一个是消息，
+服务端为(conn, message)，客户端只有一个连接，为(message)。
+"""
+import time
+
+
+class Route:
+    """一种消息类型的处理方式
+
+    login_required: 是否只接受已登录连接发来的消息
+    size_field: 受大小限制的字段(文本内容或媒体数据)，上限由size_limit中间件决定
+    """
+
+    __slots__ = ('message_type', 'handler', 'login_required', 'size_field')
+
+    def __init__(self, message_type, handler, login_required=True, size_field=None):
+        self.message_type = message_type
+        self.handler = handler          # handler(*args)，args为dispatch的参数
+        self.login_required = login_required
+        self.size_field = size_field
+
+
+class Dispatcher:
+    """消息类型到处理函数的表，以及中间件链"""
+
+    def __init__(self, observe=None):
+        self.routes = {}        # {消息类型: Route}
+        self.middleware = []    # [(名称, 函数, 生效的消息类型集合，None表示全部)]
+        self.observe = observe  # observe(阶段名称, 秒)，为None时不计时
+        self._chains = {}       # {消息类型: ((名称, 函数), ...)}，登记变化时清空
+
+    def route(self, message_type, handler, **options):
+        """登记消息类型的处理函数，重复登记时替换"""
+        self.routes[message_type] = Route(message_type, handler, **options)
+        self._chains.clear()
+
+    def use(self, name, middleware, types=None):
+        """登记中间件middleware(*args, route) -> bool，返回False时停止分发"""
+        self.middleware.append((name, middleware, frozenset(types) if types is not None else None))
+        self._chains.clear()
+
+    def chain(self, message_type):
+        """对该消息类型生效的中间件"""
+        stages = self._chains.get(message_type)
+        if stages is None:
+            stages = tuple((name, fn) for name, fn, types in self.middleware
+                           if types is None or message_type in types)
+            self._chains[message_type] = stages
+        return stages
+
+    def dispatch(self, *args):
+        """分发一条消息(最后一个参数)，返回False表示没有登记该消息类型"""
+        route = self.routes.get(args[-1].get('type'))
+        if route is None:
+            return False
+        stages = self.chain(route.message_type)
+        observe = self.observe
+        if observe is None:
+            for _, fn in stages:
+                if not fn(*args, route):
+                    return True
+            route.handler(*args)
+            return True
+
+        for name, fn in stages:
+            started = time.perf_counter()
+            proceed = fn(*args, route)
+            observe(name, time.perf_counter() - started)
+            if not proceed:
+                return True
+        started = time.perf_counter()
+        try:
+            route.handler(*args)
+        finally:
+            observe('handler', time.perf_counter() - started)
+        return True
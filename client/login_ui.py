@@ -4,15 +4,19 @@ from PySide6.QtWidgets import (QWidget, QLineEdit, QPushButton,
 from PySide6.QtCore import Qt
 import json
 import os
-from client import Client
+from chatlog import ERROR, apply_config, get_logger
+from client import AUTO_DOWNLOAD_LIMITS, MAX_FRAME_SIZE, Client
 from chat_ui import ChatWindow
 
+log = get_logger()
+
 class LoginWindow(QWidget):
     def __init__(self):
         super().__init__()
         self.config_file = os.path.join(os.path.dirname(__file__), 'conf.json')
         self.client = Client()
         self.chat_window = None
+        self.log_config = {}  # 日志配置，格式见chatlog.DEFAULT_CONFIG
         self.initUI()
         self.load_config()
         self.setup_connections()
@@ -215,7 +219,13 @@ class LoginWindow(QWidget):
             'server_port': '8000',
             'local_ip': '127.0.0.1',
             'local_port': '8001',
-            'username': 'username'
+            'username': 'username',
+            # 收到媒体时自动下载的大小上限(KB)，超过的在播放或保存时再下载
+            'auto_download_kb': {kind: limit // 1024 for kind, limit in AUTO_DOWNLOAD_LIMITS.items()},
+            # 从服务器接收的单帧大小上限(MB)，超过则断开连接
+            'max_frame_mb': MAX_FRAME_SIZE // (1024 * 1024),
+            # 日志级别和按事件类型的开关、采样，点击重置时重新加载
+            'log': {'level': 'INFO', 'events': {}}
         }
     
     def load_config(self):
@@ -236,9 +246,15 @@ class LoginWindow(QWidget):
             self.local_ip.setText(config.get('local_ip'))
             self.local_port.setText(config.get('local_port'))
             self.username.setText(config.get('username'))
+            self.apply_auto_download(config.get('auto_download_kb'))
+            if isinstance(config.get('max_frame_mb'), (int, float)) and config['max_frame_mb'] > 0:
+                self.client.max_frame_size = int(config['max_frame_mb'] * 1024 * 1024)
+            if isinstance(config.get('log'), dict):
+                self.log_config = config['log']
+                apply_config(self.log_config)
             
         except Exception as e:
-            print(f"加载配置文件失败: {e}")
+            log.error("加载配置文件失败: %s", e, extra=ERROR)
             # 加载失败时使用默认值
             config = self.get_default_config()
             self.server_ip.setText(config['server_ip'])
@@ -247,6 +263,14 @@ class LoginWindow(QWidget):
             self.local_port.setText(config['local_port'])
             self.username.setText(config['username'])
     
+    def apply_auto_download(self, limits_kb):
+        """按配置设置每种媒体自动下载的大小上限"""
+        if not isinstance(limits_kb, dict):
+            return
+        for kind, limit in limits_kb.items():
+            if kind in self.client.auto_download and isinstance(limit, (int, float)):
+                self.client.auto_download[kind] = int(limit * 1024)
+    
     def save_config(self):
         """保存当前配置到文件"""
         config = {
@@ -254,11 +278,14 @@ class LoginWindow(QWidget):
             'server_port': self.server_port.text(),
             'local_ip': self.local_ip.text(),
             'local_port': self.local_port.text(),
-            'username': self.username.text()
+            'username': self.username.text(),
+            'auto_download_kb': {kind: limit // 1024 for kind, limit in self.client.auto_download.items()},
+            'max_frame_mb': self.client.max_frame_size // (1024 * 1024),
+            'log': self.log_config
         }
         
         try:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(config, f, ensure_ascii=False, indent=4)
         except Exception as e:
-            print(f"保存配置文件败: {e}") 
\ No newline at end of file
+            log.error("保存配置文件败: %s", e, extra=ERROR) 
\ No newline at end of file
@@ -1,8 +1,10 @@
 import sys
 from PySide6.QtWidgets import QApplication
+from chatlog import setup_logging
 from login_ui import LoginWindow
 
 def main():
+    setup_logging()  # 日志由后台线程写出，不阻塞界面线程和接收线程
     app = QApplication(sys.argv)
     login_window = LoginWindow()
     login_window.show()
@@ -0,0 +1,88 @@
+import os
+import threading
+from collections import OrderedDict
+
+from protocol import media_hash
+
+
+class MediaCache:
+    """客户端本地的媒体缓存，按内容哈希保存收到和发出的媒体
+
+    收到只带哈希的媒体引用时先查缓存，命中则不必向服务器索取。
+    总大小超过quota_bytes时按最近最少使用淘汰。
+    """
+
+    def __init__(self, directory, quota_bytes=512 * 1024 * 1024):
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        self._index = None              # {哈希: 字节数}，末尾是最近使用的，第一次使用时加载
+        self.bytes_stored = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def _load(self):
+        if self._index is not None:
+            return
+        self._index = OrderedDict()
+        if not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            st = os.stat(self._path(name))
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, digest, size in sorted(entries):
+            self._index[digest] = size
+            self.bytes_stored += size
+
+    def get(self, digest):
+        """返回缓存的数据，不存在返回None"""
+        with self._lock:
+            self._load()
+            if digest not in self._index:
+                return None
+            self._index.move_to_end(digest)
+        try:
+            with open(self._path(digest), 'rb') as f:
+                return f.read()
+        except OSError:
+            with self._lock:
+                self.bytes_stored -= self._index.pop(digest, 0)
+            return None
+
+    def put(self, data, digest=None):
+        """保存数据并返回实际的内容哈希
+
+        digest是对端声明的哈希，已缓存时只更新使用顺序；否则重新计算哈希，
+        数据按实际哈希保存，声明错误的数据不会占用别的哈希。
+        """
+        with self._lock:
+            self._load()
+            if digest in self._index:
+                self._index.move_to_end(digest)
+                return digest
+        digest = media_hash(data)
+        with self._lock:
+            if digest in self._index:
+                self._index.move_to_end(digest)
+                return digest
+            if len(data) > self.quota_bytes:
+                return digest
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = os.path.join(self.directory, '.' + digest)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(digest))
+            self._index[digest] = len(data)
+            self.bytes_stored += len(data)
+            while self.bytes_stored > self.quota_bytes:
+                old, size = self._index.popitem(last=False)
+                self.bytes_stored -= size
+                try:
+                    os.unlink(self._path(old))
+                except OSError:
+                    pass
+        return digest
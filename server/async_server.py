@@ -0,0 +1,422 @@
+import asyncio
+import concurrent.futures
+import os
+import socket
+import struct
+import time
+
+from chatlog import CONNECTION, ERROR, get_logger
+from metrics import CONNECTIONS, SEND_FAILURES
+from outbound import AsyncOutboundQueue
+from protocol import MEDIA_MESSAGE_TYPES, decode_payload
+from server import MAX_FRAME_SIZE, ChatServer
+
+log = get_logger()
+
+# 处理时会读写磁盘的消息类型(媒体仓库、消息历史、离线队列)，放到I/O线程池中处理，不阻塞事件循环
+IO_MESSAGE_TYPES = frozenset(MEDIA_MESSAGE_TYPES) | {
+    'login', 'square_message', 'private_message', 'room_join', 'history_request', 'media_fetch',
+    'stream_begin', 'stream_chunk', 'stream_end',
+}
+
+
+def new_event_loop():
+    """创建事件循环，安装了uvloop时优先使用uvloop"""
+    try:
+        import uvloop
+    except ImportError:
+        return asyncio.new_event_loop()
+    return uvloop.new_event_loop()
+
+
+class StreamConnection:
+    """把asyncio的传输包装成socket风格的接口，使ChatServer的handle_*可以直接复用
+
+    收到的字节放在自己的缓冲区中，读协程从中按帧取出；交接时没有处理的字节连同连接交给新进程。
+    """
+
+    def __init__(self, loop, held=False, limit=64 * 1024):
+        self.loop = loop
+        self.writer = None
+        self.limit = limit              # 缓冲区超过两倍时暂停读取，读协程取走数据后恢复
+        self.buffer = bytearray()       # 已经收到、读协程还没有取出的字节
+        self.unprocessed = ()           # 已经取出但还没有处理的长度前缀和消息体
+        self.held = held                # 冻结和接管期间不读取，读协程等待数据时也不恢复
+        self.paused = False             # 因缓冲区过大暂停了读取
+        self.eof = False
+        self.error = None               # 连接异常断开时的异常
+        self._waiter = None
+
+    def feed(self, data):
+        self.buffer += data
+        self._wake()
+        if len(self.buffer) > 2 * self.limit and not self.paused:
+            self.paused = True
+            self.writer.transport.pause_reading()
+
+    def feed_eof(self, error=None):
+        self.eof = True
+        self.error = self.error or error
+        self._wake()
+
+    def _wake(self):
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def readexactly(self, n):
+        """取出n个字节，连接在此之前断开时抛出异常"""
+        while len(self.buffer) < n:
+            if self.eof:
+                if self.error is not None:
+                    raise self.error
+                raise asyncio.IncompleteReadError(bytes(self.buffer), n)
+            if self.paused and not self.held:
+                self.paused = False     # 要读取的帧比缓冲区上限大
+                self.writer.transport.resume_reading()
+            self._waiter = self.loop.create_future()
+            await self._waiter
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        if self.paused and not self.held and len(self.buffer) <= self.limit:
+            self.paused = False
+            self.writer.transport.resume_reading()
+        return data
+
+    def hold(self):
+        """冻结：不再从socket读取，已经收到的字节留在缓冲区中"""
+        self.held = True
+        self.writer.transport.pause_reading()
+
+    def release(self):
+        self.held = False
+        self.paused = False
+        self.writer.transport.resume_reading()
+
+    def sendall(self, data):
+        # write只把数据放入传输层缓冲区，不会阻塞事件循环
+        self.writer.write(data)
+
+    def send(self, data):
+        self.writer.write(data)
+        return len(data)
+
+    def close(self):
+        self._call(self.writer.close)
+
+    def shutdown(self, how):
+        # 超时断开：丢弃缓冲区中未发送的数据，读协程随之收到连接断开
+        self._call(self.writer.transport.abort)
+
+    def _call(self, fn):
+        """传输只能在事件循环中操作，I/O线程中的处理函数断开连接时交给事件循环执行"""
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            fn()
+        elif not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(fn)
+
+    def getpeername(self):
+        return self.writer.get_extra_info('peername')
+
+
+class ConnectionProtocol(asyncio.StreamReaderProtocol):
+    """收到的数据交给StreamConnection，写入和drain沿用StreamReaderProtocol的流量控制"""
+
+    def __init__(self, conn, connected=None):
+        self.reader = asyncio.StreamReader(loop=conn.loop)  # 只用于StreamWriter，不经过它读取
+        super().__init__(self.reader, loop=conn.loop)
+        self.conn = conn
+        self.connected = connected      # 连接建立后以conn调用
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        self.conn.writer = asyncio.StreamWriter(transport, self, self.reader, self.conn.loop)
+        if self.conn.held:
+            transport.pause_reading()   # 从旧进程接管的连接：旧进程确认交接之前不读取
+        if self.connected is not None:
+            self.connected(self.conn)
+
+    def data_received(self, data):
+        self.conn.feed(data)
+
+    def eof_received(self):
+        self.conn.feed_eof()
+        return super().eof_received()
+
+    def connection_lost(self, exc):
+        self.conn.feed_eof(exc)
+        super().connection_lost(exc)
+
+
+class AsyncChatServer(ChatServer):
+    """基于asyncio的服务器引擎，每个连接是一个协程而不是一个线程"""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        super().__init__(max_frame_size)
+        self.loop = None
+        self.async_servers = []     # 同时监听多个地址(例如IPv4和IPv6)时有多个socket
+        self.listeners = []         # 冻结期间保留的监听socket(asyncio的Server关闭后仍可交出或恢复监听)
+        self.io_threads = 4         # 处理读写磁盘的消息的线程数
+        self.io_executor = None
+
+    def start(self, host='172.20.10.4', port=8000):
+        """启动服务器并开始监听连接"""
+        self.host = host
+        self.port = port
+        self.loop = new_event_loop()
+        try:
+            self.loop.run_until_complete(self.serve())
+        except KeyboardInterrupt:
+            log.info("正在关闭服务器...")
+        except Exception as e:
+            log.error("服务器启动失败: %s", e, extra=ERROR)
+        finally:
+            self.stop()
+            self.loop.close()
+
+    async def serve(self):
+        """监听端口并持续运行直到stop()被调用"""
+        self.thawed = asyncio.Event()  # asyncio引擎中读协程在其上等待解冻
+        self.thawed.set()
+        self.io_executor = concurrent.futures.ThreadPoolExecutor(self.io_threads, thread_name_prefix='io')
+        takeover = self.receive_handoff() if self.takeover else None
+        adopted = []
+        if takeover is not None:
+            # 恢复所有会话，旧进程确认后才接受新连接、开始读取
+            self.restore_state(takeover.state)
+            adopted = [await self.adopt_connection_async(sock, record, pending)
+                       for sock, record, pending in takeover.connections]
+            self.finish_takeover(takeover)
+            # 沿用旧进程的所有监听socket，监听队列中等待的连接不会丢失
+            self.listeners = takeover.listeners
+            await self.listen_again()
+            self.host, self.port = takeover.listeners[0].getsockname()[:2]
+        else:
+            self.async_servers = [await self.loop.create_server(
+                self.new_protocol, self.host, self.port,
+                reuse_address=True, reuse_port=self.reuse_port or None, backlog=self.backlog
+            )]
+        self.running = True
+        log.info("服务器启动成功(asyncio) - %s:%s", self.host, self.port)
+        for conn in adopted:
+            conn.release()
+            self.loop.create_task(self.handle_connection(conn))
+        self.start_metrics()
+        self.start_links()
+        self.start_handoff()
+        while self.running:
+            await asyncio.sleep(self.timer_delay())  # 定期检查running状态和到期的定时器
+            if not self.frozen:
+                self.check_timers()
+
+    def new_protocol(self):
+        return ConnectionProtocol(StreamConnection(self.loop), self.accept_connection)
+
+    def accept_connection(self, conn):
+        """新的客户端连接：创建发送队列，启动读协程"""
+        self.open_connection(conn)
+        self.metrics.incr(CONNECTIONS)
+        log.info("[新连接] 地址: %s", conn.getpeername(), extra=CONNECTION)
+        self.loop.create_task(self.handle_connection(conn))
+
+    async def adopt_connection_async(self, sock, record, pending):
+        """恢复一个交接过来的连接，旧进程已读出的字节先放入缓冲区；确认交接之前不读取"""
+        conn = StreamConnection(self.loop, held=True)
+        conn.buffer += pending
+        await self.loop.connect_accepted_socket(lambda: ConnectionProtocol(conn), sock)
+        self.open_connection(conn)
+        self.restore_session(conn, record)
+        return conn
+
+    def call_soon(self, fn, *args):
+        """链路的读线程收到的帧交给事件循环处理"""
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(fn, *args)
+
+    async def handle_connection(self, conn):
+        """接收并处理单个客户端的消息"""
+        address = conn.getpeername()
+        state = self.liveness[conn]
+        try:
+            while self.running:
+                try:
+                    length_bytes = await conn.readexactly(4)
+                except asyncio.IncompleteReadError:
+                    log.info("[连接断开] %s 客户端主动断开连接", address, extra=CONNECTION)
+                    break
+                conn.unprocessed = (length_bytes,)
+                message_length = int.from_bytes(length_bytes, 'big')
+                if message_length > self.max_frame_size:
+                    log.warning("[错误] 帧长度 %d 超过上限 %d，断开连接", message_length,
+                                self.max_frame_size, extra=ERROR)
+                    break
+                payload = await conn.readexactly(message_length)
+                conn.unprocessed = (length_bytes, payload)
+                if self.frozen:
+                    # 冻结后读出的帧不处理：交接时连同缓冲区中的数据交给新进程，交接失败解冻后再处理
+                    await self.thawed.wait()
+                    if not self.running:
+                        break
+                conn.unprocessed = ()
+                state.last_recv = time.monotonic()
+
+                try:
+                    # readexactly每帧返回新的bytes，v2消息体直接以memoryview切片转发
+                    message = decode_payload(payload, copy_body=False)
+                    self.metrics.frame_in(message.get('type'), message_length + 4)
+
+                    if message.get('type') in IO_MESSAGE_TYPES:
+                        await self.process_offloaded(conn, message)
+                    else:
+                        self.process_message(conn, message)
+                except (ValueError, struct.error) as e:
+                    log.warning("[错误] 消息解析失败: %s 原始消息: %r...", e, payload[:200], extra=ERROR)
+                    continue
+        except asyncio.IncompleteReadError:
+            log.info("[错误] %s 接收消息时连接断开", address, extra=CONNECTION)
+        except ConnectionResetError:
+            log.info("[错误] %s 客户端异常断开连接", address, extra=CONNECTION)
+        except Exception as e:
+            log.warning("[错误] 接收消息时发生错误: %s", e, extra=ERROR)
+        finally:
+            if self.frozen:
+                await self.thawed.wait()  # 冻结期间断开的连接留给接管的进程处理登出
+            self.handle_logout(conn)
+            self.close_connection(conn)
+            conn.close()
+
+    async def process_offloaded(self, conn, message):
+        """在I/O线程中处理一帧；等它处理完再读下一帧，同一连接的消息仍按顺序处理
+
+        处理期间登记在reading中，冻结时等它完成后再交接。
+        """
+        self.reading.add(conn)
+        try:
+            await self.loop.run_in_executor(self.io_executor, self.process_message, conn, message)
+        finally:
+            self.reading.discard(conn)
+
+    def open_connection(self, conn):
+        """为新连接创建发送队列，并启动专属的写协程"""
+        queue = AsyncOutboundQueue(self.outbound_policy, self.loop)
+        self.outbound[conn] = queue
+        self.watch_connection(conn)
+        self.loop.create_task(self.write_messages_async(conn, queue))
+        return queue
+
+    async def write_messages_async(self, conn, queue):
+        """写协程：依次把发送队列中的帧写入连接，并等待缓冲区排空，期间记下开始时间供超时检查"""
+        state = self.liveness.get(conn)
+        while True:
+            parts = await queue.get_async()
+            if parts is None:
+                break
+            try:
+                if state is not None:
+                    state.write_started = time.monotonic()
+                conn.writer.writelines(parts)
+                await conn.writer.drain()
+                if state is not None:
+                    state.write_started = None
+            except Exception as e:
+                if not queue.closed:
+                    log.warning("[错误] 发送消息失败: %s", e, extra=ERROR)
+                    self.metrics.incr(SEND_FAILURES)
+                    self.handle_logout(conn)
+                break
+
+    def run_in_loop(self, fn, *args):
+        """在事件循环中调用fn并等待结果，交接线程通过它访问服务器状态"""
+        async def call():
+            return fn(*args)
+        return asyncio.run_coroutine_threadsafe(call(), self.loop).result()
+
+    def quiesce(self, timeout, close_listener=False):
+        return asyncio.run_coroutine_threadsafe(self.quiesce_async(timeout, close_listener), self.loop).result()
+
+    async def quiesce_async(self, timeout, close_listener):
+        """与ChatServer.quiesce相同，在事件循环中等待发送队列和传输层的缓冲区写完"""
+        deadline = time.monotonic() + timeout
+        busy = self.freeze(deadline, close_listener)
+        while self.reading and time.monotonic() < deadline:
+            await asyncio.sleep(0.005)  # I/O线程中正在处理的帧
+        busy |= set(self.reading)
+        self.settle()
+        while self.unflushed() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        return busy | self.unflushed()
+
+    def freeze(self, deadline, close_listener):
+        """暂停所有连接的读取并关闭asyncio的Server；I/O线程中正在处理的帧由quiesce_async等待"""
+        self.frozen = True
+        self.thawed.clear()
+        for conn in list(self.outbound):
+            conn.hold()
+        for server in self.async_servers:
+            if not close_listener:
+                # Server.close()会关闭监听socket，先复制一份，交接时交出，交接失败时重新监听
+                self.listeners += [socket.socket(listener.family, listener.type, fileno=os.dup(listener.fileno()))
+                                   for listener in server.sockets]
+            server.close()
+        self.async_servers = []
+        return set()
+
+    def thaw(self):
+        self.frozen = False
+        if self.thawed is not None:
+            self.thawed.set()
+
+    def unflushed(self):
+        """除了发送队列，transport的缓冲区中也不能有没写出的数据"""
+        return super().unflushed() | {conn for conn in list(self.outbound)
+                                      if conn.writer.transport.get_write_buffer_size()}
+
+    def connection_fd(self, conn):
+        return conn.writer.get_extra_info('socket').fileno()
+
+    def pending_input(self, conn):
+        """冻结时已经取出的长度前缀和消息体，以及缓冲区中的其余数据；之后收到的数据留在socket中"""
+        return b''.join(conn.unprocessed) + bytes(conn.buffer)
+
+    def export_state(self, busy):
+        return self.run_in_loop(super().export_state, busy)
+
+    def listener_fds(self):
+        return [listener.fileno() for listener in self.listeners]
+
+    def resume(self):
+        self.run_in_loop(self.resume_in_loop)
+
+    def resume_in_loop(self):
+        """交接失败：恢复读取，用保留的监听socket重新开始接受连接"""
+        for conn in list(self.outbound):
+            conn.release()
+        self.loop.create_task(self.listen_again())
+        super().resume()
+
+    async def listen_again(self):
+        listeners, self.listeners = self.listeners, []
+        for listener in listeners:
+            self.async_servers.append(await self.loop.create_server(self.new_protocol, sock=listener,
+                                                                    backlog=self.backlog))
+
+    def finish_handoff(self):
+        self.run_in_loop(super().finish_handoff)
+
+    def stop(self):
+        """停止服务器"""
+        for server in self.async_servers:
+            server.close()
+        self.async_servers = []
+        for listener in self.listeners:
+            listener.close()
+        self.listeners = []
+        if self.io_executor is not None:
+            # 等I/O线程中的帧处理完，再关闭消息历史等
+            self.io_executor.shutdown(wait=True)
+            self.io_executor = None
+        super().stop()
@@ -0,0 +1,209 @@
+"""本机进程间的消息总线：多进程模式下各个工作进程通过父进程中的BusHub交换消息
+
+每个工作进程用一个Unix socket连接BusHub。总线上的一帧为：
+    [4字节长度][4字节头部长度][头部JSON][可选：一帧v2聊天消息，带自己的4字节长度前缀]
+头部是{'op': 操作, 'from': 发送方分片, 'to': 接收方分片或None(其余所有分片), ...}。
+BusHub只解析头部，按to把整帧原样转发；聊天消息直接使用Frame.encode的结果，
+媒体数据不经过base64，也不在总线两端重新编码。
+"""
+import os
+import socket
+import threading
+
+from chatlog import CONNECTION, ERROR, get_logger
+from protocol import decode_payload, recv_exact_into, send_parts
+from serializers import JSON
+
+log = get_logger()
+
+LENGTH_SIZE = 4
+
+
+def encode_bus_frame(header, frame=None):
+    """编码总线上的一帧，返回若干段缓冲区；frame是要附带的聊天消息(Frame)"""
+    head = JSON.dumps(header)
+    parts = frame.encode(2) if frame is not None else ()
+    length = LENGTH_SIZE + len(head) + sum(map(len, parts))
+    return (length.to_bytes(4, 'big') + len(head).to_bytes(4, 'big') + head,) + tuple(parts)
+
+
+def replace_bus_header(header, payload):
+    """换掉一帧的头部，附带的聊天消息原样引用(转发时不复制)，返回若干段缓冲区"""
+    head = JSON.dumps(header)
+    tail = memoryview(payload)[LENGTH_SIZE + int.from_bytes(payload[:LENGTH_SIZE], 'big'):]
+    length = LENGTH_SIZE + len(head) + len(tail)
+    return (length.to_bytes(4, 'big') + len(head).to_bytes(4, 'big') + head, tail)
+
+
+def read_bus_frame(sock, max_size):
+    """读取一帧，返回(头部, 整帧的负载)，对端关闭时返回(None, None)"""
+    prefix = bytearray(LENGTH_SIZE)
+    if not recv_exact_into(sock, memoryview(prefix)):
+        return None, None
+    length = int.from_bytes(prefix, 'big')
+    if length > max_size:
+        raise ValueError(f"总线帧长度 {length} 超过上限 {max_size}")
+    payload = bytearray(length)
+    if not recv_exact_into(sock, memoryview(payload)):
+        raise ConnectionError("接收总线消息时连接断开")
+    head_len = int.from_bytes(payload[:LENGTH_SIZE], 'big')
+    header = JSON.loads(memoryview(payload)[LENGTH_SIZE:LENGTH_SIZE + head_len])
+    return header, payload
+
+
+def decode_bus_message(payload):
+    """取出一帧附带的聊天消息，没有时返回None；媒体数据是payload上的memoryview"""
+    start = LENGTH_SIZE + int.from_bytes(payload[:LENGTH_SIZE], 'big') + LENGTH_SIZE
+    if start > len(payload):
+        return None
+    return decode_payload(memoryview(payload)[start:], copy_body=False)
+
+
+class BusHub:
+    """父进程中的总线：接受工作进程的连接，按头部的to转发
+
+    每个工作进程一个读线程；转发给同一个工作进程的帧在锁内整帧写出，不会交错。
+    工作进程断开时向其余工作进程发送shard_down，由它们移除该分片上的在线用户。
+    """
+
+    def __init__(self, path, max_frame_size=128 * 1024 * 1024):
+        self.path = path
+        self.max_frame_size = max_frame_size
+        self.server_socket = None
+        self.running = False
+        self._lock = threading.Lock()
+        self._workers = {}              # {分片: (socket, 写锁)}
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(self.path)
+        self.server_socket.listen(64)
+        self.running = True
+        threading.Thread(target=self.accept_workers, daemon=True).start()
+
+    def accept_workers(self):
+        while self.running:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.serve_worker, args=(sock,), daemon=True).start()
+
+    def serve_worker(self, sock):
+        """读取一个工作进程发来的帧并转发，第一帧必须是hello"""
+        shard = None
+        try:
+            header, _ = read_bus_frame(sock, self.max_frame_size)
+            if header is None or header.get('op') != 'hello':
+                return
+            shard = header['from']
+            with self._lock:
+                old = self._workers.get(shard)
+                self._workers[shard] = (sock, threading.Lock())
+            if old is not None:
+                old[0].close()
+            log.info("[总线] 分片 %s 已连接", shard, extra=CONNECTION)
+            while self.running:
+                header, payload = read_bus_frame(sock, self.max_frame_size)
+                if header is None:
+                    break
+                self.forward(shard, header.get('to'), (len(payload).to_bytes(4, 'big'), payload))
+        except (OSError, ValueError) as e:
+            if self.running:
+                log.warning("[总线] 分片 %s 读取失败: %s", shard, e, extra=ERROR)
+        finally:
+            sock.close()
+            if shard is not None:
+                with self._lock:
+                    removed = self._workers.get(shard, (None,))[0] is sock
+                    if removed:
+                        del self._workers[shard]
+                if removed and self.running:
+                    log.info("[总线] 分片 %s 已断开", shard, extra=CONNECTION)
+                    self.forward(None, None, encode_bus_frame({'op': 'shard_down', 'from': None, 'shard': shard}))
+
+    def forward(self, sender, to, parts):
+        """把一帧发给分片to，to为None时发给除sender以外的所有分片"""
+        with self._lock:
+            if to is None:
+                targets = [w for s, w in self._workers.items() if s != sender]
+            else:
+                targets = [self._workers[to]] if to in self._workers else []
+        for sock, lock in targets:
+            try:
+                with lock:
+                    send_parts(sock, parts)
+            except OSError as e:
+                log.warning("[总线] 转发失败: %s", e, extra=ERROR)
+
+    def stop(self):
+        self.running = False
+        if self.server_socket is not None:
+            self.server_socket.close()
+            self.server_socket = None
+        with self._lock:
+            workers, self._workers = list(self._workers.values()), {}
+        for sock, _ in workers:
+            sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+class BusClient:
+    """工作进程一端：发送帧，并在读线程中把收到的帧交给on_frame(头部, 聊天消息或None)"""
+
+    def __init__(self, path, shard, on_frame, max_frame_size=128 * 1024 * 1024):
+        self.path = path
+        self.shard = shard
+        self.on_frame = on_frame
+        self.max_frame_size = max_frame_size
+        self.sock = None
+        self._lock = threading.Lock()
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.send('hello')
+        threading.Thread(target=self.read_frames, daemon=True).start()
+
+    def send(self, op, frame=None, to=None, **fields):
+        """发一帧给分片to，to为None时发给其余所有分片"""
+        header = {'op': op, 'from': self.shard, 'to': to}
+        header.update(fields)
+        parts = encode_bus_frame(header, frame)
+        with self._lock:
+            if self.sock is None:
+                return
+            send_parts(self.sock, parts)
+
+    def read_frames(self):
+        sock = self.sock
+        try:
+            while True:
+                header, payload = read_bus_frame(sock, self.max_frame_size)
+                if header is None:
+                    break
+                try:
+                    self.on_frame(header, decode_bus_message(payload))
+                except Exception as e:
+                    log.warning("[总线] 处理 %s 失败: %s", header.get('op'), e, extra=ERROR)
+        except (OSError, ValueError) as e:
+            if self.sock is not None:
+                log.warning("[总线] 读取失败: %s", e, extra=ERROR)
+        if self.sock is not None:
+            log.error("[总线] 与总线的连接已断开", extra=ERROR)
+
+    def close(self):
+        with self._lock:
+            sock, self.sock = self.sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
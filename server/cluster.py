@@ -0,0 +1,126 @@
+"""多进程模式：N个工作进程用SO_REUSEPORT监听同一个端口，由内核分配连接
+
+每个工作进程是一个完整的ChatServer，只持有自己接受的连接(一个分片)。跨分片的广场和聊天室消息、
+私聊和在线用户变化经过父进程中的BusHub(见bus.py)传递：
+- 登录、登出广播给其他分片，它们把远端用户加入自己的在线用户列表，并记下用户所在的分片；
+- 广场和聊天室消息广播一次，每个分片只向自己的连接分发，并各自记入消息历史；
+- 私聊只发给目标用户所在的分片；目标不在线时由发送方所在分片暂存，目标在其他分片登录后转交；
+- 分块传输的传输头、每一块和结束帧按同样的路线转发，接收方分片在本地重新分配传输编号。
+收到的帧的处理与服务器联网(federation.py)共用links.Link。父进程(Supervisor)不处理聊天消息，
+只负责总线和重新启动意外退出的工作进程。
+"""
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+
+from bus import BusClient, BusHub
+from chatlog import ERROR, get_logger
+from links import Link
+
+log = get_logger()
+
+
+class ShardLink(Link):
+    """工作进程与其他分片之间的链路，远端节点就是分片编号"""
+
+    def __init__(self, server, path, shard):
+        super().__init__(server)
+        self.shard = shard
+        self.bus = BusClient(path, shard, self.on_frame)
+
+    def __repr__(self):
+        return f"ShardLink({self.shard})"
+
+    def start(self, timeout=10.0):
+        """连接总线(父进程可能还没有就绪)，并向其他分片索取它们的在线用户"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.bus.connect()
+                break
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.1)
+        self.bus.send('sync')
+
+    def stop(self):
+        self.bus.close()
+
+    def broadcast(self, op, frame=None, **fields):
+        """发给其他所有分片"""
+        self.bus.send(op, frame, None, **fields)
+
+    def send(self, dest, op, frame=None, **fields):
+        """发给分片dest"""
+        self.bus.send(op, frame, dest, **fields)
+
+    def on_frame(self, header, message):
+        """总线读线程收到的帧，shard_down由父进程发出"""
+        if header.get('op') == 'shard_down':
+            self.drop_node(header['shard'])
+        else:
+            self.dispatch(header, message)
+
+
+class Supervisor:
+    """父进程：运行BusHub，启动N个工作进程并在其意外退出时重新启动
+
+    command(分片, 总线地址)返回启动一个工作进程的命令行。工作进程重新执行main.py而不是直接fork，
+    父进程的总线线程和日志线程不会被带入子进程。
+    """
+
+    def __init__(self, workers, command, restart_delay=1.0):
+        self.workers = workers
+        self.command = command
+        self.restart_delay = restart_delay
+        self.directory = tempfile.mkdtemp(prefix='lanchat-bus-')
+        self.hub = BusHub(os.path.join(self.directory, 'bus.sock'))
+        self.processes = {}             # {分片: Popen}
+        self.running = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        """启动总线和所有工作进程，直到stop()被调用"""
+        self.hub.start()
+        self.running = True
+        for shard in range(self.workers):
+            self.spawn(shard)
+        log.info("多进程模式已启动: %d 个工作进程，总线 %s", self.workers, self.hub.path)
+        while not self._stopped.wait(0.5):
+            for shard, process in list(self.processes.items()):
+                code = process.poll()
+                if code is not None and self.running:
+                    log.error("[工作进程] 分片 %d (pid %d) 退出，返回值 %s，%g 秒后重新启动", shard,
+                              process.pid, code, self.restart_delay, extra=ERROR)
+                    if self._stopped.wait(self.restart_delay):
+                        break
+                    self.spawn(shard)
+
+    def spawn(self, shard):
+        process = subprocess.Popen(self.command(shard, self.hub.path))
+        self.processes[shard] = process
+        log.info("[工作进程] 分片 %d 已启动 pid %d", shard, process.pid)
+
+    def stop(self, timeout=10.0):
+        """让所有工作进程正常关闭(与Ctrl+C相同)，超时后强制结束"""
+        self.running = False
+        self.hub.running = False        # 正常关闭时不再通知其他分片有分片退出
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGINT)
+        deadline = time.monotonic() + timeout
+        for process in self.processes.values():
+            try:
+                process.wait(max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self._stopped.set()
+        self.hub.stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        log.info("所有工作进程已退出")
@@ -0,0 +1,287 @@
+"""服务器联网：多台服务器(例如每栋楼一台)用TCP连接成一个广场
+
+每台服务器是一个节点，用--node-id命名(默认为主机名:端口)，--federation-port监听其他节点，
+--peer主动连接相邻节点。节点之间的帧格式与本机总线相同(bus.py)，头部另外带有：
+    id: 发出该帧的节点和序号，每个节点只处理一次，重复收到的丢弃
+    reached: 已经收到或正在发往的节点，转发时跳过这些节点
+    to: 目标节点，None表示所有节点
+广播的帧由发出的节点直接发给所有相邻节点，收到的节点只转发给reached之外的相邻节点，
+因此全连接或树形的拓扑中每帧在每条连接上只经过一次，有环时多余的副本按id丢弃，不会循环。
+发给某个节点的帧(私聊、离线消息)沿着最先收到该节点消息的相邻节点转发，不知道路线时按广播的方式扩散。
+在线用户只由用户所在的节点通告：新连接建立时两端各广播sync，每个节点收到后广播自己的用户。
+相邻节点断开时，经过它到达的节点沿同样的路线广播node_down，收到的节点把这些节点上的用户下线。
+收到的帧与多进程模式共用links.Link的处理：远端用户加入在线用户列表，广场消息由每个节点发给自己的连接。
+"""
+import itertools
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from bus import encode_bus_frame, decode_bus_message, read_bus_frame, replace_bus_header
+from chatlog import CONNECTION, ERROR, get_logger
+from links import Link
+from protocol import send_parts
+
+log = get_logger()
+
+
+def parse_peer(value):
+    """把'host:port'解析为(host, port)"""
+    host, _, port = value.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class Peer:
+    """与一个相邻节点的TCP连接，outgoing表示由本节点发起"""
+
+    def __init__(self, sock, node, outgoing):
+        self.sock = sock
+        self.node = node
+        self.outgoing = outgoing
+        self.lock = threading.Lock()
+
+    def send(self, parts):
+        with self.lock:
+            send_parts(self.sock, parts)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class FederationLink(Link):
+    """本节点与所有相邻节点的连接，远端节点用节点名标识"""
+
+    def __init__(self, server, node=None, listen=None, peers=(), reconnect_delay=2.0, max_hops=16,
+                 seen_size=65536, max_frame_size=128 * 1024 * 1024):
+        super().__init__(server)
+        self.node = node                # 本节点的名称，start()时没有设置则为主机名:端口
+        self.listen = listen            # 监听其他节点的(host, port)，为None时只主动连接
+        self.peer_addresses = list(peers)
+        self.reconnect_delay = reconnect_delay
+        self.max_hops = max_hops        # 帧最多经过的节点数，防止错误配置时无限转发
+        self.seen_size = seen_size
+        self.max_frame_size = max_frame_size
+        self.running = False
+        self.server_socket = None
+        self._lock = threading.Lock()
+        self.peers = {}                 # {相邻节点: Peer}
+        self.routes = {}                # {远端节点: 通往它的相邻节点}
+        self._seen = OrderedDict()      # 最近处理过的帧id
+        self._seq = itertools.count(1)
+
+    def __repr__(self):
+        return f"FederationLink({self.node})"
+
+    def start(self):
+        if self.node is None:
+            self.node = f"{socket.gethostname()}:{self.server.port}"
+        self.running = True
+        if self.listen is not None:
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.bind(self.listen)
+            self.server_socket.listen(16)
+            threading.Thread(target=self.accept_peers, daemon=True).start()
+            log.info("[联网] 节点 %s 在 %s:%s 等待其他节点连接", self.node, *self.listen)
+        for address in self.peer_addresses:
+            threading.Thread(target=self.connect_peer, args=(address,), daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.server_socket is not None:
+            self.server_socket.close()
+            self.server_socket = None
+        with self._lock:
+            peers, self.peers = list(self.peers.values()), {}
+        for peer in peers:
+            peer.close()
+
+    def accept_peers(self):
+        while self.running:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.serve_peer, args=(sock, False), daemon=True).start()
+
+    def connect_peer(self, address):
+        """主动连接一个相邻节点，断开后每隔reconnect_delay秒重新连接"""
+        while self.running:
+            try:
+                sock = socket.create_connection(address, timeout=5)
+                sock.settimeout(None)
+            except OSError as e:
+                log.debug("[联网] 连接 %s:%s 失败: %s", address[0], address[1], e, extra=CONNECTION)
+            else:
+                self.serve_peer(sock, True)
+            time.sleep(self.reconnect_delay)
+
+    def serve_peer(self, sock, outgoing):
+        """交换节点名后读取相邻节点发来的帧，断开时移除经过它的路线"""
+        peer = None
+        try:
+            send_parts(sock, encode_bus_frame({'op': 'hello', 'from': self.node}))
+            header, _ = read_bus_frame(sock, self.max_frame_size)
+            if header is None or header.get('op') != 'hello':
+                return
+            peer = Peer(sock, header['from'], outgoing)
+            if peer.node == self.node or not self.add_peer(peer):
+                peer = None
+                return
+            log.info("[联网] 已连接节点 %s", peer.node, extra=CONNECTION)
+            self.broadcast('sync')
+            while self.running:
+                header, payload = read_bus_frame(sock, self.max_frame_size)
+                if header is None:
+                    break
+                self.on_frame(peer, header, payload)
+        except (OSError, ValueError) as e:
+            if self.running:
+                log.warning("[联网] 与节点 %s 的连接出错: %s", peer.node if peer else '?', e, extra=ERROR)
+        finally:
+            sock.close()
+            if peer is not None:
+                self.remove_peer(peer)
+
+    def add_peer(self, peer):
+        """登记相邻节点；两个节点互相配置了--peer时只保留由名称较小的节点发起的连接"""
+        with self._lock:
+            old = self.peers.get(peer.node)
+            if old is not None:
+                initiator = self.node if peer.outgoing else peer.node
+                if initiator != min(self.node, peer.node):
+                    return False
+                old.close()
+            self.peers[peer.node] = peer
+            self.routes[peer.node] = peer.node
+        return True
+
+    def remove_peer(self, peer):
+        """相邻节点断开：经过它的节点暂时不可达，通知其余节点后重新同步，有其他路线的节点会重新通告用户"""
+        with self._lock:
+            if self.peers.get(peer.node) is not peer:
+                return
+            del self.peers[peer.node]
+        if not self.running:
+            return
+        log.warning("[联网] 节点 %s 已断开", peer.node, extra=CONNECTION)
+        lost = self.drop_routes(peer.node, None)
+        if lost:
+            self.broadcast('node_down', nodes=lost)
+            self.broadcast('sync')
+
+    def drop_routes(self, via, nodes):
+        """移除经过相邻节点via的路线(nodes不为None时只移除其中的节点)，这些节点上的用户下线，返回移除的节点"""
+        with self._lock:
+            lost = [node for node, hop in self.routes.items() if hop == via and (nodes is None or node in nodes)]
+            for node in lost:
+                del self.routes[node]
+        for node in lost:
+            self.drop_node(node)
+        return lost
+
+    def new_header(self, op, to, fields):
+        header = {'op': op, 'from': self.node, 'id': f"{self.node}:{next(self._seq)}", 'to': to, 'hops': 0}
+        header.update(fields)
+        self.remember(header['id'])
+        return header
+
+    def remember(self, frame_id):
+        """记下处理过的帧id，已经处理过时返回False"""
+        with self._lock:
+            if frame_id in self._seen:
+                return False
+            self._seen[frame_id] = None
+            if len(self._seen) > self.seen_size:
+                self._seen.popitem(last=False)
+            return True
+
+    def send_direct(self, peer, op, **fields):
+        """只发给一个相邻节点，不转发"""
+        header = self.new_header(op, peer.node, fields)
+        try:
+            peer.send(encode_bus_frame(header))
+        except OSError as e:
+            log.warning("[联网] 向节点 %s 发送 %s 失败: %s", peer.node, op, e, extra=ERROR)
+
+    def broadcast(self, op, frame=None, **fields):
+        """发给所有节点：直接发给每个相邻节点，由它们转发给更远的节点"""
+        header = self.new_header(op, None, fields)
+        self.flood(header, None, frame=frame)
+
+    def send(self, dest, op, frame=None, **fields):
+        """发给节点dest，知道路线时只发给通往它的相邻节点"""
+        header = self.new_header(op, dest, fields)
+        via = self.peers.get(self.routes.get(dest))
+        if via is None:
+            self.flood(header, None, frame=frame)
+            return
+        try:
+            via.send(encode_bus_frame(header, frame))
+        except OSError as e:
+            log.warning("[联网] 向节点 %s 发送 %s 失败: %s", via.node, op, e, extra=ERROR)
+
+    def flood(self, header, payload, frame=None, came_from=None):
+        """发给reached之外的所有相邻节点，并把它们加入reached"""
+        with self._lock:
+            reached = set(header.get('reached') or ()) | {self.node}
+            targets = [p for node, p in self.peers.items() if node not in reached and node != came_from]
+        if not targets:
+            return
+        header = dict(header, reached=sorted(reached | {p.node for p in targets}))
+        parts = replace_bus_header(header, payload) if payload is not None else encode_bus_frame(header, frame)
+        for peer in targets:
+            try:
+                peer.send(parts)
+            except OSError as e:
+                log.warning("[联网] 向节点 %s 转发 %s 失败: %s", peer.node, header.get('op'), e, extra=ERROR)
+
+    def on_frame(self, peer, header, payload):
+        """相邻节点的读线程：丢弃重复的帧，转发给其他节点，再在本节点处理"""
+        if not self.remember(header.get('id')):
+            return
+        origin = header.get('from')
+        to = header.get('to')
+        if header.get('op') == 'node_down':
+            # 只有经过同一个相邻节点到达的节点才不可达，经过其他路线可达的不再向后通知
+            lost = self.drop_routes(peer.node, header['nodes'])
+            if lost:
+                self.flood(dict(header, nodes=lost, hops=header.get('hops', 0) + 1), None, came_from=peer.node)
+            return
+        with self._lock:
+            if origin != self.node:
+                self.routes.setdefault(origin, peer.node)
+        if to is not None and to != self.node:
+            self.forward(peer, header, payload)
+            return
+        if to is None and header.get('hops', 0) + 1 < self.max_hops:
+            self.flood(dict(header, hops=header.get('hops', 0) + 1), payload, came_from=peer.node)
+        self.dispatch(header, decode_bus_message(payload))
+
+    def forward(self, peer, header, payload):
+        """转发发给其他节点的帧"""
+        hops = header.get('hops', 0) + 1
+        if hops >= self.max_hops:
+            log.warning("[联网] 发往 %s 的 %s 超过 %d 跳，已丢弃", header['to'], header.get('op'), self.max_hops,
+                        extra=ERROR)
+            return
+        header = dict(header, hops=hops)
+        via = self.peers.get(self.routes.get(header['to']))
+        if via is None or via is peer:
+            self.flood(header, payload, came_from=peer.node)
+            return
+        try:
+            via.send(replace_bus_header(header, payload))
+        except OSError as e:
+            log.warning("[联网] 向节点 %s 转发 %s 失败: %s", via.node, header.get('op'), e, extra=ERROR)
+
+    def send_users(self, dest):
+        """回复sync：本节点的用户广播给所有节点，新连接两侧的节点都能得到"""
+        users = self.sync_users()
+        if users:
+            self.broadcast('users', users=users)
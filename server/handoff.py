@@ -0,0 +1,179 @@
+"""不中断连接的重启：旧进程把监听socket、客户端连接和会话状态交给新进程
+
+旧进程用--handoff-socket在一个Unix socket上等待接管。新进程带--takeover启动(或向旧进程发送SIGUSR2，
+由它用同样的参数启动新进程)，连接这个Unix socket后：
+1. 旧进程冻结：不再接受新连接，不再从客户端连接读取新的帧，中止未完成的分块传输，
+   发出合并中的在线用户变化，断开链路，等待发送队列写完，把离线消息和消息历史写入磁盘；
+2. 旧进程用SCM_RIGHTS发送所有监听socket和每个连接的文件描述符，连同会话(用户名、地址、协议版本、
+   功能、编码、聊天室)、在线用户列表的版本号和已经读出但还没有处理的字节；
+3. 新进程恢复会话后回复ready，旧进程回复done后退出，新进程收到done才开始读取这些连接和接受新连接。
+客户端的TCP连接始终没有断开，只会感觉到交接期间(通常几十毫秒)消息稍有延迟。
+旧进程没有按时收到ready时解除冻结继续服务，不再回复done，新进程随即退出，两个进程不会同时读取同一个连接。
+
+两端之间的每条消息为[4字节长度][4字节头部长度][头部JSON][附带的数据]，文件描述符随第一段发送。
+"""
+import os
+import socket
+import threading
+
+from chatlog import CONNECTION, ERROR, get_logger
+from protocol import recv_exact_into, send_parts
+from serializers import JSON
+
+log = get_logger()
+
+MAX_FDS = 250   # 每条消息附带的文件描述符数，内核上限为253(SCM_MAX_FD)
+
+
+def send_message(sock, header, fds=(), blobs=()):
+    """发送一条消息，fds是要交给对方的文件描述符，blobs依次附在头部之后"""
+    head = JSON.dumps(header)
+    length = 4 + len(head) + sum(map(len, blobs))
+    first = length.to_bytes(4, 'big') + len(head).to_bytes(4, 'big') + head
+    sent = socket.send_fds(sock, [first], list(fds)) if fds else 0
+    send_parts(sock, (memoryview(first)[sent:],) + tuple(blobs))
+
+
+def recv_message(sock):
+    """接收一条消息，返回(头部, socket列表, 附带的数据)，对端关闭时头部为None"""
+    data, fds, flags, _ = socket.recv_fds(sock, 8, MAX_FDS + 3)
+    sockets = [socket.socket(fileno=fd) for fd in fds]
+    if not data:
+        return None, sockets, None
+    if flags & getattr(socket, 'MSG_CTRUNC', 0):
+        raise ValueError("文件描述符被截断")
+    prefix = bytearray(data)
+    if len(prefix) < 8:
+        rest = bytearray(8 - len(prefix))
+        if not recv_exact_into(sock, memoryview(rest)):
+            raise ConnectionError("接收交接消息时连接断开")
+        prefix += rest
+    length = int.from_bytes(prefix[:4], 'big')
+    head_len = int.from_bytes(prefix[4:], 'big')
+    payload = bytearray(length - 4)
+    if payload and not recv_exact_into(sock, memoryview(payload)):
+        raise ConnectionError("接收交接消息时连接断开")
+    header = JSON.loads(bytes(payload[:head_len]))
+    return header, sockets, memoryview(payload)[head_len:]
+
+
+class HandoffListener:
+    """旧进程一端：在path上等待新进程，把服务器交给它"""
+
+    def __init__(self, server, path, timeout=10.0):
+        self.server = server
+        self.path = path
+        self.timeout = timeout          # 等待发送队列写完、等待新进程回复ready的秒数
+        self.server_socket = None
+        self._busy = threading.Lock()   # 同一时间只交接一次
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(self.path)
+        self.server_socket.listen(1)
+        threading.Thread(target=self.accept, daemon=True).start()
+        log.info("[交接] 在 %s 等待新进程接管", self.path)
+
+    def stop(self):
+        """关闭监听，交接成功后path已属于新进程，不再删除"""
+        if self.server_socket is not None:
+            self.server_socket.close()
+            self.server_socket = None
+            if self.path is not None:
+                try:
+                    os.unlink(self.path)
+                except OSError:
+                    pass
+
+    def accept(self):
+        while self.server_socket is not None:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.serve, args=(sock,), daemon=True).start()
+
+    def serve(self, sock):
+        with sock, self._busy:
+            try:
+                header, _, _ = recv_message(sock)
+            except (OSError, ValueError) as e:
+                log.warning("[交接] 读取接管请求失败: %s", e, extra=ERROR)
+                return
+            if header is None or header.get('op') != 'takeover' or not self.server.running or self.server.frozen:
+                return  # 正在排空或已经停止
+            log.info("[交接] 进程 %s 请求接管，停止接受新连接和读取消息", header.get('pid'), extra=CONNECTION)
+            try:
+                busy = self.server.quiesce(self.timeout)
+                listeners, state, connections = self.server.export_state(busy)
+                self.send_state(sock, listeners, state, connections)
+                sock.settimeout(self.timeout)
+                reply, _, _ = recv_message(sock)
+                done = reply is not None and reply.get('op') == 'ready'
+                if done:
+                    send_message(sock, {'op': 'done', 'pid': os.getpid()})
+            except Exception as e:
+                log.error("[交接] 交接失败: %s", e, extra=ERROR)
+                done = False
+            if not done:
+                log.warning("[交接] 新进程没有完成接管，继续服务", extra=ERROR)
+                self.server.resume()
+                return
+            log.info("[交接] 已交给进程 %s: %d 个连接，%d 个未能交接的连接将断开", header.get('pid'),
+                     len(connections), len(busy), extra=CONNECTION)
+            self.path = None
+            self.server.finish_handoff()
+
+    def send_state(self, sock, listeners, state, connections):
+        """先发送监听socket和全局状态，再按MAX_FDS分批发送连接"""
+        send_message(sock, dict(state, op='state', connections=len(connections), listeners=len(listeners)),
+                     listeners)
+        for start in range(0, len(connections), MAX_FDS):
+            batch = connections[start:start + MAX_FDS]
+            send_message(sock, {'op': 'connections', 'records': [record for _, record, _ in batch]},
+                         [fd for fd, _, _ in batch], [pending for _, _, pending in batch if pending])
+
+
+class Takeover:
+    """新进程一端：从旧进程取得监听socket、连接和状态，恢复完成后调用ready()"""
+
+    def __init__(self, path, timeout=30.0):
+        self.path = path
+        self.timeout = timeout
+        self.sock = None
+        self.listeners = []             # 旧进程的监听socket，同时监听多个地址时有多个
+        self.state = None               # 全局状态，见ChatServer.export_state
+        self.connections = []           # [(socket, 会话记录, 已读出未处理的字节)]
+
+    def receive(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+        send_message(self.sock, {'op': 'takeover', 'pid': os.getpid()})
+        header, sockets, _ = recv_message(self.sock)
+        if header is None or header.get('op') != 'state' or not sockets:
+            raise ConnectionError("旧进程没有交出监听socket")
+        self.listeners = sockets[:header.get('listeners', 1)]
+        self.state = header
+        while len(self.connections) < header['connections']:
+            batch, sockets, blobs = recv_message(self.sock)
+            if batch is None or batch.get('op') != 'connections' or len(sockets) != len(batch['records']):
+                raise ConnectionError("接收连接时交接中断")
+            offset = 0
+            for sock, record in zip(sockets, batch['records']):
+                pending = bytes(blobs[offset:offset + record['pending']])
+                offset += record['pending']
+                self.connections.append((sock, record, pending))
+        return self
+
+    def ready(self):
+        """告诉旧进程会话已经恢复，等旧进程回复done后才能读取连接；旧进程已经恢复服务时抛出ConnectionError"""
+        try:
+            send_message(self.sock, {'op': 'ready', 'pid': os.getpid()})
+            reply, _, _ = recv_message(self.sock)
+            if reply is None or reply.get('op') != 'done':
+                raise ConnectionError("旧进程没有确认交接")
+        finally:
+            self.sock.close()
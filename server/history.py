@@ -0,0 +1,490 @@
+"""消息历史：广场和私聊消息按顺序追加到分段的日志文件中
+
+每个分段是一个.log文件(文件名为其中第一条消息的序号)和一个稀疏索引.idx，
+索引每隔index_interval字节记录一次(序号, 时间, 偏移)，分段写满segment_bytes后换新的分段。
+写入只在文件末尾追加，与已存的消息数量无关；启动时只列出分段文件并检查最后一个分段的末尾，
+不读取全部消息。读取时用mmap映射分段，按索引定位到时间范围的起点后顺序扫描。
+每条记录还指向同一会话的上一条记录，向前翻页时沿指针只读取该会话的记录，与日志中其他会话的消息数无关；
+每个会话最新一条记录的位置在内存中，换分段和关闭时写入heads文件，启动时只扫描这之后追加的记录。
+媒体消息只保存内容哈希(数据在媒体仓库中)，不保存媒体数据。
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+
+from chatlog import ERROR, get_logger
+from serializers import JSON
+
+log = get_logger()
+
+# 每条记录: 头部 + 会话名(UTF-8) + 消息(JSON)
+# 消息长度、消息的CRC32、序号、服务器时间、会话名长度、同一会话上一条记录的序号(0表示没有)和它在所在分段中的偏移
+RECORD = struct.Struct('!IIQdHQQ')
+INDEX_ENTRY = struct.Struct('!QdQ')     # 序号、时间、记录在分段中的偏移
+FORMAT = b'2'                           # 记录格式的版本，旧格式的分段移入format-1子目录
+
+SQUARE = 'square'                       # 广场的会话名
+
+
+def private_conversation(address, peer):
+    """私聊的会话名，两端地址排序后拼接，双方发送的消息属于同一个会话"""
+    a, b = sorted(f'{ip}:{int(port)}' for ip, port in (address, peer))
+    return f'private:{a}|{b}'
+
+
+def members(conversation):
+    """私聊会话双方的'ip:port'，广场没有成员"""
+    if not conversation.startswith('private:'):
+        return ()
+    return conversation[len('private:'):].split('|')
+
+
+def is_participant(conversation, address):
+    """address(ip, port)是否可以读取该会话：广场所有人可读，私聊只有双方可读"""
+    if conversation == SQUARE:
+        return True
+    ip, port = address
+    return f'{ip}:{int(port)}' in members(conversation)
+
+
+class Segment:
+    """一个分段：日志文件、稀疏索引和只读映射"""
+
+    __slots__ = ('base_seq', 'path', 'index_path', 'size', 'seqs', 'times', 'offsets',
+                 'first_time', '_indexed', '_map')
+
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        self.path = os.path.join(directory, f'{base_seq:020d}.log')
+        self.index_path = os.path.join(directory, f'{base_seq:020d}.idx')
+        self.size = 0                   # 已完整写入的字节数，读取不超过该位置
+        self.seqs = []                  # 稀疏索引，第一条记录总会被索引
+        self.times = []
+        self.offsets = []
+        self.first_time = None          # 第一条记录的时间，空分段为None
+        self._indexed = False           # 索引是否已读入内存
+        self._map = None
+
+    def read_first_time(self):
+        """只读取索引的第一项，启动时用来按时间选择分段"""
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read(INDEX_ENTRY.size)
+        except OSError:
+            data = b''
+        if len(data) == INDEX_ENTRY.size:
+            self.first_time = INDEX_ENTRY.unpack(data)[1]
+
+    def load_index(self):
+        """第一次按时间读取该分段时把索引读入内存"""
+        if self._indexed:
+            return
+        try:
+            with open(self.index_path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = b''
+        data = data[:len(data) - len(data) % INDEX_ENTRY.size]
+        for seq, when, offset in INDEX_ENTRY.iter_unpack(data):
+            if offset >= self.size:
+                break  # 上次退出时日志末尾被截断，之后的索引无效
+            self.add_index(seq, when, offset)
+        self._indexed = True
+
+    def add_index(self, seq, when, offset):
+        if not self.seqs:
+            self.first_time = when
+        # times最后追加，读取者按times查找时offsets中一定有对应的项
+        self.offsets.append(offset)
+        self.seqs.append(seq)
+        self.times.append(when)
+
+    def drop_last_index(self):
+        self.times.pop()
+        self.seqs.pop()
+        self.offsets.pop()
+        if not self.seqs:
+            self.first_time = None
+
+    def offset_for(self, since):
+        """时间不早于since的第一条记录所在索引块的起点"""
+        if since is None or not self.times:
+            return 0
+        i = bisect_left(self.times, since)
+        return self.offsets[max(i - 1, 0)]
+
+    def view(self, size):
+        """至少覆盖前size字节的只读映射，正在写入的分段变大后重新映射"""
+        mapped = self._map
+        if mapped is None or len(mapped) < size:
+            with open(self.path, 'rb') as f:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map = mapped  # 旧的映射由仍在使用它的读取者持有，用完后释放
+        return mapped
+
+    def scan(self, start, end):
+        """顺序读取[start, end)中的记录，生成(序号, 时间, 会话名起止, 消息起止)"""
+        if end <= start:
+            return
+        view = self.view(end)
+        offset = start
+        while offset + RECORD.size <= end:
+            length, _, seq, when, conv_len, _, _ = RECORD.unpack_from(view, offset)
+            conv_start = offset + RECORD.size
+            body = conv_start + conv_len
+            yield view, seq, when, conv_start, body, body + length
+            offset = body + length
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+class MessageHistory:
+    """广场和私聊消息的持久化历史
+
+    append()由处理消息的线程调用，序列化在锁外完成，锁内只有一次追加写入；
+    query()按会话和时间范围读取，不阻塞写入。
+    retention_bytes不为None时，换分段后删除最旧的分段直到总大小不超过该值。
+    before()沿同一会话的指针向前读取，只读取返回的记录。
+    """
+
+    def __init__(self, directory, segment_bytes=64 * 1024 * 1024, index_interval=64 * 1024,
+                 retention_bytes=None, max_skip=4096):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.retention_bytes = retention_bytes
+        self.max_skip = max_skip        # 翻页游标不是该会话的记录时，最多跳过的该会话更新的记录数
+        self.heads_path = os.path.join(directory, 'heads')
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()  # 读取者第一次读入已写满分段的索引
+        self._segments = []             # 按序号排列，最后一个是正在写入的分段
+        self._fd = None                 # 正在写入的分段的日志和索引
+        self._index_fd = None
+        self._last_indexed = 0          # 正在写入的分段中最后一个索引项的偏移
+        self._next_seq = 1
+        self._last_time = 0.0
+        self._heads = {}                # {会话名(bytes): 最新一条记录的(序号, 偏移)}
+        self._loaded = False
+
+        # 统计计数
+        self.appended = 0               # 本次运行追加的消息数
+        self.segments_removed = 0
+
+    def _load(self):
+        """第一次使用时列出分段文件，检查最后一个分段的末尾"""
+        if self._loaded:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        for base_seq in self._check_format():
+            segment = Segment(self.directory, base_seq)
+            segment.size = os.path.getsize(segment.path)
+            segment.read_first_time()
+            self._segments.append(segment)
+        if self._segments:
+            self._recover(self._segments[-1])
+        else:
+            self._segments.append(Segment(self.directory, self._next_seq))
+        self._load_heads()
+        self._open_active()
+        self._loaded = True
+
+    def _check_format(self):
+        """返回已有分段的起始序号；旧格式的分段(记录中没有指针)移入format-1子目录，不再读取"""
+        names = os.listdir(self.directory)
+        bases = sorted(int(name[:-4]) for name in names if name.endswith('.log') and name[:-4].isdigit())
+        format_path = os.path.join(self.directory, 'format')
+        try:
+            with open(format_path, 'rb') as f:
+                current = f.read().strip() == FORMAT
+        except OSError:
+            current = False
+        if current:
+            return bases
+        if bases:
+            old = os.path.join(self.directory, 'format-1')
+            os.makedirs(old, exist_ok=True)
+            for name in names:
+                if name.endswith(('.log', '.idx')):
+                    os.replace(os.path.join(self.directory, name), os.path.join(old, name))
+            log.warning("[消息历史] %s 中是旧格式的分段，已移到 %s", self.directory, old, extra=ERROR)
+        with open(format_path, 'wb') as f:
+            f.write(FORMAT)
+        return []
+
+    def _load_heads(self):
+        """读取heads文件，再扫描之后追加的记录(异常退出时没有写入)，得到每个会话最新一条记录的位置"""
+        try:
+            with open(self.heads_path, 'rb') as f:
+                saved = JSON.loads(f.read())
+            valid_from = saved['next_seq']
+            heads = {conv.encode(): tuple(position) for conv, position in saved['heads'].items()}
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            valid_from, heads = 0, {}
+        if valid_from > self._next_seq:
+            valid_from, heads = 0, {}   # 日志末尾被截断，heads中可能有已不存在的记录
+        bases = [segment.base_seq for segment in self._segments]
+        for segment in self._segments[max(bisect_right(bases, valid_from) - 1, 0):]:
+            segment.load_index()
+            i = bisect_right(segment.seqs, valid_from) - 1
+            for view, seq, _, conv_start, body, _ in segment.scan(segment.offsets[i] if i >= 0 else 0, segment.size):
+                if seq >= valid_from:
+                    heads[bytes(view[conv_start:body])] = (seq, conv_start - RECORD.size)
+        self._heads = heads
+
+    def _save_heads(self):
+        """把每个会话最新一条记录的位置写入heads文件，调用方持有锁"""
+        data = JSON.dumps({'next_seq': self._next_seq,
+                           'heads': {conv.decode(): list(position) for conv, position in self._heads.items()}})
+        temp = self.heads_path + '.tmp'
+        try:
+            with open(temp, 'wb') as f:
+                f.write(data)
+            os.replace(temp, self.heads_path)
+        except OSError as e:
+            log.error("[错误] 写入 %s 失败: %s", self.heads_path, e, extra=ERROR)
+
+    def _recover(self, segment):
+        """从最后一个索引项开始校验记录，截断异常退出时写了一半的记录并补齐索引"""
+        segment.load_index()
+        start = segment.offsets[-1] if segment.offsets else 0
+        self._next_seq = segment.seqs[-1] if segment.seqs else segment.base_seq
+        self._last_time = segment.times[-1] if segment.times else 0.0
+        self._last_indexed = start
+        indexed = len(segment.seqs)
+        rebuilt = []
+        valid_end = start
+        with open(segment.path, 'rb') as f:
+            f.seek(start)
+            data = f.read()
+        offset = 0
+        while offset + RECORD.size <= len(data):
+            length, crc, seq, when, conv_len, _, _ = RECORD.unpack_from(data, offset)
+            end = offset + RECORD.size + conv_len + length
+            if end > len(data) or zlib.crc32(data[end - length:end]) != crc:
+                break
+            position = start + offset
+            if not segment.seqs or (position != segment.offsets[-1]
+                                    and position - self._last_indexed >= self.index_interval):
+                segment.add_index(seq, when, position)
+                rebuilt.append(INDEX_ENTRY.pack(seq, when, position))
+                self._last_indexed = position
+            self._next_seq = seq + 1
+            self._last_time = when
+            offset = end
+            valid_end = start + offset
+        if valid_end == start and segment.seqs and segment.offsets[-1] == start:
+            # 最后一个索引项指向的记录本身不完整
+            self._next_seq = segment.seqs[-1]
+            segment.drop_last_index()
+            indexed -= 1
+            self._last_indexed = segment.offsets[-1] if segment.offsets else 0
+        if valid_end < segment.size:
+            with open(segment.path, 'r+b') as f:
+                f.truncate(valid_end)
+        segment.size = valid_end
+        # 索引只保留有效的项，再补上重新扫描得到的项
+        with open(segment.index_path, 'ab') as f:
+            f.truncate(indexed * INDEX_ENTRY.size)
+            f.write(b''.join(rebuilt))
+
+    def _open_active(self):
+        segment = self._segments[-1]
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        self._fd = os.open(segment.path, flags, 0o644)
+        self._index_fd = os.open(segment.index_path, flags, 0o644)
+        segment._indexed = True
+
+    def _roll(self):
+        """当前分段写满，换新的分段"""
+        os.close(self._fd)
+        os.close(self._index_fd)
+        self._segments.append(Segment(self.directory, self._next_seq))
+        self._last_indexed = 0
+        self._open_active()
+        if self.retention_bytes is not None:
+            total = sum(s.size for s in self._segments)
+            while total > self.retention_bytes and len(self._segments) > 1:
+                oldest = self._segments.pop(0)
+                total -= oldest.size
+                # 不关闭映射，正在读取该分段的查询仍可读完
+                for path in (oldest.path, oldest.index_path):
+                    try:
+                        os.unlink(path)
+                    except OSError:
+                        pass
+                self.segments_removed += 1
+            # 最新记录已被删除的会话不再保留
+            first = self._segments[0].base_seq
+            self._heads = {conv: position for conv, position in self._heads.items() if position[0] >= first}
+        self._save_heads()
+
+    def append(self, conversation, message, when=None):
+        """追加一条消息并返回序号，when为服务器时间(默认当前时间)，保证不小于上一条"""
+        payload = JSON.dumps(message)
+        conv = conversation.encode()
+        with self._lock:
+            self._load()
+            segment = self._segments[-1]
+            if segment.size >= self.segment_bytes:
+                self._roll()
+                segment = self._segments[-1]
+            when = max(time.time() if when is None else when, self._last_time)
+            seq = self._next_seq
+            offset = segment.size
+            prev_seq, prev_offset = self._heads.get(conv, (0, 0))
+            record = RECORD.pack(len(payload), zlib.crc32(payload), seq, when, len(conv),
+                                 prev_seq, prev_offset) + conv + payload
+            _write_all(self._fd, record)
+            if offset == 0 or offset - self._last_indexed >= self.index_interval:
+                _write_all(self._index_fd, INDEX_ENTRY.pack(seq, when, offset))
+                segment.add_index(seq, when, offset)
+                self._last_indexed = offset
+            segment.size = offset + len(record)
+            self._heads[conv] = (seq, offset)
+            self._next_seq = seq + 1
+            self._last_time = when
+            self.appended += 1
+        return seq
+
+    def latest_seq(self, conversation):
+        """会话最新一条消息的序号，没有消息时为None"""
+        with self._lock:
+            self._load()
+            position = self._heads.get(conversation.encode())
+        return position[0] if position is not None else None
+
+    def query(self, conversation, since=None, until=None, limit=None):
+        """读取一个会话中时间在[since, until)内的消息，从旧到新返回[(序号, 时间, 消息)]
+
+        limit限制返回的条数，达到后停止扫描。
+        """
+        conv = conversation.encode()
+        with self._lock:
+            self._load()
+            segments = [(segment, segment.size) for segment in self._segments]
+        # 跳过整个早于since的分段：下一个分段的第一条记录仍早于since
+        first = 0
+        if since is not None:
+            for i in range(len(segments) - 1):
+                next_time = segments[i + 1][0].first_time
+                if next_time is not None and next_time <= since:
+                    first = i + 1
+        results = []
+        for segment, size in segments[first:]:
+            if until is not None and segment.first_time is not None and segment.first_time >= until:
+                break
+            with self._index_lock:
+                segment.load_index()
+            for view, seq, when, conv_start, body, end in segment.scan(segment.offset_for(since), size):
+                if since is not None and when < since:
+                    continue
+                if until is not None and when >= until:
+                    return results
+                if view[conv_start:body] == conv:
+                    results.append((seq, when, JSON.loads(view[body:end])))
+                    if limit is not None and len(results) >= limit:
+                        return results
+        return results
+
+    def before(self, conversation, seq=None, limit=50):
+        """读取一个会话中序号小于seq(None表示到最新)的最后limit条消息，从旧到新返回[(序号, 时间, 消息)]
+
+        从该会话最新的记录(或游标seq处的记录)开始沿指针向前读取，用于向前翻页。
+        seq不是该会话的记录时从最新的记录向前跳过，最多跳过max_skip条，超过时返回空列表。
+        """
+        conv = conversation.encode()
+        with self._lock:
+            self._load()
+            segments = [(segment, segment.size) for segment in self._segments]
+            position = self._heads.get(conv)
+        bases = [segment.base_seq for segment, _ in segments]
+        skipped = 0
+        if seq is not None and position is not None and position[0] >= seq:
+            record = self._find(segments, bases, seq)
+            if record is not None and record[0][record[3]:record[4]] == conv:
+                position = record[6]    # 游标是该会话的记录(正常翻页)，从它的上一条开始
+        results = []
+        while position is not None and position[0] and len(results) < limit:
+            record = self._read_at(segments, bases, *position)
+            if record is None:
+                break   # 更早的分段已被删除
+            view, s, when, conv_start, body, end, position = record
+            if seq is not None and s >= seq:
+                skipped += 1
+                if skipped > self.max_skip:
+                    return []
+                continue
+            results.append((s, when, JSON.loads(view[body:end])))
+        results.reverse()
+        return results
+
+    def _read_at(self, segments, bases, seq, offset):
+        """读取序号为seq、在所在分段偏移offset处的记录，不存在时返回None，
+        否则返回(映射, 序号, 时间, 会话名起点, 消息起点, 消息终点, 同一会话上一条记录的(序号, 偏移))"""
+        i = bisect_right(bases, seq) - 1
+        if i < 0:
+            return None
+        segment, size = segments[i]
+        if offset + RECORD.size > size:
+            return None
+        view = segment.view(size)
+        length, _, s, when, conv_len, prev_seq, prev_offset = RECORD.unpack_from(view, offset)
+        body = offset + RECORD.size + conv_len
+        if s != seq or body + length > size:
+            return None
+        return view, s, when, offset + RECORD.size, body, body + length, (prev_seq, prev_offset)
+
+    def _find(self, segments, bases, seq):
+        """按稀疏索引找到序号为seq的记录，最多扫描一个索引块，返回值与_read_at()相同"""
+        i = bisect_right(bases, seq) - 1
+        if i < 0:
+            return None
+        segment, size = segments[i]
+        with self._index_lock:
+            segment.load_index()
+        count = len(segment.times)
+        j = bisect_right(segment.seqs, seq, 0, count) - 1
+        for _, s, _, conv_start, _, _ in segment.scan(segment.offsets[j] if j >= 0 else 0, size):
+            if s == seq:
+                return self._read_at(segments, bases, seq, conv_start - RECORD.size)
+            if s > seq:
+                break
+        return None
+
+    def close(self):
+        with self._lock:
+            if self._loaded:
+                self._save_heads()
+            if self._fd is not None:
+                os.close(self._fd)
+                os.close(self._index_fd)
+                self._fd = self._index_fd = None
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
+            self._heads = {}
+            self._loaded = False
+
+    def stats(self):
+        segments = self._segments
+        first = segments[0].base_seq if segments else self._next_seq
+        return {
+            'messages': self._next_seq - first,
+            'bytes_stored': sum(s.size for s in segments),
+            'segments': len(segments),
+            'appended': self.appended,
+            'segments_removed': self.segments_removed,
+        }
+
+
+def _write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
@@ -0,0 +1,89 @@
+"""通往其他分片或其他服务器的链路的公共部分
+
+ChatServer.links中的每条链路提供broadcast(发给所有远端)、send(发给一个远端节点)和locate(地址所在的节点)，
+服务器只通过这几个方法使用链路，不关心背后是本机总线(cluster.ShardLink)还是服务器之间的TCP连接
+(federation.FederationLink)。收到的帧由Link.dispatch按操作交给服务器的remote_*方法，
+经过server.call_soon在服务器自己的线程或事件循环中处理。
+"""
+from chatlog import CONNECTION, SESSION, get_logger
+from registry import Session, address_key
+
+log = get_logger()
+
+STREAM_OPS = ('stream_begin', 'stream_chunk', 'stream_end', 'stream_abort')
+
+
+class Link:
+    """链路的远端用户目录和收到的帧的分发，子类实现start、stop、broadcast、send"""
+
+    def __init__(self, server):
+        self.server = server
+        self.users = {}                 # 远端的在线用户 {地址键: (所在节点, 用户名, 地址)}
+
+    def locate(self, address):
+        """地址所在的远端节点，不在远端时返回None"""
+        entry = self.users.get(address_key(*address))
+        return entry[0] if entry is not None else None
+
+    def sync_users(self):
+        """回复sync时告诉对方的在线用户 [{'username', 'address'}]，默认只有本机的用户"""
+        return [{'username': s.username, 'address': s.address} for s in self.server.sessions.snapshot]
+
+    def send_users(self, dest):
+        users = self.sync_users()
+        if users:
+            self.send(dest, 'users', users=users)
+
+    def add_user(self, node, username, address):
+        """登记远端用户，返回是否是新的(或换了节点、用户名)"""
+        key = address_key(*address)
+        entry = (node, username, address)
+        if self.users.get(key) == entry:
+            return False
+        self.users[key] = entry
+        self.server.call_soon(self.server.remote_login, self, node, username, address)
+        return True
+
+    def dispatch(self, header, message):
+        """处理一帧，header['from']是发出该帧的节点，用户所在的节点可以由node字段另外给出"""
+        op = header.get('op')
+        origin = header.get('from')
+        server = self.server
+        if op == 'sync':
+            server.call_soon(self.send_users, origin)
+        elif op in ('login', 'users'):
+            for user in header.get('users') or [header]:
+                self.add_user(user.get('node', origin), user['username'], tuple(user['address']))
+        elif op == 'logout':
+            address = tuple(header['address'])
+            entry = self.users.get(address_key(*address))
+            if entry is not None and entry[0] == header.get('node', origin):
+                del self.users[address_key(*address)]
+                server.call_soon(server.remote_logout, header['username'], address)
+        elif op == 'broadcast':
+            server.call_soon(server.remote_broadcast, message)
+        elif op == 'private':
+            server.call_soon(server.remote_private, message, tuple(header['target']))
+        elif op == 'media':
+            server.call_soon(server.store_remote_media, message)
+        elif op == 'offline':
+            server.call_soon(server.remote_offline, tuple(header['target']),
+                             [record.encode('utf-8') for record in header['records']])
+        elif op == 'room_member':
+            session = Session(None, header['username'], tuple(header['address']))
+            server.call_soon(server.notify_room, header['room'], session, header['action'], None, False)
+        elif op in STREAM_OPS:
+            server.call_soon(server.remote_stream, (self, origin), message)
+        else:
+            log.debug("[链路] 未知的操作: %s", op, extra=CONNECTION)
+
+    def drop_node(self, node):
+        """远端节点不再可达：其上的用户全部下线，中止来自它的分块传输，返回下线的人数"""
+        gone = [entry for entry in list(self.users.values()) if entry[0] == node]
+        for _, username, address in gone:
+            self.users.pop(address_key(*address), None)
+            self.server.call_soon(self.server.remote_logout, username, address)
+        self.server.call_soon(self.server.abort_transfers, (self, node))
+        if gone:
+            log.warning("[链路] %s 不再可达，%d 个用户下线", node, len(gone), extra=SESSION)
+        return len(gone)
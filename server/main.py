@@ -1,21 +1,203 @@
-from server import ChatServer
+from server import MAX_FRAME_SIZE, ChatServer
+from async_server import AsyncChatServer
+from chatlog import ERROR, get_logger, load_config, setup_logging
+from history import MessageHistory
+from offline import OfflineQueue
+from media_store import MediaStore
+from cluster import ShardLink, Supervisor
+from federation import FederationLink, parse_peer
+import argparse
+import os
 import signal
+import subprocess
 import sys
+import threading
+
+server = None
+log = get_logger()
 
 def signal_handler(sig, frame):
-    print("\n收到 Ctrl+C 信号，准备关闭服务器...")
+    log.info("收到 Ctrl+C 信号，准备关闭服务器...")
     if server:
         server.stop()
     sys.exit(0)
 
+def reload_config(server, log_config, limits_config):
+    """SIGHUP时重新读取日志配置和发送限额，不需要重启服务器"""
+    def handler(sig, frame):
+        if log_config:
+            try:
+                load_config(log_config)
+                log.info("已重新加载日志配置: %s", log_config)
+            except Exception as e:
+                log.error("加载日志配置失败: %s", e, extra=ERROR)
+        if limits_config and server.rate_limits is not None:
+            try:
+                server.rate_limits.load(limits_config)
+                log.info("已重新加载发送限额: %s", limits_config)
+            except Exception as e:
+                log.error("加载发送限额失败: %s", e, extra=ERROR)
+    return handler
+
+def drain_handler(sig, frame):
+    """SIGTERM：排空后退出，排空在线程中进行，主线程继续接受信号"""
+    log.info("收到 SIGTERM 信号，排空后关闭服务器...")
+    if server:
+        threading.Thread(target=server.drain, daemon=True).start()
+
+def upgrade_handler(sig, frame):
+    """SIGUSR2：用同样的参数启动新进程，由它接管监听socket和所有连接"""
+    argv = [arg for arg in sys.argv[1:] if arg != '--takeover']
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + argv + ['--takeover'])
+    log.info("收到 SIGUSR2 信号，已启动新进程 %s 接管服务器", process.pid)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="局域网聊天室服务端")
+    parser.add_argument('--engine', choices=['thread', 'async'], default='thread',
+                        help="thread: 每个连接一个线程; async: asyncio协程(安装uvloop时自动使用)")
+    parser.add_argument('--io-threads', type=int,
+                        help="async引擎中处理媒体、消息历史和离线消息等读写磁盘的消息的线程数，默认4")
+    parser.add_argument('--host', help="监听地址")
+    parser.add_argument('--port', type=int, help="监听端口")
+    parser.add_argument('--media-dir', help="媒体仓库目录，默认server/media_store")
+    parser.add_argument('--media-quota-mb', type=int, help="媒体仓库容量上限(MB)，超过后按LRU淘汰")
+    parser.add_argument('--history-dir', help="消息历史目录，默认server/history")
+    parser.add_argument('--history-quota-mb', type=int, help="消息历史容量上限(MB)，超过后删除最旧的分段，默认不限")
+    parser.add_argument('--no-history', action='store_true', help="不保存消息历史")
+    parser.add_argument('--offline-dir', help="离线消息超过内存上限时写入的目录，默认server/offline")
+    parser.add_argument('--no-offline', action='store_true', help="目标用户不在线时不暂存私聊消息")
+    parser.add_argument('--max-frame-size', type=int,
+                        help=f"单帧最大字节数，收到长度超过它的帧时断开连接，默认{MAX_FRAME_SIZE}(100MB)")
+    parser.add_argument('--heartbeat-interval', type=float, help="空闲多少秒后向客户端发送ping，0表示不发送，默认30")
+    parser.add_argument('--idle-timeout', type=float, help="多少秒没有收到任何帧则断开连接，0表示不断开，默认90")
+    parser.add_argument('--write-timeout', type=float, help="一帧写入超过多少秒则断开连接，0表示不限，默认30")
+    parser.add_argument('--presence-interval', type=float,
+                        help="合并多少秒内的上线、下线变化再发给支持roster的客户端，0表示立即发送，默认0.2")
+    parser.add_argument('--metrics-port', type=int, help="在本机该端口用HTTP提供/metrics(Prometheus格式)，默认关闭")
+    parser.add_argument('--log-level', help="日志级别，默认INFO；DEBUG时输出每一帧的收发")
+    parser.add_argument('--log-config', help="日志配置文件(JSON)，收到SIGHUP时重新加载")
+    parser.add_argument('--limits-config',
+                        help="每个会话的发送限额(JSON)，收到SIGHUP时重新加载。默认文本每秒5条(突发20)、64KB；"
+                             "媒体每秒5条(突发20)、4MB(突发64MB)；翻页和下载请求每秒10条(突发50)")
+    parser.add_argument('--no-rate-limit', action='store_true', help="不限制发送速率")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="工作进程数，大于1时各进程用SO_REUSEPORT监听同一端口，经本机总线交换消息(仅Linux)")
+    parser.add_argument('--node-id', help="联网时本服务器的节点名，默认为主机名:端口")
+    parser.add_argument('--federation-port', type=int, help="在该端口等待其他服务器连接，与它们组成一个广场")
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help="连接另一台服务器的--federation-port，可以重复")
+    parser.add_argument('--handoff-socket', metavar='PATH',
+                        help="在该Unix socket上等待新进程接管连接，收到SIGUSR2时用同样的参数启动新进程")
+    parser.add_argument('--takeover', action='store_true',
+                        help="从--handoff-socket上运行的旧进程接管监听socket和所有连接，不断开客户端")
+    parser.add_argument('--drain-timeout', type=float,
+                        help="收到SIGTERM时停止接受新连接，最多等待多少秒把发送队列写完再退出，默认30")
+    # 多进程模式下父进程启动工作进程时使用
+    parser.add_argument('--shard', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--bus', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+def run_supervisor(workers):
+    """多进程模式的父进程：每个工作进程用同样的参数重新执行本文件，再加上分片编号和总线地址"""
+    supervisor = Supervisor(workers, lambda shard, bus: [sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
+                            + ['--shard', str(shard), '--bus', bus])
+    def stop(sig, frame):
+        log.info("收到 Ctrl+C 信号，准备关闭所有工作进程...")
+        supervisor.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    supervisor.run()
+
+def shard_directory(directory, shard):
+    """工作进程各自使用数据目录下的shard-N子目录"""
+    return os.path.join(directory, f'shard-{shard}')
+
 if __name__ == '__main__':
+    args = parse_args()
+    if args.workers > 1 and (args.federation_port is not None or args.peer):
+        sys.exit("联网(--federation-port、--peer)不能与多进程模式(--workers)同时使用")
+    if args.workers > 1 and (args.handoff_socket or args.takeover):
+        sys.exit("交接(--handoff-socket、--takeover)不能与多进程模式(--workers)同时使用")
+    if args.takeover and not args.handoff_socket:
+        sys.exit("--takeover需要同时指定--handoff-socket")
+
+    # 日志由后台线程写出
+    setup_logging()
+    if args.log_config:
+        load_config(args.log_config)
+    if args.log_level:
+        setup_logging(args.log_level)
+
+    if args.workers > 1 and args.shard is None:
+        run_supervisor(args.workers)
+        sys.exit(0)
+
     # 注册信号处理函数
     signal.signal(signal.SIGINT, signal_handler)
-    
+
     # 创建并启动服务器
-    server = ChatServer()
+    engine = AsyncChatServer if args.engine == 'async' else ChatServer
+    server = engine(args.max_frame_size or MAX_FRAME_SIZE)
+    if args.io_threads is not None and args.engine == 'async':
+        server.io_threads = args.io_threads
+    if args.media_dir is not None or args.media_quota_mb is not None:
+        server.media_store = MediaStore(
+            args.media_dir or server.media_store.directory,
+            args.media_quota_mb * 1024 * 1024 if args.media_quota_mb is not None else server.media_store.quota_bytes
+        )
+    if args.no_history:
+        server.history = None
+    elif args.history_dir is not None or args.history_quota_mb is not None:
+        server.history = MessageHistory(
+            args.history_dir or server.history.directory,
+            retention_bytes=args.history_quota_mb * 1024 * 1024 if args.history_quota_mb is not None else None
+        )
+    if args.no_offline:
+        server.offline = None
+    elif args.offline_dir is not None:
+        server.offline = OfflineQueue(args.offline_dir)
+    for name in ('heartbeat_interval', 'idle_timeout', 'write_timeout', 'presence_interval'):
+        value = getattr(args, name)
+        if value is not None:
+            setattr(server, name, value or None)
+    if args.no_rate_limit:
+        server.rate_limits = None
+    elif args.limits_config:
+        server.rate_limits.load(args.limits_config)
+    if (args.log_config or args.limits_config) and hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload_config(server, args.log_config, args.limits_config))
+    if args.metrics_port is not None:
+        server.metrics_port = args.metrics_port
+    if args.drain_timeout is not None:
+        server.drain_timeout = args.drain_timeout
+    signal.signal(signal.SIGTERM, drain_handler)
+    if args.handoff_socket:
+        server.handoff_path = args.handoff_socket
+        server.takeover = args.takeover
+        signal.signal(signal.SIGUSR2, upgrade_handler)
+    if args.shard is not None:
+        # 工作进程：与其他工作进程共用端口，数据目录按分片分开，指标端口依次加一
+        server.reuse_port = True
+        server.media_store = MediaStore(shard_directory(server.media_store.directory, args.shard),
+                                        server.media_store.quota_bytes)
+        if server.history is not None:
+            server.history = MessageHistory(shard_directory(server.history.directory, args.shard),
+                                            retention_bytes=server.history.retention_bytes)
+        if server.offline is not None:
+            server.offline = OfflineQueue(shard_directory(server.offline.directory, args.shard))
+        if server.metrics_port is not None:
+            server.metrics_port += args.shard
+        server.links.append(ShardLink(server, args.bus, args.shard))
+    if args.federation_port is not None or args.peer:
+        listen = (args.host or '', args.federation_port) if args.federation_port is not None else None
+        server.links.append(FederationLink(server, args.node_id, listen, [parse_peer(p) for p in args.peer]))
+    start_args = {}
+    if args.host is not None:
+        start_args['host'] = args.host
+    if args.port is not None:
+        start_args['port'] = args.port
     try:
-        server.start()
+        server.start(**start_args)
     except KeyboardInterrupt:
-        print("\n收到 Ctrl+C 信号，准备关闭服务器...")
-        server.stop()
\ No newline at end of file
+        log.info("收到 Ctrl+C 信号，准备关闭服务器...")
+        server.stop()
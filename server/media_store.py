@@ -0,0 +1,235 @@
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from protocol import media_hash, new_media_hasher
+from serializers import JSON
+
+
+class MediaStore:
+    """按内容哈希存放媒体数据的磁盘仓库
+
+    文件保存在 directory/<哈希前两位>/<哈希>，总大小超过quota_bytes时按最近最少使用淘汰。
+    启动时扫描目录恢复索引，按文件修改时间排列使用顺序。读取返回mmap映射的memoryview，
+    只转发引用的接收者不会让数据进入内存。
+    每个哈希还记录引用过它的会话(追加到directory/refs)，服务器据此决定谁可以索取。
+    """
+
+    def __init__(self, directory, quota_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        self._index = OrderedDict()     # {哈希: 字节数}，末尾是最近使用的
+        self._references = {}           # {哈希: 引用过它的会话名集合}
+        self.bytes_stored = 0
+        self._loaded = False
+
+        # 统计计数
+        self.hits = 0                   # 客户端提供的哈希已存在
+        self.misses = 0
+        self.bytes_saved = 0            # 因去重而不必上传的字节数
+        self.evictions = 0
+
+    def _path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def _load(self):
+        """第一次使用时扫描目录，恢复上次运行留下的文件"""
+        if self._loaded:
+            return
+        self._loaded = True
+        entries = []
+        if os.path.isdir(self.directory):
+            for prefix in os.listdir(self.directory):
+                subdir = os.path.join(self.directory, prefix)
+                if not os.path.isdir(subdir):
+                    continue
+                for name in os.listdir(subdir):
+                    if name.startswith('.'):
+                        continue  # 未完成的临时文件
+                    st = os.stat(os.path.join(subdir, name))
+                    entries.append((st.st_mtime, name, st.st_size))
+        for _, digest, size in sorted(entries):
+            self._index[digest] = size
+            self.bytes_stored += size
+        self._evict_locked()
+        self._load_references()
+
+    def _load_references(self):
+        """读取引用记录，已不在仓库中的哈希的记录被丢弃，丢弃较多时重写文件"""
+        path = os.path.join(self.directory, 'refs')
+        lines = 0
+        try:
+            with open(path, 'rb') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        digest, conversation = JSON.loads(line)
+                    except (ValueError, TypeError):
+                        continue  # 异常退出时写了一半的行
+                    if digest in self._index:
+                        self._references.setdefault(digest, set()).add(conversation)
+        except OSError:
+            return
+        kept = sum(len(conversations) for conversations in self._references.values())
+        if lines > 2 * kept:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                for digest, conversations in self._references.items():
+                    for conversation in conversations:
+                        f.write(JSON.dumps([digest, conversation]) + b'\n')
+            os.replace(tmp_path, path)
+
+    def __contains__(self, digest):
+        with self._lock:
+            self._load()
+            return digest in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def lookup(self, digest):
+        """查找并标记为最近使用，返回字节数，不存在返回None"""
+        with self._lock:
+            self._load()
+            size = self._index.get(digest)
+            if size is None:
+                self.misses += 1
+                return None
+            self._index.move_to_end(digest)
+            self.hits += 1
+            self.bytes_saved += size
+            return size
+
+    def add_reference(self, digest, conversation):
+        """记录会话中出现了该哈希的媒体"""
+        with self._lock:
+            self._load()
+            conversations = self._references.setdefault(digest, set())
+            if conversation in conversations:
+                return
+            conversations.add(conversation)
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, 'refs'), 'ab') as f:
+                f.write(JSON.dumps([digest, conversation]) + b'\n')
+
+    def references(self, digest):
+        """引用过该哈希的会话名"""
+        with self._lock:
+            self._load()
+            return set(self._references.get(digest, ()))
+
+    def get(self, digest):
+        """以memoryview返回文件内容(mmap映射)，不存在返回None"""
+        with self._lock:
+            self._load()
+            if digest not in self._index:
+                return None
+            self._index.move_to_end(digest)
+            path = self._path(digest)
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return memoryview(b'')
+                return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        except OSError:
+            self._discard(digest)
+            return None
+
+    def put(self, data, expected=None):
+        """保存数据并返回哈希；expected与实际哈希不一致时不保存，返回None"""
+        digest = media_hash(data)
+        if expected is not None and digest != expected:
+            return None
+        writer = self.open_writer(digest)
+        writer.write(data)
+        return writer.commit()
+
+    def open_writer(self, digest=None):
+        """分块写入，用于分块传输的数据边转发边落盘；digest是已经算好的哈希，写入时不再计算"""
+        return MediaWriter(self, digest)
+
+    def _add(self, digest, tmp_path, size):
+        """把写好的临时文件登记为正式文件"""
+        if size > self.quota_bytes:
+            os.unlink(tmp_path)
+            return None
+        with self._lock:
+            self._load()
+            if digest in self._index:
+                os.unlink(tmp_path)
+                self._index.move_to_end(digest)
+                return digest
+            os.replace(tmp_path, self._path(digest))
+            self._index[digest] = size
+            self.bytes_stored += size
+            self._evict_locked()
+        return digest
+
+    def _evict_locked(self):
+        while self.bytes_stored > self.quota_bytes and self._index:
+            digest, size = self._index.popitem(last=False)
+            self.bytes_stored -= size
+            self.evictions += 1
+            try:
+                os.unlink(self._path(digest))  # 已映射的数据在映射释放前仍然可读
+            except OSError:
+                pass
+
+    def _discard(self, digest):
+        with self._lock:
+            size = self._index.pop(digest, None)
+            if size is not None:
+                self.bytes_stored -= size
+
+    def stats(self):
+        return {
+            'files': len(self._index),
+            'bytes_stored': self.bytes_stored,
+            'quota_bytes': self.quota_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'bytes_saved': self.bytes_saved,
+            'evictions': self.evictions,
+        }
+
+
+class MediaWriter:
+    """写入临时文件并同时计算哈希，commit时校验后登记到仓库"""
+
+    def __init__(self, store, digest=None):
+        self.store = store
+        self.digest = digest
+        self.hasher = new_media_hasher() if digest is None else None
+        self.size = 0
+        self._file = None
+
+    def write(self, data):
+        if self._file is None:
+            subdir = os.path.join(self.store.directory, 'tmp')
+            os.makedirs(subdir, exist_ok=True)
+            self._file = tempfile.NamedTemporaryFile(dir=subdir, prefix='.', delete=False)
+        self._file.write(data)
+        if self.hasher is not None:
+            self.hasher.update(data)
+        self.size += len(data)
+
+    def commit(self, expected=None):
+        """哈希与expected一致时登记并返回哈希，否则丢弃并返回None"""
+        if self._file is None:
+            self.write(b'')
+        self._file.close()
+        digest = self.digest if self.hasher is None else self.hasher.hexdigest()
+        if expected is not None and digest != expected:
+            os.unlink(self._file.name)
+            return None
+        os.makedirs(os.path.dirname(self.store._path(digest)), exist_ok=True)
+        return self.store._add(digest, self._file.name, self.size)
+
+    def abort(self):
+        if self._file is not None:
+            self._file.close()
+            os.unlink(self._file.name)
+            self._file = None
@@ -0,0 +1,252 @@
+"""服务器运行指标：计数器和直方图，以Prometheus文本格式导出
+
+计数数组(分片)的数量固定，每个线程第一次记录时轮流分到其中一个，之后只对这个分片做加法，
+每个分片一把锁，分到同一分片的线程才会竞争；导出时把所有分片相加。
+内存只与分片数量有关，不随连接(读取线程)数增长。
+"""
+import itertools
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from protocol import TYPE_CODES, TYPE_NAMES
+
+TYPE_SLOTS = 256  # 类型码占1字节，0表示未知类型
+STAGE_SLOTS = 32  # 分发阶段(中间件和处理函数)的数量上限
+
+# 直方图桶的上限(秒)
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# 单个计数器 (名称, 说明)，用下面的下标调用Metrics.incr
+SCALARS = (
+    ('connections_total', '接受的连接数'),
+    ('logins_total', '登录次数，登录速率用rate()计算'),
+    ('logouts_total', '登出次数(包括断开)'),
+    ('send_failures_total', '发送失败次数(入队失败或写socket失败)'),
+    ('connections_reaped_total', '因心跳超时、写入超时或未登录被断开的连接数'),
+    ('rate_limited_total', '超过发送限额被拒绝的帧数'),
+)
+CONNECTIONS, LOGINS, LOGOUTS, SEND_FAILURES, REAPED, RATE_LIMITED = range(len(SCALARS))
+
+
+class Shard:
+    """若干线程共用的计数数组，修改时持有lock"""
+
+    __slots__ = ('lock', 'scalars', 'frames_in', 'bytes_in', 'frames_out', 'bytes_out',
+                 'handler_buckets', 'handler_sum', 'stage_buckets', 'stage_sum',
+                 'fanout_buckets', 'fanout_sum', 'fanout_recipients')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.scalars = [0] * len(SCALARS)
+        self.frames_in = [0] * TYPE_SLOTS
+        self.bytes_in = [0] * TYPE_SLOTS
+        self.frames_out = [0] * TYPE_SLOTS
+        self.bytes_out = [0] * TYPE_SLOTS
+        # 每种消息类型一个直方图，最后一个桶是+Inf
+        self.handler_buckets = [[0] * (len(LATENCY_BUCKETS) + 1) for _ in range(TYPE_SLOTS)]
+        self.handler_sum = [0.0] * TYPE_SLOTS
+        self.stage_buckets = [[0] * (len(LATENCY_BUCKETS) + 1) for _ in range(STAGE_SLOTS)]
+        self.stage_sum = [0.0] * STAGE_SLOTS
+        self.fanout_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.fanout_sum = 0.0
+        self.fanout_recipients = 0
+
+    def merge(self, other):
+        for name in ('scalars', 'frames_in', 'bytes_in', 'frames_out', 'bytes_out', 'handler_sum', 'stage_sum',
+                     'fanout_buckets'):
+            mine, theirs = getattr(self, name), getattr(other, name)
+            for i, value in enumerate(theirs):
+                if value:
+                    mine[i] += value
+        for mine, theirs in zip(self.handler_buckets + self.stage_buckets,
+                                other.handler_buckets + other.stage_buckets):
+            if any(theirs):
+                for i, value in enumerate(theirs):
+                    mine[i] += value
+        self.fanout_sum += other.fanout_sum
+        self.fanout_recipients += other.fanout_recipients
+
+
+class Metrics:
+    """ChatServer的运行指标，shards是分片数量"""
+
+    def __init__(self, shards=16):
+        self._lock = threading.Lock()   # 只在登记分发阶段时使用
+        self._local = threading.local()
+        self._shards = [Shard() for _ in range(shards)]
+        self._next = itertools.count()  # 线程轮流分到的分片
+        self._stages = {}               # {阶段名称: 下标}
+        self.started = time.time()
+
+    def shard(self):
+        """当前线程的分片"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._shards[next(self._next) % len(self._shards)]
+            return shard
+
+    def retire(self):
+        """线程退出前调用，计数留在分片中，只释放线程对分片的引用"""
+        if hasattr(self._local, 'shard'):
+            del self._local.shard
+
+    def incr(self, index, n=1):
+        shard = self.shard()
+        with shard.lock:
+            shard.scalars[index] += n
+
+    def frame_in(self, message_type, nbytes):
+        shard = self.shard()
+        code = TYPE_CODES.get(message_type, 0)
+        with shard.lock:
+            shard.frames_in[code] += 1
+            shard.bytes_in[code] += nbytes
+
+    def frame_out(self, message_type, nbytes):
+        shard = self.shard()
+        code = TYPE_CODES.get(message_type, 0)
+        with shard.lock:
+            shard.frames_out[code] += 1
+            shard.bytes_out[code] += nbytes
+
+    def observe_handler(self, message_type, seconds):
+        shard = self.shard()
+        code = TYPE_CODES.get(message_type, 0)
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with shard.lock:
+            shard.handler_buckets[code][bucket] += 1
+            shard.handler_sum[code] += seconds
+
+    def observe_stage(self, stage, seconds):
+        """记录分发中一个阶段(中间件或处理函数)的耗时"""
+        index = self._stages.get(stage)
+        if index is None:
+            index = self._stage_index(stage)
+        shard = self.shard()
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with shard.lock:
+            shard.stage_buckets[index][bucket] += 1
+            shard.stage_sum[index] += seconds
+
+    def _stage_index(self, stage):
+        with self._lock:
+            if stage not in self._stages:
+                if len(self._stages) >= STAGE_SLOTS:
+                    raise ValueError(f"分发阶段超过 {STAGE_SLOTS} 个")
+                self._stages[stage] = len(self._stages)
+            return self._stages[stage]
+
+    def observe_fanout(self, seconds, recipients):
+        shard = self.shard()
+        bucket = bisect_left(LATENCY_BUCKETS, seconds)
+        with shard.lock:
+            shard.fanout_buckets[bucket] += 1
+            shard.fanout_sum += seconds
+            shard.fanout_recipients += recipients
+
+    def totals(self):
+        """所有分片相加的结果"""
+        total = Shard()
+        for shard in self._shards:
+            with shard.lock:
+                total.merge(shard)
+        return total
+
+    def render(self, gauges=()):
+        """生成Prometheus文本格式，gauges是[(名称, 说明, 值)]"""
+        total = self.totals()
+        lines = []
+
+        def metric(name, kind, doc):
+            lines.append(f"# HELP lanchat_{name} {doc}")
+            lines.append(f"# TYPE lanchat_{name} {kind}")
+
+        for i, (name, doc) in enumerate(SCALARS):
+            metric(name, 'counter', doc)
+            lines.append(f"lanchat_{name} {total.scalars[i]}")
+
+        for name, values, doc in (
+                ('frames_in_total', total.frames_in, '收到的帧数'),
+                ('bytes_in_total', total.bytes_in, '收到的字节数(含长度前缀)'),
+                ('frames_out_total', total.frames_out, '放入发送队列的帧数'),
+                ('bytes_out_total', total.bytes_out, '放入发送队列的字节数')):
+            metric(name, 'counter', doc)
+            for code, value in enumerate(values):
+                if value:
+                    lines.append(f'lanchat_{name}{{type="{type_label(code)}"}} {value}')
+
+        metric('handler_seconds', 'histogram', 'process_message按消息类型的处理耗时')
+        for code, buckets in enumerate(total.handler_buckets):
+            if any(buckets):
+                histogram(lines, 'handler_seconds', buckets, total.handler_sum[code],
+                          f'type="{type_label(code)}",')
+
+        metric('stage_seconds', 'histogram', '分发中每个中间件和处理函数的耗时')
+        for stage, index in list(self._stages.items()):
+            histogram(lines, 'stage_seconds', total.stage_buckets[index], total.stage_sum[index],
+                      f'stage="{stage}",')
+
+        metric('fanout_seconds', 'histogram', '一次广播把帧放入所有接收者队列的耗时')
+        histogram(lines, 'fanout_seconds', total.fanout_buckets, total.fanout_sum, '')
+        metric('fanout_recipients_total', 'counter', '广播的接收者总数')
+        lines.append(f"lanchat_fanout_recipients_total {total.fanout_recipients}")
+
+        metric('uptime_seconds', 'gauge', '运行时间')
+        lines.append(f"lanchat_uptime_seconds {time.time() - self.started:.3f}")
+        for name, doc, value in gauges:
+            metric(name, 'gauge', doc)
+            lines.append(f"lanchat_{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def type_label(code):
+    return TYPE_NAMES.get(code, 'other')
+
+
+def histogram(lines, name, buckets, total_sum, labels):
+    cumulative = 0
+    for bound, count in zip(LATENCY_BUCKETS, buckets):
+        cumulative += count
+        lines.append(f'lanchat_{name}_bucket{{{labels}le="{bound}"}} {cumulative}')
+    cumulative += buckets[-1]
+    lines.append(f'lanchat_{name}_bucket{{{labels}le="+Inf"}} {cumulative}')
+    labels = labels.rstrip(',')
+    suffix = f'{{{labels}}}' if labels else ''
+    lines.append(f"lanchat_{name}_sum{suffix} {total_sum:.6f}")
+    lines.append(f"lanchat_{name}_count{suffix} {cumulative}")
+
+
+class MetricsServer:
+    """在本地端口上用HTTP提供/metrics，运行在后台线程中"""
+
+    def __init__(self, server, host, port):
+        chat_server = server
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?', 1)[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = chat_server.render_metrics().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # 抓取请求不写日志
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,156 @@
+"""离线消息：目标用户不在线时暂存私聊消息，在其下次登录时一次发出
+
+每个接收者(按地址'ip:port'区分)一个队列，消息在放入时编码成JSON片段，媒体只有引用。
+所有队列在内存中的总大小超过memory_bytes时，把最大的队列整体追加到磁盘文件，
+因此磁盘上总是较早的部分、内存中是较新的部分，取出时按顺序拼接。
+每个接收者按条数和字节数限制，内存和磁盘上的总大小超过memory_bytes + disk_bytes时拒绝新的消息。
+"""
+import hashlib
+import os
+import struct
+import threading
+
+from protocol import EncodedFrame
+from serializers import JSON
+
+RECORD_LENGTH = struct.Struct('!I')
+
+
+def recipient_id(address):
+    """接收者的标识'ip:port'，与私聊会话名中的地址格式相同"""
+    ip, port = address
+    return f'{ip}:{int(port)}'
+
+
+class OfflineQueue:
+    """所有离线接收者的消息队列"""
+
+    def __init__(self, directory, memory_bytes=8 * 1024 * 1024, disk_bytes=256 * 1024 * 1024,
+                 max_messages=1000, max_bytes=4 * 1024 * 1024):
+        self.directory = directory
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.max_messages = max_messages    # 每个接收者最多暂存的条数
+        self.max_bytes = max_bytes          # 每个接收者最多暂存的字节数
+        self._lock = threading.Lock()
+        self._memory = {}                   # {接收者: [JSON片段]}
+        self._memory_size = {}              # {接收者: 内存中的字节数}
+        self._usage = {}                    # {接收者: [条数, 字节数]}，包括磁盘上的部分
+        self.bytes_in_memory = 0
+        self.bytes_on_disk = None           # 第一次使用时统计
+
+        # 统计计数
+        self.queued = 0
+        self.delivered = 0
+        self.rejected = 0
+        self.spills = 0
+
+    def _path(self, recipient):
+        name = hashlib.blake2b(recipient.encode(), digest_size=16).hexdigest()
+        return os.path.join(self.directory, name + '.queue')
+
+    def _disk_total(self):
+        if self.bytes_on_disk is None:
+            total = 0
+            if os.path.isdir(self.directory):
+                for name in os.listdir(self.directory):
+                    if name.endswith('.queue'):
+                        total += os.path.getsize(os.path.join(self.directory, name))
+            self.bytes_on_disk = total
+        return self.bytes_on_disk
+
+    def _usage_of(self, recipient):
+        """接收者已暂存的条数和字节数，上次运行留下的文件在第一次用到时统计"""
+        usage = self._usage.get(recipient)
+        if usage is None:
+            usage = self._usage[recipient] = [0, 0]
+            for record in self._read_disk(recipient):
+                usage[0] += 1
+                usage[1] += len(record)
+        return usage
+
+    def _read_disk(self, recipient):
+        try:
+            with open(self._path(recipient), 'rb') as f:
+                data = f.read()
+        except OSError:
+            return []
+        records = []
+        offset = 0
+        while offset + RECORD_LENGTH.size <= len(data):
+            (length,) = RECORD_LENGTH.unpack_from(data, offset)
+            start = offset + RECORD_LENGTH.size
+            if start + length > len(data):
+                break  # 写了一半的记录
+            records.append(data[start:start + length])
+            offset = start + length
+        return records
+
+    def put(self, recipient, message):
+        """暂存一条消息，超过限制时返回False"""
+        encoded = JSON.dumps(message)
+        with self._lock:
+            usage = self._usage_of(recipient)
+            total = self._disk_total() + self.bytes_in_memory + len(encoded)
+            if (usage[0] >= self.max_messages or usage[1] + len(encoded) > self.max_bytes
+                    or total > self.memory_bytes + self.disk_bytes):
+                self.rejected += 1
+                return False
+            self._memory.setdefault(recipient, []).append(encoded)
+            self._memory_size[recipient] = self._memory_size.get(recipient, 0) + len(encoded)
+            self.bytes_in_memory += len(encoded)
+            usage[0] += 1
+            usage[1] += len(encoded)
+            self.queued += 1
+            while self.bytes_in_memory > self.memory_bytes:
+                self._spill_locked()
+            return True
+
+    def _spill_locked(self):
+        """把内存中最大的队列追加到磁盘"""
+        recipient = max(self._memory_size, key=self._memory_size.get)
+        records = self._memory.pop(recipient)
+        self.bytes_in_memory -= self._memory_size.pop(recipient)
+        data = b''.join(RECORD_LENGTH.pack(len(r)) + r for r in records)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(recipient), 'ab') as f:
+            f.write(data)
+        self.bytes_on_disk = self._disk_total() + len(data)
+        self.spills += 1
+
+    def take(self, recipient):
+        """取出并清空接收者的队列，返回JSON片段列表，从旧到新"""
+        with self._lock:
+            records = self._read_disk(recipient)
+            path = self._path(recipient)
+            if os.path.exists(path):
+                self.bytes_on_disk = self._disk_total() - os.path.getsize(path)
+                os.unlink(path)
+            records += self._memory.pop(recipient, [])
+            self.bytes_in_memory -= self._memory_size.pop(recipient, 0)
+            self._usage.pop(recipient, None)
+            self.delivered += len(records)
+            return records
+
+    def flush(self):
+        """把内存中的队列全部写入磁盘，服务器关闭时调用，下次启动后仍可投递"""
+        with self._lock:
+            while self._memory:
+                self._spill_locked()
+
+    def stats(self):
+        return {
+            'recipients': len(self._usage),
+            'bytes_in_memory': self.bytes_in_memory,
+            'bytes_on_disk': self.bytes_on_disk or 0,
+            'queued': self.queued,
+            'delivered': self.delivered,
+            'rejected': self.rejected,
+            'spills': self.spills,
+        }
+
+
+def offline_frame(records):
+    """把离线消息的JSON片段拼接成一个offline帧"""
+    meta = b''.join((b'{"messages":[', b','.join(records), b']}'))
+    return EncodedFrame({'type': 'offline', 'count': len(records)}, meta)
@@ -0,0 +1,157 @@
+import asyncio
+import threading
+from collections import deque
+
+# 队列满时可以被丢弃的消息类型（媒体消息体积大，丢弃后不影响会话状态）
+DROPPABLE_TYPES = {
+    'square_image', 'private_image',
+    'square_video', 'private_video',
+    'square_file', 'private_file',
+    'square_audio', 'private_audio',
+}
+
+
+class OutboundPolicy:
+    """慢消费者策略
+
+    max_bytes: 队列积压超过该值后开始丢弃最旧的媒体帧(drop_oldest_media为True时)
+    disconnect_bytes: 丢弃后积压仍超过该值则断开该客户端
+    """
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, disconnect_bytes=128 * 1024 * 1024,
+                 drop_oldest_media=True):
+        self.max_bytes = max_bytes
+        self.disconnect_bytes = disconnect_bytes
+        self.drop_oldest_media = drop_oldest_media
+
+
+class OutboundQueue:
+    """单个连接的有界发送队列，由该连接专属的写线程消费"""
+
+    def __init__(self, policy):
+        self.policy = policy
+        self.frames = deque()       # [(parts, size, droppable)]
+        self.cond = threading.Condition()
+        self.closed = False
+        self.writing = False        # 写线程取出的一帧还没有写完
+
+        # 统计计数
+        self.bytes_queued = 0       # 当前积压字节数
+        self.high_water = 0         # 历史最大积压字节数
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.frames_dropped = 0
+        self.bytes_dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    def put(self, parts, droppable=False):
+        """放入一帧(Frame.encode返回的若干段缓冲区)，返回False表示积压超过断开阈值，调用方应断开该连接"""
+        size = sum(len(p) for p in parts)
+        with self.cond:
+            if self.closed:
+                return True
+            if self.bytes_queued + size > self.policy.max_bytes and self.policy.drop_oldest_media:
+                self._drop_media(self.bytes_queued + size - self.policy.max_bytes)
+            if self.bytes_queued + size > self.policy.disconnect_bytes:
+                return False
+            self.frames.append((parts, size, droppable))
+            self.bytes_queued += size
+            if self.bytes_queued > self.high_water:
+                self.high_water = self.bytes_queued
+            self.cond.notify()
+        self._wakeup()
+        return True
+
+    def _drop_media(self, need):
+        """从队首开始丢弃媒体帧，直到腾出need字节"""
+        kept = deque()
+        freed = 0
+        while self.frames:
+            frame = self.frames.popleft()
+            if freed < need and frame[2]:
+                freed += frame[1]
+                self.frames_dropped += 1
+                self.bytes_dropped += frame[1]
+            else:
+                kept.append(frame)
+        self.frames = kept
+        self.bytes_queued -= freed
+
+    def _pop(self):
+        parts, size, _ = self.frames.popleft()
+        self.writing = True
+        self.bytes_queued -= size
+        self.frames_sent += 1
+        self.bytes_sent += size
+        return parts
+
+    def get(self):
+        """阻塞直到取出一帧，队列关闭后返回None；上一帧在这之前已经写完"""
+        with self.cond:
+            self.writing = False
+            while not self.frames and not self.closed:
+                self.cond.wait()
+            if self.closed:
+                return None
+            return self._pop()
+
+    def flushed(self):
+        """所有帧都已写出(交接和排空时等待)"""
+        with self.cond:
+            return not self.frames and not self.writing
+
+    def close(self):
+        """关闭队列并丢弃尚未发送的帧"""
+        with self.cond:
+            self.closed = True
+            self.frames.clear()
+            self.bytes_queued = 0
+            self.cond.notify_all()
+        self._wakeup()
+
+    def _wakeup(self):
+        pass
+
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'bytes_queued': self.bytes_queued,
+            'high_water': self.high_water,
+            'frames_sent': self.frames_sent,
+            'bytes_sent': self.bytes_sent,
+            'frames_dropped': self.frames_dropped,
+            'bytes_dropped': self.bytes_dropped,
+        }
+
+
+class AsyncOutboundQueue(OutboundQueue):
+    """asyncio引擎使用的发送队列，由写协程消费"""
+
+    def __init__(self, policy, loop):
+        super().__init__(policy)
+        self.loop = loop
+        self.ready = asyncio.Event()
+
+    def _wakeup(self):
+        try:
+            in_loop = asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            in_loop = False
+        if in_loop:
+            self.ready.set()
+        else:
+            self.loop.call_soon_threadsafe(self.ready.set)
+
+    async def get_async(self):
+        """等待直到取出一帧，队列关闭后返回None"""
+        while True:
+            with self.cond:
+                self.writing = False
+                if self.closed:
+                    return None
+                if self.frames:
+                    return self._pop()
+                self.ready.clear()
+            await self.ready.wait()
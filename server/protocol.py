@@ -0,0 +1,295 @@
+import base64
+import hashlib
+import struct
+
+from serializers import CODEC_IDS, JSON, get_codec
+
+# 协议版本：1 = 长度前缀 + JSON；2 = 长度前缀 + 二进制头 + 元数据 + 原始二进制消息体
+PROTOCOL_VERSION = 2
+
+# v2帧头: 魔数(1字节) 类型码(1字节) 标志位(2字节) 元数据长度(4字节)
+# 魔数不是'{'，接收方看第一个字节就能区分v1和v2，不需要额外的状态
+V2_MAGIC = 0xB2
+V2_HEADER = struct.Struct('!BBHI')
+
+FLAG_BODY = 0x0001  # 帧带有原始二进制消息体
+# 标志位的8~11位是元数据的编码(serializers.CODEC_IDS)，0为JSON，与旧版本兼容
+CODEC_SHIFT = 8
+CODEC_MASK = 0x0F00
+
+# 类型码，0表示类型名写在元数据的type字段中
+TYPE_CODES = {
+    'login': 1,
+    'logout': 2,
+    'old_friend_list': 3,
+    'new_friend_login': 4,
+    'one_user_logout': 5,
+    'square_message': 6,
+    'private_message': 7,
+    'square_image': 8,
+    'private_image': 9,
+    'square_video': 10,
+    'private_video': 11,
+    'square_file': 12,
+    'private_file': 13,
+    'square_audio': 14,
+    'private_audio': 15,
+    'stream_begin': 16,
+    'stream_chunk': 17,
+    'stream_end': 18,
+    'stream_abort': 19,
+    'media_status': 20,
+    'media_fetch': 21,
+    'media_data': 22,
+    'history': 23,
+    'history_request': 24,
+    'offline': 25,
+    'delivery_status': 26,
+    'ping': 27,
+    'pong': 28,
+    'error': 29,
+    'roster_delta': 30,
+    'room_join': 31,
+    'room_leave': 32,
+    'room_joined': 33,
+    'room_member': 34,
+    'room_list': 35,
+}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+# 媒体消息中携带二进制数据的字段
+MEDIA_FIELDS = {
+    'square_image': 'image_data', 'private_image': 'image_data',
+    'square_video': 'video_data', 'private_video': 'video_data',
+    'square_file': 'file_data', 'private_file': 'file_data',
+    'square_audio': 'audio_data', 'private_audio': 'audio_data',
+    'stream_chunk': 'data',
+    'media_data': 'data',
+}
+
+
+class MediaKind:
+    """一种媒体的描述，广场和私聊两种消息类型共用，通用的媒体处理函数按描述取字段"""
+
+    __slots__ = ('name', 'label', 'data_field', 'ext_field', 'optional_fields')
+
+    def __init__(self, name, label, optional_fields=()):
+        self.name = name
+        self.label = label                      # 日志中的名称
+        self.data_field = f'{name}_data'
+        self.ext_field = f'{name}_ext'
+        self.optional_fields = ('media_hash',) + tuple(optional_fields)  # 有值时原样转发
+
+
+MEDIA_KINDS = {
+    'image': MediaKind('image', '图片', ('thumbnail',)),
+    'video': MediaKind('video', '视频'),
+    'file': MediaKind('file', '文件'),
+    'audio': MediaKind('audio', '音频'),
+}
+# 媒体消息类型 -> (媒体描述, 是否私聊)
+MEDIA_MESSAGE_TYPES = {
+    f'{scope}_{name}': (kind, scope == 'private')
+    for name, kind in MEDIA_KINDS.items() for scope in ('square', 'private')
+}
+
+# 分块传输：大于STREAM_THRESHOLD的媒体拆成不超过STREAM_CHUNK_SIZE的块逐块发送，
+# 服务器收到一块转发一块，不需要缓存整个文件
+STREAM_THRESHOLD = 1024 * 1024
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# 登录时协商的可选功能
+# media_ref: 媒体消息可以只携带内容哈希(media_hash)和大小(media_size)，
+#            接收方本地没有该内容时再用media_fetch向服务器索取
+# history: 登录后收到各会话最近消息的history帧，可以用history_request向前翻页
+# offline: 登录时把不在线期间收到的私聊消息放在一个offline帧中，私聊对方不在线时收到delivery_status
+# heartbeat: 空闲时双方互发ping，收到ping回复pong；长时间收不到任何帧的连接被断开
+# roster: 在线用户列表带版本号，其他用户的上线、下线合并后以roster_delta发送，重新登录时可以只取变化
+# rooms: 可以加入、离开命名的聊天室，带room字段的广场消息只发给该聊天室的成员
+SUPPORTED_FEATURES = ('media_ref', 'history', 'offline', 'heartbeat', 'roster', 'rooms')
+
+# 可以用内容哈希引用的媒体消息类型
+MEDIA_REF_TYPES = frozenset(t for t in MEDIA_FIELDS if t not in ('stream_chunk', 'media_data'))
+# 可以带room字段发到聊天室的消息类型(广场消息的聊天室版本)，分块传输在stream_begin中带room字段
+SQUARE_MESSAGE_TYPES = frozenset(['square_message'] + [t for t, (_, private) in MEDIA_MESSAGE_TYPES.items()
+                                                       if not private])
+
+
+def negotiate_protocol(login_message):
+    """根据登录消息中客户端声明的协议版本，选出双方都支持的最高版本"""
+    try:
+        requested = int(login_message.get('protocol', 1))
+    except (TypeError, ValueError):
+        requested = 1
+    return max(1, min(requested, PROTOCOL_VERSION))
+
+
+def negotiate_features(login_message):
+    """登录消息中客户端声明的功能与服务器支持的功能取交集"""
+    requested = login_message.get('features')
+    if not isinstance(requested, list):
+        return ()
+    return tuple(f for f in SUPPORTED_FEATURES if f in requested)
+
+
+def new_media_hasher():
+    """媒体内容哈希：BLAKE2b，256位"""
+    return hashlib.blake2b(digest_size=32)
+
+
+def media_hash(data):
+    """计算媒体数据的内容哈希(十六进制字符串)"""
+    hasher = new_media_hasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def is_media_hash(value):
+    """检查是否是合法的内容哈希，避免把对端传来的任意字符串当作文件名"""
+    return (isinstance(value, str) and len(value) == 64
+            and all(c in '0123456789abcdef' for c in value))
+
+
+def media_reference(message):
+    """去掉媒体数据，只保留内容哈希和大小的引用消息"""
+    field = MEDIA_FIELDS[message['type']]
+    reference = {k: v for k, v in message.items() if k != field}
+    if message.get(field) is not None:
+        reference['media_size'] = len(message[field])
+    return reference
+
+
+def encode_v1(message):
+    """编码为v1负载(JSON)，二进制媒体数据转换为base64字符串"""
+    field = MEDIA_FIELDS.get(message.get('type'))
+    if field and isinstance(message.get(field), (bytes, bytearray, memoryview)):
+        message = dict(message)
+        message[field] = base64.b64encode(message[field]).decode('ascii')
+    return JSON.dumps(message)
+
+
+def encode_v2_parts(message, codec=JSON):
+    """编码为v2负载，返回(帧头 + 元数据, 原始二进制消息体)
+
+    元数据按codec编码，消息体原样返回（可以是memoryview），调用方可以分段发送而不必拼接复制。
+    """
+    message_type = message.get('type')
+    code = TYPE_CODES.get(message_type, 0)
+    field = MEDIA_FIELDS.get(message_type)
+
+    body = b''
+    flags = codec.id << CODEC_SHIFT
+    meta = {}
+    for key, value in message.items():
+        if key == field and value is not None:
+            body = base64.b64decode(value) if isinstance(value, str) else value
+            flags |= FLAG_BODY
+        elif key != 'type' or code == 0:
+            meta[key] = value
+    meta_bytes = codec.dumps(meta)
+    return V2_HEADER.pack(V2_MAGIC, code, flags, len(meta_bytes)) + meta_bytes, body
+
+
+def encode_v2(message, codec=JSON):
+    """编码为v2负载：帧头 + 元数据 + 原始二进制消息体"""
+    return b''.join(encode_v2_parts(message, codec))
+
+
+def decode_payload(payload, copy_body=True):
+    """解码一帧的负载（不含4字节长度），自动识别v1/v2
+
+    v2帧只解析帧头和元数据(按帧头中记录的编码)，消息体不做任何解析。copy_body为False时消息体是
+    payload上的memoryview切片，调用方需保证payload之后不会被复用。
+    """
+    if not payload or payload[0] != V2_MAGIC:
+        return JSON.loads(payload)
+
+    _, code, flags, meta_len = V2_HEADER.unpack_from(payload)
+    codec = CODEC_IDS.get((flags & CODEC_MASK) >> CODEC_SHIFT)
+    if codec is None:
+        raise ValueError(f"不支持的元数据编码 {(flags & CODEC_MASK) >> CODEC_SHIFT}")
+    meta_end = V2_HEADER.size + meta_len
+    message = codec.loads(payload[V2_HEADER.size:meta_end])
+    if code:
+        message['type'] = TYPE_NAMES.get(code, code)
+    if flags & FLAG_BODY:
+        field = MEDIA_FIELDS.get(message.get('type'), 'data')
+        body = memoryview(payload)[meta_end:]
+        message[field] = bytes(body) if copy_body else body
+    return message
+
+
+def recv_exact_into(sock, view):
+    """用recv_into把view填满，返回False表示对端在读到任何数据前关闭了连接"""
+    received = 0
+    while received < len(view):
+        n = sock.recv_into(view[received:])
+        if not n:
+            if received == 0:
+                return False
+            raise ConnectionError("接收消息时连接断开")
+        received += n
+    return True
+
+
+class Frame:
+    """编码好的一帧，广播时只构造一次，所有接收者的发送队列共享同一个对象
+
+    每种协议版本(v2还区分元数据编码)第一次被用到时编码一次并缓存，结果是若干段缓冲区：
+    v1为(长度前缀 + JSON,)；v2为(长度前缀 + 帧头 + 元数据, 消息体)，
+    消息体直接引用收到的数据，转发时不复制，由写线程用一次sendmsg发出。
+    带有media_hash的媒体消息还可以编码为不含数据的引用(ref=True)。
+    """
+
+    __slots__ = ('message', 'type', 'has_media_ref', '_encoded')
+
+    def __init__(self, message):
+        self.message = message
+        self.type = message.get('type')
+        self.has_media_ref = self.type in MEDIA_REF_TYPES and is_media_hash(message.get('media_hash'))
+        self._encoded = {}
+
+    def encode(self, version=1, ref=False, codec='json'):
+        key = (version, ref and self.has_media_ref, codec if version >= 2 else 'json')
+        parts = self._encoded.get(key)
+        if parts is None:
+            message = media_reference(self.message) if key[1] else self.message
+            if version >= 2:
+                head, body = encode_v2_parts(message, get_codec(codec))
+                prefix = (len(head) + len(body)).to_bytes(4, 'big')
+                parts = (prefix + head, body) if len(body) else (prefix + head,)
+            else:
+                payload = encode_v1(message)
+                parts = (len(payload).to_bytes(4, 'big') + payload,)
+            self._encoded[key] = parts
+        return parts
+
+
+class EncodedFrame(Frame):
+    """元数据已经编码好的v2帧(JSON)，所有接收者共享同一份字节
+
+    用于由预先序列化的片段拼接成的批量消息，只能发给协议版本为2的接收者；
+    message是用于日志和统计的摘要。
+    """
+
+    __slots__ = ('_parts',)
+
+    def __init__(self, message, meta_bytes):
+        super().__init__(message)
+        head = V2_HEADER.pack(V2_MAGIC, TYPE_CODES[self.type], JSON.id << CODEC_SHIFT, len(meta_bytes))
+        self._parts = ((len(head) + len(meta_bytes)).to_bytes(4, 'big') + head + meta_bytes,)
+
+    def encode(self, version=1, ref=False, codec='json'):
+        return self._parts
+
+
+def send_parts(sock, parts):
+    """用sendmsg一次系统调用发送多段缓冲区，处理部分发送的情况"""
+    views = [memoryview(p).cast('B') for p in parts]
+    while views:
+        sent = sock.sendmsg(views)
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views and sent:
+            views[0] = views[0][sent:]
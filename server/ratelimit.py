@@ -0,0 +1,121 @@
+"""每个会话的发送限额：按消息类别分别限制每秒条数和字节数(令牌桶)
+
+消息在分发前由rate_limit中间件检查，超过限额的帧不再转发，发送方收到error帧。
+限额配置由所有会话共用，load()替换配置后对已有会话立即生效，令牌桶只保存余额和上次更新时间。
+"""
+import json
+
+from protocol import MEDIA_MESSAGE_TYPES
+
+
+class Limit:
+    """一类消息的限额，为None的项不限制
+
+    messages: 每秒条数，message_burst: 条数的突发上限
+    bytes: 每秒字节数，byte_burst: 字节数的突发上限，单条超过突发上限的消息在桶满时仍可发送，之后需要等待补足
+    """
+
+    __slots__ = ('messages', 'message_burst', 'bytes', 'byte_burst')
+
+    def __init__(self, messages=None, message_burst=None, bytes=None, byte_burst=None):
+        self.messages = messages
+        self.message_burst = message_burst if message_burst is not None else messages
+        self.bytes = bytes
+        self.byte_burst = byte_burst if byte_burst is not None else bytes
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data.get('messages_per_second'), data.get('message_burst'),
+                   data.get('bytes_per_second'), data.get('byte_burst'))
+
+
+# 消息类型所属的类别，没有列出的类型不受限制(登录、心跳、分块传输中的块等)
+TYPE_CATEGORIES = {'square_message': 'text', 'private_message': 'text', 'stream_begin': 'media',
+                   'history_request': 'request', 'media_fetch': 'request',
+                   'room_join': 'request', 'room_leave': 'request', 'room_list': 'request'}
+TYPE_CATEGORIES.update((message_type, 'media') for message_type in MEDIA_MESSAGE_TYPES)
+
+DEFAULT_LIMITS = {
+    'text': Limit(messages=5, message_burst=20, bytes=64 * 1024, byte_burst=256 * 1024),
+    'media': Limit(messages=5, message_burst=20, bytes=4 * 1024 * 1024, byte_burst=64 * 1024 * 1024),
+    'request': Limit(messages=10, message_burst=50),
+}
+
+
+class RateLimits:
+    """所有会话共用的限额配置"""
+
+    def __init__(self, limits=None):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)   # {类别: Limit}
+
+    def load(self, path):
+        """从JSON文件读取限额并替换当前配置，文件中没有的类别不限制
+
+        格式: {"text": {"messages_per_second": 5, "message_burst": 20,
+                        "bytes_per_second": 65536, "byte_burst": 262144}, ...}
+        """
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        self.limits = {category: Limit.from_dict(values) for category, values in data.items()}
+
+
+class TokenBucket:
+    """令牌桶，第一次使用时是满的"""
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self):
+        self.tokens = None
+        self.updated = 0.0
+
+    def available(self, rate, burst, now):
+        if self.tokens is None:
+            return burst
+        return min(burst, self.tokens + (now - self.updated) * rate)
+
+    def consume(self, amount, rate, burst, now):
+        self.tokens = self.available(rate, burst, now) - amount
+        self.updated = now
+
+
+class RateLimiter:
+    """一个连接的令牌桶，每个类别一个条数桶和一个字节桶，只由该连接的读线程(协程)使用"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._buckets = {}              # {类别: (条数桶, 字节桶)}
+        self._notified = {}             # {类别: 上次发送error帧的时间}，避免每个被拒的帧都回复
+
+    def check(self, message_type, nbytes, now):
+        """检查并扣除一条消息的额度，允许时返回None，否则返回建议等待的秒数"""
+        category = TYPE_CATEGORIES.get(message_type)
+        limit = self.limits.limits.get(category) if category is not None else None
+        if limit is None:
+            return None
+        buckets = self._buckets.get(category)
+        if buckets is None:
+            buckets = self._buckets[category] = (TokenBucket(), TokenBucket())
+        wait = 0.0
+        for bucket, rate, burst, amount in ((buckets[0], limit.messages, limit.message_burst, 1),
+                                            (buckets[1], limit.bytes, limit.byte_burst, nbytes)):
+            if not rate:
+                continue
+            need = min(amount, burst)   # 超过突发上限的单条消息在桶满时放行
+            tokens = bucket.available(rate, burst, now)
+            if tokens < need:
+                wait = max(wait, (need - tokens) / rate)
+        if wait:
+            return wait
+        if limit.messages:
+            buckets[0].consume(1, limit.messages, limit.message_burst, now)
+        if limit.bytes:
+            buckets[1].consume(nbytes, limit.bytes, limit.byte_burst, now)
+        return None
+
+    def should_notify(self, message_type, now, interval=1.0):
+        """同一类别每interval秒最多回复一次error帧"""
+        category = TYPE_CATEGORIES.get(message_type)
+        if now - self._notified.get(category, float('-inf')) < interval:
+            return False
+        self._notified[category] = now
+        return True
@@ -0,0 +1,140 @@
+"""最近消息：每个会话一个有界的环形缓冲区，登录时批量回放
+
+缓冲区中的每条消息在加入时就编码成JSON片段，回放和翻页时把片段拼接成一个history帧的元数据，
+不再逐条序列化；同一个会话的最新一页在下一条消息到来前只拼接一次，登录高峰时所有人共享同一帧。
+每个会话按条数和字节数限制，会话数超过max_conversations时淘汰最久没有新消息的会话。
+缓冲区从会话的第一条消息开始且还没有丢弃过消息时是完整的，翻页时不必再读取消息历史。
+"""
+import threading
+from collections import OrderedDict, deque
+
+from history import SQUARE, members
+from protocol import EncodedFrame
+from serializers import JSON
+
+
+class RecentBuffer:
+    """一个会话的最近消息 [(序号, JSON片段)]"""
+
+    __slots__ = ('entries', 'bytes', 'latest', 'complete')
+
+    def __init__(self, complete=False):
+        self.entries = deque()
+        self.bytes = 0
+        self.latest = None              # 缓存的最新一页 (条数, EncodedFrame)
+        self.complete = complete        # 是否包含会话的全部消息
+
+
+class RecentHistory:
+    """所有会话的最近消息"""
+
+    def __init__(self, max_messages=200, max_bytes=512 * 1024, max_conversations=1000):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_conversations = max_conversations
+        self._lock = threading.Lock()
+        self._buffers = OrderedDict()   # {会话名: RecentBuffer}，末尾是最近有新消息的
+        self._members = {}              # {'ip:port': 该地址参与的私聊会话名集合}
+
+    def add(self, conversation, seq, message, first=False):
+        """加入一条消息，message是保存到历史中的形式(媒体只有引用)
+
+        first表示这是会话的第一条消息，此时新建的缓冲区是完整的。
+        """
+        encoded = encode_entry(seq, message)
+        with self._lock:
+            buffer = self._buffers.get(conversation)
+            if buffer is None:
+                buffer = self._buffers[conversation] = RecentBuffer(first)
+                for member in members(conversation):
+                    self._members.setdefault(member, set()).add(conversation)
+                while len(self._buffers) > self.max_conversations:
+                    self._evict_locked()
+            else:
+                self._buffers.move_to_end(conversation)
+            buffer.entries.append((seq, encoded))
+            buffer.bytes += len(encoded)
+            while buffer.entries and (len(buffer.entries) > self.max_messages or buffer.bytes > self.max_bytes):
+                buffer.bytes -= len(buffer.entries.popleft()[1])
+                buffer.complete = False
+            buffer.latest = None
+
+    def _evict_locked(self):
+        conversation, _ = self._buffers.popitem(last=False)
+        for member in members(conversation):
+            conversations = self._members.get(member)
+            if conversations is not None:
+                conversations.discard(conversation)
+                if not conversations:
+                    del self._members[member]
+
+    def conversations_for(self, address):
+        """登录时回放的会话：广场和该地址参与的私聊"""
+        ip, port = address
+        with self._lock:
+            return [SQUARE] + sorted(self._members.get(f'{ip}:{int(port)}', ()))
+
+    def before(self, conversation, seq=None, limit=50):
+        """序号小于seq(None表示到最新)的最后limit条 [(序号, JSON片段)]，从旧到新"""
+        return self.page(conversation, seq, limit)[0]
+
+    def page(self, conversation, seq=None, limit=50):
+        """与before()相同，另外返回缓冲区是否完整，完整时不足limit条说明没有更早的消息"""
+        with self._lock:
+            buffer = self._buffers.get(conversation)
+            if buffer is None:
+                return [], False
+            entries = buffer.entries
+            if seq is None:
+                return (list(entries)[-limit:] if limit < len(entries) else list(entries)), buffer.complete
+            page = []
+            for entry in reversed(entries):
+                if entry[0] < seq:
+                    page.append(entry)
+                    if len(page) >= limit:
+                        break
+            page.reverse()
+            return page, buffer.complete
+
+    def cached_latest(self, conversation, limit):
+        with self._lock:
+            buffer = self._buffers.get(conversation)
+            if buffer is not None and buffer.latest is not None and buffer.latest[0] == limit:
+                return buffer.latest[1]
+            return None
+
+    def cache_latest(self, conversation, limit, frame, newest_seq):
+        """缓存最新一页，期间有新消息加入时不缓存"""
+        with self._lock:
+            buffer = self._buffers.get(conversation)
+            if buffer is not None and buffer.entries and buffer.entries[-1][0] == newest_seq:
+                buffer.latest = (limit, frame)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'conversations': len(self._buffers),
+                'messages': sum(len(b.entries) for b in self._buffers.values()),
+                'bytes': sum(b.bytes for b in self._buffers.values()),
+            }
+
+
+def encode_entry(seq, message):
+    """一条消息的JSON片段，带上序号作为翻页的游标"""
+    return JSON.dumps(dict(message, seq=seq))
+
+
+def history_frame(conversation, entries, cursor, replay=False):
+    """把JSON片段拼接成一个history帧
+
+    cursor是下一页的游标(本页最旧一条的序号)，没有更早的消息时为None。
+    """
+    meta = b''.join((
+        b'{"conversation":', JSON.dumps(conversation),
+        b',"cursor":', JSON.dumps(cursor),
+        b',"replay":', b'true' if replay else b'false',
+        b',"messages":[', b','.join(encoded for _, encoded in entries), b']}',
+    ))
+    summary = {'type': 'history', 'conversation': conversation, 'cursor': cursor, 'count': len(entries),
+               'newest': entries[-1][0] if entries else None}
+    return EncodedFrame(summary, meta)
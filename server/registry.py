@@ -0,0 +1,102 @@
+import threading
+
+
+def address_key(ip, port):
+    """把(ip, port)规范化为索引键，端口统一为int（登录消息中的端口可能是字符串）"""
+    try:
+        return (ip, int(port))
+    except (TypeError, ValueError):
+        return (ip, port)
+
+
+class Session:
+    """一个已登录用户的会话记录"""
+
+    __slots__ = ('sock', 'username', 'address', 'key', 'protocol', 'features', 'codec')
+
+    def __init__(self, sock, username, address, protocol=1, features=(), codec='json'):
+        self.sock = sock
+        self.username = username
+        self.address = address          # 登录时上报的(local_ip, local_port)，原样返回给其他客户端
+        self.key = address_key(*address)
+        self.protocol = protocol        # 登录时协商的协议版本，决定发给该用户的帧格式
+        self.features = frozenset(features)  # 登录时协商的可选功能，如media_ref
+        self.codec = codec              # 登录时协商的v2元数据编码，如json、msgpack
+
+    def __repr__(self):
+        return f"Session({self.username!r}, {self.address[0]}:{self.address[1]})"
+
+
+class SessionRegistry:
+    """在线会话注册表
+
+    所有修改都在锁内完成，并同时维护socket、地址、用户名三个索引。
+    每次修改后发布一个新的不可变元组snapshot，广播方直接遍历snapshot，
+    既不需要加锁也不需要复制。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_sock = {}
+        self._by_address = {}
+        self._by_username = {}
+        self.snapshot = ()
+
+    def __len__(self):
+        return len(self.snapshot)
+
+    def __contains__(self, sock):
+        return sock in self._by_sock
+
+    def __iter__(self):
+        return iter(self.snapshot)
+
+    def get(self, sock):
+        return self._by_sock.get(sock)
+
+    def find(self, ip, port):
+        """按地址查找在线会话，找不到返回None"""
+        return self._by_address.get(address_key(ip, port))
+
+    def find_by_username(self, username):
+        """按用户名查找在线会话，找不到返回None"""
+        return self._by_username.get(username)
+
+    def add(self, sock, username, address, protocol=1, features=(), codec='json'):
+        """登记会话；同一个socket重复登录时替换旧记录"""
+        session = Session(sock, username, address, protocol, features, codec)
+        with self._lock:
+            old = self._remove_locked(sock)
+            snapshot = self.snapshot
+            if old is not None:
+                snapshot = tuple(s for s in snapshot if s is not old)
+            self._by_sock[sock] = session
+            self._by_address[session.key] = session
+            self._by_username[username] = session
+            self.snapshot = snapshot + (session,)
+        return session
+
+    def remove(self, sock):
+        """移除会话并返回被移除的记录，不存在时返回None"""
+        with self._lock:
+            session = self._remove_locked(sock)
+            if session is not None:
+                self.snapshot = tuple(s for s in self.snapshot if s is not session)
+            return session
+
+    def _remove_locked(self, sock):
+        session = self._by_sock.pop(sock, None)
+        if session is None:
+            return None
+        if self._by_address.get(session.key) is session:
+            del self._by_address[session.key]
+        if self._by_username.get(session.username) is session:
+            del self._by_username[session.username]
+        return session
+
+    def clear(self):
+        with self._lock:
+            self._by_sock.clear()
+            self._by_address.clear()
+            self._by_username.clear()
+            self.snapshot = ()
@@ -0,0 +1,112 @@
+"""聊天室：用户加入的命名房间，以及房间到成员的索引
+
+广场消息发给所有在线用户；带room字段的广场消息(square_message、square_image等)只发给该聊天室的成员，
+广播时只遍历成员，不遍历所有在线用户。每个聊天室的成员是不可变元组，修改时在锁内发布新的元组，
+广播方直接遍历，不需要加锁也不需要复制(与SessionRegistry.snapshot相同)。没有成员的聊天室随即删除。
+"""
+import threading
+
+ROOM_PREFIX = 'room:'       # 聊天室在消息历史中的会话名前缀
+MAX_ROOM_NAME = 32
+
+
+def room_conversation(room):
+    """聊天室的会话名"""
+    return ROOM_PREFIX + room
+
+
+def room_of(conversation):
+    """会话名对应的聊天室名，不是聊天室时返回None"""
+    if isinstance(conversation, str) and conversation.startswith(ROOM_PREFIX):
+        return conversation[len(ROOM_PREFIX):]
+    return None
+
+
+def is_room_name(name):
+    """聊天室名：1~MAX_ROOM_NAME个可打印字符，首尾没有空白"""
+    return (isinstance(name, str) and 0 < len(name) <= MAX_ROOM_NAME and name == name.strip()
+            and name.isprintable())
+
+
+class RoomRegistry:
+    """所有聊天室的成员，成员是登录时的Session"""
+
+    def __init__(self, max_rooms_per_session=50):
+        self.max_rooms_per_session = max_rooms_per_session
+        self._lock = threading.Lock()
+        self._members = {}              # {聊天室名: (Session, ...)}
+        self._rooms = {}                # {socket: 该连接加入的聊天室名集合}
+
+    def __len__(self):
+        return len(self._members)
+
+    def members(self, room):
+        """聊天室当前的成员，不存在时为空元组"""
+        return self._members.get(room, ())
+
+    def is_member(self, sock, room):
+        return room in self._rooms.get(sock, ())
+
+    def rooms_of(self, sock):
+        with self._lock:
+            return sorted(self._rooms.get(sock, ()))
+
+    def join(self, session, room):
+        """加入聊天室，返回加入后的成员；已经是成员时原样返回，超过每个连接的上限时返回None"""
+        with self._lock:
+            rooms = self._rooms.setdefault(session.sock, set())
+            if room in rooms:
+                return self._members[room]
+            if len(rooms) >= self.max_rooms_per_session:
+                if not rooms:
+                    del self._rooms[session.sock]
+                return None
+            rooms.add(room)
+            members = self._members.get(room, ()) + (session,)
+            self._members[room] = members
+            return members
+
+    def leave(self, sock, room):
+        """离开聊天室，返回离开前的Session，不是成员时返回None"""
+        with self._lock:
+            rooms = self._rooms.get(sock)
+            if rooms is None or room not in rooms:
+                return None
+            rooms.discard(room)
+            if not rooms:
+                del self._rooms[sock]
+            return self._remove_locked(sock, room)
+
+    def leave_all(self, sock):
+        """连接断开时离开所有聊天室，返回[(聊天室名, Session)]"""
+        with self._lock:
+            rooms = self._rooms.pop(sock, ())
+            return [(room, self._remove_locked(sock, room)) for room in sorted(rooms)]
+
+    def _remove_locked(self, sock, room):
+        members = self._members.get(room, ())
+        session = next((s for s in members if s.sock is sock), None)
+        remaining = tuple(s for s in members if s.sock is not sock)
+        if remaining:
+            self._members[room] = remaining
+        else:
+            self._members.pop(room, None)
+        return session
+
+    def listing(self):
+        """所有聊天室及其人数 [{'room', 'members'}]，按人数从多到少"""
+        rooms = [{'room': room, 'members': len(members)} for room, members in list(self._members.items())]
+        rooms.sort(key=lambda r: (-r['members'], r['room']))
+        return rooms
+
+    def stats(self):
+        with self._lock:
+            return {
+                'rooms': len(self._members),
+                'memberships': sum(len(members) for members in self._members.values()),
+            }
+
+    def clear(self):
+        with self._lock:
+            self._members.clear()
+            self._rooms.clear()
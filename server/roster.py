@@ -0,0 +1,127 @@
+"""带版本号的在线用户列表
+
+每次上线或下线版本号加一。新登录的用户收到整份列表，列表由每个用户预先编码好的JSON片段拼接而成，
+同一版本只拼接一次；其他用户不再逐个收到上线、下线消息，而是每隔一小段时间收到一个roster_delta，
+其中同一用户在这段时间内的多次变化合并为最终状态。最近的变化保存在有界的日志中，
+重新连接的客户端带上上次看到的版本号，服务器只回复这之后的变化。
+"""
+import os
+import threading
+from collections import deque
+
+from registry import address_key
+from serializers import JSON
+
+
+class Roster:
+    """在线用户列表和最近的变化"""
+
+    def __init__(self, max_changes=4096):
+        # 修改列表、发送整份列表和发送变化都在锁内进行，保证每个客户端按版本顺序收到
+        self.lock = threading.RLock()
+        self.epoch = os.urandom(4).hex()    # 服务器每次启动不同，客户端据此判断版本号是否仍然有效
+        self.version = 0
+        self._entries = {}                  # {地址键: (用户名, 地址, JSON片段)}，按上线顺序
+        self._changes = deque(maxlen=max_changes)  # [(版本号, 地址键)]
+        self._pending = {}                  # {地址键: 本批变化开始前的(用户名, 地址)或None}
+        self._pending_since = 0             # 本批变化开始前的版本号
+        self._snapshot = None               # (版本号, 拼接好的列表)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def join(self, username, address):
+        """用户上线(同一地址重复登录时替换)，返回新的版本号"""
+        key = address_key(*address)
+        with self.lock:
+            old = self._entries.pop(key, None)  # 重新登录的用户排到最后
+            self._record(key, old)
+            entry = {'username': username, 'address': address}
+            self._entries[key] = (username, address, JSON.dumps(entry))
+            return self._changed(key)
+
+    def leave(self, address):
+        """用户下线，不在列表中时返回None"""
+        key = address_key(*address)
+        with self.lock:
+            old = self._entries.pop(key, None)
+            if old is None:
+                return None
+            self._record(key, old)
+            return self._changed(key)
+
+    def _record(self, key, old):
+        """记下本批变化开始前该地址的状态"""
+        if not self._pending:
+            self._pending_since = self.version
+        self._pending.setdefault(key, old[:2] if old is not None else None)
+
+    def _changed(self, key):
+        self.version += 1
+        self._changes.append((self.version, key))
+        return self.version
+
+    def restore(self, epoch, version, users):
+        """接管旧进程时恢复列表，沿用旧进程的epoch和版本号，已连接的客户端看到的版本保持连续"""
+        with self.lock:
+            self.epoch = epoch
+            self.version = version
+            self._entries = {}
+            for user in users:
+                address = tuple(user['address'])
+                entry = {'username': user['username'], 'address': address}
+                self._entries[address_key(*address)] = (user['username'], address, JSON.dumps(entry))
+            self._changes.clear()
+            self._pending = {}
+            self._snapshot = None
+
+    def snapshot(self):
+        """当前版本的整份列表，返回(版本号, JSON数组的内容)，同一版本只拼接一次"""
+        with self.lock:
+            if self._snapshot is None or self._snapshot[0] != self.version:
+                self._snapshot = (self.version, b','.join(entry[2] for entry in self._entries.values()))
+            return self._snapshot
+
+    def users(self):
+        """当前列表 [{'username', 'address'}]"""
+        with self.lock:
+            return [{'username': username, 'address': address} for username, address, _ in self._entries.values()]
+
+    def changes_since(self, version):
+        """version之后的变化 (joined, left)，日志中已经没有这么早的变化时返回None"""
+        with self.lock:
+            if version > self.version:
+                return None
+            if version < self.version and (not self._changes or self._changes[0][0] > version + 1):
+                return None
+            keys = {key for v, key in self._changes if v > version}
+            return self._diff(keys, None)
+
+    def has_pending(self):
+        return bool(self._pending)
+
+    def take_pending(self):
+        """取出本批变化 (起始版本号, 版本号, joined, left)，合并后没有变化时joined和left都为空"""
+        with self.lock:
+            pending, self._pending = self._pending, {}
+            joined, left = self._diff(pending, pending)
+            return self._pending_since, self.version, joined, left
+
+    def _diff(self, keys, before=None):
+        """keys中每个地址的最终状态：在线的列入joined，不在线的列入left
+
+        before是本批变化开始前的状态，给出时省略前后相同的用户(上线后又下线、重复登录但用户名不变)；
+        没有before时left中的用户名为None，客户端按地址移除。
+        """
+        joined, left = [], []
+        for key in keys:
+            entry = self._entries.get(key)
+            previous = before.get(key) if before is not None else None
+            if entry is not None:
+                if previous is not None and previous[0] == entry[0]:
+                    continue
+                joined.append({'username': entry[0], 'address': entry[1]})
+            elif before is None or previous is not None:
+                left.append({'username': previous[0] if previous is not None else None,
+                             'address': previous[1] if previous is not None else key})
+        return joined, left
@@ -0,0 +1,95 @@
+"""消息序列化
+
+标准库json始终可用；安装了orjson时json改用orjson编解码(输出仍是JSON，与对端实现无关)；
+安装了msgpack时可以在登录时协商使用msgpack。
+v2帧头的标志位中记录元数据使用的编码(CODEC_IDS)，接收方按帧解码，不需要记住连接的状态。
+"""
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Codec:
+    """一种序列化方式
+
+    name是登录时协商使用的名称；backend是实际使用的库，json的两种实现输出相同的格式。
+    """
+
+    __slots__ = ('name', 'id', 'backend', 'dumps', 'loads')
+
+    def __init__(self, name, codec_id, backend, dumps, loads):
+        self.name = name
+        self.id = codec_id
+        self.backend = backend
+        self.dumps = dumps      # 对象 -> bytes
+        self.loads = loads      # bytes/bytearray/memoryview -> 对象
+
+    def __repr__(self):
+        return f"Codec({self.name!r}, backend={self.backend!r})"
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False).encode()
+
+
+def _stdlib_loads(data):
+    if isinstance(data, memoryview):
+        data = bytes(data)
+    return json.loads(data)
+
+
+STDLIB_JSON = Codec('json', 0, 'json', _stdlib_dumps, _stdlib_loads)
+
+if orjson is not None:
+    def _orjson_dumps(obj):
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            return _stdlib_dumps(obj)  # orjson不支持的类型(如超过64位的整数)交给标准库
+
+    ORJSON = Codec('json', 0, 'orjson', _orjson_dumps, orjson.loads)
+else:
+    ORJSON = None
+
+if msgpack is not None:
+    def _msgpack_dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def _msgpack_loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+    MSGPACK = Codec('msgpack', 1, 'msgpack', _msgpack_dumps, _msgpack_loads)
+else:
+    MSGPACK = None
+
+JSON = ORJSON or STDLIB_JSON  # json的最快实现
+
+# 本端可用的编码，按优先顺序排列：orjson编解码比msgpack快(见benchmarks/bench_codecs.py)，
+# 没有orjson时msgpack比标准库json快
+_PREFERENCE = (JSON, MSGPACK) if ORJSON is not None else (MSGPACK, JSON)
+CODECS = {codec.name: codec for codec in _PREFERENCE if codec is not None}
+CODEC_IDS = {codec.id: codec for codec in CODECS.values()}
+
+
+def get_codec(name):
+    """按名称取编码，不支持时退回json"""
+    return CODECS.get(name, JSON)
+
+
+def negotiate_codec(login_message):
+    """从登录消息中客户端声明的编码里，按本端的优先顺序选出一种，没有共同的则使用json"""
+    requested = login_message.get('codecs')
+    if not isinstance(requested, list):
+        return JSON.name
+    for name in CODECS:
+        if name in requested:
+            return name
+    return JSON.name
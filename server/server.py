@@ -1,16 +1,125 @@
+import base64
+import functools
+import itertools
+import logging
+import os
+import select
 import socket
-import json
+import struct
 import threading
+import time
 from datetime import datetime
 
+from chatlog import (CHAT, CONNECTION, ERROR, RECV, ROSTER, SEND, SESSION, TRANSFER, Redacted,
+                     Truncated, get_logger)
+from dispatch import Dispatcher
+from outbound import DROPPABLE_TYPES, OutboundPolicy, OutboundQueue
+from handoff import HandoffListener, Takeover
+from history import SQUARE, MessageHistory, is_participant, private_conversation
+from media_store import MediaStore
+from metrics import CONNECTIONS, LOGINS, LOGOUTS, RATE_LIMITED, REAPED, SEND_FAILURES, Metrics, MetricsServer
+from offline import OfflineQueue, offline_frame, recipient_id
+from recent import RecentHistory, encode_entry, history_frame
+from protocol import (MEDIA_FIELDS, MEDIA_MESSAGE_TYPES, MEDIA_REF_TYPES, SQUARE_MESSAGE_TYPES, EncodedFrame,
+                      Frame, decode_payload, is_media_hash, negotiate_features, negotiate_protocol,
+                      recv_exact_into, send_parts)
+from ratelimit import RateLimiter, RateLimits
+from registry import Session, SessionRegistry
+from rooms import RoomRegistry, is_room_name, room_conversation, room_of
+from roster import Roster
+from serializers import JSON, negotiate_codec
+from streaming import Transfer
+from timers import Liveness, TimerHeap
+
+log = get_logger()
+
+PRESENCE_TIMER = 'presence'  # 定时器堆中合并发送在线用户变化的键
+# 默认的单帧最大字节数。旧客户端整帧发送50MB视频，base64后约67MB，因此留有余量
+MAX_FRAME_SIZE = 100 * 1024 * 1024
+
+
+def is_replayable(message):
+    """回放的媒体消息只有引用，没能存入媒体仓库(没有哈希)的媒体无法回放"""
+    return message.get('type') not in MEDIA_REF_TYPES or is_media_hash(message.get('media_hash'))
+
+
 class ChatServer:
-    def __init__(self):
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
         # 初始化服务器属性
         self.host = ''           # 服务器主机地址
         self.port = 0           # 服务器端口
         self.server_socket = None  # 服务器socket对象
-        self.clients = {}       # 存储客户端信息 {client_socket: {'username': str, 'address': tuple}}
+        self.extra_listeners = []  # 从asyncio引擎接管的其他监听socket(它同时监听多个地址时)
+        self.sessions = SessionRegistry()  # 在线会话，按socket、地址、用户名索引
         self.running = False    # 服务器运行状态
+        self.backlog = 128      # 监听队列长度，登录高峰时避免握手被丢弃
+        self.reuse_port = False  # 多进程模式下各工作进程用SO_REUSEPORT监听同一个端口
+        self.outbound = {}      # 每个连接的发送队列 {client_socket: OutboundQueue}
+        self.outbound_policy = OutboundPolicy()  # 慢消费者策略
+        self.slow_consumer_disconnects = 0       # 因积压过多被断开的连接数
+        self.max_frame_size = max_frame_size  # 单帧最大字节数，读取长度前缀后、分配内存前检查
+        self.recv_buffer_size = 64 * 1024  # 每个连接预分配的接收缓冲区，不超过该长度的帧在其中原地解码
+        # 心跳和超时(秒)，设为None时不检查。支持heartbeat的客户端空闲heartbeat_interval后收到ping，
+        # idle_timeout内没有任何帧则断开；未登录的连接idle_timeout后断开；一帧写入超过write_timeout则断开
+        self.heartbeat_interval = 30.0
+        self.idle_timeout = 90.0
+        self.write_timeout = 30.0
+        self.timers = TimerHeap()  # 所有连接的下一次检查时间
+        self.liveness = {}         # 每个连接最近收到帧和正在写入的时间 {client_socket: Liveness}
+        # 每个会话按消息类别限制每秒条数和字节数，load()重新读取后立即生效；设为None时不限制
+        self.rate_limits = RateLimits()
+        self.limiters = {}         # 每个连接的令牌桶 {client_socket: RateLimiter}
+        # 带版本号的在线用户列表；支持roster的客户端收到的上线、下线变化每presence_interval秒合并发送一次，
+        # 设为None时立即发送
+        self.roster = Roster()
+        self.presence_interval = 0.2
+        self.rooms = RoomRegistry()  # 聊天室到成员的索引，聊天室消息只发给成员
+        # 通往其他分片(多进程模式)的链路，跨分片的广播、私聊和在线用户变化经过链路转发
+        self.links = []
+        # 不中断连接的重启(handoff.py)：在handoff_path上等待新进程接管；takeover为True时启动时接管该路径上的旧进程
+        self.handoff_path = None
+        self.takeover = False
+        self.handoff_timeout = 10.0  # 交接时最多等待发送队列写完、等待新进程回复的秒数
+        self.drain_timeout = 30.0    # 排空时最多等待发送队列写完的秒数
+        self.handoff = None
+        # 交接或排空期间冻结：不接受新连接、不读取新的帧、不检查定时器；交接完成后不再解冻
+        self.frozen = False
+        self.handed_off = False
+        self.thawed = threading.Event()  # 冻结期间清除，读线程在其上等待
+        self.thawed.set()
+        self.reading = set()    # 正在读取或处理一帧的连接(以及正在接受连接的监听socket)
+        self.transfers = {}     # 进行中的分块传输 {(client_socket, 客户端传输编号): Transfer}
+        self.transfer_ids = itertools.count(1)
+        # 按内容哈希存放的媒体仓库，重复发送的文件只转发引用；超过配额按LRU淘汰
+        self.media_store = MediaStore(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'media_store'),
+            quota_bytes=1024 * 1024 * 1024
+        )
+        # 广场和私聊消息的持久化历史，媒体只保存内容哈希；设为None时不保存
+        self.history = MessageHistory(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history')
+        )
+        # 每个会话最近消息的环形缓冲区，登录时回放最新的replay_count条；设为None时不回放
+        self.recent = RecentHistory(max_messages=200, max_bytes=512 * 1024)
+        self.replay_count = 50
+        self.history_page_limit = 200  # 向前翻页时一页最多的条数
+        self.message_seqs = itertools.count(1)  # 没有消息历史时最近消息使用的序号
+        # 目标用户不在线时暂存的私聊消息，超过内存上限的部分写入磁盘，登录时一次发出；设为None时不暂存
+        self.offline = OfflineQueue(
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), 'offline')
+        )
+        self.metrics = Metrics()  # 运行指标，热路径上只锁当前线程分到的分片
+        self.metrics_host = '127.0.0.1'  # 指标只在本机提供
+        self.metrics_port = None  # 设置后在该端口用HTTP提供/metrics(Prometheus文本格式)
+        self.metrics_server = None
+        # 按消息类型限制字段长度(文本为字符数，媒体为字节数)，没有列出的类型只受max_frame_size限制
+        self.message_limits = {
+            'square_message': 64 * 1024,
+            'private_message': 64 * 1024,
+        }
+        # 消息类型到处理函数的表和中间件链，每个阶段的耗时记入metrics
+        self.dispatcher = Dispatcher(observe=self.metrics.observe_stage)
+        self.register_handlers()
 
     def start(self, host='172.20.10.4', port=8000):
         """启动服务器并开始监听连接"""
@@ -19,32 +128,60 @@ class ChatServer:
             self.host = host
             self.port = port
 
-            # 创建并配置服务器socket
-            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 允许地址重用
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(5)  # 最大连接数为5
+            takeover = self.receive_handoff() if self.takeover else None
+            if takeover is not None:
+                # 沿用旧进程的所有监听socket，监听队列中等待的连接不会丢失
+                self.server_socket, *self.extra_listeners = takeover.listeners
+                self.host, self.port = self.server_socket.getsockname()[:2]
+            else:
+                # 创建并配置服务器socket
+                self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)  # 允许地址重用
+                if self.reuse_port:
+                    self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                self.server_socket.bind((self.host, self.port))
+                self.server_socket.listen(self.backlog)
             self.running = True
 
-            print(f"服务器启动成功 - {self.host}:{self.port}")
+            log.info("服务器启动成功 - %s:%s", self.host, self.port)
+            if takeover is not None:
+                self.adopt(takeover)
+            self.start_metrics()
+            self.start_links()
+            self.start_handoff()
             self.accept_connections()  # 开始接受客户端连接
             
         except KeyboardInterrupt:
-            print("\n正在关闭服务器...")
+            log.info("正在关闭服务器...")
             self.stop()
         except Exception as e:
-            print(f"服务器启动失败: {e}")
+            log.error("服务器启动失败: %s", e, extra=ERROR)
             self.stop()
 
     def accept_connections(self):
         """接受客户端连接的主循环"""
         while self.running:
             try:
-                # 设置accept超时，以便定期检查running状态
-                self.server_socket.settimeout(1.0)
+                if self.frozen:
+                    # 交接或排空期间：新连接留在监听队列中(交接时由新进程接受)，也不检查定时器
+                    time.sleep(0.05)
+                    continue
+                # 设置等待超时，以便定期检查running状态和到期的连接定时器
+                self.check_timers()
+                delay = max(0.01, self.timer_delay())
+                # 先等待有连接可以接受，冻结之后不再从监听队列中取出连接
+                ready = select.select([self.server_socket] + self.extra_listeners, [], [], delay)[0]
+                if not ready:
+                    continue
+                listener = ready[0]
+                if not self.enter_frame(listener, wait=False):
+                    continue
                 try:
-                    client_socket, address = self.server_socket.accept()
-                    print(f"新的连接: {address}")
+                    listener.settimeout(delay)
+                    client_socket, address = listener.accept()
+                    log.debug("新的连接: %s", address, extra=CONNECTION)
+                    self.metrics.incr(CONNECTIONS)
+                    self.open_connection(client_socket)
                     
                     # 为每个客户端创建独立的处理线程
                     client_thread = threading.Thread(
@@ -56,13 +193,17 @@ class ChatServer:
                     
                 except socket.timeout:
                     continue  # 超时后继续循环
+                finally:
+                    self.leave_frame(listener)
                     
             except KeyboardInterrupt:
-                print("\n正在关闭服务器...")
+                log.info("正在关闭服务器...")
                 break
             except Exception as e:
+                if self.frozen:
+                    continue  # 排空时关闭了监听socket
                 if self.running:
-                    print(f"接受连接失败: {e}")
+                    log.error("接受连接失败: %s", e, extra=ERROR)
                 break
         
         self.stop()  # 确保服务器正确关闭
@@ -70,14 +211,22 @@ class ChatServer:
     def stop(self):
         """停止服务器"""
         self.running = False
+        if self.handoff is not None:
+            self.handoff.stop()
+            self.handoff = None
+        for link in self.links:
+            link.stop()
         
         # 断开所有客户端连接
-        for client_socket in list(self.clients.keys()):
+        for session in self.sessions.snapshot:
             try:
-                client_socket.close()
+                session.sock.close()
             except:
                 pass
-        self.clients.clear()
+        self.sessions.clear()
+        self.rooms.clear()
+        for client_socket in list(self.outbound.keys()):
+            self.close_connection(client_socket)
         
         # 关闭服务器socket
         if self.server_socket:
@@ -86,124 +235,720 @@ class ChatServer:
             except:
                 pass
             self.server_socket = None
+        for listener in self.extra_listeners:
+            listener.close()
+        self.extra_listeners = []
+            
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+            
+        if self.history is not None:
+            self.history.close()
+        if self.offline is not None:
+            try:
+                self.offline.flush()
+            except OSError as e:
+                log.error("[错误] 写入离线消息失败: %s", e, extra=ERROR)
+        if not self.handed_off:
+            self.thaw()  # 排空后停下的读线程随之退出；已经交接的连接不能再读取
             
-        print("服务器已关闭")
+        log.info("服务器已关闭")
     
+    def start_metrics(self):
+        """设置了metrics_port时启动指标HTTP服务"""
+        if self.metrics_port is None or self.metrics_server is not None:
+            return
+        try:
+            self.metrics_server = MetricsServer(self, self.metrics_host, self.metrics_port)
+            self.metrics_server.start()
+            log.info("指标服务已启动 - http://%s:%s/metrics", self.metrics_host, self.metrics_port)
+        except OSError as e:
+            log.error("指标服务启动失败: %s", e, extra=ERROR)
+    
+    def start_links(self):
+        """连接通往其他分片的链路"""
+        for link in self.links:
+            try:
+                link.start()
+                log.info("已连接 %r", link, extra=CONNECTION)
+            except OSError as e:
+                log.error("连接 %r 失败: %s", link, e, extra=ERROR)
+
+    def start_handoff(self):
+        """设置了handoff_path时等待新进程接管"""
+        if self.handoff_path is None or self.handoff is not None:
+            return
+        try:
+            self.handoff = HandoffListener(self, self.handoff_path, self.handoff_timeout)
+            self.handoff.start()
+        except OSError as e:
+            self.handoff = None
+            log.error("[交接] 无法在 %s 等待接管: %s", self.handoff_path, e, extra=ERROR)
+
+    def receive_handoff(self):
+        """从handoff_path上的旧进程取得监听socket、连接和状态"""
+        takeover = Takeover(self.handoff_path, self.handoff_timeout * 3).receive()
+        log.info("[交接] 已从进程 %s 取得 %d 个连接", takeover.state['pid'], len(takeover.connections),
+                 extra=CONNECTION)
+        return takeover
+
+    def enter_frame(self, sock, wait=True):
+        """读线程开始读取一帧前登记；冻结期间wait为True时等到解冻(交接完成后不再返回)，否则返回False
+
+        先登记再检查frozen，freeze()先设置frozen再检查reading，两边总有一方看到对方，热路径上不加锁。
+        """
+        while True:
+            self.reading.add(sock)
+            if not self.frozen:
+                return True
+            self.reading.discard(sock)
+            if not wait:
+                return False
+            self.thawed.wait()
+
+    def leave_frame(self, sock):
+        self.reading.discard(sock)
+
+    def thaw(self):
+        self.frozen = False
+        self.thawed.set()
+
+    def freeze(self, deadline, close_listener):
+        """不再接受新连接和读取新的帧，等待正在读取和处理的帧完成，返回超时仍未完成的连接"""
+        self.thawed.clear()
+        self.frozen = True
+        while self.reading and time.monotonic() < deadline:
+            time.sleep(0.005)
+        busy = self.reading - {self.server_socket, *self.extra_listeners}
+        if close_listener and self.server_socket is not None:
+            self.server_socket.close()
+            self.server_socket = None
+            for listener in self.extra_listeners:
+                listener.close()
+            self.extra_listeners = []
+        return busy
+
+    def quiesce(self, timeout, close_listener=False):
+        """交接和排空的第一步：冻结后发出手头的消息，等待发送队列写完
+
+        返回不能交接的连接：timeout内仍在读取一帧(例如正在上传大文件)或没有写完的连接。
+        close_listener为True时关闭监听socket，新连接立即被拒绝而不是在监听队列中等待。
+        """
+        deadline = time.monotonic() + timeout
+        busy = self.freeze(deadline, close_listener)
+        self.settle()
+        while self.unflushed() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return busy | self.unflushed()
+
+    def settle(self):
+        """冻结后：中止未完成的分块传输，发出合并中的在线用户变化，断开链路，写出离线消息和消息历史"""
+        for key in list(self.transfers):
+            self.abort_transfer(key)
+        self.flush_presence()
+        for link in self.links:
+            link.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+            self.metrics_server = None
+        if self.history is not None:
+            self.history.close()
+        if self.offline is not None:
+            try:
+                self.offline.flush()
+            except OSError as e:
+                log.error("[错误] 写入离线消息失败: %s", e, extra=ERROR)
+
+    def unflushed(self):
+        """发送队列中还有没写完的帧的连接"""
+        return {sock for sock, queue in list(self.outbound.items()) if not queue.flushed()}
+
+    def connection_fd(self, client_socket):
+        return client_socket.fileno()
+
+    def pending_input(self, client_socket):
+        """已经从连接读出但还没有处理的字节；线程引擎冻结时只窥视，没有这样的字节"""
+        return b''
+
+    def export_state(self, busy):
+        """冻结后的状态：([监听socket的文件描述符], 全局状态, [(连接的文件描述符, 会话记录, 未处理的字节)])"""
+        connections = []
+        for sock in list(self.outbound):
+            if sock in busy:
+                continue
+            pending = self.pending_input(sock)
+            record = {'pending': len(pending)}
+            session = self.sessions.get(sock)
+            if session is not None:
+                record['session'] = {
+                    'username': session.username,
+                    'address': session.address,
+                    'protocol': session.protocol,
+                    'features': sorted(session.features),
+                    'codec': session.codec,
+                }
+                record['rooms'] = self.rooms.rooms_of(sock)
+            connections.append((self.connection_fd(sock), record, pending))
+        state = {
+            'pid': os.getpid(),
+            'roster': {'epoch': self.roster.epoch, 'version': self.roster.version, 'users': self.roster.users()},
+            'transfer_id': next(self.transfer_ids),
+            'message_seq': next(self.message_seqs),
+        }
+        return self.listener_fds(), state, connections
+
+    def listener_fds(self):
+        return [listener.fileno() for listener in [self.server_socket] + self.extra_listeners]
+
+    def resume(self):
+        """交接失败：解冻并重新连接链路，继续服务"""
+        self.thaw()
+        self.start_metrics()
+        self.start_links()
+
+    def finish_handoff(self):
+        """交接完成：停止服务器但不再读取或关闭已交出的连接"""
+        self.handed_off = True
+        self.running = False
+
+    def drain(self, timeout=None):
+        """排空后退出：拒绝新连接，不再读取新的帧，最多等待timeout秒把发送队列写完，然后停止服务器"""
+        timeout = self.drain_timeout if timeout is None else timeout
+        log.info("[排空] 停止接受新连接，等待发送队列写完(最多 %g 秒)", timeout, extra=CONNECTION)
+        busy = self.quiesce(timeout, close_listener=True)
+        if busy:
+            log.warning("[排空] %d 个连接没能在 %g 秒内写完", len(busy), timeout, extra=ERROR)
+        self.running = False
+
+    def adopt(self, takeover):
+        """接管旧进程的连接：恢复在线用户列表和所有会话，旧进程确认后才开始读取"""
+        self.restore_state(takeover.state)
+        for sock, record, _ in takeover.connections:
+            self.adopt_connection(sock, record)
+        self.finish_takeover(takeover)
+        for sock, _, pending in takeover.connections:
+            try:
+                address = sock.getpeername()
+            except OSError:
+                address = None
+            threading.Thread(target=self.receive_messages, args=(sock, address, pending), daemon=True).start()
+
+    def restore_state(self, state):
+        """沿用旧进程的在线用户列表版本号和编号，已连接的客户端看到的序列保持连续"""
+        roster = state['roster']
+        self.roster.restore(roster['epoch'], roster['version'], roster['users'])
+        self.transfer_ids = itertools.count(state['transfer_id'])
+        self.message_seqs = itertools.count(state['message_seq'])
+
+    def finish_takeover(self, takeover):
+        """会话都已恢复：等待旧进程确认并退出，旧进程已经恢复服务时抛出ConnectionError"""
+        takeover.ready()
+        # 其他分片或节点上的用户等链路重新连接后再加入，在这之前按下线处理
+        for user in takeover.state['roster']['users']:
+            address = tuple(user['address'])
+            if self.sessions.find(*address) is None:
+                self.remote_logout(user['username'], address)
+        log.info("[交接] 已接管 %d 个连接，在线用户 %d 人", len(takeover.connections), len(self.sessions),
+                 extra=SESSION)
+
+    def adopt_connection(self, client_socket, record):
+        """为交接过来的连接创建发送队列并恢复会话"""
+        client_socket.setblocking(True)  # asyncio引擎交出的socket是非阻塞的
+        self.open_connection(client_socket)
+        self.restore_session(client_socket, record)
+
+    def restore_session(self, client_socket, record):
+        session = record.get('session')
+        if session is None:
+            return
+        restored = self.sessions.add(client_socket, session['username'], tuple(session['address']),
+                                     session['protocol'], session['features'], session['codec'])
+        for room in record.get('rooms', ()):
+            self.rooms.join(restored, room)
+        self.reschedule(client_socket)
+
+    def call_soon(self, fn, *args):
+        """在处理客户端消息的上下文中调用fn，链路的读线程用它把收到的帧交给服务器"""
+        fn(*args)
+
+    def publish(self, op, frame=None, **fields):
+        """通过所有链路发给其他分片"""
+        for link in self.links:
+            try:
+                link.broadcast(op, frame, **fields)
+            except OSError as e:
+                log.warning("[错误] 通过 %r 发送 %s 失败: %s", link, op, e, extra=ERROR)
+
+    def route(self, address, op, frame=None, **fields):
+        """发给地址所在的分片，返回False表示该地址不在其他分片上"""
+        for link in self.links:
+            dest = link.locate(address)
+            if dest is None:
+                continue
+            try:
+                link.send(dest, op, frame, **fields)
+            except OSError as e:
+                log.warning("[错误] 通过 %r 发送 %s 失败: %s", link, op, e, extra=ERROR)
+            return True
+        return False
+
+    def is_remote(self, address):
+        """该地址的用户是否在其他分片上在线"""
+        return any(link.locate(address) is not None for link in self.links)
+
+    def fanout(self, frame, recipients, exclude=None):
+        """把一帧发给recipients中的会话(跳过socket为exclude的)，返回发送的个数"""
+        count = 0
+        started = time.perf_counter()
+        for session in recipients:
+            if session.sock is not exclude:
+                try:
+                    self.send_message(session.sock, frame)
+                    count += 1
+                except Exception as e:
+                    log.warning("[错误] 向 %s 发送 %s 失败: %s", session.username, frame.type, e, extra=ERROR)
+        if count:
+            self.metrics.observe_fanout(time.perf_counter() - started, count)
+        return count
+
+    def render_metrics(self):
+        """导出计数器、直方图和当前的队列积压(Prometheus文本格式)"""
+        outbound = self.outbound_stats()
+        store = self.media_store.stats()
+        history = self.history.stats() if self.history is not None else {'messages': 0, 'bytes_stored': 0}
+        recent = self.recent.stats() if self.recent is not None else {'messages': 0, 'bytes': 0}
+        offline = (self.offline.stats() if self.offline is not None
+                   else {'recipients': 0, 'bytes_in_memory': 0, 'bytes_on_disk': 0})
+        rooms = self.rooms.stats()
+        return self.metrics.render([
+            ('connections', '当前连接数', outbound['connections']),
+            ('online_users', '当前在线用户数', len(self.sessions)),
+            ('outbound_frames_queued', '所有发送队列中等待发送的帧数', outbound['frames_queued']),
+            ('outbound_bytes_queued', '所有发送队列中等待发送的字节数', outbound['bytes_queued']),
+            ('outbound_max_bytes_queued', '积压最多的一个发送队列的字节数', outbound['max_bytes_queued']),
+            ('outbound_frames_dropped', '当前连接因积压丢弃的媒体帧数', outbound['frames_dropped']),
+            ('slow_consumer_disconnects', '因积压过多被断开的连接数', outbound['slow_consumer_disconnects']),
+            ('transfers_active', '进行中的分块传输数', len(self.transfers)),
+            ('media_store_bytes', '媒体仓库占用的字节数', store['bytes_stored']),
+            ('media_store_files', '媒体仓库中的文件数', store['files']),
+            ('history_messages', '消息历史中保存的消息数', history['messages']),
+            ('history_bytes', '消息历史占用的字节数', history['bytes_stored']),
+            ('recent_messages', '最近消息缓冲区中的消息数', recent['messages']),
+            ('recent_bytes', '最近消息缓冲区占用的字节数', recent['bytes']),
+            ('offline_recipients', '有离线消息等待投递的用户数', offline['recipients']),
+            ('offline_bytes_in_memory', '内存中的离线消息字节数', offline['bytes_in_memory']),
+            ('offline_bytes_on_disk', '磁盘上的离线消息字节数', offline['bytes_on_disk']),
+            ('roster_version', '在线用户列表的版本号', self.roster.version),
+            ('rooms', '当前有成员的聊天室数', rooms['rooms']),
+            ('room_memberships', '所有聊天室的成员数之和', rooms['memberships']),
+            ('remote_users', '在其他分片上在线的用户数', sum(len(link.users) for link in self.links)),
+        ])
+
+    def open_connection(self, client_socket):
+        """为新连接创建发送队列，并启动专属的写线程"""
+        queue = OutboundQueue(self.outbound_policy)
+        self.outbound[client_socket] = queue
+        self.watch_connection(client_socket)
+        writer_thread = threading.Thread(
+            target=self.write_messages,
+            args=(client_socket, queue)
+        )
+        writer_thread.daemon = True
+        writer_thread.start()
+        return queue
+
+    def close_connection(self, client_socket):
+        """关闭连接的发送队列，写线程随之退出"""
+        self.liveness.pop(client_socket, None)
+        self.limiters.pop(client_socket, None)
+        self.timers.cancel(client_socket)
+        queue = self.outbound.pop(client_socket, None)
+        if queue is not None:
+            queue.close()
+
+    def watch_connection(self, client_socket):
+        """为新连接记录活动时间并安排第一次检查"""
+        now = time.monotonic()
+        self.liveness[client_socket] = Liveness(now)
+        if self.rate_limits is not None:
+            self.limiters[client_socket] = RateLimiter(self.rate_limits)
+        deadline = self.next_check(now, now, None, None)
+        if deadline is not None:
+            self.timers.schedule(client_socket, deadline)
+
+    def reschedule(self, client_socket):
+        """登录(或接管会话)后按协商的功能重新安排检查，支持heartbeat的会话空闲heartbeat_interval后就收到第一个ping"""
+        state = self.liveness.get(client_socket)
+        if state is None:
+            return
+        now = time.monotonic()
+        deadline = self.next_check(now, state.last_recv, state.write_started, self.sessions.get(client_socket))
+        if deadline is not None:
+            self.timers.schedule(client_socket, max(deadline, now))
+
+    def next_check(self, now, last_recv, write_started, session):
+        """连接的下一次检查时间，不需要检查时返回None
+
+        所有连接至少每write_timeout检查一次，以便发现卡住的写入；支持heartbeat的会话在空闲
+        heartbeat_interval时检查(发送ping)，之后在idle_timeout时检查；未登录的连接在idle_timeout时检查。
+        """
+        deadlines = []
+        if self.write_timeout is not None:
+            deadlines.append(write_started + self.write_timeout if write_started is not None
+                             else now + self.write_timeout)
+        if self.idle_timeout is not None and session is None:
+            deadlines.append(last_recv + self.idle_timeout)
+        elif session is not None and 'heartbeat' in session.features:
+            if self.heartbeat_interval is not None and now - last_recv < self.heartbeat_interval:
+                deadlines.append(last_recv + self.heartbeat_interval)
+            elif self.idle_timeout is not None:
+                deadlines.append(last_recv + self.idle_timeout)
+        return min(deadlines) if deadlines else None
+
+    def check_timers(self):
+        """处理所有到期的定时器：连接检查和合并发送的在线用户变化"""
+        now = time.monotonic()
+        for key in self.timers.expired(now):
+            if key == PRESENCE_TIMER:
+                self.flush_presence()
+            else:
+                self.check_connection(key, now)
+
+    def timer_delay(self):
+        """距离最早的定时器到期还有多少秒
+
+        在线用户变化可能在等待期间由其他线程安排，因此最多等待一个合并窗口，变化最迟两个窗口后发出。
+        """
+        limit = min(1.0, self.presence_interval or 1.0)
+        deadline = self.timers.next_deadline()
+        if deadline is None:
+            return limit
+        return min(limit, max(0.0, deadline - time.monotonic()))
+
+    def check_connection(self, client_socket, now):
+        """连接的定时器到期：写入卡住或空闲过久的断开，空闲超过心跳间隔的发送ping，然后安排下一次检查"""
+        state = self.liveness.get(client_socket)
+        if state is None:
+            return
+        session = self.sessions.get(client_socket)
+        write_started = state.write_started
+        idle = now - state.last_recv
+        if self.write_timeout is not None and write_started is not None and now - write_started >= self.write_timeout:
+            self.reap(client_socket, f"写入超过 {self.write_timeout:g} 秒")
+            return
+        heartbeat = session is not None and 'heartbeat' in session.features
+        if self.idle_timeout is not None and (session is None or heartbeat) and idle >= self.idle_timeout:
+            self.reap(client_socket, f"{idle:.0f} 秒没有收到任何消息" if heartbeat else "长时间没有登录")
+            return
+        if heartbeat and self.heartbeat_interval is not None and idle >= self.heartbeat_interval:
+            self.send_message(client_socket, {
+                'type': 'ping',
+                'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            })
+        deadline = self.next_check(now, state.last_recv, write_started, session)
+        if deadline is not None and client_socket in self.liveness:
+            self.timers.schedule(client_socket, max(deadline, now))
+
+    def reap(self, client_socket, reason):
+        """断开超时的连接：关闭socket的读写，读线程随之退出并完成登出"""
+        log.warning("[连接超时] %s %s，断开连接", self.sessions.get(client_socket) or client_socket, reason,
+                    extra=CONNECTION)
+        self.metrics.incr(REAPED)
+        self.liveness.pop(client_socket, None)
+        try:
+            client_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def write_messages(self, client_socket, queue):
+        """写线程：依次把发送队列中的帧写入socket，写入期间记下开始时间供超时检查"""
+        state = self.liveness.get(client_socket)
+        while True:
+            parts = queue.get()
+            if parts is None:
+                break
+            try:
+                if state is not None:
+                    state.write_started = time.monotonic()
+                send_parts(client_socket, parts)
+                if state is not None:
+                    state.write_started = None
+            except Exception as e:
+                if not queue.closed:
+                    log.warning("[错误] 发送消息失败: %s", e, extra=ERROR)
+                    self.metrics.incr(SEND_FAILURES)
+                    self.handle_logout(client_socket)
+                break
+        self.metrics.retire()
+
+    def outbound_stats(self):
+        """汇总所有发送队列的积压情况"""
+        queues = list(self.outbound.values())
+        return {
+            'connections': len(queues),
+            'frames_queued': sum(len(q) for q in queues),
+            'bytes_queued': sum(q.bytes_queued for q in queues),
+            'max_bytes_queued': max((q.bytes_queued for q in queues), default=0),
+            'frames_dropped': sum(q.frames_dropped for q in queues),
+            'slow_consumer_disconnects': self.slow_consumer_disconnects,
+        }
+
     def send_message(self, client_socket, message):
-        """发送消息到客户端"""
-        if client_socket:
+        """把消息放入客户端的发送队列，由写线程负责实际发送
+
+        message可以是消息字典，也可以是广播前已经编码好的Frame。
+        """
+        queue = self.outbound.get(client_socket)
+        if queue is not None:
             try:
-                # 将消息转换为JSON字符串
-                message_json = json.dumps(message, ensure_ascii=False)
-                # 发送消息长度
-                message_length = len(message_json.encode())
-                client_socket.sendall(message_length.to_bytes(4, 'big'))
-                # 发送消息内容
-                client_socket.sendall(message_json.encode())
+                frame = message if isinstance(message, Frame) else Frame(message)
+                target = self.sessions.get(client_socket)
+                version = target.protocol if target else 1
+                ref = target is not None and 'media_ref' in target.features
+                parts = frame.encode(version, ref, target.codec if target else 'json')
+                accepted = queue.put(parts, droppable=frame.type in DROPPABLE_TYPES)
+                self.metrics.frame_out(frame.type, sum(map(len, parts)))
+                if not accepted:
+                    self.slow_consumer_disconnects += 1
+                    raise ConnectionError(f"发送队列积压超过 {self.outbound_policy.disconnect_bytes} 字节")
                 
-                print(f"\n[发送消息]")
-                if client_socket in self.clients:
-                    target = self.clients[client_socket]
-                    print(f"目标用户: {target['username']} ({target['address'][0]}:{target['address'][1]})")
-                print(f"消息类型: {message.get('type')}")
-                if message.get('type') in ['square_image', 'private_image']:
-                    print("消息内容: [图片数据]")
-                else:
-                    print(f"消息内容: {message}")
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("[发送消息] 目标用户: %s 类型: %s 内容: %s", target, frame.type,
+                              Redacted(frame.message), extra=SEND)
                 
             except Exception as e:
-                print(f"[错误] 发送消息失败: {e}")
-                if client_socket in self.clients:
-                    target = self.clients[client_socket]
-                    print(f"目标用户: {target['username']} ({target['address'][0]}:{target['address'][1]})")
+                target = self.sessions.get(client_socket)
+                log.warning("[错误] 发送消息失败: %s 目标用户: %s", e, target, extra=ERROR)
+                self.metrics.incr(SEND_FAILURES)
                 # 如果发送失败，关闭连接
                 self.handle_logout(client_socket)
 
-    def receive_messages(self, client_socket, address):
-        """接收并处理客户端消息"""
+    def read_pending(self, client_socket, pending):
+        """处理旧进程(asyncio引擎)已经读出但还没有处理的字节，末尾不完整的帧用socket中的数据补齐"""
+        data = bytearray(pending)
+
+        def fill(size):
+            if size > 0:
+                extra = bytearray(size)
+                if not recv_exact_into(client_socket, memoryview(extra)):
+                    raise ConnectionError("接收消息时连接断开")
+                data.extend(extra)
+
+        offset = 0
+        while offset < len(data):
+            fill(offset + 4 - len(data))
+            message_length = int.from_bytes(data[offset:offset + 4], 'big')
+            if message_length > self.max_frame_size:
+                raise ValueError(f"帧长度 {message_length} 超过上限 {self.max_frame_size}")
+            fill(offset + 4 + message_length - len(data))
+            payload = bytes(data[offset + 4:offset + 4 + message_length])
+            offset += 4 + message_length
+            message = decode_payload(payload, copy_body=False)
+            self.metrics.frame_in(message.get('type'), message_length + 4)
+            self.process_message(client_socket, message)
+
+    def receive_messages(self, client_socket, address, pending=None):
+        """接收并处理客户端消息；pending不为None表示是从旧进程接管的连接，先处理旧进程已读出的字节"""
+        state = self.liveness[client_socket]
+        # 长度前缀和小帧读入预先分配的缓冲区，不再为每帧拼接分块列表
+        header = bytearray(4)
+        buffer = bytearray(self.recv_buffer_size)
         try:
-            print(f"\n[新连接] 地址: {address}")
+            if pending is None:
+                log.info("[新连接] 地址: %s", address, extra=CONNECTION)
+            elif pending:
+                self.read_pending(client_socket, pending)
             while self.running:
+                # 等待下一帧时只窥视不取走：冻结(交接、排空)后数据留在socket中，由接管的进程读取
+                try:
+                    peeked = client_socket.recv(1, socket.MSG_PEEK)
+                except OSError as e:
+                    if not self.frozen:
+                        log.info("[错误] %s 客户端异常断开连接: %s", address, e, extra=CONNECTION)
+                        break
+                    peeked = b''
+                if not peeked and not self.frozen:
+                    log.info("[连接断开] %s 客户端主动断开连接", address, extra=CONNECTION)
+                    break
+                self.enter_frame(client_socket)
                 try:
+                    if not self.running:
+                        break
                     # 接收消息长度
-                    length_bytes = client_socket.recv(4)
-                    if not length_bytes:
-                        print(f"[连接断开] 客户端主动断开连接")
+                    if not recv_exact_into(client_socket, memoryview(header)):
+                        log.info("[连接断开] %s 客户端主动断开连接", address, extra=CONNECTION)
                         break
                         
-                    message_length = int.from_bytes(length_bytes, 'big')
-                    
-                    # 分块接收大消息
-                    chunks = []
-                    bytes_received = 0
-                    while bytes_received < message_length:
-                        chunk = client_socket.recv(min(8192, message_length - bytes_received))
-                        if not chunk:
-                            raise ConnectionError("接收消息时连接断开")
-                        chunks.append(chunk)
-                        bytes_received += len(chunk)
+                    message_length = int.from_bytes(header, 'big')
+                    if message_length > self.max_frame_size:
+                        log.warning("[错误] 帧长度 %d 超过上限 %d，断开连接", message_length,
+                                    self.max_frame_size, extra=ERROR)
+                        break
                     
-                    # 组合所有分块
-                    message_json = b''.join(chunks).decode()
+                    # 小帧复用缓冲区，解码时复制出消息体；大帧单独分配一块，
+                    # v2消息体以memoryview切片的形式直接转发给接收者，不再复制
+                    reuse = message_length <= len(buffer)
+                    payload = memoryview(buffer if reuse else bytearray(message_length))[:message_length]
+                    if not recv_exact_into(client_socket, payload):
+                        raise ConnectionError("接收消息时连接断开")
+                    state.last_recv = time.monotonic()
                     
                     try:
-                        message = json.loads(message_json)
-                        print(f"\n[收到消息] 类型: {message.get('type')}")
-                        if message.get('type') in ['square_image', 'private_image']:
-                            print("消息内容: [图片数据]")
-                        else:
-                            print(f"消息内容: {message}")
+                        # v1(JSON)和v2(二进制)帧都可以解析
+                        message = decode_payload(payload, copy_body=reuse)
+                        self.metrics.frame_in(message.get('type'), message_length + 4)
                         
-                        # 处理��息
+                        # 处理消息
                         self.process_message(client_socket, message)
-                    except json.JSONDecodeError as e:
-                        print(f"[错误] JSON解析失败: {e}")
-                        print(f"原始消息: {message_json[:200]}...")  # 只打印前200个字符
+                    except (ValueError, struct.error) as e:
+                        log.warning("[错误] 消息解析失败: %s 原始消息: %r...", e, bytes(payload[:200]),
+                                    extra=ERROR)  # 只打印前200个字节
                         continue
                         
                 except ConnectionResetError:
-                    print(f"[错误] 客户端异常断开连接")
+                    log.info("[错误] %s 客户端异常断开连接", address, extra=CONNECTION)
                     break
                 except Exception as e:
-                    print(f"[错误] 接收消息时发生错误: {e}")
+                    log.warning("[错误] 接收消息时发生错误: %s", e, extra=ERROR)
                     break
+                finally:
+                    self.leave_frame(client_socket)
                     
         except Exception as e:
-            if client_socket in self.clients:
-                user_info = self.clients[client_socket]
-                print(f"[错误] 处理客户端消息失败: {e}")
-                print(f"用户信息: {user_info['username']} ({user_info['address'][0]}:{user_info['address'][1]})")
+            user_info = self.sessions.get(client_socket)
+            if user_info:
+                log.error("[错误] 处理客户端消息失败: %s 用户信息: %s", e, user_info, extra=ERROR)
         finally:
+            # 冻结期间断开的连接留给接管的进程处理登出
+            self.thawed.wait()
             self.handle_logout(client_socket)
+            self.close_connection(client_socket)
+            client_socket.close()  # 未登录的连接不会经过handle_logout
+            self.metrics.retire()
+
+    def register_handlers(self):
+        """登记中间件和每种消息类型的处理函数，新增消息类型时在这里登记"""
+        dispatcher = self.dispatcher
+        dispatcher.use('log', self.log_received)
+        dispatcher.use('auth', self.check_login)
+        dispatcher.use('rate_limit', self.check_rate)
+        dispatcher.use('size_limit', self.check_size)
+        dispatcher.use('room', self.check_room, types=SQUARE_MESSAGE_TYPES | {'stream_begin'})
+        dispatcher.use('media_ref', self.check_media_ref, types=MEDIA_REF_TYPES)
+
+        dispatcher.route('login', self.handle_login, login_required=False)
+        dispatcher.route('logout', lambda client_socket, message: self.handle_logout(client_socket),
+                         login_required=False)
+        dispatcher.route('square_message', self.handle_square_message, size_field='content')
+        dispatcher.route('private_message', self.handle_private_message, size_field='content')
+        # 8种媒体消息共用一个转发函数，按媒体描述取字段
+        for message_type, (kind, private) in MEDIA_MESSAGE_TYPES.items():
+            dispatcher.route(message_type, functools.partial(self.relay_media, kind=kind, private=private),
+                             size_field=kind.data_field)
+        dispatcher.route('stream_begin', self.handle_stream_begin)
+        dispatcher.route('stream_chunk', self.handle_stream_chunk)
+        dispatcher.route('stream_end', self.handle_stream_end)
+        dispatcher.route('stream_abort', self.handle_stream_abort)
+        dispatcher.route('media_fetch', self.handle_media_fetch)
+        dispatcher.route('history_request', self.handle_history_request)
+        dispatcher.route('room_join', self.handle_room_join)
+        dispatcher.route('room_leave', self.handle_room_leave)
+        dispatcher.route('room_list', self.handle_room_list)
+        dispatcher.route('ping', self.handle_ping, login_required=False)
+        dispatcher.route('pong', self.handle_pong, login_required=False)
 
     def process_message(self, client_socket, message):
-        """处理客户端消息"""
-        message_type = message.get('type')
-        
-        if message_type == 'login':
-            self.handle_login(client_socket, message)
-        elif message_type == 'square_message':
-            self.handle_square_message(client_socket, message)
-        elif message_type == 'private_message':
-            self.handle_private_message(client_socket, message)
-        elif message_type == 'square_image':
-            self.handle_square_image(client_socket, message)
-        elif message_type == 'private_image':
-            self.handle_private_image(client_socket, message)
-        elif message_type == 'square_video':
-            self.handle_square_video(client_socket, message)
-        elif message_type == 'private_video':
-            self.handle_private_video(client_socket, message)
-        elif message_type == 'square_file':
-            self.handle_square_file(client_socket, message)
-        elif message_type == 'private_file':
-            self.handle_private_file(client_socket, message)
-        elif message_type == 'square_audio':
-            self.handle_square_audio(client_socket, message)
-        elif message_type == 'private_audio':
-            self.handle_private_audio(client_socket, message)
-        elif message_type == 'logout':
-            self.handle_logout(client_socket)
+        """处理客户端消息，按消息类型记录处理耗时"""
+        started = time.perf_counter()
+        try:
+            if not self.dispatcher.dispatch(client_socket, message):
+                log.debug("未知的消息类型: %s", message.get('type'), extra=RECV)
+        finally:
+            self.metrics.observe_handler(message.get('type'), time.perf_counter() - started)
+
+    def handle_ping(self, client_socket, message):
+        """回复客户端的心跳"""
+        self.send_message(client_socket, {'type': 'pong', 'timestamp': message.get('timestamp')})
+
+    def handle_pong(self, client_socket, message):
+        """心跳回复，收到帧的时间已在接收循环中记下"""
+
+    def log_received(self, client_socket, message, route):
+        """中间件：DEBUG级别时输出收到的每一帧"""
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("[收到消息] 类型: %s 内容: %s", route.message_type, Redacted(message), extra=RECV)
+        return True
+
+    def check_login(self, client_socket, message, route):
+        """中间件：未登录的连接只能发送登录和登出消息"""
+        if route.login_required and client_socket not in self.sessions:
+            log.warning("[错误] 未登录的连接发送了 %s，已忽略", route.message_type, extra=ERROR)
+            return False
+        return True
+
+    def check_rate(self, client_socket, message, route):
+        """中间件：按会话的令牌桶限制发送速率，超过限额的帧在转发前丢弃，并回复error帧"""
+        limiter = self.limiters.get(client_socket)
+        if limiter is None:
+            return True
+        if route.message_type == 'stream_begin':
+            try:
+                nbytes = int(message.get('size') or 0)  # 分块传输按声明的总大小一次扣除
+            except (TypeError, ValueError):
+                nbytes = 0
+        else:
+            value = message.get(route.size_field) if route.size_field is not None else None
+            nbytes = len(value) if value is not None else 0
+        now = time.monotonic()
+        wait = limiter.check(route.message_type, nbytes, now)
+        if wait is None:
+            return True
+        self.metrics.incr(RATE_LIMITED)
+        if limiter.should_notify(route.message_type, now):
+            log.warning("[限流] %s 发送 %s 过于频繁，已拒绝", self.sessions.get(client_socket), route.message_type,
+                        extra=ERROR)
+            self.send_error(client_socket, 'rate_limited', route.message_type, "发送过于频繁，请稍后再试", wait)
+        return False
+
+    def send_error(self, client_socket, code, message_type, reason, retry_after=0.0):
+        """告诉客户端它发来的一帧被拒绝，code如rate_limited、not_in_room"""
+        self.send_message(client_socket, {
+            'type': 'error',
+            'code': code,
+            'message_type': message_type,
+            'retry_after': round(retry_after, 3),
+            'reason': reason,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+
+    def check_size(self, client_socket, message, route):
+        """中间件：按message_limits检查文本或媒体字段的长度"""
+        limit = self.message_limits.get(route.message_type)
+        if limit is None or route.size_field is None:
+            return True
+        value = message.get(route.size_field)
+        if value is not None and len(value) > limit:
+            log.warning("[错误] %s 的 %s 长度 %d 超过上限 %d，已丢弃", route.message_type, route.size_field,
+                        len(value), limit, extra=ERROR)
+            return False
+        return True
+
+    def check_room(self, client_socket, message, route):
+        """中间件：带room字段的广场消息只能由该聊天室的成员发送"""
+        room = message.get('room')
+        if room is None or self.rooms.is_member(client_socket, room):
+            return True
+        log.warning("[错误] %s 没有加入聊天室 %r，%s 已丢弃", self.sessions.get(client_socket), room,
+                    route.message_type, extra=ERROR)
+        self.send_error(client_socket, 'not_in_room', route.message_type, f"没有加入聊天室 {room}")
+        return False
+
+    def check_media_ref(self, client_socket, message, route):
+        """中间件：带内容哈希的媒体消息先经过媒体仓库"""
+        if not is_media_hash(message.get('media_hash')):
+            return True
+        return self.resolve_media(client_socket, message)
 
     def handle_login(self, client_socket, message):
         """处理登录消息"""
@@ -212,70 +957,173 @@ class ChatServer:
         local_port = message.get('local_port')
         timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         
-        print(f"\n[用户登录] {timestamp}")
-        print(f"用户名: {username}")
-        print(f"地址: {local_ip}:{local_port}")
+        # 协商协议版本，之后发给该用户的消息都使用此版本编码
+        protocol = negotiate_protocol(message)
+        features = negotiate_features(message)
+        # v2帧的元数据编码(msgpack、json)，v1固定为JSON
+        codec = negotiate_codec(message) if protocol >= 2 else 'json'
         
-        # 保存客户端信息
-        self.clients[client_socket] = {
-            'username': username,
-            'address': (local_ip, local_port)
-        }
+        # 保存客户端信息。加入列表、发送列表和广播上线在roster锁内进行，新用户收到的列表与之后的变化版本号连续，
+        # 同时登录的用户不会既在列表中看到对方又收到对方的上线消息
+        with self.roster.lock:
+            self.sessions.add(client_socket, username, (local_ip, local_port), protocol, features, codec)
+            self.roster.join(username, (local_ip, local_port))
+            try:
+                self.send_message(client_socket, self.friend_list_reply(message, protocol, features, codec))
+            except Exception as e:
+                log.warning("向新用户发送当前用户列表消息失败: %s", e, extra=ERROR)
+            self.schedule_presence()
+            self.announce_login(username, (local_ip, local_port), exclude=client_socket)
+        # 连接建立时安排的检查没有考虑心跳，登录后按心跳间隔重新安排
+        self.reschedule(client_socket)
+        self.metrics.incr(LOGINS)
+        online = self.sessions.snapshot
         
-        print(f"当前在线用户: {len(self.clients)}人")
-        for sock, info in self.clients.items():
-            print(f"- {info['username']} ({info['address'][0]}:{info['address'][1]})")
-
-        # 向新用户发送当前用户列表
-        users = []  # 得到所有用户，包括自己
-        for c, info in self.clients.items():
-            users.append({
-                'username': info['username'],
-                'address': info['address']
-            })
+        log.info("[用户登录] %s 地址: %s:%s 协议版本: v%d 编码: %s 当前在线用户: %d人", username,
+                 local_ip, local_port, protocol, codec, len(online), extra=SESSION)
+        # 完整列表的输出与在线人数成正比，只在DEBUG级别输出
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("当前在线用户: %s", ', '.join(map(repr, online)), extra=ROSTER)
         
-        print(f"发送给新用户的用户列表: {users}")
+        # 回放广场和该用户参与的私聊的最近消息
+        if 'history' in features and protocol >= 2:
+            self.replay_recent(client_socket, (local_ip, local_port))
+        # 发出不在线期间收到的私聊消息
+        self.deliver_offline(client_socket)
+
+        # 其他分片把该用户加入在线用户列表，并转交各自暂存的离线消息
+        self.publish('login', username=username, address=(local_ip, local_port))
 
+    def announce_login(self, username, address, exclude=None):
+        """向不支持roster的老用户立即广播新用户上线消息，支持的在合并后的roster_delta中收到"""
+        login_frame = Frame({
+            'type': 'new_friend_login',
+            'username': username,
+            'local_ip': address[0],
+            'local_port': address[1],
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+        legacy = [s for s in self.sessions.snapshot if 'roster' not in s.features]
+        return self.fanout(login_frame, legacy, exclude)
+
+    def remote_login(self, link, dest, username, address):
+        """其他分片上的用户登录：加入在线用户列表，本分片为其暂存的离线消息转交给那个分片"""
+        with self.roster.lock:
+            self.roster.join(username, address)
+            self.schedule_presence()
+        self.announce_login(username, address)
+        log.debug("[远端登录] %s 地址: %s:%s 分片: %s", username, address[0], address[1], dest, extra=SESSION)
+        if self.offline is None:
+            return
         try:
-            self.send_message(client_socket, {
-                'type': 'old_friend_list',
-                'users': users,
+            records = self.offline.take(recipient_id(address))
+        except OSError as e:
+            log.error("[错误] 读取离线消息失败: %s", e, extra=ERROR)
+            return
+        if records:
+            log.info("[离线消息] %s 在分片 %s 登录，转交 %d 条离线消息", username, dest, len(records), extra=CHAT)
+            # 离线消息中的媒体只有引用，先把数据发过去存入那个分片的媒体仓库
+            for message in map(JSON.loads, records):
+                data = self.media_store.get(message.get('media_hash')) if message.get('type') in MEDIA_FIELDS else None
+                if data is not None:
+                    link.send(dest, 'media', Frame({'type': 'media_data', 'media_hash': message['media_hash'],
+                                                    'data': data}))
+            link.send(dest, 'offline', target=address, records=[record.decode('utf-8') for record in records])
+            self.notify_delivered(records)
+
+    def remote_logout(self, username, address):
+        """其他分片上的用户登出：同一地址已经在本分片或别的分片重新登录时保留在列表中"""
+        with self.roster.lock:
+            if self.sessions.find(*address) is not None or self.is_remote(address):
+                return
+            self.roster.leave(address)
+            self.schedule_presence()
+        self.announce_logout(username, address)
+
+    def friend_list_reply(self, message, protocol, features, codec):
+        """登录回复old_friend_list，调用方持有roster锁
+
+        支持roster的客户端带上一次看到的roster_version和roster_epoch时，如果变化仍在日志中，
+        只回复这之后的变化(delta)；v2客户端的整份列表直接拼接预先编码好的片段。
+        """
+        reply = {
+            'type': 'old_friend_list',
+            'protocol': protocol,
+            'features': list(features),
+            'codec': codec,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        }
+        if 'roster' not in features:
+            reply['users'] = self.roster.users()  # 得到所有用户，包括自己
+            return reply
+        reply['roster_version'] = self.roster.version
+        reply['roster_epoch'] = self.roster.epoch
+        known = message.get('roster_version')
+        if isinstance(known, int) and message.get('roster_epoch') == self.roster.epoch:
+            changes = self.roster.changes_since(known)
+            if changes is not None:
+                reply['delta'] = {'joined': changes[0], 'left': changes[1]}
+                return reply
+        if protocol < 2:
+            reply['users'] = self.roster.users()
+            return reply
+        version, users = self.roster.snapshot()
+        rest = JSON.dumps({k: v for k, v in reply.items() if k != 'type'})
+        meta = b''.join((b'{"users":[', users, b'],', rest[1:]))
+        return EncodedFrame({'type': 'old_friend_list', 'roster_version': version}, meta)
+
+    def schedule_presence(self):
+        """有未发送的在线用户变化时安排一次合并发送，已经安排的不推迟"""
+        if self.presence_interval is None:
+            self.flush_presence()
+        elif self.roster.has_pending() and PRESENCE_TIMER not in self.timers:
+            self.timers.schedule(PRESENCE_TIMER, time.monotonic() + self.presence_interval)
+
+    def flush_presence(self):
+        """把合并后的上线、下线变化用一个roster_delta发给所有支持roster的用户"""
+        with self.roster.lock:
+            since, version, joined, left = self.roster.take_pending()
+            if not joined and not left:
+                return
+            delta_frame = Frame({
+                'type': 'roster_delta',
+                'since': since,
+                'version': version,
+                'epoch': self.roster.epoch,
+                'joined': joined,
+                'left': left,
                 'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             })
-        except Exception as e:
-            print(f"向新用户发送当前用户列表消息失败: {e}")
+            broadcast_count = 0
+            started = time.perf_counter()
+            for session in self.sessions.snapshot:
+                if 'roster' not in session.features:
+                    continue
+                try:
+                    self.send_message(session.sock, delta_frame)
+                    broadcast_count += 1
+                except Exception as e:
+                    log.warning("[错误] 向 %s 发送在线用户变化失败: %s", session.username, e, extra=ERROR)
+        self.metrics.observe_fanout(time.perf_counter() - started, broadcast_count)
+        log.debug("[在线用户] 版本 %d -> %d 上线 %d 人 下线 %d 人，已通知 %d 个用户", since, version,
+                  len(joined), len(left), broadcast_count, extra=ROSTER)
 
-        # 向老用户广播新用户上线消息
-        for c in list(self.clients.keys()):
-            if c == client_socket:  # 排除自己
-                continue
-            try:
-                self.send_message(c, {
-                    'type': 'new_friend_login',
-                    'username': username,
-                    'local_ip': local_ip,
-                    'local_port': local_port,
-                    'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                })
-            except Exception as e:
-                print(f"向老用户发送新用户登录消息失败: {e}")
-        
     def handle_square_message(self, client_socket, message):
         """处理广场消息"""
-        if client_socket not in self.clients:
+        sender = self.sessions.get(client_socket)
+        if sender is None:
             return
         
-        sender = self.clients[client_socket]
-        username = sender['username']
-        ip, port = sender['address']
+        username = sender.username
+        ip, port = sender.address
         content = message.get('content')
         timestamp = message.get('timestamp')
+        conversation, recipients = self.square_recipients(message)
         
-        print(f"\n[广场消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"内容: {content}")
+        log.info("[广场消息] %s 发送者: %s (%s:%s) %s内容: %s", timestamp, username, ip, port,
+                 f"聊天室: {message['room']} " if conversation != SQUARE else '', Truncated(content), extra=CHAT)
         
-        # 广播消息给所有用户
+        # 广播消息给所有用户，聊天室消息只发给成员
         broadcast_message = {
             'type': 'square_message',
             'username': username,
@@ -284,436 +1132,761 @@ class ChatServer:
             'content': content,
             'timestamp': timestamp
         }
+        if conversation != SQUARE:
+            broadcast_message['room'] = message['room']
+        self.record_history(conversation, broadcast_message)
+        broadcast_frame = Frame(broadcast_message)
         
         # 广播给所有用户（除了发送者）
-        broadcast_count = 0
-        for c in list(self.clients.keys()):
-            if c != client_socket:
-                try:
-                    self.send_message(c, broadcast_message)
-                    broadcast_count += 1
-                except Exception as e:
-                    print(f"[错误] 向 {self.clients[c]['username']} 发送消息失败: {e}")
+        broadcast_count = self.fanout(broadcast_frame, recipients, exclude=client_socket)
+        # 其他分片各自发给自己的连接
+        self.publish('broadcast', broadcast_frame)
         
-        print(f"消息已广播给 {broadcast_count} 个用户")
+        log.debug("消息已广播给 %d 个用户", broadcast_count, extra=CHAT)
+
+    def square_recipients(self, message):
+        """广场消息的会话名和接收者：带room字段的只发给该聊天室的成员(发送方已由room中间件检查)"""
+        room = message.get('room')
+        if room is None:
+            return SQUARE, self.sessions.snapshot
+        return room_conversation(room), self.rooms.members(room)
+
     # 1.3 logout
     def handle_logout(self, client_socket):
         """处理登出消息"""
-        if client_socket in self.clients:
+        # 先从注册表移除，并发调用时只有一个线程会拿到会话并广播
+        with self.roster.lock:
+            user_info = self.sessions.remove(client_socket)
+            # 同一地址已经在新的连接上(或其他分片上)重新登录时保留在列表中
+            gone = user_info is not None and self.sessions.find(*user_info.address) is None
+            if gone and not self.is_remote(user_info.address):
+                self.roster.leave(user_info.address)
+                self.schedule_presence()
+        if user_info is not None:
+            self.metrics.incr(LOGOUTS)
             # 获取用户信息
-            user_info = self.clients[client_socket]
-            username = user_info['username']
-            local_ip, local_port = user_info['address']
-            timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            username = user_info.username
+            local_ip, local_port = user_info.address
             
-            print(f"\n[用户登出] {timestamp}")
-            print(f"用户名: {username}")
-            print(f"地址: {local_ip}:{local_port}")
+            broadcast_count = self.announce_logout(username, user_info.address)
+            if gone:
+                self.publish('logout', username=username, address=user_info.address)
             
-            # 向其他用户广播该用户登出消息
-            logout_message = {
-                'type': 'one_user_logout',
-                'username': username,
-                'local_ip': local_ip,
-                'local_port': local_port,
-                'timestamp': timestamp
-            }
+            # 离开所有聊天室并通知其余成员
+            for room, session in self.rooms.leave_all(client_socket):
+                if session is not None:
+                    self.notify_room(room, session, 'leave')
             
-            # 广播登出消息
-            broadcast_count = 0
-            for c in list(self.clients.keys()):
-                if c != client_socket:
-                    try:
-                        self.send_message(c, logout_message)
-                        broadcast_count += 1
-                    except Exception as e:
-                        print(f"[错误] 向 {self.clients[c]['username']} 发送登出消息失败: {e}")
+            # 中止该用户未完成的分块传输
+            self.abort_transfers(client_socket)
             
-            # 移除客户端
+            # 关闭连接
+            self.close_connection(client_socket)
             client_socket.close()
-            del self.clients[client_socket]
             
-            print(f"登出消息已广播给 {broadcast_count} 个用户")
-            print(f"当前在线用户: {len(self.clients)}人")
-            for sock, info in self.clients.items():
-                print(f"- {info['username']} ({info['address'][0]}:{info['address'][1]})")
+            online = self.sessions.snapshot
+            log.info("[用户登出] %s 地址: %s:%s 已通知 %d 个用户 当前在线用户: %d人", username,
+                     local_ip, local_port, broadcast_count, len(online), extra=SESSION)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("当前在线用户: %s", ', '.join(map(repr, online)), extra=ROSTER)
+
+    def announce_logout(self, username, address):
+        """向不支持roster的老用户广播登出消息，支持的在合并后的roster_delta中收到"""
+        logout_frame = Frame({
+            'type': 'one_user_logout',
+            'username': username,
+            'local_ip': address[0],
+            'local_port': address[1],
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+        legacy = [s for s in self.sessions.snapshot if 'roster' not in s.features]
+        return self.fanout(logout_frame, legacy)
 
     def handle_private_message(self, client_socket, message):
         """处理私聊消息"""
-        if client_socket not in self.clients:
+        sender = self.sessions.get(client_socket)
+        if sender is None:
             return
         
-        sender = self.clients[client_socket]
-        username = sender['username']
-        sender_ip, sender_port = sender['address']
+        username = sender.username
+        sender_ip, sender_port = sender.address
         
         target_ip = message.get('target_ip')
         target_port = int(message.get('target_port'))
         content = message.get('content')
         timestamp = message.get('timestamp')
         
-        print(f"\n处理私聊消息:")
-        print(f"发送者: {username} ({sender_ip}:{sender_port})")
-        print(f"目标地址: {target_ip}:{target_port}")
-        print(f"当前在线用户: {self.clients}")
+        log.info("[私聊消息] %s 发送者: %s (%s:%s) 目标地址: %s:%s", timestamp, username,
+                 sender_ip, sender_port, target_ip, target_port, extra=CHAT)
+        
+        private_message = {
+            'type': 'private_message',
+            'username': username,
+            'ip': sender_ip,
+            'port': sender_port,
+            'content': content,
+            'timestamp': timestamp
+        }
+        entry = dict(private_message, target_ip=target_ip, target_port=target_port)
+        seq = self.record_history(private_conversation(sender.address, (target_ip, target_port)), entry)
         
         # 查找目标用户的socket
-        target_socket = None
-        for sock, info in self.clients.items():
-            if (info['address'][0] == target_ip and 
-                info['address'][1] == int(target_port)):  # 确保端口号也匹配
-                target_socket = sock
-                print(f"找到目标用户: {info['username']}")
-                break
+        target = self.sessions.find(target_ip, target_port)
         
-        if target_socket:
+        if target:
             try:
                 # 发送私聊消息给目标用户
-                self.send_message(target_socket, {
-                    'type': 'private_message',
-                    'username': username,
-                    'ip': sender_ip,
-                    'port': sender_port,
-                    'content': content,
-                    'timestamp': timestamp
-                })
-                print(f"私聊消息发送成功")
+                self.send_message(target.sock, private_message)
             except Exception as e:
-                print(f"发送私聊消息失败: {e}")
-        else:
-            print(f"未找到目标用户")
+                log.warning("发送私聊消息失败: %s", e, extra=ERROR)
+        elif not self.route((target_ip, target_port), 'private', Frame(private_message),
+                            target=(target_ip, target_port)):
+            self.queue_offline(client_socket, (target_ip, target_port), entry, seq)
 
     def send_private_message(self, from_user, to_user, message):
         """发送私聊消息"""
         # 找到目标用户的socket
-        target_socket = None
-        for client_socket, client_info in self.clients.items():
-            if client_info['username'] == to_user:
-                target_socket = client_socket
-                break
-                
-        if target_socket:
-            try:
-                message_json = json.dumps(message)
-                message_length = len(message_json.encode())
-                target_socket.send(message_length.to_bytes(4, 'big'))
-                target_socket.send(message_json.encode())
-            except Exception as e:
-                print(f"发送私聊消息失败: {e}")
-                self.remove_client(target_socket) 
+        target = self.sessions.find_by_username(to_user)
+        if target:
+            self.send_message(target.sock, message)
+
+    def relay_media(self, client_socket, message, kind, private):
+        """转发图片、视频、文件、音频消息：广场消息发给除发送者以外的所有用户，私聊消息发给目标用户
 
-    def handle_square_image(self, client_socket, message):
-        """处理广场图片消息"""
-        if client_socket not in self.clients:
+        kind是protocol.MEDIA_KINDS中的媒体描述，决定数据、扩展名和可选字段的名称。
+        """
+        sender = self.sessions.get(client_socket)
+        if sender is None:
             return
         
-        sender = self.clients[client_socket]
-        username = sender['username']
-        ip, port = sender['address']
-        image_data = message.get('image_data')
-        image_ext = message.get('image_ext')
-        file_name = message.get('file_name')  # 获取文件名
+        username = sender.username
+        ip, port = sender.address
+        file_name = message.get('file_name')
         timestamp = message.get('timestamp')
         
-        print(f"\n[广场图片消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"文件名: {file_name}")
-        
-        # 广播消息给所有用户
-        broadcast_message = {
-            'type': 'square_image',
+        relay_message = {
+            'type': message.get('type'),
             'username': username,
             'ip': ip,
             'port': port,
-            'image_data': image_data,
-            'image_ext': image_ext,
-            'file_name': file_name,  # 添加文件名
+            kind.data_field: message.get(kind.data_field),
+            kind.ext_field: message.get(kind.ext_field),
+            'file_name': file_name,
             'timestamp': timestamp
         }
+        for field in kind.optional_fields:  # 内容哈希、缩略图等可选字段
+            if message.get(field) is not None:
+                relay_message[field] = message[field]
+        if not private and message.get('room') is not None:
+            relay_message['room'] = message['room']
         
-        # 广播给所有用户（除了发送者）
-        for c in list(self.clients.keys()):
-            if c != client_socket:
+        if private:
+            target_ip = message.get('target_ip')
+            target_port = message.get('target_port')
+            target = self.sessions.find(target_ip, target_port)
+            conversation = private_conversation(sender.address, (target_ip, target_port))
+            # 目标不在线时离线队列中也只保存引用
+            entry = seq = None
+            if self.history is not None or self.recent is not None or (target is None and self.offline is not None):
+                entry = self.media_history_entry(relay_message, kind, target_ip=target_ip, target_port=target_port)
+                seq = self.record_history(conversation, entry)
+            else:
+                self.reference_media(conversation, relay_message)
+            log.info("[私聊%s消息] %s 发送者: %s (%s:%s) 接收者: %s:%s 文件名: %s", kind.label, timestamp,
+                     username, ip, port, target_ip, target_port, file_name, extra=CHAT)
+            if target:
                 try:
-                    self.send_message(c, broadcast_message)
+                    self.send_message(target.sock, relay_message)
                 except Exception as e:
-                    print(f"向用户发送广场图片消息失败: {e}")
-                    
-    def handle_private_image(self, client_socket, message):
-        """处理私聊图片消息"""
-        if client_socket not in self.clients:
+                    log.warning("发送私聊%s消息失败: %s", kind.label, e, extra=ERROR)
+            elif not self.route((target_ip, target_port), 'private', Frame(relay_message),
+                                target=(target_ip, target_port)):
+                self.queue_offline(client_socket, (target_ip, target_port), entry, seq)
             return
-            
-        sender = self.clients[client_socket]
-        username = sender['username']
-        ip, port = sender['address']
-        target_ip = message.get('target_ip')
-        target_port = message.get('target_port')
-        image_data = message.get('image_data')
-        image_ext = message.get('image_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
         
-        print(f"\n[私聊图片消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"接收者: {target_ip}:{target_port}")
-        print(f"文件名: {file_name}")
+        conversation, online = self.square_recipients(message)
+        log.info("[广场%s消息] %s 发送者: %s (%s:%s) %s文件名: %s", kind.label, timestamp, username, ip, port,
+                 f"聊天室: {message['room']} " if conversation != SQUARE else '', file_name, extra=CHAT)
+        if self.history is not None or self.recent is not None:
+            self.record_history(conversation, self.media_history_entry(relay_message, kind))
+        else:
+            self.reference_media(conversation, relay_message)
+        broadcast_frame = Frame(relay_message)
         
-        # 查找目标客户端
-        target_client = None
-        for c, info in self.clients.items():
-            if info['address'] == (target_ip, int(target_port)):
-                target_client = c
-                break
-                
-        if target_client:
+        # 广播给所有用户（除了发送者），聊天室消息只发给成员
+        self.fanout(broadcast_frame, online, exclude=client_socket)
+        self.publish('broadcast', broadcast_frame)
+
+    def remote_broadcast(self, message):
+        """其他分片转来的广场或聊天室消息：记入本分片的消息历史，发给本分片的接收者"""
+        conversation, recipients = self.square_recipients(message)
+        media = MEDIA_MESSAGE_TYPES.get(message.get('type'))
+        if media is not None:
+            self.store_remote_media(message, media[0].data_field)
+            if self.history is not None or self.recent is not None:
+                self.record_history(conversation, self.media_history_entry(message, media[0]))
+            else:
+                self.reference_media(conversation, message)
+        else:
+            self.record_history(conversation, message)
+        self.fanout(Frame(message), recipients)
+
+    def remote_private(self, message, target_address):
+        """其他分片转来的私聊消息：目标已经不在本分片时放入本分片的离线队列"""
+        target_ip, target_port = target_address
+        media = MEDIA_MESSAGE_TYPES.get(message.get('type'))
+        if media is not None:
+            self.store_remote_media(message, media[0].data_field)
+            entry = self.media_history_entry(message, media[0], target_ip=target_ip, target_port=target_port)
+        else:
+            entry = dict(message, target_ip=target_ip, target_port=target_port)
+        seq = self.record_history(private_conversation((message.get('ip'), message.get('port')), target_address),
+                                  entry)
+        target = self.sessions.find(target_ip, target_port)
+        if target:
+            self.send_message(target.sock, message)
+        else:
+            self.queue_offline(None, target_address, entry, seq)
+
+    def store_remote_media(self, message, field='data'):
+        """其他分片转来的带哈希的媒体存入本分片的媒体仓库，本分片的客户端之后可以按引用索取"""
+        digest = message.get('media_hash')
+        data = message.get(field)
+        if not is_media_hash(digest) or data is None or digest in self.media_store:
+            return
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        try:
+            if self.media_store.put(data, expected=digest) is None:
+                del message['media_hash']
+        except OSError as e:
+            log.error("[错误] 写入媒体仓库失败: %s", e, extra=ERROR)
+
+    def record_history(self, conversation, message):
+        """把一条消息追加到消息历史和最近消息，返回序号；写入失败不影响转发，此时返回None"""
+        self.reference_media(conversation, message)
+        first = False
+        if self.history is not None:
             try:
-                self.send_message(target_client, {
-                    'type': 'private_image',
-                    'username': username,
-                    'ip': ip,
-                    'port': port,
-                    'image_data': image_data,
-                    'image_ext': image_ext,
-                    'file_name': file_name,  # 添加文件名
-                    'timestamp': timestamp
-                })
-            except Exception as e:
-                print(f"发送私聊图片消息失败: {e}")
+                # 消息历史中还没有该会话时，最近消息中新建的缓冲区包含会话的全部消息
+                first = self.recent is not None and self.history.latest_seq(conversation) is None
+                seq = self.history.append(conversation, message)
+            except OSError as e:
+                log.error("[错误] 写入消息历史失败: %s", e, extra=ERROR)
+                return None
+        elif self.recent is not None:
+            seq = next(self.message_seqs)
+        else:
+            return None
+        if self.recent is not None and is_replayable(message):
+            self.recent.add(conversation, seq, message, first)
+        return seq
 
-    def handle_square_video(self, client_socket, message):
-        """处理广场视频消息"""
-        if client_socket not in self.clients:
+    def reference_media(self, conversation, message):
+        """记录会话中出现了带哈希的媒体，该会话的参与者之后可以索取"""
+        digest = message.get('media_hash')
+        if not is_media_hash(digest):
             return
-        
-        sender = self.clients[client_socket]
-        username = sender['username']
-        ip, port = sender['address']
-        video_data = message.get('video_data')
-        video_ext = message.get('video_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
-        
-        print(f"\n[广场视频消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"文件名: {file_name}")
-        
-        # 广播消息给所有用户
-        broadcast_message = {
-            'type': 'square_video',
-            'username': username,
-            'ip': ip,
-            'port': port,
-            'video_data': video_data,
-            'video_ext': video_ext,
-            'file_name': file_name,  # 添加文件名
-            'timestamp': timestamp
-        }
-        
-        # 广播给所有用户（除了发送者）
-        for c in list(self.clients.keys()):
-            if c != client_socket:
-                try:
-                    self.send_message(c, broadcast_message)
-                except Exception as e:
-                    print(f"向用户发送广场视频消息失败: {e}")
-                    
-    def handle_private_video(self, client_socket, message):
-        """处理私聊视频消息"""
-        if client_socket not in self.clients:
+        try:
+            self.media_store.add_reference(digest, conversation)
+        except OSError as e:
+            log.error("[错误] 写入媒体引用失败: %s", e, extra=ERROR)
+
+    def can_read(self, client_socket, address, conversation):
+        """私聊只有双方可以读取，聊天室只有成员可以读取，广场所有人都可以读取"""
+        room = room_of(conversation)
+        if room is not None:
+            return self.rooms.is_member(client_socket, room)
+        return isinstance(conversation, str) and is_participant(conversation, address)
+
+    def queue_offline(self, client_socket, target_address, message, seq=None):
+        """目标用户不在线时把私聊消息放入其离线队列，并把结果告诉发送方
+
+        message是保存到历史中的形式(媒体只有引用)，没能存入媒体仓库的媒体无法暂存。
+        """
+        target_ip, target_port = target_address
+        if self.offline is None:
+            log.info("未找到目标用户 %s:%s", target_ip, target_port, extra=CHAT)
             return
-            
-        sender = self.clients[client_socket]
-        username = sender['username']
-        ip, port = sender['address']
-        target_ip = message.get('target_ip')
-        target_port = message.get('target_port')
-        video_data = message.get('video_data')
-        video_ext = message.get('video_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
-        
-        print(f"\n[私聊视频消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"接收者: {target_ip}:{target_port}")
-        print(f"文件名: {file_name}")
-        
-        # 查找目标客户端
-        target_client = None
-        for c, info in self.clients.items():
-            if info['address'] == (target_ip, int(target_port)):
-                target_client = c
-                break
-                
-        if target_client:
+        if seq is not None:
+            message = dict(message, seq=seq)
+        queued = False
+        if is_replayable(message):
             try:
-                self.send_message(target_client, {
-                    'type': 'private_video',
-                    'username': username,
-                    'ip': ip,
-                    'port': port,
-                    'video_data': video_data,
-                    'video_ext': video_ext,
-                    'file_name': file_name,  # 添加文件名
-                    'timestamp': timestamp
-                })
-            except Exception as e:
-                print(f"��送私聊视频消息失败: {e}")
+                queued = self.offline.put(recipient_id(target_address), message)
+            except OSError as e:
+                log.error("[错误] 写入离线消息失败: %s", e, extra=ERROR)
+        log.info("[离线消息] 目标用户 %s:%s 不在线，%s", target_ip, target_port,
+                 '已暂存' if queued else '无法暂存', extra=CHAT)
+        self.send_delivery_status(client_socket, 'queued' if queued else 'rejected', message)
+
+    def deliver_offline(self, client_socket):
+        """登录时发出该用户的离线消息，并告诉仍在线的发送方消息已送达
 
-    def handle_square_file(self, client_socket, message):
-        """处理广场文件消息"""
-        if client_socket not in self.clients:
+        支持offline的客户端收到一个offline帧，消息片段直接拼接不再逐条编码；
+        其他客户端逐条收到原来的消息，不支持media_ref的从媒体仓库取回数据。
+        """
+        session = self.sessions.get(client_socket)
+        if self.offline is None or session is None:
+            return
+        try:
+            records = self.offline.take(recipient_id(session.address))
+        except OSError as e:
+            log.error("[错误] 读取离线消息失败: %s", e, extra=ERROR)
+            return
+        if records:
+            self.send_offline(session, records)
+            self.notify_delivered(records)
+
+    def send_offline(self, session, records):
+        """把离线消息的JSON片段发给刚登录的用户"""
+        client_socket = session.sock
+        log.info("[离线消息] 向 %s 发送 %d 条离线消息", session, len(records), extra=CHAT)
+        if 'offline' in session.features and session.protocol >= 2:
+            self.send_message(client_socket, offline_frame(records))
+        else:
+            for message in map(JSON.loads, records):
+                media = MEDIA_MESSAGE_TYPES.get(message.get('type'))
+                if media is not None and 'media_ref' not in session.features:
+                    data = self.media_store.get(message.get('media_hash'))
+                    if data is None:
+                        log.warning("[离线消息] 媒体仓库中已没有 %s，跳过", message.get('media_hash'), extra=TRANSFER)
+                        continue
+                    message[media[0].data_field] = data
+                self.send_message(client_socket, message)
+
+    def notify_delivered(self, records):
+        """离线消息已送达：告诉仍在线的发送方，每个发送方一条，带上送达的条数"""
+        senders = {}
+        for message in map(JSON.loads, records):
+            _, count = senders.get((message.get('ip'), message.get('port')), (None, 0))
+            senders[(message.get('ip'), message.get('port'))] = (message, count + 1)
+        for (ip, port), (message, count) in senders.items():
+            sender = self.sessions.find(ip, port)
+            if sender is not None:
+                self.send_delivery_status(sender.sock, 'delivered', message, count)
+
+    def remote_offline(self, target_address, records):
+        """其他分片转交的离线消息：目标已经不在本分片时重新暂存"""
+        # 媒体数据已经转到本分片的媒体仓库，记下所属的私聊，接收方才能索取
+        for message in map(JSON.loads, records):
+            if is_media_hash(message.get('media_hash')):
+                sender = (message.get('ip'), message.get('port'))
+                self.reference_media(private_conversation(sender, target_address), message)
+        session = self.sessions.find(*target_address)
+        if session is not None:
+            self.send_offline(session, records)
+            return
+        for record in records:
+            self.queue_offline(None, target_address, JSON.loads(record))
+
+    def send_delivery_status(self, client_socket, status, message, count=1):
+        """告诉私聊发送方消息的投递状态：queued(已暂存)、rejected(无法暂存)、delivered(已送达)
+
+        delivered时message是送达的最后一条，count是送达的条数。
+        """
+        session = self.sessions.get(client_socket)
+        if session is None or 'offline' not in session.features:
+            return
+        self.send_message(client_socket, {
+            'type': 'delivery_status',
+            'status': status,
+            'message_type': message.get('type'),
+            'target_ip': message.get('target_ip'),
+            'target_port': message.get('target_port'),
+            'file_name': message.get('file_name'),
+            'seq': message.get('seq'),
+            'count': count,
+            'timestamp': message.get('timestamp'),
+        })
+
+    def replay_recent(self, client_socket, address):
+        """登录后把每个会话的最近消息用一个history帧发送，最新一页在有新消息前只编码一次"""
+        conversations = self.recent.conversations_for(address) if self.recent is not None else [SQUARE]
+        for conversation in conversations:
+            self.replay_conversation(client_socket, conversation)
+
+    def replay_conversation(self, client_socket, conversation):
+        """用一个history帧发送会话最新的replay_count条消息"""
+        frame = self.recent.cached_latest(conversation, self.replay_count) if self.recent is not None else None
+        if frame is None:
+            frame = self.history_page(conversation, None, self.replay_count, replay=True)
+            if self.recent is not None and frame.message['count']:
+                self.recent.cache_latest(conversation, self.replay_count, frame, frame.message['newest'])
+        if frame.message['count']:
+            self.send_message(client_socket, frame)
+
+    def history_page(self, conversation, before=None, limit=50, replay=False):
+        """一个会话中序号小于before(None表示到最新)的最后limit条消息，编码为一个history帧
+
+        先从最近消息中取，不够且缓冲区不完整时再从消息历史中向前读取；没有更早的消息时游标为None。
+        """
+        entries, complete = self.recent.page(conversation, before, limit) if self.recent is not None else ([], False)
+        exhausted = False
+        if len(entries) < limit:
+            if self.history is not None and not complete:
+                oldest = entries[0][0] if entries else before
+                older = self.history.before(conversation, oldest, limit - len(entries))
+                exhausted = len(older) < limit - len(entries)
+                entries = [(seq, encode_entry(seq, message)) for seq, _, message in older
+                           if is_replayable(message)] + entries
+            else:
+                exhausted = True
+        cursor = entries[0][0] if entries and not exhausted else None
+        return history_frame(conversation, entries, cursor, replay)
+
+    def handle_history_request(self, client_socket, message):
+        """向前翻页：返回会话中序号小于before的消息，私聊只有双方可以读取，聊天室只有成员可以读取"""
+        sender = self.sessions.get(client_socket)
+        conversation = message.get('conversation')
+        if sender is None or sender.protocol < 2:
+            return
+        if not self.can_read(client_socket, sender.address, conversation):
+            log.warning("[错误] %s 无权读取会话 %s", sender, conversation, extra=ERROR)
+            return
+        try:
+            before = int(message['before']) if message.get('before') is not None else None
+            limit = max(1, min(int(message.get('limit', self.replay_count)), self.history_page_limit))
+        except (TypeError, ValueError):
+            log.warning("[错误] 翻页参数无效: %s", Redacted(message), extra=ERROR)
+            return
+        self.send_message(client_socket, self.history_page(conversation, before, limit))
+
+    def handle_room_join(self, client_socket, message):
+        """加入聊天室：回复成员列表和最近消息，并通知其他成员"""
+        session = self.sessions.get(client_socket)
+        room = message.get('room')
+        if session is None or 'rooms' not in session.features:
+            return
+        if not is_room_name(room):
+            self.send_error(client_socket, 'invalid_room', 'room_join', "聊天室名称无效")
+            return
+        joined = not self.rooms.is_member(client_socket, room)
+        members = self.rooms.join(session, room)
+        if members is None:
+            self.send_error(client_socket, 'too_many_rooms', 'room_join',
+                            f"最多加入 {self.rooms.max_rooms_per_session} 个聊天室")
+            return
+        self.send_message(client_socket, {
+            'type': 'room_joined',
+            'room': room,
+            'members': [{'username': s.username, 'address': s.address} for s in members],
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+        if 'history' in session.features and session.protocol >= 2:
+            self.replay_conversation(client_socket, room_conversation(room))
+        if joined:
+            log.info("[加入聊天室] %s 加入 %s 当前成员: %d人", session, room, len(members), extra=SESSION)
+            self.notify_room(room, session, 'join', exclude=client_socket)
+
+    def handle_room_leave(self, client_socket, message):
+        """离开聊天室，通知其余成员"""
+        room = message.get('room')
+        session = self.rooms.leave(client_socket, room)
+        if session is None:
+            return
+        log.info("[离开聊天室] %s 离开 %s 当前成员: %d人", session, room, len(self.rooms.members(room)),
+                 extra=SESSION)
+        self.notify_room(room, session, 'leave')
+
+    def handle_room_list(self, client_socket, message):
+        """回复所有聊天室及其人数"""
+        self.send_message(client_socket, {
+            'type': 'room_list',
+            'rooms': self.rooms.listing(),
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+
+    def notify_room(self, room, session, action, exclude=None, publish=True):
+        """告诉聊天室的成员有人加入(join)或离开(leave)，publish时同时告诉其他分片上的成员"""
+        member_frame = Frame({
+            'type': 'room_member',
+            'room': room,
+            'action': action,
+            'username': session.username,
+            'address': session.address,
+            'timestamp': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        })
+        self.fanout(member_frame, self.rooms.members(room), exclude)
+        if publish:
+            self.publish('room_member', room=room, action=action, username=session.username,
+                         address=session.address)
+
+    def media_history_entry(self, relay_message, kind, **extra):
+        """媒体消息在历史中的形式：去掉数据，只保留内容哈希和大小
+
+        没有哈希的媒体(小文件或v1客户端)此时存入媒体仓库，超过仓库容量时哈希为None。
+        """
+        entry = {k: v for k, v in relay_message.items() if k != kind.data_field}
+        entry.update(extra)
+        data = relay_message.get(kind.data_field)
+        if data is None:
+            return entry
+        if isinstance(data, str):
+            data = base64.b64decode(data)  # v1客户端
+        if not is_media_hash(entry.get('media_hash')):
+            try:
+                entry['media_hash'] = self.media_store.put(data)
+            except OSError as e:
+                log.error("[错误] 写入媒体仓库失败: %s", e, extra=ERROR)
+                entry['media_hash'] = None
+        entry['media_size'] = len(data)
+        return entry
+
+    def handle_stream_begin(self, client_socket, message):
+        """处理分块传输的开始：确定接收者，转发传输头"""
+        sender = self.sessions.get(client_socket)
+        if sender is None:
             return
         
-        sender = self.clients[client_socket]
-        username = sender['username']
-        ip, port = sender['address']
-        file_data = message.get('file_data')
-        file_ext = message.get('file_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
-        
-        print(f"\n[广场文件消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"文件名: {file_name}")
+        media_type = message.get('media_type')
+        if media_type not in MEDIA_REF_TYPES:
+            log.warning("[错误] 不支持分块传输的消息类型: %s", media_type, extra=ERROR)
+            return
         
-        # 广播消息给所有用户
-        broadcast_message = {
-            'type': 'square_file',
-            'username': username,
-            'ip': ip,
-            'port': port,
-            'file_data': file_data,
-            'file_ext': file_ext,
-            'file_name': file_name,  # 添加文件名
-            'timestamp': timestamp
-        }
+        # 私聊目标在其他分片上时由那个分片转发和暂存，广场和聊天室的传输每个分片各自转发
+        forward = None
+        if self.links:
+            if not media_type.startswith('private_'):
+                forward = self.publish
+            elif self.sessions.find(message.get('target_ip'), message.get('target_port')) is None:
+                target_address = (message.get('target_ip'), message.get('target_port'))
+                if self.is_remote(target_address):
+                    forward = functools.partial(self.route, target_address)
+        transfer, header = self.begin_transfer((client_socket, message.get('transfer_id')), sender, message,
+                                               offline=forward is None)
+        if forward is not None:
+            transfer.forward = forward
+            forward('stream_begin', Frame(dict(header, target_ip=message.get('target_ip'),
+                                               target_port=message.get('target_port'))))
+
+    def remote_stream(self, origin, message):
+        """其他分片转来的分块传输帧，origin是(链路, 分片)，在本分片重新分配传输编号"""
+        key = (origin, message.get('transfer_id'))
+        message_type = message.get('type')
+        if message_type == 'stream_begin':
+            sender = Session(None, message.get('username'), (message.get('ip'), message.get('port')))
+            self.begin_transfer(key, sender, message)
+        elif message_type == 'stream_chunk':
+            self.forward_chunk(key, message.get('data') or b'')
+        elif message_type == 'stream_end':
+            self.end_transfer(key, origin)
+        else:
+            self.abort_transfer(key)
+
+    def begin_transfer(self, key, sender, message, offline=True):
+        """登记一次分块传输并把传输头发给本机的接收者，返回(Transfer, 传输头)
+
+        offline为False时私聊目标不在本机也不放入离线队列(目标在其他分片上)。
+        """
+        media_type = message.get('media_type')
+        # 私聊只发给目标用户，广场发给除发送者以外的所有用户，聊天室发给除发送者以外的成员
+        if media_type.startswith('private_'):
+            target = self.sessions.find(message.get('target_ip'), message.get('target_port'))
+            recipients = (target,) if target else ()
+        else:
+            conversation, members = self.square_recipients(message)
+            recipients = tuple(s for s in members if s.sock is not sender.sock)
+        size = int(message.get('size', 0))
+        # 带内容哈希的大文件边转发边写入媒体仓库；支持media_ref的接收者不接收分块，
+        # 存入仓库后只收到引用，需要时再来索取
+        by_reference = ()
+        if is_media_hash(message.get('media_hash')) and size <= self.media_store.quota_bytes:
+            by_reference = tuple(s.sock for s in recipients if 'media_ref' in s.features)
+        # 分块帧只有v2客户端能解析
+        streamable = tuple(s.sock for s in recipients if s.protocol >= 2 and s.sock not in by_reference)
         
-        # 广播给所有用户（除了发送者）
-        for c in list(self.clients.keys()):
-            if c != client_socket:
-                try:
-                    self.send_message(c, broadcast_message)
-                except Exception as e:
-                    print(f"向用户发送广场文件消息失败: {e}")
-                    
-    def handle_private_file(self, client_socket, message):
-        """处理私聊文件消息"""
-        if client_socket not in self.clients:
-            return
-            
-        sender = self.clients[client_socket]
-        username = sender['username']
-        ip, port = sender['address']
-        target_ip = message.get('target_ip')
-        target_port = message.get('target_port')
-        file_data = message.get('file_data')
-        file_ext = message.get('file_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
+        transfer = Transfer(next(self.transfer_ids), sender, streamable, media_type, size)
+        self.transfers[key] = transfer
+        if is_media_hash(message.get('media_hash')):
+            transfer.media_hash = message['media_hash']
+            transfer.writer = self.media_store.open_writer()
+            transfer.ref_recipients = by_reference
         
-        print(f"\n[私聊文件消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"接收者: {target_ip}:{target_port}")
-        print(f"文件名: {file_name}")
+        log.info("[分块传输开始] 编号: %d 发送者: %s 类型: %s 大小: %d字节 文件名: %s", transfer.id,
+                 sender, media_type, transfer.size, message.get('file_name'), extra=TRANSFER)
+        skipped = len(recipients) - len(streamable) - len(by_reference)
+        if skipped:
+            log.info("%d 个旧版客户端不支持分块传输，已跳过", skipped, extra=TRANSFER)
         
-        # 查找目标客户端
-        target_client = None
-        for c, info in self.clients.items():
-            if info['address'] == (target_ip, int(target_port)):
-                target_client = c
-                break
-                
-        if target_client:
-            try:
-                self.send_message(target_client, {
-                    'type': 'private_file',
-                    'username': username,
-                    'ip': ip,
-                    'port': port,
-                    'file_data': file_data,
-                    'file_ext': file_ext,
-                    'file_name': file_name,  # 添加文件名
-                    'timestamp': timestamp
-                })
-            except Exception as e:
-                print(f"发送私聊文件消息失败: {e}")
+        header = {k: v for k, v in message.items() if k not in ('target_ip', 'target_port')}
+        header.update({
+            'transfer_id': transfer.id,
+            'username': sender.username,
+            'ip': sender.address[0],
+            'port': sender.address[1],
+        })
+        if by_reference:
+            transfer.reference = {k: v for k, v in header.items()
+                                  if k not in ('transfer_id', 'media_type', 'size')}
+            transfer.reference.update({'type': media_type, 'media_size': size})
+        if transfer.writer is not None:
+            # 写入媒体仓库的传输在完成后记入消息历史
+            entry = {k: v for k, v in header.items() if k not in ('transfer_id', 'media_type', 'size')}
+            entry.update({'type': media_type, 'media_size': size})
+            if media_type.startswith('private_'):
+                target_address = (message.get('target_ip'), message.get('target_port'))
+                entry.update(target_ip=target_address[0], target_port=target_address[1])
+                transfer.record = (private_conversation(sender.address, target_address), entry)
+                if not recipients and offline:
+                    transfer.offline_target = target_address
+            else:
+                transfer.record = (conversation, entry)
+        header_frame = Frame(header)
+        started = time.perf_counter()
+        for sock in streamable:
+            self.send_message(sock, header_frame)
+        self.metrics.observe_fanout(time.perf_counter() - started, len(streamable))
+        return transfer, header
 
-    def handle_square_audio(self, client_socket, message):
-        """处理广场音频消息"""
-        if client_socket not in self.clients:
+    def handle_stream_chunk(self, client_socket, message):
+        """转发一块数据，服务器不保留已转发的块"""
+        self.forward_chunk((client_socket, message.get('transfer_id')), message.get('data') or b'')
+
+    def forward_chunk(self, key, data):
+        """把一块数据转发给本机的接收者，需要时转给其他分片"""
+        transfer = self.transfers.get(key)
+        if transfer is None:
             return
         
-        sender = self.clients[client_socket]
-        username = sender['username']
-        ip, port = sender['address']
-        audio_data = message.get('audio_data')
-        audio_ext = message.get('audio_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
-        
-        print(f"\n[广场音频消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"文件名: {file_name}")
-        
-        # 广播消息给所有用户
-        broadcast_message = {
-            'type': 'square_audio',
-            'username': username,
-            'ip': ip,
-            'port': port,
-            'audio_data': audio_data,
-            'audio_ext': audio_ext,
-            'file_name': file_name,  # 添加���件名
-            'timestamp': timestamp
-        }
+        transfer.received += len(data)
+        if transfer.received > transfer.size:
+            log.warning("[错误] 分块传输 %d 超过声明的大小 %d，已中止", transfer.id, transfer.size, extra=ERROR)
+            self.abort_transfer(key)
+            return
+        if transfer.writer is not None:
+            try:
+                transfer.writer.write(data)
+            except OSError as e:
+                log.error("[错误] 写入媒体仓库失败: %s", e, extra=ERROR)
+                transfer.writer.abort()
+                transfer.writer = None
         
-        # 广播给所有用户（除了发送者）
-        for c in list(self.clients.keys()):
-            if c != client_socket:
-                try:
-                    self.send_message(c, broadcast_message)
-                except Exception as e:
-                    print(f"向用户发送广场音频消息失败: {e}")
-                    
-    def handle_private_audio(self, client_socket, message):
-        """处理私聊音频消息"""
-        if client_socket not in self.clients:
+        chunk_frame = Frame({'type': 'stream_chunk', 'transfer_id': transfer.id, 'data': data})
+        started = time.perf_counter()
+        for sock in transfer.recipients:
+            self.send_message(sock, chunk_frame)
+        self.metrics.observe_fanout(time.perf_counter() - started, len(transfer.recipients))
+        if transfer.forward is not None:
+            transfer.forward('stream_chunk', chunk_frame)
+
+    def handle_stream_end(self, client_socket, message):
+        """分块传输结束"""
+        self.end_transfer((client_socket, message.get('transfer_id')), client_socket)
+
+    def end_transfer(self, key, client_socket):
+        """完成分块传输：记入消息历史，向等待引用的接收者发送引用"""
+        transfer = self.transfers.pop(key, None)
+        if transfer is None:
             return
-            
-        sender = self.clients[client_socket]
-        username = sender['username']
-        ip, port = sender['address']
-        target_ip = message.get('target_ip')
-        target_port = message.get('target_port')
-        audio_data = message.get('audio_data')
-        audio_ext = message.get('audio_ext')
-        file_name = message.get('file_name')  # 获取文件名
-        timestamp = message.get('timestamp')
         
-        print(f"\n[私聊音频消息] {timestamp}")
-        print(f"发送者: {username} ({ip}:{port})")
-        print(f"接收者: {target_ip}:{target_port}")
-        print(f"文件名: {file_name}")
+        log.info("[分块传输完成] 编号: %d 共 %d 字节", transfer.id, transfer.received, extra=TRANSFER)
+        stored = transfer.writer is not None and transfer.writer.commit(transfer.media_hash) is not None
+        if transfer.writer is not None and not stored:
+            log.warning("[媒体仓库] 分块传输 %d 未保存(哈希与声明不一致或超过容量)", transfer.id, extra=TRANSFER)
+        if stored and transfer.record is not None:
+            seq = self.record_history(*transfer.record)
+            if transfer.offline_target is not None:
+                self.queue_offline(client_socket, transfer.offline_target, transfer.record[1], seq)
+        if transfer.ref_recipients:
+            if stored:
+                reference_frame = Frame(transfer.reference)
+                for sock in transfer.ref_recipients:
+                    self.send_message(sock, reference_frame)
+            else:
+                log.warning("%d 个等待引用的接收者无法收到该文件", len(transfer.ref_recipients), extra=TRANSFER)
+        end_frame = Frame({'type': 'stream_end', 'transfer_id': transfer.id})
+        for sock in transfer.recipients:
+            self.send_message(sock, end_frame)
+        if transfer.forward is not None:
+            transfer.forward('stream_end', end_frame)
+
+    def handle_stream_abort(self, client_socket, message):
+        """发送方主动中止分块传输"""
+        self.abort_transfer((client_socket, message.get('transfer_id')))
+
+    def abort_transfer(self, key):
+        """中止分块传输并通知接收者丢弃已收到的块"""
+        transfer = self.transfers.pop(key, None)
+        if transfer is None:
+            return
         
-        # 查找目标客户端
-        target_client = None
-        for c, info in self.clients.items():
-            if info['address'] == (target_ip, int(target_port)):
-                target_client = c
-                break
-                
-        if target_client:
+        log.info("[分块传输中止] 编号: %d", transfer.id, extra=TRANSFER)
+        if transfer.writer is not None:
+            transfer.writer.abort()
+        abort_frame = Frame({'type': 'stream_abort', 'transfer_id': transfer.id})
+        for sock in transfer.recipients:
+            self.send_message(sock, abort_frame)
+        if transfer.forward is not None:
+            transfer.forward('stream_abort', abort_frame)
+
+    def abort_transfers(self, owner):
+        """中止某个连接(或其他分片)发来的所有未完成的分块传输"""
+        for key in [k for k in list(self.transfers) if k[0] == owner]:
+            self.abort_transfer(key)
+
+    def resolve_media(self, client_socket, message):
+        """处理带有内容哈希的媒体消息，返回False表示消息不再继续分发
+
+        带数据的消息是首次上传，校验哈希后存入媒体仓库；只带哈希的是引用，
+        服务器有该内容且发送方可以读取引用过它的某个会话时从仓库取出数据继续分发，
+        否则通知发送方上传完整数据(只知道哈希不能取得别人私聊中的文件)。
+        两种情况下支持media_ref的接收者都只收到引用，本地没有缓存时再来索取。
+        """
+        field = MEDIA_FIELDS[message['type']]
+        digest = message['media_hash']
+        data = message.get(field)
+        if data is not None:
+            if isinstance(data, str):
+                data = base64.b64decode(data)  # v1客户端
             try:
-                self.send_message(target_client, {
-                    'type': 'private_audio',
-                    'username': username,
-                    'ip': ip,
-                    'port': port,
-                    'audio_data': audio_data,
-                    'audio_ext': audio_ext,
-                    'file_name': file_name,  # 添加文件名
-                    'timestamp': timestamp
-                })
-            except Exception as e:
-                print(f"发送私聊音频消息失败: {e}")
\ No newline at end of file
+                stored = self.media_store.put(data, expected=digest)
+            except OSError as e:
+                log.error("[错误] 写入媒体仓库失败: %s", e, extra=ERROR)
+                stored = None
+            if stored is None:
+                # 哈希不一致或没能存入仓库，接收者无法再索取，按普通媒体消息转发
+                log.warning("[媒体仓库] 未保存 %.16s...，按完整数据转发", digest, extra=TRANSFER)
+                del message['media_hash']
+            return True
+        
+        present = self.may_fetch(client_socket, digest) and self.media_store.lookup(digest) is not None
+        data = self.media_store.get(digest) if present else None
+        log.info("[媒体引用] %.16s... %s", digest, '已存在，跳过上传' if data is not None else '不存在，等待上传',
+                 extra=TRANSFER)
+        self.send_message(client_socket, {
+            'type': 'media_status',
+            'media_hash': digest,
+            'present': data is not None,
+        })
+        if data is None:
+            return False
+        message[field] = data
+        return True
+
+    def may_fetch(self, client_socket, digest):
+        """连接的用户可以读取某个引用过该内容的会话"""
+        sender = self.sessions.get(client_socket)
+        return sender is not None and any(self.can_read(client_socket, sender.address, conversation)
+                                          for conversation in self.media_store.references(digest))
+
+    def handle_media_fetch(self, client_socket, message):
+        """客户端本地没有引用的内容时，从媒体仓库取出发给它
+
+        只有引用过该内容的某个会话的参与者可以索取，否则与仓库中没有时一样回复空数据。
+        """
+        sender = self.sessions.get(client_socket)
+        if sender is None:
+            return
+        digest = message.get('media_hash')
+        allowed = is_media_hash(digest) and self.may_fetch(client_socket, digest)
+        data = self.media_store.get(digest) if allowed else None
+        if not allowed:
+            log.warning("[错误] %s 无权索取 %s", sender, digest, extra=ERROR)
+        elif data is None:
+            log.warning("[错误] 媒体仓库中没有 %s", digest, extra=TRANSFER)
+        self.send_message(client_socket, {
+            'type': 'media_data',
+            'media_hash': digest,
+            'data': data,
+        })
@@ -0,0 +1,25 @@
+class Transfer:
+    """一次正在进行的分块传输
+
+    接收者在stream_begin时确定，之后每收到一块就转发给这些接收者，
+    服务器只持有正在转发的那一块数据。
+    """
+
+    __slots__ = ('id', 'sender', 'recipients', 'media_type', 'size', 'received',
+                 'media_hash', 'writer', 'ref_recipients', 'reference', 'record',
+                 'offline_target', 'forward')
+
+    def __init__(self, transfer_id, sender, recipients, media_type, size):
+        self.id = transfer_id           # 服务器分配的传输编号，转发给接收者时使用
+        self.sender = sender            # 发送方Session
+        self.recipients = recipients    # 接收者socket元组
+        self.media_type = media_type    # 对应的完整消息类型，如square_video
+        self.size = size                # 发送方声明的总字节数
+        self.received = 0               # 已转发的字节数
+        self.media_hash = None          # 发送方声明的内容哈希，有值时数据同时写入媒体仓库
+        self.writer = None              # 写入媒体仓库的MediaWriter
+        self.ref_recipients = ()        # 支持media_ref的接收者socket元组，传输完成后只收到引用
+        self.reference = None           # 发给ref_recipients的引用消息
+        self.record = None              # 完成后记入消息历史的(会话名, 消息)
+        self.offline_target = None      # 私聊目标不在线时的地址，完成后放入其离线队列
+        self.forward = None             # forward(操作, Frame)把每一帧转给其他分片，不需要时为None
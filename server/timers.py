@@ -0,0 +1,73 @@
+"""连接定时器：截止时间放在一个最小堆中，服务端每个连接一个键，客户端为心跳检查和写入超时两个键
+
+收发帧时只记下时间(Liveness)，不操作堆；每个键在堆中只有一个截止时间，到期时再根据
+记下的时间决定断开、发送ping还是安排下一次检查。重新安排或取消时不从堆中删除旧条目，
+只在字典中记下每个键当前的截止时间，弹出时跳过作废的条目；作废的条目过多时重建堆。
+"""
+import heapq
+import itertools
+import threading
+
+
+class TimerHeap:
+    """按截止时间取出到期的键，键可以是任意可哈希对象"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._heap = []                 # [(截止时间, 序号, 键)]，序号保证不比较键本身
+        self._deadlines = {}            # {键: 当前的截止时间}
+        self._order = itertools.count()
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def schedule(self, key, deadline):
+        """设置键的截止时间，替换之前的设置"""
+        with self._lock:
+            self._deadlines[key] = deadline
+            heapq.heappush(self._heap, (deadline, next(self._order), key))
+            if len(self._heap) > 64 and len(self._heap) > 2 * len(self._deadlines):
+                self._rebuild_locked()
+
+    def cancel(self, key):
+        with self._lock:
+            self._deadlines.pop(key, None)
+
+    def next_deadline(self):
+        """最早的截止时间，没有定时器时返回None"""
+        with self._lock:
+            self._discard_stale_locked()
+            return self._heap[0][0] if self._heap else None
+
+    def expired(self, now):
+        """取出截止时间不晚于now的键，这些键不再有定时器"""
+        keys = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self._heap)
+                if self._deadlines.get(key) == deadline:
+                    del self._deadlines[key]
+                    keys.append(key)
+        return keys
+
+    def _discard_stale_locked(self):
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def _rebuild_locked(self):
+        self._heap = [(deadline, next(self._order), key) for key, deadline in self._deadlines.items()]
+        heapq.heapify(self._heap)
+
+
+class Liveness:
+    """一个连接最近一次收到帧的时间和正在进行的写入，时间取自time.monotonic()"""
+
+    __slots__ = ('last_recv', 'write_started')
+
+    def __init__(self, now):
+        self.last_recv = now            # 最近一次收到完整帧的时间
+        self.write_started = None       # 正在写入socket的一帧开始的时间，没有写入时为None
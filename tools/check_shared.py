@@ -0,0 +1,82 @@
+"""检查server/和client/下共用模块的副本是否一致
+
+客户端目录单独分发、单独运行，不依赖服务端目录，因此日志、序列化、定时器、分发和帧格式
+在两边各有一份。修改其中一边后运行本脚本，不一致时输出差异并以状态码1退出。
+
+用法: python tools/check_shared.py
+"""
+import ast
+import difflib
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_DIR = os.path.join(ROOT_DIR, 'server')
+CLIENT_DIR = os.path.join(ROOT_DIR, 'client')
+
+# 两边完全相同的模块
+IDENTICAL = ('chatlog.py', 'serializers.py', 'timers.py', 'dispatch.py')
+# 两边各有专用定义的模块，其余同名的顶层定义必须相同，以及只在客户端中的定义
+PARTIAL = {'protocol.py': {'encode_frame'}}
+
+
+def read(directory, name):
+    with open(os.path.join(directory, name), encoding='utf-8') as f:
+        return f.read()
+
+
+def diff(name, server_text, client_text):
+    return ''.join(difflib.unified_diff(server_text.splitlines(True), client_text.splitlines(True),
+                                        f'server/{name}', f'client/{name}'))
+
+
+def definitions(source):
+    """顶层的函数、类和赋值 {名称: 源代码}，模块文档字符串和import不计入"""
+    result = {}
+    for node in ast.parse(source).body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            names = [node.name]
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names = [n.id for target in targets for n in ast.walk(target) if isinstance(n, ast.Name)]
+        else:
+            continue
+        segment = ast.get_source_segment(source, node, padded=True)
+        for name in names:
+            result[name] = segment
+    return result
+
+
+def check():
+    """返回不一致之处的说明列表"""
+    problems = []
+    for name in IDENTICAL:
+        server_text, client_text = read(SERVER_DIR, name), read(CLIENT_DIR, name)
+        if server_text != client_text:
+            problems.append(diff(name, server_text, client_text))
+    for name, client_only in PARTIAL.items():
+        server_defs = definitions(read(SERVER_DIR, name))
+        client_defs = definitions(read(CLIENT_DIR, name))
+        for symbol, client_text in client_defs.items():
+            if symbol in client_only:
+                continue
+            server_text = server_defs.get(symbol)
+            if server_text is None:
+                problems.append(f"client/{name}: {symbol} 不在server/{name}中\n")
+            elif server_text != client_text:
+                problems.append(f"{name}: {symbol}\n" + diff(name, server_text + '\n', client_text + '\n'))
+    return problems
+
+
+def main():
+    problems = check()
+    for problem in problems:
+        sys.stdout.write(problem + '\n')
+    if problems:
+        print(f"共 {len(problems)} 处不一致")
+        sys.exit(1)
+    print("server/和client/下的共用模块一致")
+
+
+if __name__ == '__main__':
+    main()